@@ -1 +1 @@
-start pythonw "IdleMiner.py"
\ No newline at end of file
+start pythonw "IdleMiner.py" %*
\ No newline at end of file
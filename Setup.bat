@@ -1,10 +1,9 @@
 @echo off
 setlocal enableextensions
 
-echo The following Python packages will be installed: uptime, pypiwin32, pyyaml
+echo The following Python packages will be installed: pypiwin32, pyyaml
 pause
 
-pip install uptime
 pip install pypiwin32
 pip install pyyaml
 
@@ -1,16 +1,90 @@
 import time
-import win32gui
-import subprocess
 import os
 import sys
-import SysTrayIcon as tray
-import IdleMiner_Helpers as helpers
-import _thread
+import IdleMiner_Startup as startup
+
+# Phase times and import costs, printed once the idle scheduler runs (--profile-startup)
+profiler = startup.StartupProfiler(startup.FLAG in sys.argv)
+
+import argparse
+import json
+import IdleMiner_Instance as instance
+
+LOG_PATH = os.path.abspath("IdleMiner.log")
+LOG_MAX_SIZE = 1024*1024  # Bytes; the previous log is kept as IdleMiner.log.1
+
+# Under pythonw there is no console, so printed messages would be lost; send them to a log file instead
+if sys.stdout is None:
+	if os.path.exists(LOG_PATH) and os.path.getsize(LOG_PATH) > LOG_MAX_SIZE:
+		os.replace(LOG_PATH, LOG_PATH + '.1')
+	sys.stdout = sys.stderr = open(LOG_PATH, 'a', buffering=1)
+	print('-- ' + time.strftime('%Y-%m-%d %H:%M:%S') + ' --')
+
+LOCK_PATH = os.path.abspath("IdleMiner.lock")
+INSTANCE_COMMANDS = ('start', 'stop', 'pause', 'status', 'quit')
+
+def parseArgs():
+	parser = argparse.ArgumentParser(description="Starts cryptocurrency miners when the system is idle.")
+	parser.add_argument('--benchmark', nargs='*', metavar='PROFILE',
+						help="Benchmark the given miner profiles (all if none given) over the BENCHMARK search space, "
+							 "save the best options to the config file and exit.")
+	parser.add_argument('command', nargs='?', choices=INSTANCE_COMMANDS,
+						help="Command for the running instance (by default, a second launch shows its status). "
+							 "'start' also launches IdleMiner if it is not running.")
+	parser.add_argument('--daemon', action='store_true',
+						help="Run without the tray icon, controlled through the local control API (see IdleMiner_Api.py).")
+	parser.add_argument(startup.FLAG, action='store_true',
+						help="Print the wall time and import cost of each startup phase (see IdleMiner_Startup.py).")
+	return parser.parse_args()
+
+# Only one instance may run the miners (two miners on the same GPU slow each other down). A second launch
+# forwards its command to the running instance and exits before anything else is set up.
+guard = None
+if __name__ == "__main__":
+	args = parseArgs()
+	guard = instance.InstanceGuard(LOCK_PATH)
+	if not guard.acquire():
+		if args.benchmark is not None:
+			print("IdleMiner is already running; quit it before benchmarking.")
+			sys.exit(1)
+		try:
+			print(json.dumps(instance.forward(LOCK_PATH, args.command or 'status')))
+		except instance.InstanceError as e:
+			print(str(e))
+			sys.exit(1)
+		sys.exit(0)
+	if args.command not in (None, 'start'):
+		guard.release()
+		print("IdleMiner is not running.")
+		sys.exit(1)
+	profiler.mark('instance')
+
+# The miners' modules are imported only once this is the running instance, so a second launch exits quickly.
+# Modules of optional features (throttle, thermal governor, pool failover, profit switching, history, fleet)
+# are imported where the feature is enabled, so they cost nothing at startup when it is off.
+import signal
+import IdleMiner_Menu as traymenu
+import IdleMiner_Config as cfg
+import IdleMiner_Idle as idle
+import IdleMiner_Policy as policy
+import IdleMiner_Output as output
+import IdleMiner_Profiles as profiles
+import IdleMiner_Orchestrator as orch
+import IdleMiner_Health as health
+import IdleMiner_Capture as capture
+import IdleMiner_Events as events
+import IdleMiner_Api as api
+import threading
 import yaml
+profiler.mark('imports')
+
+# The idle source is set up first: it is all the idle timer needs to start counting, and it takes no settings
+idle_source = idle.createIdleSource(headless=True)
+profiler.mark('idle source')
 
 # -- Requirements --
 # Python 3
-# Non-Standard Dependencies: uptime, pypiwin32, pyyaml
+# Non-Standard Dependencies: pypiwin32 (tray only; not needed with --daemon), pyyaml
 
 ## TODO ##
 ## ✓ Add a tray icon with options for running out of idle mode and changing/removing idle timer
@@ -19,12 +93,12 @@ import yaml
 ## ✓ Add config file that stores user-changed settings (YAML?)
 ## ✓ Change tray double-click functionality to start/stop mining
 ## ✓ Update icon when mining auto-starts from idle timer
-## - Generalize command in Miner class to accomodate different mining programs
-## - Prevent multiple instances from running (https://raspberrypi.stackexchange.com/questions/22005/how-to-prevent-python-script-from-running-more-than-once)
-## - Add logging
-## - Add readout in tray menu showing current hashrate
+## ✓ Generalize command in Miner class to accomodate different mining programs
+## ✓ Prevent multiple instances from running (https://raspberrypi.stackexchange.com/questions/22005/how-to-prevent-python-script-from-running-more-than-once)
+## ✓ Add logging
+## ✓ Add readout in tray menu showing current hashrate
 ## - Implement error checking to stop program if miner file not found or mining can't start
-## - Fix miner shutdown. Not shutting down sometimes.
+## ✓ Fix miner shutdown. Not shutting down sometimes.
 
 ## Behavior ##
 ## Miner will begin on Windows startup and run in tray. On startup, idle timer will be active.
@@ -34,78 +108,399 @@ import yaml
 # ####################### #
 # #### CONFIGURATION #### #
 
-# Default options
-IDLE_TIMER = 1*60  # Run after this many seconds idle
-
-# Load config file
+CONFIG_PATH = os.path.abspath("IdleMiner_Config.yaml")
+# Load config file. Keys missing from the file take their defaults (see SCHEMA in IdleMiner_Config.py).
+# Edits to the file while running are picked up by the ConfigWatcher started below.
 try:
-	with open("IdleMiner_Config.yaml", 'r') as ymlfile:
-		config = yaml.load(ymlfile)
-		ymlfile.close()
-	
-	POOL_SERVER = config['POOL_SERVER']
-	USER_ADDRESS = config['USER_ADDRESS']
-	EXTRA_OPTIONS = []
-	for opt in config['EXTRA_OPTIONS']:
-		EXTRA_OPTIONS.append( '--' + opt )
-		EXTRA_OPTIONS.append( str(config['EXTRA_OPTIONS'][opt]) )
-	
-	MINER_PATH = config['MINER_PATH']
-	
-	IDLE_TIMER = config['IDLE_TIMER']
-	
-	
+	settings = cfg.load(CONFIG_PATH)
 except FileNotFoundError:
 	print("Config file not found.")
-except KeyError:
-	print("Config file not formatted properly.")
+	settings = cfg.Config({})
+except (yaml.YAMLError, cfg.ConfigError) as e:
+	print("Config file not formatted properly: " + str(e))
+	settings = cfg.Config({})
+
+# One profile per miner process (see IdleMiner_Profiles.py for the MINER_PROFILES format).
+# Falls back to a single profile built from MINER_PATH, POOL_SERVER, USER_ADDRESS and EXTRA_OPTIONS.
+MINER_PROFILES = profiles.loadProfiles(settings)
+
+IDLE_TIMER = settings.IDLE_TIMER  # Run after this many seconds idle
+
+# Tray changes are batched and written atomically
+configWriter = cfg.ConfigWriter(CONFIG_PATH)
+profiler.mark('config')
 
-	
 def updateConfig_IDLE_TIMER(n):
-	with open(os.path.abspath("IdleMiner_Config.yaml"), 'r') as ymlfile:
-		config = yaml.load(ymlfile)
-		ymlfile.close()
-	
 	if (5 <= round(n) <= 60*60):
-		config["IDLE_TIMER"] = round(n)
-		
-		with open(os.path.abspath("IdleMiner_Config.yaml"), "w") as ymlfile:
-			yaml.dump(config, ymlfile)
-			ymlfile.close()
+		configWriter.update({'IDLE_TIMER': round(n)})
 	
 # ####################### #
 # ####################### #
 
+# Config keys that change the miner profiles, and those the supervisors (throttle, governor, ...) are built from
+PROFILE_KEYS = ('MINER_PROFILES', 'MINER_PATH', 'MINER_TYPE', 'ALGORITHM', 'POOL_SERVER', 'USER_ADDRESS', 'EXTRA_OPTIONS')
+CONTROLLER_KEYS = ('THROTTLE', 'THERMAL', 'WATCHDOG', 'POOLS', 'PROFIT_SWITCHING', 'BENCHMARK_RESULTS')
+
 # Timer options
 timer_options = [1, 5, 10, 15, 30]
 
+# Seconds between hashrate readout refreshes in the tray, and window for the average
+HASHRATE_REFRESH = 5
+HASHRATE_AVERAGE = 10*60
+
+# Lines of miner output shown in the tray for a failing miner
+TRAY_TAIL_LINES = 3
+
 # Save main script working directory
 dir_Script = os.getcwd()
 
 class Miner():
-	def __init__(self, path_to_miner):
-		self.isMining = False
-		self.timerOverride = False
-		self.timerActive = True
-		self.path_to_miner = path_to_miner
+	def __init__(self, miner_profiles, bus):
+		# Mining state (idle/mining/manual/...) is owned by the state machine; it calls startMining and
+		# stopMining on the event bus thread when a transition needs the miners started or stopped
+		# Without a user input source, idle time never resets, so a stop request holds until the next start
+		self.machine = events.MinerStateMachine(bus, self.startMining, self.stopMining,
+												suspend=lambda: settings.SUSPEND_MODE,
+												hold_on_stop=isinstance(idle_source, idle.HeadlessIdleSource))
+		bus.subscribe(events.STATE, self.onStateChange)
+		bus.subscribe(events.SWITCH_PROFILE, lambda event: self.switchProfile(event.data))
+		self.bus = bus
+		
+		# Miner output goes to rotating, compressed log files and an in-memory tail (see IdleMiner_Capture.py).
+		# Changes to CAPTURE apply on restart.
+		capture_settings = settings.CAPTURE
+		self.capture = None
+		if capture_settings.get('enabled', True):
+			try:
+				directory = os.path.join(os.path.dirname(CONFIG_PATH), capture_settings.get('directory', 'logs'))
+				self.capture = capture.CaptureManager(directory, max_file=capture_settings.get('max_file', 4*1024*1024),
+													  max_age=capture_settings.get('max_age', 24*60*60),
+													  max_total=capture_settings.get('max_total', 64*1024*1024),
+													  tail=capture_settings.get('tail', 500)).start()
+			except OSError as e:
+				print("Miner output capture disabled, log directory not usable: " + repr(e))
+				self.capture = None
 		
-	def startMining(self):
-		cmd = [self.path_to_miner, '--server', POOL_SERVER, '--user', USER_ADDRESS] + EXTRA_OPTIONS
+		# Runs one miner process per profile, concurrently, on a background event loop
+		self.orchestrator = orch.MinerOrchestrator(miner_profiles, onSample=onHashrateSample,
+												   stop_timeout=settings.STOP_TIMEOUT, capture=self.capture)
 		
-		# Prepare options for window hiding. See: https://docs.python.org/3/library/subprocess.html#subprocess.STARTUPINFO
-		startupinfo = subprocess.STARTUPINFO()
-		startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+		self.throttle = None
+		self.governor = None
+		self.watchdog = None
+		self.pools = None
+		self.switcher = None
+		self.buildControllers(settings)
 		
-		self.miner_process = subprocess.Popen(cmd, startupinfo=startupinfo)
-		self.isMining = True
+	def buildControllers(self, settings):
+		# (Re)creates the throttle, thermal governor, watchdog, pool selector and profit switcher from the config,
+		# replacing any running ones
+		if self.throttle:
+			self.throttle.stop()
+		if self.governor:
+			self.governor.stop()
+		if self.watchdog:
+			self.watchdog.stop()
+		if self.pools:
+			self.pools.stop()
+		if self.switcher:
+			self.switcher.stop()
 		
-	def stopMining(self):
-		self.isMining = False
-		self.miner_process.terminate()
+		# Adaptive throttling: while mining, step miner priority/affinity/options down as other load rises
+		# instead of running flat out (see IdleMiner_Throttle.py)
+		throttle_settings = settings.THROTTLE
+		self.throttle = None
+		if throttle_settings.get('enabled', False):
+			import IdleMiner_Throttle as throttle
+			levels = throttle.DEFAULT_LEVELS
+			if 'levels' in throttle_settings:
+				levels = throttle.loadLevels(throttle_settings['levels'])
+			self.throttle = throttle.ThrottleController(self.orchestrator, throttle.createLoadSource(), levels,
+														interval=throttle_settings.get('interval', 5),
+														settle=throttle_settings.get('settle', 30),
+														restart_dwell=throttle_settings.get('restart_dwell', 120),
+														memory_limit=throttle_settings.get('memory_limit', 0.9))
+		
+		# Thermal governor: step intensity down or pause before the temperature/power ceilings are reached, and
+		# track hashes per watt (see IdleMiner_Thermal.py). Levels and efficiency survive config reloads.
+		thermal_settings = settings.THERMAL
+		previous = self.governor
+		self.governor = None
+		self.orchestrator.option_limits = {}
+		if thermal_settings.get('enabled', False):
+			import IdleMiner_Thermal as thermal
+			self.governor = thermal.ThermalGovernor(self.orchestrator, thermal.createSensorSource(),
+													limit=thermal_settings.get('limit', 80),
+													margin=thermal_settings.get('margin', 5),
+													power_limit=thermal_settings.get('power_limit'),
+													option=thermal_settings.get('option', 'intensity'),
+													steps=thermal_settings.get('steps', thermal.DEFAULT_STEPS),
+													interval=thermal_settings.get('interval', 10),
+													dwell=thermal_settings.get('dwell', 30),
+													settle=thermal_settings.get('settle', 120))
+			if previous and previous.option == self.governor.option:
+				self.governor.efficiency_data = previous.efficiency_data
+		
+		# Health watchdog: restart miners that exit, hang or stop hashing, with backoff and a crash-loop breaker
+		# (see IdleMiner_Health.py)
+		watchdog_settings = settings.WATCHDOG
+		self.watchdog = None
+		if watchdog_settings.get('enabled', True):
+			options = {key: watchdog_settings[key] for key in ('interval', 'warmup', 'stall', 'zero', 'decay',
+															   'decay_window', 'reject_ratio', 'reject_min', 'backoff',
+															   'backoff_max', 'max_restarts', 'restart_window',
+															   'breaker_cooldown') if key in watchdog_settings}
+			self.watchdog = health.MinerWatchdog(self.orchestrator, onChange=self.onHealthChange, **options)
+		
+		# Pool failover: probe each profile's endpoints and mine on the fastest one that answers, moving off
+		# endpoints that go down or reject too many shares (see IdleMiner_Pools.py). Probe results survive reloads.
+		pool_settings = settings.POOLS
+		previous = self.pools
+		self.pools = None
+		if pool_settings.get('enabled', False):
+			import IdleMiner_Pools as pools
+			options = {key: pool_settings[key] for key in ('interval', 'probe_interval', 'timeout', 'handshake',
+														   'margin', 'min_gain', 'dwell', 'stale_ratio', 'stale_min',
+														   'stale_window', 'penalty') if key in pool_settings}
+			self.pools = pools.PoolSelector(self.orchestrator, **options)
+			if previous:
+				self.pools.stats = previous.stats
+		else:
+			for m in self.orchestrator.miners:
+				m.server = None
+		
+		# Profit switching: run the most profitable profile of each device group (see IdleMiner_Profit.py)
+		profit_settings = settings.PROFIT_SWITCHING
+		self.switcher = None
+		if profit_settings.get('enabled', False):
+			import IdleMiner_Profit as profit
+			rates = profit.createRateSource(profit_settings['source'], profit_settings.get('ttl', 300))
+			self.switcher = profit.ProfitSwitcher(self.orchestrator, rates, profit.benchmarkedHashrates(settings),
+												  margin=profit_settings.get('margin', 0.05),
+												  interval=profit_settings.get('interval', 600))
+		else:
+			self.orchestrator.selected = set(m.profile.name for m in self.orchestrator.miners)
+		
+		if self.machine.isMining():
+			if self.throttle:
+				self.throttle.start()
+			else:
+				# Throttling was switched off: back to full speed
+				self.orchestrator.option_overrides = {}
+				self.orchestrator.resumeAll()
+			if self.governor:
+				self.governor.start()
+			if self.watchdog:
+				self.watchdog.start()
+			if self.pools:
+				self.pools.start()
+			if self.switcher:
+				self.switcher.start()
+		
+	def applySettings(self, new, old):
+		# Applies a reloaded config to the running miners
+		self.orchestrator.setStopTimeout(new.STOP_TIMEOUT)
+		
+		profiles_changed = any(new[key] != old[key] for key in PROFILE_KEYS)
+		if profiles_changed:
+			self.orchestrator.updateProfiles(profiles.loadProfiles(new), self.machine.isMining())
+		if profiles_changed or any(new[key] != old[key] for key in CONTROLLER_KEYS):
+			self.buildControllers(new)
+		
+	def startMining(self, resume):
+		if self.switcher:
+			# Pick the best profiles before starting
+			self.switcher.checkNow()
+		if self.pools:
+			# Start on the fastest endpoints (paused miners keep theirs until the next check)
+			self.pools.checkNow()
+		if resume or settings.SUSPEND_MODE:
+			self.orchestrator.resumeAll()
+		else:
+			self.orchestrator.startAll()
+		
+	def stopMining(self, pause):
+		if pause:
+			self.orchestrator.pauseAll(settings.SUSPEND_MAX_PAUSE)
+		else:
+			self.orchestrator.stopAll()
+			self.checkStopLatency()
 		print("\n-- System no longer idle. Mining suspended. --\n")
+		
+	def onStateChange(self, event):
+		# Supervisors run only while mining: started once the miners are up, stopped before they are stopped
+		transition = event.data
+		if transition.old == events.STARTING and transition.new in (events.MINING, events.MANUAL):
+			if self.throttle:
+				self.throttle.start()
+			if self.governor:
+				self.governor.start()
+			if self.watchdog:
+				self.watchdog.start()
+			if self.pools:
+				self.pools.start()
+			if self.switcher:
+				self.switcher.start()
+		elif transition.new == events.STOPPING:
+			if self.throttle:
+				self.throttle.stop()
+			if self.governor:
+				self.governor.stop()
+			if self.watchdog:
+				self.watchdog.stop()
+			if self.pools:
+				self.pools.stop()
+			if self.switcher:
+				self.switcher.stop()
+		elif transition.new in (events.IDLE, events.PAUSED):
+			updateHashrateReadout()
+		
+	def onHealthChange(self, name, miner_health):
+		# Called on the orchestrator thread; the tray and status are updated from the event thread
+		self.bus.post(events.HEALTH, (name, miner_health.state, miner_health.reason))
+		
+	def switchProfile(self, name):
+		# Runs profile 'name' instead of the profile currently selected in its group
+		group = self.orchestrator.getMiner(name).profile.group
+		current = None
+		for m in self.orchestrator.miners:
+			if m.profile.group == group and m.profile.name in self.orchestrator.selected and m.profile.name != name:
+				current = m.profile.name
+		self.orchestrator.call(self.orchestrator.replaceProfile(current, name, self.machine.isMining()))
+		
+	def checkStopLatency(self):
+		# Stop latency histogram is in self.orchestrator.stop_latency
+		for m in self.orchestrator.miners:
+			if m.last_stop_latency is not None and m.last_stop_latency > settings.STOP_SLA:
+				print("Miner '" + m.profile.name + "' took " + str(round(m.last_stop_latency, 2)) + "s to stop (SLA " +
+					  str(settings.STOP_SLA) + "s)")
+
+# Hashrate readout
+hashrate_text = 'Hashrate: -'
+last_readout = 0
+
+def onHashrateSample(managedMiner, sample):
+	# Called from the orchestrator thread for every parsed hashrate line
+	if recorder:
+		recorder.sample(managedMiner, sample)
+	if time.time() - last_readout >= HASHRATE_REFRESH:
+		updateHashrateReadout()
+	
+def updateHashrateReadout():
+	global hashrate_text, last_readout
+	last_readout = time.time()
+	
+	if miner.machine.isMining():
+		current = output.formatTotals(miner.orchestrator.hashrate())
+		average = output.formatTotals(miner.orchestrator.averageHashrate(HASHRATE_AVERAGE))
+		hashrate_text = 'Hashrate: ' + current + ' (avg ' + average + ')'
+		tip = hover_text + ' - ' + current + ' (avg ' + average + ')'
+	else:
+		hashrate_text = 'Hashrate: -'
+		tip = hover_text
+	
+	# Update menu readout in place; the native menu is only rebuilt when it is next opened
+	with menu.lock:
+		menu.setText(node_hashrate, hashrate_text)
+		menu.setChildren(node_hashrate, hashrateLines())
+	publishStatus()
+	
+	if T_tray is None:
+		return
+	
+	# Update hover text
+	T_tray.set_hover_text(tip)
+
+def hashrateLines():
+	# With several miners or GPUs, or in suspend mode, the readout becomes a submenu with one line per miner
+	# (and per GPU), miners the watchdog found failing (with their last output lines), and the warm-up time
+	# saved by resuming paused miners
+	lines = []
+	watched = miner.watchdog.status() if miner.watchdog and miner.machine.isMining() else {}
+	for m in miner.orchestrator.miners:
+		name, state, rate, unit = m.profile.name, m.state, m.hashrate(), m.output.parser.UNIT
+		if len(miner.orchestrator.miners) > 1:
+			lines.append((name + ': ' + state + ', ' + output.formatHashrate(rate, unit), None, showHashrate))
+		sample = m.output.samples.latest()
+		if m.isActive() and sample is not None and len(sample.gpus) > 1:
+			for gpu, gpu_rate in sorted(sample.gpus.items()):
+				lines.append(('  GPU ' + str(gpu) + ': ' + output.formatHashrate(gpu_rate, unit), None, showHashrate))
+		h = watched.get(name)
+		failing = h and h['health'] not in (health.HEALTHY, health.STARTING, health.PAUSED)
+		if failing:
+			lines.append(('  ' + h['health'] + ': ' + h['reason'], None, showHashrate))
+		if m.log and (failing or state == orch.EXITED):
+			for text in m.log.lastLines(TRAY_TAIL_LINES):
+				lines.append(('    ' + text[:80], None, showHashrate))
+	if miner.throttle and miner.machine.isMining():
+		lines.append(('Throttle: ' + miner.throttle.levelName(), None, showHashrate))
+	if settings.SUSPEND_MODE:
+		saved = miner.orchestrator.warmupSaved()
+		lines.append(('Warm-up saved: ' + str(round(saved/60, 1)) + ' min', None, showHashrate))
+	return lines
+
+# Threads communicate through events (see IdleMiner_Events.py), dispatched in order on one thread
+bus = events.EventBus()
 
 # Instantiate Miner object
-miner = Miner(MINER_PATH)
+miner = Miner(MINER_PROFILES, bus)
+profiler.mark('miners')
+
+# Mining history: sessions and hashrate samples are recorded in a local database (see IdleMiner_History.py)
+history_settings = settings.HISTORY
+store = None
+recorder = None
+if history_settings.get('enabled', True):
+	import IdleMiner_History as history
+	try:
+		store = history.HistoryStore(os.path.join(os.path.dirname(CONFIG_PATH),
+												  history_settings.get('path', 'IdleMiner_History.db')),
+									 retention=history_settings.get('retention'))
+		recorder = history.SessionRecorder(store, bus)
+	except Exception as e:
+		print("Mining history disabled, database could not be opened: " + repr(e))
+		store = None
+
+# Status for the control API, rebuilt on every change so that reading it costs nothing
+status = api.StatusSnapshot()
+profiler.mark('history')
+
+scheduler = None  # Created below
+
+def publishStatus():
+	orchestrator = miner.orchestrator
+	decision = scheduler.decision if scheduler else None
+	watched = miner.watchdog.status() if miner.watchdog else {}
+	miners = []
+	for m in orchestrator.miners:
+		miners.append({'name': m.profile.name, 'state': m.state, 'hashrate': m.hashrate(),
+					   'unit': m.output.parser.UNIT, 'group': m.profile.group,
+					   'selected': m.profile.name in orchestrator.selected,
+					   'starts': m.starts, 'resumes': m.resumes, 'pool': m.endpoint})
+		miners[-1].update(watched.get(m.profile.name, {}))
+	status.update({'state': miner.machine.state,
+				   'held': miner.machine.held,
+				   'timer': {'seconds': IDLE_TIMER, 'enabled': miner.machine.timerActive},
+				   'hashrate': orchestrator.hashrate(),
+				   'mining_seconds': round(miner.machine.miningSeconds(), 1),
+				   'throttle': miner.throttle.levelName() if miner.throttle and miner.machine.isMining() else None,
+				   'miners': miners,
+				   'thermal': thermalStatus(),
+				   'pools': miner.pools.status() if miner.pools else None,
+				   'policy': {'action': decision.action, 'rule': decision.rule,
+							  'reason': decision.reason} if decision else None,
+				   'time': time.time()})
+
+def thermalStatus():
+	governor = miner.governor
+	if governor is None:
+		return None
+	reading = governor.last_reading
+	return {'temperatures': reading.temps if reading else {},
+			'power': reading.power if reading else {},
+			'limits': {name: governor.limitFor(level) for name, level in governor.level.items()},
+			'efficiency': governor.efficiency(),
+			'best': governor.best()}
 
 # Setup system tray icon
 icon_on = os.path.join(dir_Script, "IdleMiner_iconOn.ico")
@@ -114,133 +509,300 @@ icon_check = os.path.join(dir_Script, "IdleMiner_iconCheck.ico")
 hover_text = "IdleMiner"
 toggleMiner_text = 'Start Mining'
 toggleTimer_text = 'Disable Timer'
-T_hwnd = 0
-T_msgindex = 0
+T_tray = None
+control = None
 
 # Menu handler functions
 def changeTimer(sysTrayIcon, id):
-	opt_text = sysTrayIcon.find_menu_option(sysTrayIcon.menu_options, id)  # Get text of selected menu option
-	opt_time = [int(opt_text) for opt_text in str.split(opt_text) if opt_text.isdigit()][0]  # Extract number from option text
-
-	# Update icons
-	global menu_changeTimer
-	menu_changeTimer_list = helpers.tupleToList(menu_changeTimer)  # Convert to list for editing
-	
-	for idx, opt in enumerate(menu_changeTimer_list[2]):
-		if opt[0] == opt_text:
-			menu_changeTimer_list[2][idx][1] = icon_check
-		else:
-			menu_changeTimer_list[2][idx][1] = None
-	
-	menu_changeTimer = helpers.listToTuple(menu_changeTimer_list)  # Convert back to tuple
-	
-	
-	menu_options = (menu_toggleMiner, menu_toggleTimer, menu_changeTimer)
-	# Refresh menu items
-	sysTrayIcon.update_menu_options(menu_options)
+	opt_time = menu.get(id).data  # Minutes the selected option stands for
+	bus.post(events.SET_TIMER, opt_time*60)
 	
-	# Change timer
+def setIdleTimer(seconds):
+	# Applies a new idle timer (from the tray or the control API) and saves it to the config file
 	global IDLE_TIMER
-	IDLE_TIMER = opt_time*60
+	IDLE_TIMER = seconds
 	updateConfig_IDLE_TIMER(IDLE_TIMER)
+	scheduler.setIdleTimer(IDLE_TIMER)
 	
-def toggleMiner(sysTrayIcon, id):
-	if miner.isMining:
-		toggleMiner_text = 'Start Mining'
-		sysTrayIcon.icon = icon_off
-		miner.timerOverride = False
-		miner.stopMining()
-	else:
-		toggleMiner_text = 'Stop Mining'
-		sysTrayIcon.icon = icon_on
-		miner.timerOverride = True
-		miner.startMining()
-	
-	# Update icon
-	sysTrayIcon.refresh_icon()
-		
-	# Update menu item text
-	menu_toggleMiner = (toggleMiner_text, None, toggleMiner)
-	menu_options = (menu_toggleMiner, menu_toggleTimer, menu_changeTimer)
+	# Update icons
+	updateTimerMenu()
 	
-	# Refresh menu items
-	sysTrayIcon.update_menu_options(menu_options)
+def updateTimerMenu():
+	# Moves the check icon in the timer submenu to the option matching IDLE_TIMER
+	with menu.lock:
+		for node in node_changeTimer.children:
+			menu.setChecked(node, node.data*60 == IDLE_TIMER)
 	
+def toggleMiner(sysTrayIcon, id):
+	# The state machine decides; the tray is updated when the resulting transition is published
+	if miner.machine.isMining():
+		bus.post(events.MANUAL_STOP)
+	else:
+		bus.post(events.MANUAL_START)
 
 def toggleTimer(sysTrayIcon, id):
-	if miner.timerActive:
-		toggleTimer_text = 'Enable Timer'
-		miner.timerActive = False
+	if miner.machine.timerActive:
+		bus.post(events.TIMER_OFF)
 	else:
-		toggleTimer_text = 'Disable Timer'
-		miner.timerActive = True
+		bus.post(events.TIMER_ON)
 	
-	# Update menu item text
-	menu_toggleTimer = (toggleTimer_text, None, toggleTimer)
-	menu_options = (menu_toggleMiner, menu_toggleTimer, menu_changeTimer)
-	
-	# Refresh menu items
-	sysTrayIcon.update_menu_options(menu_options)
+def showHashrate(sysTrayIcon, id):
+	# Readout only
+	pass
 	
 def bye(sysTrayIcon): 
 	print ("Quitting...")
+	# Miners are stopped on the event thread, then the main thread shuts down (see onQuit)
+	bus.post(events.QUIT)
 
 	
-# Menu options
-menu_toggleMiner = (toggleMiner_text, None, toggleMiner)
-menu_toggleTimer = (toggleTimer_text, None, toggleTimer)
+# Menu options. Nodes are kept so handlers can update them in place (see IdleMiner_Menu.py).
+menu = traymenu.MenuTree(traymenu.FIRST_ID, check_icon=icon_check)
+node_toggleMiner = menu.add(None, toggleMiner_text, action=toggleMiner)
+node_toggleTimer = menu.add(None, toggleTimer_text, action=toggleTimer)
 
-menu_changeTimer = ['Change Timer', None, []]
+node_changeTimer = menu.add(None, 'Change Timer')
 for t in timer_options:
-	icon_or_none = None
-	if(t*60==IDLE_TIMER):
-		icon_or_none = icon_check
 	if(t==1): 
-		menu_changeTimer[2].append([str(t) + ' minute', icon_or_none, changeTimer])
+		menu.add(node_changeTimer, str(t) + ' minute', action=changeTimer, checked=(t*60==IDLE_TIMER), data=t)
 	else: 
-		menu_changeTimer[2].append([str(t) + ' minutes', icon_or_none, changeTimer])
-menu_changeTimer = helpers.listToTuple(menu_changeTimer)
+		menu.add(node_changeTimer, str(t) + ' minutes', action=changeTimer, checked=(t*60==IDLE_TIMER), data=t)
 
-menu_options = (menu_toggleMiner, menu_toggleTimer, menu_changeTimer)
+node_hashrate = menu.add(None, hashrate_text, action=showHashrate)
+profiler.mark('menu')
 
 def get_tray_data(sysTrayIcon):
-	# Used to get (initial) information from SysTrayIcon object, i.e. hwnd window ID for sending messages.
-	global T_hwnd
-	global T_msgindex
-	T_hwnd = sysTrayIcon.hwnd  # Window ID (to send messages)
-	T_msgindex = sysTrayIcon.FIRST_ID + sysTrayIcon.OFFSET + 1  # ID of custom message trigger
+	# Called once the tray window exists. Only from then on is the tray subscribed to state changes,
+	# so no message is ever posted to a window that does not exist yet.
+	global T_tray
+	T_tray = sysTrayIcon
+	bus.subscribe([events.STATE, events.TIMER_ON, events.TIMER_OFF], onTrayEvent)
+	updateTray()
+	
+# Tray subscriber (runs on the event thread)
+def onTrayEvent(event):
+	if event.kind == events.TIMER_ON:
+		menu.setText(node_toggleTimer, 'Disable Timer')
+	elif event.kind == events.TIMER_OFF:
+		menu.setText(node_toggleTimer, 'Enable Timer')
+	else:
+		updateTray()
 	
+def updateTray():
+	import win32gui
+	mining = miner.machine.isMining()
+	menu.setText(node_toggleMiner, 'Stop Mining' if mining else 'Start Mining')
+	
+	# Post custom message to icon window, triggering icon update function in SysTrayIcon.
+	# The third argument is the index of the icon in the provided extra_icon_paths list.
+	msgindex = T_tray.FIRST_ID + T_tray.OFFSET + 1  # ID of custom message trigger
+	win32gui.PostMessage(T_tray.hwnd, msgindex, 0 if mining else 1)
 	
 # Create a separate thread to handle tray icon
 def trayThread():
+	import SysTrayIcon as tray
 	# Create tray icon (this object will block the thread it runs in)
-	tray.SysTrayIcon(icon_off, hover_text, menu_options, on_quit=bye, default_menu_index=0, 
+	tray.SysTrayIcon(icon_off, hover_text, menu, on_quit=bye, default_menu_index=0, 
 					 window_class_name="IdleMiner", data_feedback=get_tray_data, extra_icon_paths=[icon_on, icon_off])
 
-try:
-	_thread.start_new_thread( trayThread, () )
-except:
-	print("Error: unable to start thread")
+# Idle scheduler callbacks (run on the main thread; the state machine acts on them on the event thread)
+def onIdle():
+	bus.post(events.IDLE_DETECTED, scheduler.detection_lag)
 	
+def onActive():
+	if scheduler.decision.rule == policy.IdleRule.name:
+		bus.post(events.USER_ACTIVE)
+	else:
+		bus.post(events.POLICY_STOP, scheduler.decision.rule)
+
+def onPolicyDecision(decision):
+	# Report starts, stops and anything other than waiting for the idle timer, with the rule behind it
+	if decision.action != policy.STAY or decision.rule != policy.IdleRule.name:
+		print("Policy: " + decision.action + " (" + decision.rule + ": " + decision.reason + ")")
+	publishStatus()
+
+def loadPolicy(config):
+	return policy.loadRules(config.POLICY, config.IDLE_TIMER, os.path.dirname(CONFIG_PATH))
+
+# The scheduler samples idle time once per pass and sleeps until the policy's answer can change (the idle
+# threshold, a mining window, ...), instead of waking every second. While mining it wakes on user input.
+idle_rule, policy_rules = loadPolicy(settings)
+scheduler = idle.IdleScheduler(idle_source, IDLE_TIMER, onIdle, onActive,
+							   isMining=miner.machine.isMining,
+							   isEnabled=miner.machine.timerEnabled,
+							   policy_engine=policy.PolicyEngine(idle_rule, policy_rules, clock=idle_source.now))
+scheduler.onDecision = onPolicyDecision
+profiler.mark('scheduler')
+
+def trackMining(event):
+	# Mining time for the policy's cooldown and daily budget, whether started by the idle timer or manually
+	transition = event.data
+	if transition.new in (events.MINING, events.MANUAL):
+		scheduler.policy.started()
+	elif transition.new in (events.IDLE, events.PAUSED):
+		scheduler.policy.stopped()
+
+bus.subscribe(events.STATE, trackMining)
+
+# Re-evaluate whenever the mining state or the timer setting changes
+bus.subscribe([events.STATE, events.TIMER_ON, events.TIMER_OFF], lambda event: scheduler.wake())
+
+# Show miner failures and restarts in the tray readout as they happen
+bus.subscribe(events.HEALTH, lambda event: updateHashrateReadout())
+
+def onQuit(event):
+	# Subscribed after the state machine, so the miners have been stopped by now
+	configWriter.flush()  # Write out any pending tray change
+	scheduler.stop()
+
+bus.subscribe(events.QUIT, onQuit)
+bus.subscribe(events.SET_TIMER, lambda event: setIdleTimer(event.data))
+
+# Control API queries
+def apiHashesPerDay(params):
+	# e.g. /history/hashes?days=7&profile=P
+	if store is None:
+		raise ValueError("mining history is disabled")
+	# Whole days: the day bucket the window starts in is included
+	since = history.daysBefore(int(params.get('days', 30)), time.time())
+	rows = store.hashesPerDay(since=since, machine=params.get('machine'), profile=params.get('profile'))
+	return [{'day': time.strftime('%Y-%m-%d', time.localtime(day)), 'machine': machine, 'profile': profile,
+			 'unit': unit.split('/')[0], 'hashes': hashes} for day, machine, profile, unit, hashes in rows]
+
+def apiMinerOutput(params):
+	# e.g. /miners/output?name=P&lines=100 (the name may be left out with a single miner)
+	names = [m.profile.name for m in miner.orchestrator.miners]
+	name = params.get('name', names[0] if len(names) == 1 else None)
+	if name not in names:
+		raise ValueError("unknown profile: " + str(name))
+	m = miner.orchestrator.getMiner(name)
+	if m.log is None:
+		raise ValueError("miner output capture is disabled")
+	return {'name': name, 'file': m.log.path, 'dropped': m.log.dropped,
+			'lines': m.log.lastLines(int(params.get('lines', 100)))}
+
+def apiSessions(params):
+	if store is None:
+		raise ValueError("mining history is disabled")
+	return store.sessions(since=time.time() - float(params.get('days', 7))*24*60*60, machine=params.get('machine'))
+
+# Commands for the control API and for later launches (see IdleMiner_Instance.py)
+commands = api.eventCommands(bus, lambda: [m.profile.name for m in miner.orchestrator.miners])
+
+def onInstanceCommand(command, params):
+	if command == 'status':
+		return json.loads(status.body().decode('utf-8'))
+	if command not in commands:
+		raise ValueError("unknown command: " + str(command))
+	return commands[command](params)
+
+def startControlServer():
+	global control
+	host = settings.API.get('host', '127.0.0.1')
+	port = settings.API.get('port', api.DEFAULT_PORT)
+	queries = {'history/hashes': apiHashesPerDay,
+			   'history/sessions': apiSessions,
+			   'miners/output': apiMinerOutput}
+	metrics = lambda: api.renderMetrics(miner.machine, miner.orchestrator, miner.governor, miner.watchdog,
+										miner.pools)
+	control = api.ControlServer(status, commands, metrics, host, port, queries).start()
+	print("Control API listening on " + control.url)
+	if host not in ('127.0.0.1', 'localhost', '::1'):
+		print("Warning: the control API has no authentication and is reachable from other machines.")
+
+# Fleet agent: reports the status snapshot to a fleet coordinator and merges config pushed from it into the
+# config file, where the watcher picks it up (see IdleMiner_Fleet.py)
+fleetAgent = None
+
+def startFleetAgent():
+	global fleetAgent
+	if fleetAgent:
+		fleetAgent.stop()
+		fleetAgent = None
+	fleet_settings = settings.FLEET
+	if not fleet_settings.get('enabled', False):
+		return
+	import IdleMiner_Fleet as fleet
+	fleetAgent = fleet.FleetAgent(fleet_settings.get('coordinator', 'http://127.0.0.1:' + str(fleet.DEFAULT_PORT)),
+								  lambda: json.loads(status.body().decode('utf-8')), configWriter.update,
+								  name=fleet_settings.get('name'), interval=fleet_settings.get('interval', 10),
+								  flush=fleet_settings.get('flush', 30), buffer=fleet_settings.get('buffer', 2000),
+								  token=fleet_settings.get('token'))
+	fleetAgent.start()
+	print("Reporting to fleet coordinator " + fleetAgent.url + " as '" + fleetAgent.host + "'")
+
+# Keep the status snapshot current (subscribed after the state machine, so it sees the new state)
+bus.subscribe(None, lambda event: publishStatus())
+
+# Config file reloads. The watcher thread posts them; they are applied on the event thread, in order
+# with starts and stops.
+def onConfigChange(new, old):
+	bus.post(events.CONFIG, (new, old))
+
+def applyConfig(event):
+	global settings, IDLE_TIMER
+	new, old = event.data
+	print("Config file changed, applying.")
+	settings = new
+	if new.IDLE_TIMER != IDLE_TIMER:
+		IDLE_TIMER = new.IDLE_TIMER
+		scheduler.setIdleTimer(IDLE_TIMER)
+		updateTimerMenu()
+	if new.POLICY != old.POLICY:
+		scheduler.policy.setRules(*loadPolicy(new))
+		scheduler.wake()
+	miner.applySettings(new, old)
+	if store and new.HISTORY != old.HISTORY:
+		store.setRetention(new.HISTORY.get('retention'))  # The database path applies on restart
+	if new.FLEET != old.FLEET:
+		startFleetAgent()
+	updateHashrateReadout()
+
+bus.subscribe(events.CONFIG, applyConfig)
+profiler.mark('handlers')
+
 if __name__ == "__main__":
 	
-	while True:
-	
-		if (miner.timerActive == True and miner.timerOverride == False):
-		
-			if (helpers.getIdleTime() >= IDLE_TIMER and miner.isMining == False):
-				miner.startMining()
-				
-				# Post custom message to icon window, triggering icon update function in SysTrayIcon.
-				# The third argument is the index of the icon in the provided extra_icon_paths list.
-				win32gui.PostMessage(T_hwnd, T_msgindex, 0)
-				
-			if (helpers.getIdleTime() < (IDLE_TIMER/2) and miner.isMining == True):
-				miner.stopMining()
-				
-				# Post custom message to icon window, triggering icon update function in SysTrayIcon.
-				# The third argument is the index of the icon in the provided extra_icon_paths list.
-				win32gui.PostMessage(T_hwnd, T_msgindex, 1)
-				
-		time.sleep(1)
-		
\ No newline at end of file
+	if args.benchmark is not None:
+		import IdleMiner_Benchmark as benchmark
+		benchmark.main(CONFIG_PATH, settings, MINER_PROFILES, args.benchmark)
+		guard.release()
+		sys.exit(0)
+	
+	bus.start()
+	if store:
+		store.start()
+	if args.daemon:
+		# Quit on Ctrl+C or service stop, the same way as from the tray
+		signal.signal(signal.SIGINT, lambda signum, frame: bus.post(events.QUIT))
+		signal.signal(signal.SIGTERM, lambda signum, frame: bus.post(events.QUIT))
+	if args.daemon or settings.API.get('enabled', False):
+		startControlServer()
+	cfg.ConfigWatcher(CONFIG_PATH, settings, onConfigChange).start()
+	publishStatus()
+	startFleetAgent()
+	guard.serve(onInstanceCommand)
+	if args.command == 'start':
+		bus.post(events.MANUAL_START)
+	profiler.mark('services')
+	
+	# The tray is built last, on its own thread, so it does not hold up the idle scheduler
+	if not args.daemon:
+		threading.Thread(target=trayThread, name='Tray', daemon=True).start()
+		profiler.mark('tray')
+	if profiler.enabled:
+		print(profiler.report())
+	scheduler.run()
+	
+	# Quit from the tray, a signal or a forwarded command
+	bus.stop()
+	if fleetAgent:
+		fleetAgent.stop()
+	if control:
+		control.stop()
+	if store:
+		store.close()  # Writes out the last session
+	miner.orchestrator.shutdown()
+	if miner.capture:
+		miner.capture.close()  # Writes out the miners' last lines
+	guard.release()
@@ -0,0 +1,224 @@
+import json
+import threading
+import urllib.parse
+
+import IdleMiner_Events as events
+
+# Local control and metrics API.
+#
+# A small HTTP server, bound to localhost by default, for scripting IdleMiner and for running it headless
+# (IdleMiner.py --daemon). Endpoints:
+#
+#	GET  /status			Current state as JSON
+#	GET  /metrics			Prometheus text format
+#	POST /start				Start mining (like the tray's Start Mining)
+#	POST /stop				Stop mining
+#	POST /pause				Pause the miners and hold them paused until /start
+#	POST /quit				Stop the miners and exit
+#	POST /timer?seconds=N	Set the idle timer; &enabled=0/1 disables/enables it
+#	POST /profile?name=P	Run profile P in its device group
+#
+# The main program may add read-only GET queries (e.g. /history/hashes, see IdleMiner_History.py); they take the
+# same kind of parameters and answer JSON.
+#
+# Parameters may also be sent as a JSON object body. Control commands are posted to the event bus and applied
+# asynchronously; the response says which event was queued. /status never touches the miners: the main program
+# pushes a new StatusSnapshot whenever something changes, and the handler only writes out its pre-encoded body.
+
+DEFAULT_PORT = 8470
+
+
+class StatusSnapshot():
+	# Pre-encoded JSON status. update() replaces the whole body, so readers never need a lock.
+	def __init__(self):
+		self._body = b'{}'
+		self.updates = 0
+
+	def update(self, status):
+		self._body = json.dumps(status, sort_keys=True).encode('utf-8')
+		self.updates += 1
+
+	def body(self):
+		return self._body
+
+
+def _label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def renderMetrics(machine, orchestrator, governor=None, watchdog=None, pools=None):
+	# Prometheus text format for the state machine, the miners, the watchdog, the pool endpoints and the thermal
+	# governor's sensors
+	lines = ['# HELP idleminer_mining_seconds_total Seconds spent mining.',
+			 '# TYPE idleminer_mining_seconds_total counter',
+			 'idleminer_mining_seconds_total ' + repr(float(machine.miningSeconds())),
+			 '# HELP idleminer_state Current mining state.',
+			 '# TYPE idleminer_state gauge']
+	for state in ('idle', 'starting', 'mining', 'stopping', 'paused', 'manual'):
+		lines.append('idleminer_state{state="' + state + '"} ' + ('1' if machine.state == state else '0'))
+
+	lines += ['# HELP idleminer_hashrate Current hashrate per miner, in the unit its miner reports.',
+			  '# TYPE idleminer_hashrate gauge']
+	for m in orchestrator.miners:
+		rate = m.hashrate()
+		labels = 'miner="' + _label(m.profile.name) + '",unit="' + _label(m.output.parser.UNIT) + '"'
+		lines.append('idleminer_hashrate{' + labels + '} ' + repr(float(rate or 0)))
+
+	for name, attr, text in (('idleminer_miner_starts_total', 'starts', 'Fresh miner process launches.'),
+							 ('idleminer_miner_resumes_total', 'resumes', 'Paused miners resumed.')):
+		lines += ['# HELP ' + name + ' ' + text, '# TYPE ' + name + ' counter']
+		for m in orchestrator.miners:
+			lines.append(name + '{miner="' + _label(m.profile.name) + '"} ' + str(getattr(m, attr)))
+
+	if watchdog is not None:
+		health = watchdog.status()
+		lines += ['# HELP idleminer_miner_healthy 1 if the watchdog finds the miner healthy (or warming up or paused).',
+				  '# TYPE idleminer_miner_healthy gauge']
+		for name, h in sorted(health.items()):
+			healthy = h['health'] in ('healthy', 'starting', 'paused')
+			lines.append('idleminer_miner_healthy{miner="' + _label(name) + '",state="' + _label(h['health']) + '"} ' +
+						 ('1' if healthy else '0'))
+		lines += ['# HELP idleminer_watchdog_restarts_total Miners restarted by the watchdog.',
+				  '# TYPE idleminer_watchdog_restarts_total counter']
+		for name, h in sorted(health.items()):
+			lines.append('idleminer_watchdog_restarts_total{miner="' + _label(name) + '"} ' + str(h['restarts']))
+
+	if pools is not None:
+		endpoints = pools.status()
+		lines += ['# HELP idleminer_pool_up 1 if the pool endpoint answered its last probe.',
+				  '# TYPE idleminer_pool_up gauge']
+		for endpoint, e in endpoints.items():
+			lines.append('idleminer_pool_up{endpoint="' + _label(endpoint) + '"} ' + ('1' if e['ok'] else '0'))
+		lines += ['# HELP idleminer_pool_latency_seconds Smoothed stratum handshake time of each pool endpoint.',
+				  '# TYPE idleminer_pool_latency_seconds gauge']
+		for endpoint, e in endpoints.items():
+			if e['latency'] is not None:
+				lines.append('idleminer_pool_latency_seconds{endpoint="' + _label(endpoint) + '"} ' +
+							 repr(float(e['latency'])))
+
+	lines += ['# HELP idleminer_stop_latency_seconds Stop request until the miner process tree is gone.',
+			  '# TYPE idleminer_stop_latency_seconds histogram']
+	lines += orchestrator.stop_latency.render('idleminer_stop_latency_seconds')
+	lines += ['# HELP idleminer_decision_latency_seconds Triggering event until miners started or stopped.',
+			  '# TYPE idleminer_decision_latency_seconds histogram']
+	lines += machine.latency.render('idleminer_decision_latency_seconds')
+
+	if governor is not None and governor.last_reading is not None:
+		for name, values, text in (('idleminer_temperature_celsius', governor.last_reading.temps, 'Sensor temperature.'),
+								   ('idleminer_power_watts', governor.last_reading.power, 'Sensor power draw.')):
+			lines += ['# HELP ' + name + ' ' + text, '# TYPE ' + name + ' gauge']
+			for sensor, value in sorted(values.items()):
+				lines.append(name + '{sensor="' + _label(sensor) + '"} ' + repr(float(value)))
+	if governor is not None:
+		lines += ['# HELP idleminer_hashes_per_watt Hashes per watt-second at each operating point.',
+				  '# TYPE idleminer_hashes_per_watt gauge']
+		for e in governor.efficiency():
+			labels = ('miner="' + _label(e['profile']) + '",option="' + _label(e['option']) + '",value="' +
+					  _label(e['value']) + '"')
+			lines.append('idleminer_hashes_per_watt{' + labels + '} ' + repr(float(e['per_watt'])))
+	return '\n'.join(lines) + '\n'
+
+
+def eventCommands(bus, profiles):
+	# The POST commands above, each queueing its event on 'bus'. 'profiles' is a function returning the profile
+	# names /profile accepts. The commands run on the server's threads, so they only post events.
+	def post(kind, data=None):
+		bus.post(kind, data)
+		return {'queued': kind}
+
+	def timer(params):
+		result = {'queued': []}
+		if 'seconds' in params:
+			seconds = int(params['seconds'])
+			if not 5 <= seconds <= 60*60:
+				raise ValueError("seconds must be between 5 and 3600")
+			result['queued'].append(post(events.SET_TIMER, seconds)['queued'])
+		if 'enabled' in params:
+			enabled = str(params['enabled']).lower() in ('1', 'true', 'yes', 'on')
+			result['queued'].append(post(events.TIMER_ON if enabled else events.TIMER_OFF)['queued'])
+		if not result['queued']:
+			raise ValueError("expected 'seconds' and/or 'enabled'")
+		return result
+
+	def profile(params):
+		name = params.get('name')
+		if name not in profiles():
+			raise ValueError("unknown profile: " + str(name))
+		return post(events.SWITCH_PROFILE, name)
+
+	return {'start': lambda params: post(events.MANUAL_START),
+			'stop': lambda params: post(events.MANUAL_STOP),
+			'pause': lambda params: post(events.PAUSE),
+			'quit': lambda params: post(events.QUIT),
+			'timer': timer,
+			'profile': profile}
+
+
+class ControlServer():
+	# 'commands' maps a POST path (without '/') to a function(params) returning a JSON-serialisable result;
+	# raising ValueError answers 400. 'metrics' is a function returning the /metrics text. 'queries' maps extra
+	# GET paths the same way as 'commands'.
+	def __init__(self, snapshot, commands, metrics, host='127.0.0.1', port=DEFAULT_PORT, queries=None):
+		self.snapshot = snapshot
+		self.commands = commands
+		self.metrics = metrics
+		self.queries = queries or {}
+		server = self
+		import http.server  # Only needed once the API is enabled
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				url = urllib.parse.urlsplit(self.path)
+				query = server.queries.get(url.path.strip('/'))
+				if url.path == '/status':
+					self.reply(200, server.snapshot.body())
+				elif url.path == '/metrics':
+					self.reply(200, server.metrics().encode('utf-8'), 'text/plain; version=0.0.4')
+				elif query is not None:
+					try:
+						self.replyJson(200, query(dict(urllib.parse.parse_qsl(url.query))))
+					except ValueError as e:
+						self.replyJson(400, {'error': str(e)})
+				else:
+					self.replyJson(404, {'error': 'not found'})
+
+			def do_POST(self):
+				url = urllib.parse.urlsplit(self.path)
+				command = server.commands.get(url.path.strip('/'))
+				if command is None:
+					self.replyJson(404, {'error': 'unknown command'})
+					return
+				params = dict(urllib.parse.parse_qsl(url.query))
+				length = int(self.headers.get('Content-Length') or 0)
+				try:
+					if length:
+						params.update(json.loads(self.rfile.read(length).decode('utf-8')))
+					self.replyJson(202, command(params))
+				except ValueError as e:
+					self.replyJson(400, {'error': str(e)})
+
+			def replyJson(self, code, data):
+				self.reply(code, json.dumps(data).encode('utf-8'))
+
+			def reply(self, code, body, content_type='application/json'):
+				self.send_response(code)
+				self.send_header('Content-Type', content_type)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+		self.httpd.daemon_threads = True
+		self.url = 'http://' + host + ':' + str(self.httpd.server_address[1])
+		self._thread = threading.Thread(target=self.httpd.serve_forever, name='ControlServer', daemon=True)
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
@@ -0,0 +1,153 @@
+import time
+import itertools
+import collections
+
+import yaml
+
+import IdleMiner_Config as cfg
+import IdleMiner_Orchestrator as orch
+import IdleMiner_Output as output
+
+# Benchmark mode (IdleMiner.py --benchmark).
+#
+# Runs a miner profile for a fixed window under each candidate option set from a declared search space,
+# measures its steady-state hashrate from the miner's own output (readings from the first 'warmup' seconds
+# after launch are discarded), and writes the best option set back into the config file together with the
+# measured hashrate. The search space is read from the BENCHMARK section of the config file:
+#
+#	BENCHMARK:
+#	  window: 120		# Seconds to run each candidate, including warm-up
+#	  warmup: 30		# Seconds of readings to discard after launch
+#	  space:			# Option -> candidate values; every combination is tried
+#	    intensity: [32, 48, 64]
+#
+# A profile in MINER_PROFILES may declare its own 'benchmark_space'. Results are stored per profile under
+# BENCHMARK_RESULTS, and a human-readable report is written to REPORT_PATH.
+
+REPORT_PATH = 'IdleMiner_Benchmark.txt'
+
+# Result of one candidate run. 'hashrate' is the steady-state mean, or None if the miner produced no readings.
+Result = collections.namedtuple('Result', ['options', 'hashrate', 'samples', 'discarded', 'returncode'])
+
+
+def candidates(space):
+	# All combinations of the search space, as a list of option dicts (in a stable order)
+	keys = sorted(space)
+	return [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+
+
+def steadyState(samples, started_at, warmup):
+	# Splits readings into (steady-state hashrates, number discarded as warm-up)
+	steady = [s.hashrate for s in samples if s.hashrate is not None and s.time - started_at >= warmup]
+	return steady, len(samples) - len(steady)
+
+
+class Benchmark():
+	def __init__(self, profile, space, window=120, warmup=30, sleep=time.sleep):
+		self.profile = profile
+		self.space = space
+		self.window = window
+		self.warmup = warmup
+		self.sleep = sleep
+		self.results = []
+
+	def runCandidate(self, orchestrator, options):
+		m = orchestrator.getMiner(self.profile.name)
+		orchestrator.call(m.start(options))
+		self.sleep(self.window)
+		samples = m.output.samples.items()
+		returncode = m.process.returncode
+		orchestrator.call(m.stop())
+
+		steady, discarded = steadyState(samples, m.started_at, self.warmup)
+		hashrate = sum(steady) / len(steady) if steady else None
+		return Result(options, hashrate, len(steady), discarded, returncode)
+
+	def run(self, onResult=None):
+		# Tries every candidate and returns the best Result (None if no candidate produced readings)
+		orchestrator = orch.MinerOrchestrator([self.profile])
+		try:
+			for candidate in candidates(self.space):
+				options = dict(self.profile.options)
+				options.update(candidate)
+				result = self.runCandidate(orchestrator, options)
+				self.results.append(result)
+				if onResult:
+					onResult(result)
+		finally:
+			orchestrator.shutdown()
+		return self.best()
+
+	def best(self):
+		measured = [r for r in self.results if r.hashrate is not None]
+		return max(measured, key=lambda r: r.hashrate) if measured else None
+
+	def unit(self):
+		return output.PARSERS[self.profile.miner_type].UNIT
+
+
+def formatResult(result, unit):
+	rate = 'no readings' if result.hashrate is None else '{:.1f} {}'.format(result.hashrate, unit)
+	opts = ', '.join(str(k) + '=' + str(v) for k, v in sorted(result.options.items()))
+	return '{:>16}  ({} readings, {} warm-up discarded)  {}'.format(rate, result.samples, result.discarded, opts)
+
+
+def writeReport(path, reports):
+	# reports: list of (Benchmark, best Result)
+	with open(path, 'w') as f:
+		f.write('IdleMiner benchmark report - ' + time.strftime('%Y-%m-%d %H:%M:%S') + '\n')
+		for bench, best in reports:
+			unit = bench.unit()
+			f.write('\nProfile: ' + bench.profile.name + '  (window ' + str(bench.window) + 's, warm-up ' +
+					str(bench.warmup) + 's)\n')
+			for result in sorted(bench.results, key=lambda r: -(r.hashrate or 0)):
+				f.write(('* ' if result is best else '  ') + formatResult(result, unit) + '\n')
+			if best is None:
+				f.write('  No candidate produced hashrate readings; config not changed.\n')
+
+
+def saveBest(config_path, profile, best, unit):
+	# Writes the winning options and measured hashrate back into the config file
+	with open(config_path, 'r') as ymlfile:
+		config = yaml.load(ymlfile, Loader=cfg.SafeLoader)
+
+	if config.get('MINER_PROFILES') and profile.name in config['MINER_PROFILES']:
+		config['MINER_PROFILES'][profile.name]['options'] = dict(best.options)
+	else:
+		config['EXTRA_OPTIONS'] = dict(best.options)
+
+	results = config.get('BENCHMARK_RESULTS') or {}
+	results[profile.name] = {'hashrate': round(best.hashrate, 2),
+							 'unit': unit,
+							 'options': dict(best.options),
+							 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+	config['BENCHMARK_RESULTS'] = results
+
+	cfg.writeAtomic(config_path, config)
+
+
+def main(config_path, config, profiles, names=None):
+	# Benchmarks the named profiles (all if names is empty) and updates the config file. Returns the reports.
+	settings = config.get('BENCHMARK') or {}
+	window = settings.get('window', 120)
+	warmup = settings.get('warmup', 30)
+	profile_configs = config.get('MINER_PROFILES') or {}
+
+	reports = []
+	for profile in profiles:
+		if names and profile.name not in names:
+			continue
+		space = (profile_configs.get(profile.name) or {}).get('benchmark_space') or settings.get('space') or {}
+		bench = Benchmark(profile, space, window, warmup)
+		print('Benchmarking ' + profile.name + ': ' + str(len(candidates(space))) + ' candidates x ' +
+			  str(window) + 's')
+		best = bench.run(onResult=lambda r, b=bench: print(formatResult(r, b.unit())))
+		reports.append((bench, best))
+
+		if best is not None:
+			saveBest(config_path, profile, best, bench.unit())
+			print('Best for ' + profile.name + ': ' + formatResult(best, bench.unit()))
+
+	writeReport(REPORT_PATH, reports)
+	print('Report written to ' + REPORT_PATH)
+	return reports
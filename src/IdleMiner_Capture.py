@@ -0,0 +1,262 @@
+import os
+import re
+import gzip
+import time
+import queue
+import shutil
+import threading
+import collections
+
+import IdleMiner_Output as output
+
+# Miner output capture.
+#
+# Miners run without a console window, so whatever they print is gone once it has been parsed for hashrates.
+# A CaptureManager keeps it: every line a miner prints (stdout and stderr share one pipe) is stamped with the
+# time and appended to that miner's log file, along with a marker line for each start and exit. Capturing
+# never slows the miner down: lines are handed from the orchestrator loop to a writer thread through a bounded
+# queue that is drained in batches, and if the disk cannot keep up the overflow is dropped and counted instead
+# of waiting.
+#
+# Log files are rotated once they reach 'max_file' bytes or 'max_age' seconds, and the rotated segments are
+# gzipped by a background thread. Then the oldest segments are deleted until all of the directory's logs
+# (including the miners' current files) fit in 'max_total' bytes. Each miner also keeps its last 'tail' lines
+# in memory, shown by the tray for failing miners and served by the control API (/miners/output).
+#
+# Memory use is bounded by ('tail' per miner + 'queue_size' shared) lines of at most output.MAX_LINE bytes each.
+# Disk use is bounded by 'max_total', provided it is larger than 'max_file' per miner.
+#
+#	logs/miner-<profile>.log						Current file
+#	logs/miner-<profile>.20260101-120000.log.gz		Rotated segments
+
+PREFIX = 'miner-'
+SEGMENT = re.compile(r'^' + PREFIX + r'.+\.\d{8}-\d{6}(-\d+)?\.log(\.gz)?$')
+
+
+def fileName(name):
+	return PREFIX + re.sub(r'[^\w.-]', '_', name)
+
+
+class MinerLog():
+	# Capture of one miner's output. write() and mark() are called on the orchestrator loop and never block.
+
+	def __init__(self, manager, name, tail):
+		self.manager = manager
+		self.name = name
+		self.base = os.path.join(manager.directory, fileName(name))
+		self.path = self.base + '.log'
+		self.tail = collections.deque(maxlen=tail)  # (time, line bytes)
+		self.lines = 0
+		self.dropped = 0  # Lines not written to disk because the writer fell behind
+		self.errors = 0
+		# Written by the writer thread only
+		self.file = None
+		self.size = 0
+		self.opened_at = None
+
+	def write(self, data):
+		now = time.time()
+		line = data.rstrip(b'\r\n')
+		self.lines += 1
+		self.tail.append((now, line))
+		pending = len(self.manager.pending)
+		if pending < self.manager.queue_size:
+			self.manager.pending.append((self, now, line))
+			if pending == self.manager.queue_size // 2:
+				self.manager._wake.set()  # Filling up; write now rather than at the next interval
+		else:
+			self.dropped += 1
+
+	def mark(self, text):
+		# Adds a marker line, e.g. when the miner starts or exits
+		self.write(b'-- ' + text.encode('utf-8', 'replace') + b' --')
+
+	def lastLines(self, count=None):
+		# The in-memory tail as 'HH:MM:SS line' strings, oldest first, without colour codes
+		items = list(self.tail)
+		if count is not None:
+			items = items[-count:] if count > 0 else []
+		return [time.strftime('%H:%M:%S', time.localtime(t)) + ' ' +
+				output.ANSI_ESCAPE.sub('', line.decode('utf-8', 'replace')) for t, line in items]
+
+	def segments(self):
+		prefix = os.path.basename(self.base) + '.'
+		try:
+			names = os.listdir(self.manager.directory)
+		except OSError:
+			return []
+		return sorted(os.path.join(self.manager.directory, n) for n in names if n.startswith(prefix) and SEGMENT.match(n))
+
+
+class CaptureManager():
+	def __init__(self, directory, max_file=4*1024*1024, max_age=24*60*60, max_total=64*1024*1024, tail=500,
+				 queue_size=10000, flush_interval=1.0):
+		self.directory = os.path.abspath(directory)
+		self.max_file = max_file
+		self.max_age = max_age
+		self.max_total = max_total
+		self.tail = tail
+		self.flush_interval = flush_interval  # Seconds between writes; lines wait in 'pending' until then
+		self.queue_size = queue_size
+		self.pending = collections.deque()  # (MinerLog, time, line); appended to by the loop, drained by the writer
+		self.logs = {}  # Profile name -> MinerLog
+		self.rotations = 0
+		self.deleted = 0
+		self._compress = queue.Queue()
+		self._stamp = (None, b'')
+		self._stopped = threading.Event()
+		self._wake = threading.Event()
+		self._writer = threading.Thread(target=self._writeLoop, name='CaptureWriter', daemon=True)
+		self._compressor = threading.Thread(target=self._compressLoop, name='CaptureCompressor', daemon=True)
+
+	def start(self):
+		os.makedirs(self.directory, exist_ok=True)
+		# Segments left uncompressed by an earlier run that was cut short
+		for name in sorted(os.listdir(self.directory)):
+			if SEGMENT.match(name) and name.endswith('.log'):
+				self._compress.put(os.path.join(self.directory, name))
+		self._writer.start()
+		self._compressor.start()
+		return self
+
+	def open(self, name):
+		# Returns the MinerLog for profile 'name'
+		log = self.logs.get(name)
+		if log is None:
+			log = self.logs[name] = MinerLog(self, name, self.tail)
+		return log
+
+	def close(self):
+		# Writes out what is queued, then stops both threads
+		if self._writer.is_alive():
+			self._stopped.set()
+			self._wake.set()
+			self._writer.join(10)
+		if self._compressor.is_alive():
+			self._compress.put(None)
+			self._compressor.join(30)
+
+	def _writeLoop(self):
+		while True:
+			self._wake.wait(self.flush_interval)
+			self._wake.clear()
+			stopping = self._stopped.is_set()
+			records = {}  # MinerLog -> records, written out together
+			while self.pending:
+				log, now, line = self.pending.popleft()
+				if log.file is not None and log.size and log.size + len(line) + 21 > self.max_file:
+					self._writeRecords(log, records.pop(log, []))
+					self._rotate(log, now)
+				if log.file is None:
+					self._writeRecords(log, records.pop(log, []))
+					self._open(log, now)
+				if log.file is None:
+					log.dropped += 1
+					continue
+				record = self._timestamp(now) + line + b'\n'
+				records.setdefault(log, []).append(record)
+				log.size += len(record)
+			for log, lines in records.items():
+				self._writeRecords(log, lines)
+			now = time.time()
+			for log in list(self.logs.values()):
+				if log.file is not None and now - log.opened_at >= self.max_age:
+					self._rotate(log, now)
+			if stopping:
+				for log in list(self.logs.values()):
+					if log.file is not None:
+						log.file.close()
+						log.file = None
+				return
+
+	def _timestamp(self, now):
+		second = int(now)
+		if self._stamp[0] != second:
+			self._stamp = (second, time.strftime('%Y-%m-%d %H:%M:%S ', time.localtime(second)).encode('ascii'))
+		return self._stamp[1]
+
+	def _open(self, log, now):
+		try:
+			log.file = open(log.path, 'ab')
+			log.size = log.file.tell()
+			log.opened_at = now
+		except OSError as e:
+			self._failed(log, e)
+
+	def _writeRecords(self, log, records):
+		if not records or log.file is None:
+			return
+		try:
+			log.file.write(b''.join(records))
+			log.file.flush()
+		except OSError as e:
+			log.dropped += len(records)
+			self._failed(log, e)
+
+	def _failed(self, log, e):
+		# Disk full or directory gone: report once, drop lines and try to reopen the file with the next batch
+		if not log.errors:
+			print("Capture: cannot write " + log.path + ": " + str(e))
+		log.errors += 1
+		if log.file is not None:
+			try:
+				log.file.close()
+			except OSError:
+				pass
+			log.file = None
+
+	def _rotate(self, log, now):
+		log.file.close()
+		log.file = None
+		log.size = 0
+		segment = log.base + '.' + time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+		suffix = ''
+		while os.path.exists(segment + suffix + '.log') or os.path.exists(segment + suffix + '.log.gz'):
+			suffix = '-' + str(int(suffix[1:] or 0) + 1)
+		try:
+			os.replace(log.path, segment + suffix + '.log')
+		except OSError as e:
+			self._failed(log, e)
+			return
+		self.rotations += 1
+		self._compress.put(segment + suffix + '.log')
+
+	def _compressLoop(self):
+		while True:
+			path = self._compress.get()
+			if path is None:
+				return
+			try:
+				with open(path, 'rb') as source, gzip.open(path + '.gz.tmp', 'wb', compresslevel=6) as target:
+					shutil.copyfileobj(source, target)
+				os.replace(path + '.gz.tmp', path + '.gz')
+				os.remove(path)
+			except FileNotFoundError:
+				pass  # Already pruned
+			except OSError as e:
+				print("Capture: cannot compress " + path + ": " + str(e))
+			self.prune()
+
+	def prune(self):
+		# Deletes the oldest rotated segments until all logs fit in max_total
+		try:
+			names = [n for n in os.listdir(self.directory) if n.startswith(PREFIX) and
+					 (n.endswith('.log') or n.endswith('.log.gz'))]
+			files = [(os.stat(os.path.join(self.directory, n)), n) for n in names]
+		except OSError:
+			return
+		total = sum(st.st_size for st, _ in files)
+		for st, name in sorted((f for f in files if SEGMENT.match(f[1])), key=lambda f: f[0].st_mtime):
+			if total <= self.max_total:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except OSError:
+				continue
+			total -= st.st_size
+			self.deleted += 1
+
+	def status(self):
+		# Profile name -> {'lines', 'dropped', 'file', 'segments'}
+		return {name: {'lines': log.lines, 'dropped': log.dropped, 'file': log.path, 'segments': len(log.segments())}
+				for name, log in self.logs.items()}
@@ -0,0 +1,376 @@
+import os
+import sys
+import copy
+import time
+import select
+import threading
+import tempfile
+import collections.abc
+
+import yaml
+
+import IdleMiner_Profiles as profiles
+import IdleMiner_Policy as policy
+
+# Configuration.
+#
+# IdleMiner_Config.yaml is loaded with PyYAML's safe loader (the C implementation when available) into an
+# immutable, validated Config object. A ConfigWatcher reloads the file when it changes on disk (inotify on Linux,
+# change notifications on Windows, polling elsewhere) and hands the new Config to a callback, so edits apply
+# to the running miner without restarting. Changes made from the tray go through a ConfigWriter, which batches
+# them for a short debounce period and then writes the file atomically (temp file + rename), so a crash
+# mid-write can never leave a truncated config behind.
+
+try:
+	SafeLoader = yaml.CSafeLoader
+	SafeDumper = yaml.CSafeDumper
+except AttributeError:
+	SafeLoader = yaml.SafeLoader
+	SafeDumper = yaml.SafeDumper
+
+NUMBER = (int, float)
+
+# Key -> (allowed types, default, check). A check returns an error message, or None if the value is fine.
+SCHEMA = {
+	'IDLE_TIMER': (int, 300, lambda v: None if 5 <= v <= 60*60 else 'must be between 5 and 3600 seconds'),
+	'MINER_PATH': (str, None, None),
+	'MINER_TYPE': (str, 'ewbf', None),
+	'ALGORITHM': (str, 'equihash', None),
+	'POOL_SERVER': ((str, list, tuple), None, None),  # One endpoint, or a list to fail over between
+	'USER_ADDRESS': (str, None, None),
+	'EXTRA_OPTIONS': (dict, {}, None),
+	'MINER_PROFILES': (dict, None, None),
+	# Pause miners instead of stopping them when the user returns, so they resume without a warm-up.
+	# Miners paused longer than SUSPEND_MAX_PAUSE seconds are stopped and restarted fresh next time.
+	'SUSPEND_MODE': (bool, False, None),
+	'SUSPEND_MAX_PAUSE': (NUMBER, 30*60, lambda v: None if v >= 0 else 'must not be negative'),
+	# Seconds a miner gets to exit after being asked before it is killed, and the stop latency
+	# (request until the whole miner process tree is gone) above which a warning is printed
+	'STOP_TIMEOUT': (NUMBER, 5, lambda v: None if v > 0 else 'must be positive'),
+	'STOP_SLA': (NUMBER, 2, lambda v: None if v > 0 else 'must be positive'),
+	'THROTTLE': (dict, {}, None),
+	'THERMAL': (dict, {}, None),
+	'WATCHDOG': (dict, {}, None),
+	'POOLS': (dict, {}, None),
+	'PROFIT_SWITCHING': (dict, {}, None),
+	'BENCHMARK': (dict, {}, None),
+	'BENCHMARK_RESULTS': (dict, {}, None),
+	'API': (dict, {}, None),
+	'HISTORY': (dict, {}, None),
+	'CAPTURE': (dict, {}, None),
+	# Reporting to a fleet coordinator, see IdleMiner_Fleet.py
+	'FLEET': (dict, {}, None),
+	# Start/stop rules for the idle timer, see IdleMiner_Policy.py
+	'POLICY': ((list, tuple), [], None),
+}
+
+
+class ConfigError(ValueError):
+	def __init__(self, errors):
+		ValueError.__init__(self, 'Invalid config: ' + '; '.join(errors))
+		self.errors = errors
+
+
+def _freeze(value):
+	# Recursively converts dicts to read-only mappings and lists to tuples
+	if isinstance(value, dict):
+		return FrozenDict({k: _freeze(v) for k, v in value.items()})
+	if isinstance(value, list):
+		return tuple(_freeze(v) for v in value)
+	return value
+
+
+def _thaw(value):
+	if isinstance(value, collections.abc.Mapping):
+		return {k: _thaw(v) for k, v in value.items()}
+	if isinstance(value, tuple):
+		return [_thaw(v) for v in value]
+	return value
+
+
+class FrozenDict(collections.abc.Mapping):
+	def __init__(self, data):
+		self._data = data
+
+	def __getitem__(self, key):
+		return self._data[key]
+
+	def __iter__(self):
+		return iter(self._data)
+
+	def __len__(self):
+		return len(self._data)
+
+	def __repr__(self):
+		return repr(self._data)
+
+
+class Config(FrozenDict):
+	# Immutable, validated config. Keys are available as items (config['IDLE_TIMER']) and attributes
+	# (config.IDLE_TIMER); keys missing from the file, or left empty, take their SCHEMA default.
+
+	def __init__(self, data):
+		merged = {key: copy.deepcopy(default) for key, (_, default, _) in SCHEMA.items()}
+		merged.update((k, v) for k, v in data.items() if v is not None or k not in SCHEMA)
+		FrozenDict.__init__(self, {k: _freeze(v) for k, v in merged.items()})
+
+	def __getattr__(self, key):
+		if key.startswith('_'):
+			raise AttributeError(key)
+		try:
+			return self._data[key]
+		except KeyError:
+			raise AttributeError(key)
+
+	def __setattr__(self, key, value):
+		if key != '_data':
+			raise AttributeError('Config is immutable')
+		object.__setattr__(self, key, value)
+
+	def toDict(self):
+		# Mutable deep copy, e.g. for writing back to disk
+		return _thaw(self)
+
+
+def validate(data):
+	# Returns a list of error messages for a parsed config dict
+	if not isinstance(data, dict):
+		return ['top level must be a mapping']
+
+	errors = []
+	for key, (types, _, check) in SCHEMA.items():
+		if key not in data or data[key] is None:
+			continue
+		value = data[key]
+		if not isinstance(value, types) or (isinstance(value, bool) and types is not bool):
+			errors.append(key + ': wrong type ' + type(value).__name__)
+		elif check and check(value):
+			errors.append(key + ': ' + check(value))
+
+	if not errors:
+		try:
+			for profile in profiles.loadProfiles(Config(data)):
+				if not profile.binary and data.get('MINER_PROFILES'):
+					errors.append('MINER_PROFILES.' + profile.name + ': missing binary')
+		except (KeyError, TypeError, AttributeError) as e:
+			errors.append('MINER_PROFILES: ' + str(e))
+
+		try:
+			policy.loadRules(data.get('POLICY'), data.get('IDLE_TIMER') or 300)
+		except (KeyError, TypeError, ValueError, AttributeError) as e:
+			errors.append('POLICY: ' + repr(e))
+
+		for level in (data.get('THROTTLE') or {}).get('levels') or []:
+			if not isinstance(level, dict) or 'name' not in level or 'below' not in level:
+				errors.append('THROTTLE.levels: each level needs a name and a below limit')
+
+		steps = (data.get('THERMAL') or {}).get('steps')
+		if steps is not None and (not isinstance(steps, (list, tuple)) or not steps or
+								  not all(isinstance(v, (int, float)) for v in steps)):
+			errors.append('THERMAL.steps: must be a list of numbers')
+	return errors
+
+
+def parse(text):
+	data = yaml.load(text, Loader=SafeLoader) or {}
+	errors = validate(data)
+	if errors:
+		raise ConfigError(errors)
+	return Config(data)
+
+
+def load(path):
+	# Loads and validates a config file. Raises OSError, yaml.YAMLError or ConfigError.
+	with open(path, 'r') as ymlfile:
+		return parse(ymlfile.read())
+
+
+def writeAtomic(path, data):
+	# Writes 'data' as YAML to a temp file in the same directory, flushes it to disk and renames it over 'path'.
+	# The rename is atomic, so readers see either the old or the new file, never a partial one.
+	directory = os.path.dirname(os.path.abspath(path))
+	fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+	try:
+		if os.path.exists(path):
+			os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+		with os.fdopen(fd, 'w') as tmp:
+			yaml.dump(data, tmp, Dumper=SafeDumper, default_flow_style=None)
+			tmp.flush()
+			os.fsync(tmp.fileno())
+		os.replace(tmp_path, path)
+	except BaseException:
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+		raise
+
+
+class ConfigWriter():
+	# Debounced, atomic config updates. update() may be called many times in quick succession (e.g. clicking
+	# through tray options); the merged changes are written once, 'debounce' seconds after the last call.
+
+	def __init__(self, path, debounce=1.0):
+		self.path = path
+		self.debounce = debounce
+		self.writes = 0
+		self._pending = {}
+		self._timer = None
+		self._lock = threading.Lock()
+
+	def update(self, changes):
+		with self._lock:
+			self._pending.update(changes)
+			if self._timer is not None:
+				self._timer.cancel()
+			self._timer = threading.Timer(self.debounce, self.flush)
+			self._timer.daemon = True
+			self._timer.start()
+
+	def flush(self):
+		with self._lock:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			if not self._pending:
+				return
+			changes, self._pending = self._pending, {}
+
+			# Start from the file on disk so keys edited by hand in the meantime are kept
+			with open(self.path, 'r') as ymlfile:
+				data = yaml.load(ymlfile, Loader=SafeLoader) or {}
+			data.update(changes)
+			errors = validate(data)
+			if errors:
+				print('Not saving config: ' + '; '.join(errors))
+				return
+			writeAtomic(self.path, data)
+			self.writes += 1
+
+
+class ConfigWatcher(threading.Thread):
+	# Reloads the config file whenever it changes and calls onChange(new_config, old_config) if the content
+	# differs. Invalid edits are reported and ignored; the previous config stays in effect.
+
+	POLL_INTERVAL = 2  # Seconds between checks when no change notification API is available
+	SETTLE = 0.1  # Seconds to wait after a change event so editors can finish writing
+
+	def __init__(self, path, config, onChange):
+		threading.Thread.__init__(self, name='ConfigWatcher', daemon=True)
+		self.path = os.path.abspath(path)
+		self.config = config
+		self.onChange = onChange
+		self.reloads = 0
+		self._stopped = threading.Event()
+		self._wakeRead, self._wakeWrite = os.pipe()
+		self._win32StopEvent = None
+
+	def stop(self):
+		self._stopped.set()
+		os.write(self._wakeWrite, b'\0')
+		if self._win32StopEvent is not None:
+			import win32event
+			win32event.SetEvent(self._win32StopEvent)
+
+	def reload(self):
+		try:
+			new = load(self.path)
+		except (OSError, yaml.YAMLError, ConfigError) as e:
+			print('Config reload failed, keeping previous config: ' + str(e))
+			return
+		if new == self.config:
+			return
+		old, self.config = self.config, new
+		self.reloads += 1
+		self.onChange(new, old)
+
+	def run(self):
+		if sys.platform.startswith('linux'):
+			try:
+				self._runInotify()
+				return
+			except OSError:
+				pass
+		elif sys.platform == 'win32':
+			try:
+				self._runWin32()
+				return
+			except ImportError:
+				pass
+		self._runPolling()
+
+	def _runInotify(self):
+		import ctypes
+		import ctypes.util
+		import struct
+		IN_CLOSE_WRITE = 0x00000008
+		IN_MOVED_TO = 0x00000080
+
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		fd = libc.inotify_init()
+		if fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init failed')
+		try:
+			# Watch the directory: atomic writes replace the file, which would drop a watch on the file itself
+			directory, name = os.path.split(self.path)
+			if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+				raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+			while not self._stopped.is_set():
+				ready, _, _ = select.select([fd, self._wakeRead], [], [])
+				if fd not in ready:
+					continue
+				data = os.read(fd, 4096)
+				changed = False
+				offset = 0
+				while offset < len(data):
+					_, _, _, length = struct.unpack_from('iIII', data, offset)
+					event_name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode(errors='replace')
+					changed = changed or event_name == name
+					offset += 16 + length
+				if changed:
+					time.sleep(self.SETTLE)
+					self.reload()
+		finally:
+			os.close(fd)
+
+	def _runWin32(self):
+		import win32file
+		import win32event
+		import win32con
+		directory = os.path.dirname(self.path)
+		handle = win32file.FindFirstChangeNotification(directory, False, win32con.FILE_NOTIFY_CHANGE_LAST_WRITE |
+													   win32con.FILE_NOTIFY_CHANGE_FILE_NAME)
+		self._win32StopEvent = win32event.CreateEvent(None, True, False, None)
+		try:
+			last = self._stat()
+			while not self._stopped.is_set():
+				waited = win32event.WaitForMultipleObjects([handle, self._win32StopEvent], False, win32event.INFINITE)
+				if waited == win32event.WAIT_OBJECT_0:
+					current = self._stat()
+					if current != last:
+						last = current
+						time.sleep(self.SETTLE)
+						self.reload()
+					win32file.FindNextChangeNotification(handle)
+		finally:
+			win32file.FindCloseChangeNotification(handle)
+
+	def _stat(self):
+		try:
+			st = os.stat(self.path)
+			return (st.st_mtime_ns, st.st_size)
+		except OSError:
+			return None
+
+	def _runPolling(self):
+		last = self._stat()
+		while not self._stopped.wait(self.POLL_INTERVAL):
+			current = self._stat()
+			if current != last:
+				# Only reload once the file has stopped changing: a file being rewritten in place may be empty
+				time.sleep(self.SETTLE)
+				if self._stat() != current:
+					continue
+				last = current
+				self.reload()
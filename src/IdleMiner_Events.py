@@ -0,0 +1,218 @@
+import time
+import queue
+import threading
+import collections
+
+import IdleMiner_Metrics as metrics
+
+# Event bus and miner state machine.
+#
+# The idle scheduler, the tray and the config watcher run on their own threads. Instead of sharing flags, they
+# post events to an EventBus; one dispatcher thread delivers every event, in order, to the callbacks subscribed
+# to its kind. The MinerStateMachine is one such subscriber and the only owner of the mining state, so state
+# changes never race. Every transition it makes is published as a STATE event carrying a Transition record, and
+# the tray, idle scheduler and miner supervisors (throttle, profit switcher) subscribe to those.
+#
+#	idle ----IDLE_DETECTED----> starting --> mining ----USER_ACTIVE----> stopping --> idle (or paused)
+#	mining ----POLICY_STOP----> stopping --> idle (or paused)
+#	idle/paused --MANUAL_START--> starting --> manual ----MANUAL_STOP----> stopping --> idle
+#	paused --IDLE_DETECTED--> starting --> mining		mining --MANUAL_START--> manual
+#	mining/manual --PAUSE--> stopping --> paused (held: the idle timer does not resume it)
+#
+# With hold_on_stop (set when there is no user input to watch, so idle time never resets), MANUAL_STOP holds
+# too: the idle timer would otherwise start the miners again at once. Only a manual start resumes.
+#
+# Each Transition is stamped with the time the triggering event was posted and the time the new state was
+# reached, so decision-to-action latency (e.g. user input until the miners are stopped) can be measured.
+
+# Event kinds
+IDLE_DETECTED = 'idle_detected'  # Idle timer threshold crossed; data is how many seconds ago, if known
+USER_ACTIVE = 'user_active'  # User returned while mining
+POLICY_STOP = 'policy_stop'  # A policy rule no longer allows mining; data is the rule's name
+MANUAL_START = 'manual_start'  # Start mining from the tray (overrides the idle timer)
+MANUAL_STOP = 'manual_stop'
+PAUSE = 'pause'  # Pause the miners now and hold them paused until started again (control API)
+TIMER_ON = 'timer_on'  # Idle timer enabled/disabled from the tray
+TIMER_OFF = 'timer_off'
+CONFIG = 'config'  # Config file reloaded; data is (new config, old config)
+SET_TIMER = 'set_timer'  # data is the new idle timer in seconds
+SWITCH_PROFILE = 'switch_profile'  # data is the name of the profile to run in its group
+HEALTH = 'health'  # A miner's health changed (see IdleMiner_Health.py); data is (profile name, state, reason)
+QUIT = 'quit'
+STATE = 'state'  # Published by the state machine; data is a Transition
+
+# Miner states
+IDLE = 'idle'
+STARTING = 'starting'
+MINING = 'mining'  # Started by the idle timer
+STOPPING = 'stopping'
+PAUSED = 'paused'  # Miners suspended (suspend mode), resumed on the next start
+MANUAL = 'manual'  # Started from the tray; the idle timer is overridden until stopped from the tray
+
+Event = collections.namedtuple('Event', ['kind', 'time', 'data'])
+
+# 'posted' is when the triggering event was posted, 'time' when the state was entered
+Transition = collections.namedtuple('Transition', ['old', 'new', 'event', 'posted', 'time'])
+
+_STOP = object()  # Sentinel that ends the dispatcher thread
+
+
+class EventBus():
+	def __init__(self, clock=time.monotonic):
+		self.clock = clock
+		self.dispatched = 0
+		self._queue = queue.Queue()
+		self._subscribers = {}  # kind -> [callback]; kind None receives every event
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def subscribe(self, kinds, callback):
+		# 'kinds' is an event kind, a list of kinds, or None for all events. Callbacks run on the dispatcher
+		# thread, in subscription order, and are called as callback(event).
+		if kinds is None or isinstance(kinds, str):
+			kinds = [kinds]
+		with self._lock:
+			for kind in kinds:
+				self._subscribers[kind] = self._subscribers.get(kind, []) + [callback]
+
+	def unsubscribe(self, callback):
+		with self._lock:
+			for kind in self._subscribers:
+				self._subscribers[kind] = [c for c in self._subscribers[kind] if c != callback]
+
+	def post(self, kind, data=None):
+		# Queues an event. Safe to call from any thread, including from a subscriber.
+		event = Event(kind, self.clock(), data)
+		self._queue.put(event)
+		return event
+
+	def dispatch(self, event):
+		with self._lock:
+			callbacks = self._subscribers.get(event.kind, []) + self._subscribers.get(None, [])
+		for callback in callbacks:
+			try:
+				callback(event)
+			except Exception as e:
+				print("Error handling event '" + event.kind + "': " + repr(e))
+		self.dispatched += 1
+
+	def runPending(self):
+		# Dispatches queued events (including ones posted meanwhile) until the queue is empty
+		while True:
+			try:
+				event = self._queue.get_nowait()
+			except queue.Empty:
+				return
+			if event is not _STOP:
+				self.dispatch(event)
+
+	def run(self):
+		while True:
+			event = self._queue.get()
+			if event is _STOP:
+				return
+			self.dispatch(event)
+
+	def start(self):
+		self._thread = threading.Thread(target=self.run, name='EventBus', daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self, timeout=None):
+		# Dispatches everything already queued, then ends the dispatcher thread
+		self._queue.put(_STOP)
+		if self._thread is not None and self._thread is not threading.current_thread():
+			self._thread.join(timeout)
+
+
+class MinerStateMachine():
+	# start(resume) and stop(pause) carry out the transitions; they run on the dispatcher thread and may block.
+	# stop() is asked to pause when suspend() returns True and mining was started by the idle timer.
+
+	def __init__(self, bus, start, stop, suspend=lambda: False, history=100, hold_on_stop=False):
+		self.bus = bus
+		self.start = start
+		self.stop = stop
+		self.suspend = suspend
+		self.state = IDLE
+		self.timerActive = True
+		self.held = False  # Paused (or stopped, with hold_on_stop) on request; only a manual start resumes
+		self.hold_on_stop = hold_on_stop
+		self.mining_seconds = 0.0  # Time spent in MINING/MANUAL, excluding the current stretch
+		self.mining_since = None
+		self.transitions = collections.deque(maxlen=history)
+		# Seconds from the triggering event being posted until its action completed (miners started or stopped)
+		self.latency = metrics.Histogram()
+		bus.subscribe([IDLE_DETECTED, USER_ACTIVE, POLICY_STOP, MANUAL_START, MANUAL_STOP, PAUSE, TIMER_ON, TIMER_OFF, QUIT],
+					  self.handle)
+
+	def isMining(self):
+		return self.state in (STARTING, MINING, MANUAL)
+
+	def timerEnabled(self):
+		# The idle timer acts only while enabled and not overridden by a manual start or a held pause
+		return self.timerActive and self.state != MANUAL and not self.held
+
+	def miningSeconds(self):
+		# Total time spent mining, including the current stretch
+		if self.mining_since is None:
+			return self.mining_seconds
+		return self.mining_seconds + self.bus.clock() - self.mining_since
+
+	def handle(self, event):
+		kind = event.kind
+		if kind == TIMER_ON or kind == TIMER_OFF:
+			self.timerActive = kind == TIMER_ON
+		elif kind == IDLE_DETECTED and self.timerEnabled() and self.state in (IDLE, PAUSED):
+			self._start(event, MINING)
+		elif (kind == USER_ACTIVE or kind == POLICY_STOP) and self.state == MINING:
+			self._stop(event, self.suspend())
+		elif kind == MANUAL_START and self.state in (IDLE, PAUSED):
+			self.held = False
+			self._start(event, MANUAL)
+		elif kind == MANUAL_START and self.state == MINING:
+			# Already mining; the tray takes over from the idle timer
+			self._enter(event, MANUAL)
+		elif kind == MANUAL_STOP and self.state in (MINING, MANUAL, PAUSED):
+			self.held = self.hold_on_stop
+			self._stop(event, False)
+		elif kind == MANUAL_STOP and self.state == IDLE:
+			self.held = self.hold_on_stop
+		elif kind == PAUSE and self.state in (MINING, MANUAL):
+			self.held = True
+			self._stop(event, True)
+		elif kind == QUIT and self.state != IDLE:
+			self._stop(event, False)
+
+	def _enter(self, event, state):
+		transition = Transition(self.state, state, event.kind, event.time, self.bus.clock())
+		if state in (MINING, MANUAL) and self.mining_since is None:
+			self.mining_since = transition.time
+		elif state not in (MINING, MANUAL) and self.mining_since is not None:
+			self.mining_seconds += transition.time - self.mining_since
+			self.mining_since = None
+		self.state = state
+		self.transitions.append(transition)
+		self.bus.post(STATE, transition)
+		return transition
+
+	def _start(self, event, target):
+		resume = self.state == PAUSED
+		self._enter(event, STARTING)
+		try:
+			self.start(resume)
+		except Exception as e:
+			print("Starting miners failed: " + repr(e))
+			self._enter(event, IDLE)
+			return
+		transition = self._enter(event, target)
+		self.latency.observe(transition.time - transition.posted)
+
+	def _stop(self, event, pause):
+		self._enter(event, STOPPING)
+		try:
+			self.stop(pause)
+		except Exception as e:
+			print("Stopping miners failed: " + repr(e))
+		transition = self._enter(event, PAUSED if pause else IDLE)
+		self.latency.observe(transition.time - transition.posted)
@@ -0,0 +1,61 @@
+import sys
+import time
+import random
+import argparse
+
+# Fake miner for offline testing.
+#
+# Prints EWBF-style console output with a synthetic hashrate that depends on --intensity, so benchmark mode,
+# the output parsers and the orchestrator can be exercised without a GPU or a pool. Unknown options are
+# accepted and ignored, so it can stand in for a real miner in any profile:
+#
+#	MINER_PROFILES:
+#	  fake:
+#	    binary: python
+#	    args: [IdleMiner_FakeMiner.py, --server, '{server}', --user, '{user}']
+#	    options: {intensity: 64, rate: 300}
+#
+# The hashrate peaks at --best_intensity and falls off quadratically either side of it. During the first
+# --warmup seconds it ramps up from zero, like a real miner initialising its solver.
+
+
+def hashrateAt(rate, intensity, best_intensity):
+	return max(0.0, rate * (1 - ((intensity - best_intensity) / 128) ** 2))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Fake miner emitting EWBF-style hashrate lines.')
+	parser.add_argument('--intensity', type=float, default=64)
+	parser.add_argument('--best_intensity', type=float, default=48)
+	parser.add_argument('--rate', type=float, default=300, help='Total Sol/s at the best intensity')
+	parser.add_argument('--gpus', type=int, default=1)
+	parser.add_argument('--warmup', type=float, default=5, help='Seconds of ramp-up before full speed')
+	parser.add_argument('--interval', type=float, default=1, help='Seconds between hashrate lines')
+	parser.add_argument('--noise', type=float, default=0.02, help='Relative random noise on each reading')
+	parser.add_argument('--duration', type=float, default=None, help='Exit after this many seconds')
+	parser.add_argument('--seed', type=int, default=None)
+	args, _ = parser.parse_known_args(argv)
+
+	rng = random.Random(args.seed)
+	target = hashrateAt(args.rate, args.intensity, args.best_intensity)
+	start = time.monotonic()
+	accepted = 0
+
+	print('EWBF-compatible fake miner, intensity ' + str(args.intensity), flush=True)
+	while args.duration is None or time.monotonic() - start < args.duration:
+		elapsed = time.monotonic() - start
+		ramp = min(1.0, elapsed / args.warmup) if args.warmup > 0 else 1.0
+		per_gpu = [target * ramp / args.gpus * (1 + rng.uniform(-args.noise, args.noise)) for _ in range(args.gpus)]
+
+		print('Temp: ' + ' '.join('GPU' + str(i) + ': 60C' for i in range(args.gpus)))
+		print(' '.join('GPU' + str(i) + ': ' + str(round(r)) + ' Sol/s' for i, r in enumerate(per_gpu)))
+		print('Total speed: ' + str(round(sum(per_gpu))) + ' Sol/s')
+		if ramp >= 1 and rng.random() < 0.3:
+			accepted += 1
+			print('INFO ' + time.strftime('%H:%M:%S') + ': GPU0 Accepted share 40ms [A:' + str(accepted) + ', R:0]')
+		sys.stdout.flush()
+		time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,468 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import argparse
+import threading
+import collections
+import http.server
+import urllib.parse
+import urllib.request
+
+import yaml
+
+import IdleMiner_Config as cfg
+
+# Fleet coordination.
+#
+# With FLEET enabled, IdleMiner runs a FleetAgent that reports to a coordinator (python IdleMiner_Fleet.py
+# coordinator). Every 'interval' seconds the agent takes the status snapshot (the same one the control API
+# serves) and queues a report of the keys that changed since the previous report. Every 'flush' seconds the
+# queued reports are sent as one zlib-compressed JSON batch. Each report names the report it builds on
+# ('base'), so the coordinator can tell when it missed something (e.g. after a coordinator restart) and ask
+# for the full status again; the agent then sends the oldest queued report in full.
+#
+# While the coordinator is unreachable, reports stay queued (up to 'buffer' of them; beyond that the oldest
+# two are merged into one, which keeps the chain intact at a coarser time resolution) and sending is retried
+# with a doubling delay. Once it is back, the backlog is sent and the coordinator's hash totals include the
+# outage.
+#
+# The coordinator keeps each host's latest status, fleet-wide hashrate and mined-hash totals, and per-host
+# health (online, state, failing miners), served as JSON at /fleet and in Prometheus format at /metrics.
+# It also pushes config: its fleet file holds config keys for all hosts and per host,
+#
+#	all:
+#	  IDLE_TIMER: 600
+#	  THROTTLE: {enabled: true}
+#	hosts:
+#	  office-pc-12:
+#	    MINER_PROFILES: {...}
+#
+# and hosts whose config differs receive it in the reply to their next report. Agents merge it into their
+# config file, so it is applied live by the config watcher and kept across restarts. Keys removed from the
+# fleet file keep their last pushed value on the agents. FLEET itself cannot be pushed.
+#
+# Pushed config can change the miner binaries agents run, so set a shared 'token' whenever the coordinator
+# is reachable from other machines. To try it on one host, run a coordinator and a few simulated agents:
+#
+#	python IdleMiner_Fleet.py coordinator --port 8480 --config IdleMiner_Fleet.yaml
+#	python IdleMiner_Fleet.py agents --count 10 --coordinator http://127.0.0.1:8480
+
+DEFAULT_PORT = 8480
+MAX_GAP = 10*60  # Seconds; longer gaps between reports are not counted as mining time in the hash totals
+
+HEALTHY_STATES = ('healthy', 'starting', 'paused')
+
+
+def configVersion(settings):
+	return format(zlib.crc32(json.dumps(settings, sort_keys=True).encode('utf-8')), '08x')
+
+
+def _merge(older, newer):
+	# One report covering both (older directly precedes newer in the queue)
+	changes = dict(older['changes'])
+	changes.update(newer['changes'])
+	return {'seq': newer['seq'], 'base': older['base'], 'time': newer['time'], 'full': older['full'],
+			'changes': changes}
+
+
+class FleetAgent(threading.Thread):
+	# Reports getStatus() (a function returning the status dict) to the coordinator at 'url' and calls
+	# onConfig(settings) with config pushed by the coordinator.
+
+	def __init__(self, url, getStatus, onConfig, name=None, interval=10, flush=30, buffer=2000, batch=500,
+				 token=None, timeout=10, retry_max=300):
+		threading.Thread.__init__(self, name='FleetAgent', daemon=True)
+		self.url = url.rstrip('/')
+		self.getStatus = getStatus
+		self.onConfig = onConfig
+		self.host = name or socket.gethostname()
+		self.interval = interval
+		self.flush = flush
+		self.batch = batch
+		self.token = token
+		self.timeout = timeout
+		self.retry_max = retry_max
+		self.queue = collections.deque()
+		self.buffer = buffer
+		self.seq = 0
+		self.config_version = None
+		self.connected = None
+		self.last_error = None
+		self.sent = 0  # Reports acknowledged by the coordinator
+		self.merged = 0  # Reports merged because the queue was full
+		self._last = None  # Status as of the newest queued report
+		self._acked = {}  # Status as of the last report the coordinator acknowledged
+		self._full = True  # Next report carries the full status
+		self._retry = flush
+		self._next_send = 0
+		self._stopped = threading.Event()
+
+	def stop(self):
+		self._stopped.set()
+
+	def snapshot(self, now=None):
+		# Queues a report of what changed since the previous one
+		current = self.getStatus()
+		if self._full or self._last is None:
+			changes = dict(current)
+		else:
+			changes = {key: value for key, value in current.items() if self._last.get(key) != value}
+			changes.update((key, None) for key in self._last if key not in current)
+		self.seq += 1
+		self.queue.append({'seq': self.seq, 'base': None if self._full else self.seq - 1,
+						   'time': time.time() if now is None else now, 'full': self._full, 'changes': changes})
+		self._last = current
+		self._full = False
+		while len(self.queue) > max(2, self.buffer):
+			older, newer = self.queue.popleft(), self.queue.popleft()
+			self.queue.appendleft(_merge(older, newer))
+			self.merged += 1
+
+	def send(self):
+		# Posts up to 'batch' queued reports. Returns True if the coordinator answered.
+		reports = [self.queue[i] for i in range(min(self.batch, len(self.queue)))]
+		body = zlib.compress(json.dumps({'host': self.host, 'config_version': self.config_version,
+										 'backlog': len(self.queue), 'reports': reports}).encode('utf-8'))
+		request = urllib.request.Request(self.url + '/report', data=body, method='POST',
+										 headers={'Content-Type': 'application/json', 'Content-Encoding': 'deflate'})
+		if self.token:
+			request.add_header('Authorization', 'Bearer ' + self.token)
+		try:
+			with urllib.request.urlopen(request, timeout=self.timeout) as response:
+				reply = json.loads(response.read().decode('utf-8'))
+		except (OSError, ValueError) as e:
+			self.last_error = str(e)
+			if self.connected is not False:
+				print("Fleet: coordinator unreachable, buffering reports: " + str(e))
+			self.connected = False
+			return False
+
+		if self.connected is False:
+			print("Fleet: coordinator reachable again, " + str(len(self.queue)) + " reports queued")
+		self.connected = True
+		self.last_error = None
+		ack = reply.get('ack')
+		while self.queue and ack is not None and self.queue[0]['seq'] <= ack:
+			report = self.queue.popleft()
+			if report['full']:
+				self._acked = {}
+			self._acked.update(report['changes'])
+			self.sent += 1
+		if reply.get('resync'):
+			# The coordinator lost track (restarted, or missed a report): turn the oldest queued report into a
+			# full one so the backlog still counts, or send the full status next
+			if self.queue and not self.queue[0]['full']:
+				first = dict(self.queue[0])
+				first['changes'] = dict(self._acked, **first['changes'])
+				first['full'] = True
+				first['base'] = None
+				self.queue[0] = first
+			elif not self.queue:
+				self._full = True
+		config = reply.get('config')
+		if config is not None and config.get('version') != self.config_version:
+			if config.get('settings'):
+				print("Fleet: applying config from the coordinator (" + ', '.join(sorted(config['settings'])) + ")")
+				self.onConfig(config['settings'])
+			self.config_version = config.get('version')
+		return True
+
+	def run(self):
+		while True:
+			now = time.time()
+			try:
+				self.snapshot(now)
+			except Exception as e:
+				print("Fleet: " + repr(e))
+			if now >= self._next_send:
+				ok = self.send()
+				while ok and self.queue and (len(self.queue) >= self.batch or self.queue[0]['full']):
+					ok = self.send()  # Catching up on a backlog, or resending after a resync
+				if ok and self._full:
+					self.snapshot()
+					ok = self.send()
+				self._retry = self.flush if ok else min(self.retry_max, self._retry * 2)
+				self._next_send = time.time() + self._retry
+			if self._stopped.wait(self.interval):
+				return
+
+
+class HostState():
+	def __init__(self, name):
+		self.name = name
+		self.status = {}
+		self.seq = None  # Last report applied
+		self.report_time = None  # Agent time of that report
+		self.last_seen = 0  # Coordinator time of the last contact
+		self.config_version = None
+		self.backlog = 0
+		self.reports = 0
+		self.resyncs = 0
+		self.hashes = {}  # Unit -> hashes mined, integrated from the reported hashrate
+
+
+class FleetCoordinator():
+	# Receives agent reports over HTTP and pushes the fleet file's config. 'stale' is the seconds without a
+	# report after which a host counts as offline.
+
+	def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, config_path=None, token=None, stale=120,
+				 clock=time.time):
+		self.config_path = config_path
+		self.token = token
+		self.stale = stale
+		self.clock = clock
+		self.hosts = {}  # Host name -> HostState
+		self.fleet_config = {'all': {}, 'hosts': {}}
+		self._config_stat = None
+		self._lock = threading.Lock()
+		self.reloadConfig()
+		coordinator = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				path = urllib.parse.urlsplit(self.path).path
+				if path == '/fleet':
+					self.reply(200, json.dumps(coordinator.summary()).encode('utf-8'))
+				elif path == '/metrics':
+					self.reply(200, coordinator.renderMetrics().encode('utf-8'), 'text/plain; version=0.0.4')
+				else:
+					self.reply(404, b'{"error": "not found"}')
+
+			def do_POST(self):
+				if urllib.parse.urlsplit(self.path).path != '/report':
+					self.reply(404, b'{"error": "not found"}')
+					return
+				if coordinator.token and self.headers.get('Authorization') != 'Bearer ' + coordinator.token:
+					self.reply(401, b'{"error": "unauthorized"}')
+					return
+				try:
+					body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+					if self.headers.get('Content-Encoding') == 'deflate':
+						body = zlib.decompress(body)
+					reply = coordinator.receive(json.loads(body.decode('utf-8')))
+				except (ValueError, KeyError, TypeError, zlib.error) as e:
+					self.reply(400, json.dumps({'error': str(e)}).encode('utf-8'))
+					return
+				self.reply(200, json.dumps(reply).encode('utf-8'))
+
+			def reply(self, code, body, content_type='application/json'):
+				self.send_response(code)
+				self.send_header('Content-Type', content_type)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+		self.httpd.daemon_threads = True
+		self.url = 'http://' + host + ':' + str(self.httpd.server_address[1])
+		self._thread = threading.Thread(target=self.httpd.serve_forever, name='FleetCoordinator', daemon=True)
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def reloadConfig(self):
+		# Rereads the fleet file if it changed. An invalid file is reported and the previous one kept.
+		if not self.config_path:
+			return
+		try:
+			st = os.stat(self.config_path)
+		except OSError:
+			return
+		if (st.st_mtime_ns, st.st_size) == self._config_stat:
+			return
+		self._config_stat = (st.st_mtime_ns, st.st_size)
+		try:
+			with open(self.config_path, 'r') as f:
+				data = yaml.load(f, Loader=cfg.SafeLoader) or {}
+			fleet = {'all': data.get('all') or {}, 'hosts': data.get('hosts') or {}}
+			errors = []
+			for name, settings in [('all', fleet['all'])] + sorted(fleet['hosts'].items()):
+				if not isinstance(settings, dict):
+					errors.append(str(name) + ': must be a mapping')
+					continue
+				if 'FLEET' in settings:
+					errors.append(str(name) + ': FLEET cannot be set from the coordinator')
+				errors += [str(name) + ': ' + e for e in cfg.validate(dict(fleet['all'], **settings))]
+		except (OSError, AttributeError, yaml.YAMLError) as e:
+			errors = [str(e)]
+		if errors:
+			print('Fleet config not applied: ' + '; '.join(errors))
+			return
+		self.fleet_config = fleet
+		print('Fleet config loaded: ' + str(len(fleet['all'])) + ' keys for all hosts, ' +
+			  str(len(fleet['hosts'])) + ' hosts with their own')
+
+	def settingsFor(self, name):
+		settings = dict(self.fleet_config['all'])
+		settings.update(self.fleet_config['hosts'].get(name) or {})
+		return settings
+
+	def receive(self, data):
+		# Applies an agent's batch of reports; returns the reply (acknowledged report, resync request, config)
+		self.reloadConfig()
+		name = str(data['host'])
+		with self._lock:
+			host = self.hosts.get(name)
+			if host is None:
+				host = self.hosts[name] = HostState(name)
+			host.last_seen = self.clock()
+			host.backlog = data.get('backlog', 0)
+			host.config_version = data.get('config_version')
+			resync = False
+			for report in data['reports']:
+				if report['seq'] <= (host.seq or 0) and not report['full']:
+					continue  # Already applied (the agent did not get our reply)
+				if report['full']:
+					host.status = dict(report['changes'])
+				elif report['base'] == host.seq:
+					self._integrate(host, report['time'])
+					host.status.update(report['changes'])
+					host.status = {key: value for key, value in host.status.items() if value is not None}
+				else:
+					resync = True
+					host.resyncs += 1
+					break
+				host.seq = report['seq']
+				host.report_time = report['time']
+				host.reports += 1
+			if host.seq is None:
+				resync = True
+			reply = {'ack': host.seq, 'resync': resync}
+			settings = self.settingsFor(name)
+			version = configVersion(settings)
+			if version != host.config_version:
+				reply['config'] = {'version': version, 'settings': settings}
+			return reply
+
+	def _integrate(self, host, until):
+		# Adds the hashes mined at the last reported hashrate since the last report
+		if host.report_time is None:
+			return
+		elapsed = until - host.report_time
+		if not 0 < elapsed <= MAX_GAP or host.status.get('state') not in ('mining', 'manual'):
+			return
+		for unit, rate in (host.status.get('hashrate') or {}).items():
+			host.hashes[unit] = host.hashes.get(unit, 0) + (rate or 0) * elapsed
+
+	def hostSummary(self, host, now):
+		status = host.status
+		failing = [{'name': m.get('name'), 'health': m.get('health'), 'reason': m.get('reason')}
+				   for m in status.get('miners') or [] if m.get('health', 'healthy') not in HEALTHY_STATES]
+		return {'online': now - host.last_seen <= self.stale, 'last_seen': host.last_seen,
+				'state': status.get('state'), 'hashrate': status.get('hashrate') or {}, 'hashes': dict(host.hashes),
+				'failing': failing, 'backlog': host.backlog, 'reports': host.reports, 'resyncs': host.resyncs,
+				'config_current': host.config_version == configVersion(self.settingsFor(host.name))}
+
+	def summary(self):
+		# Fleet totals (hashrate of online hosts, hashes mined by all) and per-host health
+		now = self.clock()
+		with self._lock:
+			hosts = {name: self.hostSummary(host, now) for name, host in sorted(self.hosts.items())}
+		hashrate = {}
+		hashes = {}
+		for h in hosts.values():
+			for unit, rate in h['hashrate'].items():
+				if h['online']:
+					hashrate[unit] = hashrate.get(unit, 0) + (rate or 0)
+			for unit, total in h['hashes'].items():
+				hashes[unit] = hashes.get(unit, 0) + total
+		return {'hosts': hosts, 'hashrate': hashrate, 'hashes': hashes,
+				'online': sum(1 for h in hosts.values() if h['online']),
+				'mining': sum(1 for h in hosts.values() if h['online'] and h['state'] in ('mining', 'manual')),
+				'failing': sum(1 for h in hosts.values() if h['online'] and h['failing']),
+				'time': now}
+
+	def renderMetrics(self):
+		fleet = self.summary()
+		label = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		lines = ['# HELP idleminer_fleet_hosts Hosts by status.', '# TYPE idleminer_fleet_hosts gauge']
+		for key in ('online', 'mining', 'failing'):
+			lines.append('idleminer_fleet_hosts{status="' + key + '"} ' + str(fleet[key]))
+		lines += ['# HELP idleminer_fleet_host_up 1 if the host reported recently.',
+				  '# TYPE idleminer_fleet_host_up gauge']
+		for name, h in fleet['hosts'].items():
+			lines.append('idleminer_fleet_host_up{host="' + label(name) + '"} ' + ('1' if h['online'] else '0'))
+		lines += ['# HELP idleminer_fleet_hashrate Current hashrate per host.', '# TYPE idleminer_fleet_hashrate gauge']
+		for name, h in fleet['hosts'].items():
+			for unit, rate in sorted(h['hashrate'].items()):
+				lines.append('idleminer_fleet_hashrate{host="' + label(name) + '",unit="' + label(unit) + '"} ' +
+							 repr(float(rate or 0)))
+		lines += ['# HELP idleminer_fleet_hashes_total Hashes mined per host, from the reported hashrate.',
+				  '# TYPE idleminer_fleet_hashes_total counter']
+		for name, h in fleet['hosts'].items():
+			for unit, total in sorted(h['hashes'].items()):
+				lines.append('idleminer_fleet_hashes_total{host="' + label(name) + '",unit="' + label(unit) + '"} ' +
+							 repr(float(total)))
+		return '\n'.join(lines) + '\n'
+
+
+class SimulatedHost():
+	# Status of a made-up miner for load-testing a coordinator: mines and idles at random, hashrate wanders
+	def __init__(self, name):
+		self.name = name
+		self.state = 'idle'
+		self.rate = random.uniform(200, 800)
+		self.config = {}
+
+	def status(self):
+		if random.random() < 0.05:
+			self.state = 'mining' if self.state == 'idle' else 'idle'
+		self.rate = max(0, self.rate * random.uniform(0.97, 1.03))
+		mining = self.state == 'mining'
+		return {'state': self.state, 'hashrate': {'Sol/s': round(self.rate, 1)} if mining else {},
+				'miners': [{'name': 'gpu', 'state': 'running' if mining else 'stopped', 'health': 'healthy'}],
+				'timer': {'seconds': self.config.get('IDLE_TIMER', 300), 'enabled': True}}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='IdleMiner fleet coordinator, or simulated agents to test one.')
+	commands = parser.add_subparsers(dest='command', required=True)
+	serve = commands.add_parser('coordinator', help='Collect agent reports and push the fleet config')
+	serve.add_argument('--host', default='127.0.0.1')
+	serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+	serve.add_argument('--config', help='Fleet config file (keys for all hosts and per host)')
+	serve.add_argument('--token', help='Shared secret agents must send')
+	agents = commands.add_parser('agents', help='Run simulated agents against a coordinator')
+	agents.add_argument('--coordinator', default='http://127.0.0.1:' + str(DEFAULT_PORT))
+	agents.add_argument('--count', type=int, default=10)
+	agents.add_argument('--interval', type=float, default=1)
+	agents.add_argument('--flush', type=float, default=5)
+	agents.add_argument('--token')
+	args = parser.parse_args()
+
+	if args.command == 'coordinator':
+		coordinator = FleetCoordinator(args.host, args.port, args.config, args.token).start()
+		print('Fleet coordinator listening on ' + coordinator.url + ', Ctrl+C to stop.')
+		if args.host not in ('127.0.0.1', 'localhost', '::1') and not args.token:
+			print('Warning: no --token; anyone who can reach the coordinator can push config to the fleet.')
+		try:
+			while True:
+				time.sleep(1)
+		except KeyboardInterrupt:
+			coordinator.stop()
+	else:
+		running = []
+		for i in range(args.count):
+			host = SimulatedHost('sim-' + str(i + 1))
+			agent = FleetAgent(args.coordinator, host.status, host.config.update, name=host.name,
+							   interval=args.interval, flush=args.flush, token=args.token)
+			running.append(agent)
+			agent.start()
+		print(str(args.count) + ' simulated agents reporting to ' + args.coordinator + ', Ctrl+C to stop.')
+		try:
+			while True:
+				time.sleep(1)
+		except KeyboardInterrupt:
+			sys.exit(0)
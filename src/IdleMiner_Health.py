@@ -0,0 +1,222 @@
+import time
+import asyncio
+import collections
+
+import IdleMiner_Orchestrator as orch
+
+# Miner health watchdog.
+#
+# A miner that crashes, loses its pool or hangs at 0 Sol/s leaves IdleMiner 'mining' nothing until the user
+# returns. While mining, a MinerWatchdog checks every selected miner every few seconds:
+#
+#	exited		The process exited without being asked to
+#	stalled		No hashrate reading for 'stall' seconds (hung, or printing nothing but pool reconnect errors),
+#				or none within 'warmup' seconds of starting
+#	no_hashrate	Only zero readings for 'zero' seconds
+#	degraded	Hashrate over the last 'zero' seconds below 'decay' x the best 'decay_window' average of this run
+#	rejecting	At least 'reject_min' rejected shares, and more than 'reject_ratio' of all shares, in 'decay_window'
+#
+# A failed miner is stopped at once (so a hung one frees its GPU) and started again after a backoff that doubles
+# with each consecutive failure, from 'backoff' up to 'backoff_max' seconds. Once it has run healthy for
+# 'backoff_max' seconds the backoff starts over. If it needs more than 'max_restarts' restarts within
+# 'restart_window' seconds it is crash-looping (bad overclock, wrong pool address): the breaker opens, the
+# miner is left stopped for 'breaker_cooldown' seconds, and then gets another chance.
+#
+# Paused miners (suspend mode, throttle, thermal governor) are not checked. After a fresh start, including
+# restarts by the throttle or governor, a miner gets 'warmup' seconds before the hashrate checks apply.
+
+# Health states
+STARTING = 'starting'  # Warming up after a start
+HEALTHY = 'healthy'
+PAUSED = 'paused'
+BACKOFF = 'backoff'  # Stopped after a failure, waiting to restart
+FAILED = 'failed'  # Crash loop: breaker open, waiting for the cooldown
+EXITED = 'exited'
+STALLED = 'stalled'
+NO_HASHRATE = 'no_hashrate'
+DEGRADED = 'degraded'
+REJECTING = 'rejecting'
+
+FAILURES = (EXITED, STALLED, NO_HASHRATE, DEGRADED, REJECTING)
+
+
+class MinerHealth():
+	# Watchdog state of one miner
+	def __init__(self, now):
+		self.state = STARTING
+		self.reason = ''
+		self.since = now  # When the state was entered
+		self.run = None  # (starts, resumes) of the miner when last checked; changes on every start or resume
+		self.grace_until = now
+		self.baseline = None  # Best decay_window average of the current run
+		self.failures = 0  # Consecutive failures, for the backoff
+		self.restarts = collections.deque()  # Times of recent restarts, for the breaker
+		self.total_restarts = 0
+		self.retry_at = None
+
+
+class MinerWatchdog():
+	def __init__(self, orchestrator, interval=5, warmup=120, stall=60, zero=60, decay=0.5, decay_window=300,
+				 reject_ratio=0.3, reject_min=5, backoff=10, backoff_max=600, max_restarts=5, restart_window=30*60,
+				 breaker_cooldown=30*60, onChange=None, clock=time.time):
+		self.orchestrator = orchestrator
+		self.interval = interval
+		self.warmup = warmup
+		self.stall = stall
+		self.zero = zero
+		self.decay = decay
+		self.decay_window = decay_window
+		self.reject_ratio = reject_ratio
+		self.reject_min = reject_min
+		self.backoff = backoff
+		self.backoff_max = backoff_max
+		self.max_restarts = max_restarts
+		self.restart_window = restart_window
+		self.breaker_cooldown = breaker_cooldown
+		self.onChange = onChange  # Called as onChange(profile name, MinerHealth) when a miner's state changes
+		self.clock = clock
+		self.health = {}  # Profile name -> MinerHealth
+		self._future = None
+
+	def check(self, m, h, now):
+		# Returns (state, reason) for an active or exited miner. Samples are stamped with time.time().
+		if m.state == orch.PAUSED:
+			return PAUSED, 'paused by ' + str(m.paused_by)
+		if m.state == orch.EXITED:
+			return EXITED, 'exit code ' + str(m.returncode)
+
+		run = (m.starts, m.resumes)
+		if run != h.run:
+			fresh = h.run is None or run[0] != h.run[0]
+			h.run = run
+			h.grace_until = now + (self.warmup if fresh else self.stall)
+			if fresh:
+				h.baseline = None
+
+		if now < h.grace_until:
+			return STARTING, 'warming up'
+		samples = m.output.samples.items()
+		if not samples:
+			return STALLED, 'no hashrate reading ' + str(self.warmup) + ' s after start'
+		if now - samples[-1].time >= self.stall:
+			return STALLED, 'no hashrate reading for ' + str(int(now - samples[-1].time)) + ' s'
+
+		recent = [s for s in samples if now - s.time <= self.zero]
+		if now - h.grace_until >= self.zero and recent and not any(s.hashrate for s in recent):
+			return NO_HASHRATE, 'zero hashrate for ' + str(self.zero) + ' s'
+
+		window = [s for s in samples if now - s.time <= self.decay_window and s.time >= h.grace_until]
+		rates = [s.hashrate for s in window if s.hashrate is not None]
+		if rates and now - h.grace_until >= self.decay_window:
+			average = sum(rates) / len(rates)
+			h.baseline = max(h.baseline or 0, average)
+		current = [s.hashrate for s in recent if s.hashrate is not None]
+		if h.baseline and current and sum(current) / len(current) < self.decay * h.baseline:
+			return DEGRADED, ('hashrate ' + str(round(sum(current) / len(current), 1)) + ', below ' +
+							  str(int(self.decay * 100)) + '% of ' + str(round(h.baseline, 1)))
+
+		if window:
+			accepted = window[-1].accepted - window[0].accepted
+			rejected = window[-1].rejected - window[0].rejected
+			if rejected >= self.reject_min and rejected > self.reject_ratio * (accepted + rejected):
+				return REJECTING, str(rejected) + ' of ' + str(accepted + rejected) + ' shares rejected'
+		return HEALTHY, ''
+
+	def setState(self, name, h, state, reason, now):
+		h.reason = reason
+		if state == h.state:
+			return
+		h.state = state
+		h.since = now
+		if state not in (STARTING, HEALTHY, PAUSED):
+			print("Watchdog: '" + name + "' " + state + (" (" + reason + ")" if reason else ""))
+		if self.onChange:
+			self.onChange(name, h)
+
+	async def tick(self):
+		now = self.clock()
+		for m in self.orchestrator.miners:
+			name = m.profile.name
+			if name not in self.orchestrator.selected:
+				self.health.pop(name, None)
+				continue
+			h = self.health.get(name)
+			if h is None:
+				h = self.health[name] = MinerHealth(now)
+
+			if h.state in (BACKOFF, FAILED):
+				if now >= h.retry_at:
+					await self.restart(m, h, now)
+				elif h.state == FAILED and m.isActive():
+					await m.stop()  # Started again with the other miners; the breaker is still open
+				continue
+			if not (m.isActive() or m.state in (orch.PAUSED, orch.EXITED)):
+				continue  # Stopped on purpose (profit switching, pause expiry); not ours to restart
+
+			state, reason = self.check(m, h, now)
+			if state in FAILURES:
+				await self.fail(m, h, state, reason, now)
+				continue
+			if state == HEALTHY and h.failures and now - h.since >= self.backoff_max:
+				h.failures = 0
+			self.setState(name, h, state, reason, now)
+
+	async def fail(self, m, h, state, reason, now):
+		name = m.profile.name
+		self.setState(name, h, state, reason, now)
+		if m.state != orch.STOPPED:
+			await m.stop()
+		h.failures += 1
+		while h.restarts and now - h.restarts[0] > self.restart_window:
+			h.restarts.popleft()
+		if len(h.restarts) >= self.max_restarts:
+			h.retry_at = now + self.breaker_cooldown
+			h.restarts.clear()
+			self.setState(name, h, FAILED, 'crash loop: ' + str(self.max_restarts) + ' restarts in ' +
+						  str(int(self.restart_window / 60)) + ' min, retrying in ' +
+						  str(int(self.breaker_cooldown / 60)) + ' min', now)
+		else:
+			delay = min(self.backoff_max, self.backoff * 2 ** (h.failures - 1))
+			h.retry_at = now + delay
+			self.setState(name, h, BACKOFF, 'restarting in ' + str(int(delay)) + ' s', now)
+
+	async def restart(self, m, h, now):
+		h.restarts.append(now)
+		h.total_restarts += 1
+		h.run = None
+		print("Watchdog: restarting '" + m.profile.name + "'")
+		try:
+			await m.start(self.orchestrator.optionsFor(m))
+		except Exception as e:
+			print("Watchdog: '" + m.profile.name + "' failed to start: " + repr(e))
+			m.state = orch.EXITED
+		self.setState(m.profile.name, h, STARTING, 'restarted', now)
+
+	def status(self):
+		# Profile name -> {'health', 'reason', 'restarts'}
+		return {name: {'health': h.state, 'reason': h.reason, 'restarts': h.total_restarts}
+				for name, h in self.health.items()}
+
+	async def run(self):
+		while True:
+			try:
+				await self.tick()
+			except Exception as e:
+				print("Watchdog: " + repr(e))
+			await asyncio.sleep(self.interval)
+
+	def start(self):
+		# Starts checking on the orchestrator loop (called when mining starts). Failure counts carry over, so a
+		# miner that crash-looped is not retried at full speed every time the user leaves.
+		if self._future is None:
+			for h in self.health.values():
+				h.run = None
+				if h.state != FAILED:
+					h.state = STARTING
+					h.reason = ''
+			self._future = asyncio.run_coroutine_threadsafe(self.run(), self.orchestrator.loop)
+
+	def stop(self):
+		if self._future is not None:
+			self._future.cancel()
+			self._future = None
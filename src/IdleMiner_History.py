@@ -0,0 +1,330 @@
+import time
+import queue
+import socket
+import sqlite3
+import threading
+
+import IdleMiner_Events as events
+
+# Mining history.
+#
+# Every mining session (from the miners being started until they are stopped or paused) is recorded in a local
+# SQLite database, with its start and stop reasons, duration, idle-detection lag (how long after the idle timer
+# ran out the scheduler noticed), warm-up time (start until the first hashrate reading) and the parsed hashrate
+# samples. Callers never touch the database: SessionRecorder queues rows, and one writer thread inserts them in
+# batches, one transaction per batch.
+#
+# Samples are also added up into minute, hour and day rollups as they are written, so totals never need a scan
+# of the raw samples. Hashes are estimated as hashrate x seconds since that miner's previous sample (in the unit
+# the miner reports, e.g. Sol/s x s = Sol). Old rows are deleted by a retention policy: raw samples are kept for
+# days, minute rollups for weeks, hour rollups for months and day rollups for years, so the database stays small.
+# Rollup buckets follow local time: a day bucket starts at local midnight (and lasts 23 or 25 hours when the clocks
+# change), and minute and hour buckets start on the local minute and hour, also in time zones with a half-hour
+# offset.
+
+PERIODS = (('minute', 60), ('hour', 60*60), ('day', 24*60*60))
+
+# Days to keep each kind of row
+DEFAULT_RETENTION = {'samples': 2, 'minute': 14, 'hour': 180, 'day': 3650, 'sessions': 365}
+
+
+def bucketStart(period, seconds, t):
+	# Start of the local-time bucket of 'period' containing time t
+	local = time.localtime(t)
+	if period == 'day':
+		return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+	return int((t + local.tm_gmtoff) // seconds * seconds - local.tm_gmtoff)
+
+
+def daysBefore(days, t):
+	# Local midnight starting the day 'days' calendar days before the day of t (days=0 is the 'day' bucket of
+	# t), so a clock change in between does not shift it to the wrong day
+	local = time.localtime(t)
+	return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday - days, 0, 0, 0, 0, 0, -1)))
+
+
+MAX_GAP = 60  # Seconds a sample can stand for; longer gaps between samples (e.g. a stalled miner) count as this
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+	id INTEGER PRIMARY KEY,
+	machine TEXT NOT NULL,
+	start REAL NOT NULL,
+	stop REAL,
+	start_reason TEXT,
+	stop_reason TEXT,
+	duration REAL,
+	idle_lag REAL,
+	warmup REAL,
+	profiles TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_start ON sessions (start);
+CREATE TABLE IF NOT EXISTS samples (
+	session INTEGER NOT NULL,
+	time REAL NOT NULL,
+	machine TEXT NOT NULL,
+	profile TEXT NOT NULL,
+	unit TEXT NOT NULL,
+	hashrate REAL NOT NULL,
+	hashes REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_time ON samples (time);
+CREATE TABLE IF NOT EXISTS rollups (
+	period TEXT NOT NULL,
+	bucket INTEGER NOT NULL,
+	machine TEXT NOT NULL,
+	profile TEXT NOT NULL,
+	unit TEXT NOT NULL,
+	samples INTEGER NOT NULL,
+	hashrate_sum REAL NOT NULL,
+	hashes REAL NOT NULL,
+	PRIMARY KEY (period, bucket, machine, profile, unit)
+);
+'''
+
+
+class HistoryStore():
+	# Owns the database file. record*() only queue rows; the writer thread inserts them every 'flush_interval'
+	# seconds or once 'batch_size' rows are waiting. Queries open their own connection and may run on any thread.
+
+	def __init__(self, path, retention=None, flush_interval=5.0, batch_size=500, prune_interval=60*60):
+		self.path = path
+		self.retention = dict(DEFAULT_RETENTION)
+		self.retention.update(retention or {})
+		self.flush_interval = flush_interval
+		self.batch_size = batch_size
+		self.prune_interval = prune_interval
+		self.batches = 0
+		self.rows = 0
+		self.last_prune = 0
+		self._queue = queue.Queue()
+		self._flushed = threading.Condition()
+		self._queued = 0
+		self._written = 0
+
+		db = self.connect()
+		db.executescript(SCHEMA)
+		self.last_session = db.execute('SELECT coalesce(max(id), 0) FROM sessions').fetchone()[0]
+		db.close()
+		self._thread = threading.Thread(target=self._run, name='HistoryWriter', daemon=True)
+
+	def connect(self):
+		db = sqlite3.connect(self.path, timeout=10)
+		db.execute('PRAGMA journal_mode=WAL')  # Queries don't wait for the writer
+		return db
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def setRetention(self, retention):
+		self.retention = dict(DEFAULT_RETENTION)
+		self.retention.update(retention or {})
+
+	def newSessionId(self):
+		self.last_session += 1
+		return self.last_session
+
+	def recordSession(self, row):
+		# 'row' is a dict of sessions columns; a session is recorded when it starts and again when it ends
+		self._put(('session', row))
+
+	def recordSample(self, row):
+		# 'row' is a dict of samples columns
+		self._put(('sample', row))
+
+	def _put(self, item):
+		with self._flushed:
+			self._queued += 1
+		self._queue.put(item)
+
+	def flush(self, timeout=None):
+		# Waits until everything queued so far is written
+		with self._flushed:
+			target = self._queued
+			return self._flushed.wait_for(lambda: self._written >= target, timeout)
+
+	def close(self, timeout=10):
+		self._queue.put(None)
+		if self._thread.is_alive():
+			self._thread.join(timeout)
+
+	def _run(self):
+		db = self.connect()
+		try:
+			closing = False
+			while not closing:
+				batch = []
+				deadline = None
+				while len(batch) < self.batch_size:
+					try:
+						if deadline is None:
+							item = self._queue.get(timeout=self.prune_interval)
+							deadline = time.monotonic() + self.flush_interval
+						else:
+							item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+					except queue.Empty:
+						break
+					if item is None:
+						closing = True
+						break
+					batch.append(item)
+				try:
+					if batch:
+						self._write(db, batch)
+					if time.time() - self.last_prune >= self.prune_interval:
+						self.prune(db)
+				except sqlite3.Error as e:
+					print("Could not write mining history: " + repr(e))
+				with self._flushed:
+					self._written += len(batch)
+					self._flushed.notify_all()
+		finally:
+			db.close()
+
+	def _write(self, db, batch):
+		sessions = {}
+		samples = []
+		rollups = {}
+		for kind, row in batch:
+			if kind == 'session':
+				sessions[row['id']] = row  # The latest record of a session wins
+			else:
+				samples.append(row)
+				for period, seconds in PERIODS:
+					key = (period, bucketStart(period, seconds, row['time']), row['machine'], row['profile'], row['unit'])
+					n, rate, hashes = rollups.get(key, (0, 0.0, 0.0))
+					rollups[key] = (n + 1, rate + row['hashrate'], hashes + row['hashes'])
+
+		with db:
+			db.executemany('INSERT OR REPLACE INTO sessions (id, machine, start, stop, start_reason, stop_reason, '
+						   'duration, idle_lag, warmup, profiles) VALUES (:id, :machine, :start, :stop, '
+						   ':start_reason, :stop_reason, :duration, :idle_lag, :warmup, :profiles)',
+						   sessions.values())
+			db.executemany('INSERT INTO samples (session, time, machine, profile, unit, hashrate, hashes) '
+						   'VALUES (:session, :time, :machine, :profile, :unit, :hashrate, :hashes)', samples)
+			db.executemany('INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+						   'ON CONFLICT (period, bucket, machine, profile, unit) DO UPDATE SET '
+						   'samples = samples + excluded.samples, hashrate_sum = hashrate_sum + excluded.hashrate_sum, '
+						   'hashes = hashes + excluded.hashes',
+						   [key + value for key, value in rollups.items()])
+		self.batches += 1
+		self.rows += len(batch)
+
+	def prune(self, db, now=None):
+		# Deletes rows older than the retention policy allows
+		now = now if now is not None else time.time()
+		day = 24*60*60
+		with db:
+			db.execute('DELETE FROM samples WHERE time < ?', (now - self.retention['samples'] * day,))
+			db.execute('DELETE FROM sessions WHERE start < ?', (now - self.retention['sessions'] * day,))
+			for period, seconds in PERIODS:
+				db.execute('DELETE FROM rollups WHERE period = ? AND bucket < ?',
+						   (period, now - self.retention[period] * day))
+		self.last_prune = now
+
+	# Queries
+
+	def hashesPerDay(self, since=None, until=None, machine=None, profile=None):
+		# List of (local midnight starting the day, machine, profile, unit, hashes), from the day rollups
+		return self._query('SELECT bucket, machine, profile, unit, hashes FROM rollups WHERE period = \'day\'',
+						   'bucket', since, until, machine, profile, 'ORDER BY bucket, machine, profile')
+
+	def hashrate(self, period='hour', since=None, until=None, machine=None, profile=None):
+		# List of (period start, machine, profile, unit, average hashrate) for 'minute', 'hour' or 'day'
+		if period not in dict(PERIODS):
+			raise ValueError('period must be one of ' + ', '.join(p for p, s in PERIODS))
+		return self._query('SELECT bucket, machine, profile, unit, hashrate_sum / samples FROM rollups '
+						   'WHERE period = \'' + period + '\'',
+						   'bucket', since, until, machine, profile, 'ORDER BY bucket, machine, profile')
+
+	def sessions(self, since=None, until=None, machine=None):
+		# Session records (as dicts), oldest first
+		db = self.connect()
+		try:
+			db.row_factory = sqlite3.Row
+			rows = self._select(db, 'SELECT * FROM sessions WHERE 1', 'start', since, until, machine, None,
+								'ORDER BY start')
+			return [dict(r) for r in rows]
+		finally:
+			db.close()
+
+	def _query(self, sql, time_column, since, until, machine, profile, order):
+		db = self.connect()
+		try:
+			return [tuple(r) for r in self._select(db, sql, time_column, since, until, machine, profile, order)]
+		finally:
+			db.close()
+
+	def _select(self, db, sql, time_column, since, until, machine, profile, order):
+		params = []
+		for column, op, value in ((time_column, '>=', since), (time_column, '<', until),
+								  ('machine', '=', machine), ('profile', '=', profile)):
+			if value is not None:
+				sql += ' AND ' + column + ' ' + op + ' ?'
+				params.append(value)
+		return db.execute(sql + ' ' + order, params).fetchall()
+
+
+class SessionRecorder():
+	# Turns state machine transitions and hashrate samples into session and sample rows. Subscribe it to the
+	# event bus and call sample() for every parsed hashrate sample (from any thread).
+
+	def __init__(self, store, bus, machine=None, clock=time.time):
+		self.store = store
+		self.machine = machine or socket.gethostname()
+		self.clock = clock
+		self.session = None  # Row of the current session, or None when not mining
+		self.started = None  # Transition that started the current session
+		self.idle_lag = None  # From the last IDLE_DETECTED event
+		self.policy_rule = None  # From the last POLICY_STOP event
+		self._last = {}  # profile -> time of its previous sample in this session
+		self._lock = threading.Lock()
+		bus.subscribe([events.IDLE_DETECTED, events.POLICY_STOP, events.STATE], self.onEvent)
+
+	def onEvent(self, event):
+		if event.kind == events.IDLE_DETECTED:
+			self.idle_lag = event.data
+			return
+		if event.kind == events.POLICY_STOP:
+			self.policy_rule = event.data
+			return
+		transition = event.data
+		with self._lock:
+			if transition.new == events.STARTING and self.session is None:
+				self.started = transition
+				self.session = {'id': self.store.newSessionId(), 'machine': self.machine, 'start': self.clock(),
+								'stop': None, 'start_reason': transition.event, 'stop_reason': None,
+								'duration': None, 'warmup': None, 'profiles': None,
+								'idle_lag': self.idle_lag if transition.event == events.IDLE_DETECTED else None}
+				self._last = {}
+				self.store.recordSession(dict(self.session))
+			elif transition.new in (events.IDLE, events.PAUSED) and self.session is not None:
+				# Stopped, paused, or the start failed
+				failed = transition.old == events.STARTING
+				reason = transition.event
+				if reason == events.POLICY_STOP:
+					reason += ':' + str(self.policy_rule)  # e.g. policy_stop:window
+				self.session.update({'stop': self.clock(),
+									 'stop_reason': 'start_failed' if failed else reason,
+									 'duration': transition.time - self.started.time,
+									 'profiles': ','.join(sorted(self._last))})
+				self.store.recordSession(self.session)
+				self.session = None
+
+	def sample(self, managedMiner, sample):
+		if sample.hashrate is None:
+			return
+		with self._lock:
+			if self.session is None:
+				return
+			if self.session['warmup'] is None:
+				self.session['warmup'] = max(0.0, sample.time - self.session['start'])
+				self.store.recordSession(dict(self.session))
+			name = managedMiner.profile.name
+			previous = self._last.get(name)
+			self._last[name] = sample.time
+			seconds = min(sample.time - previous, MAX_GAP) if previous is not None else 0.0
+			self.store.recordSample({'session': self.session['id'], 'time': sample.time, 'machine': self.machine,
+									 'profile': name, 'unit': managedMiner.output.parser.UNIT,
+									 'hashrate': sample.hashrate, 'hashes': sample.hashrate * seconds})
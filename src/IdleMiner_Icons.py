@@ -0,0 +1,189 @@
+import os
+import itertools
+
+# Icon and menu bitmap handle cache for the tray.
+#
+# Loading an icon file and rendering it into a menu bitmap allocates GDI handles. Doing that on every right-click
+# and every icon change leaks handles over weeks of uptime and makes the menu lag, so SysTrayIcon loads each
+# icon once through an IconCache, keyed by (kind, path), and releases everything when the tray is destroyed.
+#
+# The cache talks to the OS through an IconBackend. Win32IconBackend does the real GDI work; FakeIconBackend
+# hands out numbered handles and tracks which are still alive, so the cache can be exercised without Windows.
+
+TRAY = 'tray'  # Full-size icon for the notification area
+MENU = 'menu'  # Small icon rendered onto a bitmap with the menu background colour
+
+
+class IconBackend():
+	# Base class for icon backends. Handles are opaque values.
+	def exists(self, path):
+		return os.path.isfile(path)
+
+	def loadIcon(self, path):
+		# Full-size icon from a file
+		raise NotImplementedError
+
+	def defaultIcon(self):
+		# Shared system icon; must not be destroyed
+		raise NotImplementedError
+
+	def loadMenuBitmap(self, path):
+		# Small icon from a file, drawn onto a bitmap usable as a menu item image
+		raise NotImplementedError
+
+	def destroyIcon(self, handle):
+		raise NotImplementedError
+
+	def deleteBitmap(self, handle):
+		raise NotImplementedError
+
+
+class Win32IconBackend(IconBackend):
+	def __init__(self, hwnd):
+		import win32api
+		import win32con
+		import win32gui
+		self.win32con = win32con
+		self.win32gui = win32gui
+		self.hwnd = hwnd
+		self.small_size = (win32api.GetSystemMetrics(win32con.SM_CXSMICON),
+						   win32api.GetSystemMetrics(win32con.SM_CYSMICON))
+
+	def loadIcon(self, path):
+		return self.win32gui.LoadImage(self.win32gui.GetModuleHandle(None), path, self.win32con.IMAGE_ICON, 0, 0,
+									   self.win32con.LR_LOADFROMFILE | self.win32con.LR_DEFAULTSIZE)
+
+	def defaultIcon(self):
+		return self.win32gui.LoadIcon(0, self.win32con.IDI_APPLICATION)
+
+	def loadMenuBitmap(self, path):
+		# Based on: https://stackoverflow.com/questions/45716730/add-image-in-window-tray-menu/45890829
+		win32gui = self.win32gui
+		win32con = self.win32con
+		ico_x, ico_y = self.small_size
+		hicon = win32gui.LoadImage(0, path, win32con.IMAGE_ICON, ico_x, ico_y, win32con.LR_LOADFROMFILE)
+
+		hwndDC = win32gui.GetWindowDC(self.hwnd)
+		memDC = win32gui.CreateCompatibleDC(hwndDC)
+		hbm = win32gui.CreateCompatibleBitmap(hwndDC, ico_x, ico_y)
+		oldBmp = win32gui.SelectObject(memDC, hbm)
+		brush = win32gui.GetSysColorBrush(win32con.COLOR_MENU)  # Cached by the system, not freed
+
+		win32gui.FillRect(memDC, (0, 0, ico_x, ico_y), brush)
+		win32gui.DrawIconEx(memDC, 0, 0, hicon, ico_x, ico_y, 0, 0, win32con.DI_NORMAL)
+
+		win32gui.SelectObject(memDC, oldBmp)
+		win32gui.DeleteDC(memDC)
+		win32gui.ReleaseDC(self.hwnd, hwndDC)
+		win32gui.DestroyIcon(hicon)  # Only the bitmap is kept
+		return hbm
+
+	def destroyIcon(self, handle):
+		self.win32gui.DestroyIcon(handle)
+
+	def deleteBitmap(self, handle):
+		self.win32gui.DeleteObject(handle)
+
+
+class FakeIconBackend(IconBackend):
+	# Numbered handles. 'files' is the set of paths that exist (all paths if None).
+	def __init__(self, files=None):
+		self.files = files
+		self.live = {}  # Handle -> (kind, path) for every handle allocated and not yet freed
+		self.loads = 0
+		self._ids = itertools.count(1)
+
+	def exists(self, path):
+		return self.files is None or path in self.files
+
+	def _allocate(self, kind, path):
+		handle = next(self._ids)
+		self.live[handle] = (kind, path)
+		self.loads += 1
+		return handle
+
+	def loadIcon(self, path):
+		return self._allocate(TRAY, path)
+
+	def defaultIcon(self):
+		return 0
+
+	def loadMenuBitmap(self, path):
+		return self._allocate(MENU, path)
+
+	def _free(self, handle, kind):
+		if self.live.get(handle, (None,))[0] != kind:
+			raise ValueError('Freeing ' + kind + ' handle ' + str(handle) + ' that is not live')
+		del self.live[handle]
+
+	def destroyIcon(self, handle):
+		self._free(handle, TRAY)
+
+	def deleteBitmap(self, handle):
+		self._free(handle, MENU)
+
+
+class IconCache():
+	def __init__(self, backend):
+		self.backend = backend
+		self.hits = 0
+		self.misses = 0
+		self._handles = {}  # (kind, path) -> handle
+		self._shared = set()  # Keys whose handle the cache does not own (default icon, missing menu icon)
+
+	def _get(self, kind, path, load):
+		key = (kind, path)
+		if key in self._handles:
+			self.hits += 1
+			return self._handles[key]
+		self.misses += 1
+		if self.backend.exists(path):
+			handle = load(path)
+		elif kind == TRAY:
+			print("Can't find icon file - using default.")
+			handle = self.backend.defaultIcon()
+			self._shared.add(key)
+		else:
+			print("Can't find menu icon file: " + str(path))
+			handle = None
+			self._shared.add(key)
+		self._handles[key] = handle
+		return handle
+
+	def trayIcon(self, path):
+		# Icon handle for the notification area
+		return self._get(TRAY, path, self.backend.loadIcon)
+
+	def menuBitmap(self, path):
+		# Bitmap handle for a menu item image
+		return self._get(MENU, path, self.backend.loadMenuBitmap)
+
+	def preload(self, tray_paths=(), menu_paths=()):
+		for path in tray_paths:
+			self.trayIcon(path)
+		for path in menu_paths:
+			self.menuBitmap(path)
+
+	def live(self):
+		# Number of handles the cache owns
+		return len(self._handles) - len(self._shared)
+
+	def _free(self, kinds):
+		for key, handle in list(self._handles.items()):
+			if key[0] not in kinds:
+				continue
+			if key not in self._shared:
+				if key[0] == MENU:
+					self.backend.deleteBitmap(handle)
+				else:
+					self.backend.destroyIcon(handle)
+			self._shared.discard(key)
+			del self._handles[key]
+
+	def releaseBitmaps(self):
+		# Frees the menu bitmaps, e.g. after a theme change so they are redrawn with the new menu colour
+		self._free((MENU,))
+
+	def release(self):
+		# Frees every handle; the cache can still be used afterwards and will reload on demand
+		self._free((TRAY, MENU))
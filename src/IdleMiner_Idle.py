@@ -0,0 +1,427 @@
+import os
+import sys
+import glob
+import time
+import math
+import select
+import struct
+import bisect
+import threading
+
+import IdleMiner_Policy as policy
+
+# Idle detection and scheduling.
+#
+# An IdleSource reports the number of seconds since the last user input and knows how to sleep until either a
+# deadline passes or (while mining) new input arrives. The IdleScheduler samples the source once per pass,
+# works out the earliest time a threshold could possibly be crossed, and sleeps until then. This replaces the
+# old loop that woke every second and kept the CPU out of deep C-states.
+#
+# Backends:
+#	Win32IdleSource		GetLastInputInfo/GetTickCount (same method as before, without the uptime library)
+#	LinuxIdleSource		evdev devices under /dev/input (needs read access, i.e. the 'input' group)
+#	X11IdleSource		XScreenSaver extension, used on Linux when /dev/input is not readable
+#	HeadlessIdleSource	No user input at all (servers, mining rigs); always idle
+#	FakeIdleSource		Virtual clock with scripted input events, for tests and simulation
+
+
+class IdleSource():
+	# Base class for idle-time backends. Subclasses must implement getIdleTime().
+
+	def __init__(self):
+		self._wakeEvent = threading.Event()
+
+	def now(self):
+		# Monotonic clock used by the scheduler for deadlines
+		return time.monotonic()
+
+	def getIdleTime(self):
+		# Returns seconds since last user input
+		raise NotImplementedError
+
+	def sleep(self, timeout):
+		# Sleeps for 'timeout' seconds (None = forever) or until interrupt() is called.
+		# Returns True if interrupted early.
+		woke = self._wakeEvent.wait(timeout)
+		self._wakeEvent.clear()
+		return woke
+
+	def waitForInput(self, timeout):
+		# Like sleep(), but also returns early (True) as soon as user input is detected.
+		# The base implementation has no input notification, so it only honours interrupt().
+		return self.sleep(timeout)
+
+	def interrupt(self):
+		# Wakes up a pending sleep() or waitForInput(). Safe to call from any thread.
+		self._wakeEvent.set()
+
+	def close(self):
+		pass
+
+
+class Win32IdleSource(IdleSource):
+	# The Windows API function GetLastInputInfo returns the tick count (ms since boot) of the last user input.
+	# Comparing it against GetTickCount rather than uptime.uptime() keeps both values on the same 32-bit clock,
+	# so the difference stays correct when the tick counter wraps after 49.7 days.
+	# Reference:
+	#	https://msdn.microsoft.com/en-us/library/windows/desktop/ms646302(v=vs.85).aspx
+	#
+	# Windows has no cheap blocking notification for input without installing global hooks, so waitForInput()
+	# polls GetLastInputInfo every INPUT_POLL seconds. It is only used while the miner is running, when the
+	# machine is busy anyway, so this does not cost any idle-state residency.
+
+	INPUT_POLL = 0.05
+
+	def __init__(self):
+		IdleSource.__init__(self)
+		import win32api
+		self._win32api = win32api
+
+	def getIdleTime(self):
+		idle_milliseconds = (self._win32api.GetTickCount() - self._win32api.GetLastInputInfo()) & 0xFFFFFFFF
+		return idle_milliseconds / 1000
+
+	def waitForInput(self, timeout):
+		lastInput = self._win32api.GetLastInputInfo()
+		deadline = None if timeout is None else self.now() + timeout
+
+		while True:
+			if deadline is None:
+				wait = self.INPUT_POLL
+			else:
+				wait = min(self.INPUT_POLL, deadline - self.now())
+				if wait <= 0:
+					return False
+			if self.sleep(wait):
+				return True
+			if self._win32api.GetLastInputInfo() != lastInput:
+				return True
+
+
+class LinuxIdleSource(IdleSource):
+	# Reads the evdev input devices directly. Every input_event carries a kernel timestamp, so draining the
+	# devices' queues gives the exact time of the last input even if nothing was listening when it happened.
+	# waitForInput() blocks in select() on the device fds, so input wakes the scheduler within milliseconds.
+
+	# struct input_event { struct timeval time; __u16 type; __u16 code; __s32 value; }
+	EVENT_FORMAT = 'llHHi'
+	EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+	def __init__(self, device_glob='/dev/input/event*'):
+		IdleSource.__init__(self)
+		self._fds = []
+		for path in sorted(glob.glob(device_glob)):
+			try:
+				self._fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+			except OSError:
+				pass
+		if not self._fds:
+			raise OSError("No readable input devices matching " + device_glob)
+
+		# Self-pipe so that interrupt() can break out of select()
+		self._wakeRead, self._wakeWrite = os.pipe()
+		os.set_blocking(self._wakeRead, False)
+		os.set_blocking(self._wakeWrite, False)
+
+		self._lastInput = time.time()
+
+	def _drain(self, fds):
+		# Reads all pending events and updates the last input time from their timestamps
+		for fd in fds:
+			while True:
+				try:
+					data = os.read(fd, self.EVENT_SIZE * 64)
+				except BlockingIOError:
+					break
+				except OSError:
+					# Device unplugged
+					self._fds.remove(fd)
+					os.close(fd)
+					break
+				if not data:
+					break
+				for offset in range(0, len(data) - self.EVENT_SIZE + 1, self.EVENT_SIZE):
+					sec, usec, _, _, _ = struct.unpack_from(self.EVENT_FORMAT, data, offset)
+					self._lastInput = max(self._lastInput, sec + usec / 1e6)
+
+	def getIdleTime(self):
+		self._drain(list(self._fds))
+		return max(0.0, time.time() - self._lastInput)
+
+	def _select(self, fds, timeout):
+		try:
+			ready, _, _ = select.select(fds + [self._wakeRead], [], [], timeout)
+		except InterruptedError:
+			return []
+		if self._wakeRead in ready:
+			try:
+				while os.read(self._wakeRead, 64):
+					pass
+			except BlockingIOError:
+				pass
+		return ready
+
+	def sleep(self, timeout):
+		return bool(self._select([], timeout))
+
+	def waitForInput(self, timeout):
+		ready = self._select(list(self._fds), timeout)
+		self._drain([fd for fd in ready if fd != self._wakeRead])
+		return bool(ready)
+
+	def interrupt(self):
+		try:
+			os.write(self._wakeWrite, b'\0')
+		except BlockingIOError:
+			pass
+
+	def close(self):
+		for fd in self._fds + [self._wakeRead, self._wakeWrite]:
+			os.close(fd)
+		self._fds = []
+
+
+class X11IdleSource(IdleSource):
+	# Fallback for desktop sessions without access to /dev/input. XScreenSaverQueryInfo reports the
+	# server's idle time directly; there is no input notification, so waitForInput() polls like Win32.
+
+	INPUT_POLL = 0.05
+
+	def __init__(self):
+		IdleSource.__init__(self)
+		import ctypes
+		import ctypes.util
+
+		class XScreenSaverInfo(ctypes.Structure):
+			_fields_ = [('window', ctypes.c_ulong),
+						('state', ctypes.c_int),
+						('kind', ctypes.c_int),
+						('til_or_since', ctypes.c_ulong),
+						('idle', ctypes.c_ulong),
+						('eventMask', ctypes.c_ulong)]
+
+		xlib_path = ctypes.util.find_library('X11')
+		xss_path = ctypes.util.find_library('Xss')
+		if not xlib_path or not xss_path:
+			raise OSError("libX11/libXss not found")
+		self._xlib = ctypes.cdll.LoadLibrary(xlib_path)
+		self._xss = ctypes.cdll.LoadLibrary(xss_path)
+		self._xlib.XOpenDisplay.restype = ctypes.c_void_p
+		self._xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+		self._xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+		self._xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(XScreenSaverInfo)
+		self._xss.XScreenSaverQueryInfo.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XScreenSaverInfo)]
+
+		self._display = self._xlib.XOpenDisplay(None)
+		if not self._display:
+			raise OSError("Cannot open X display")
+		self._root = self._xlib.XDefaultRootWindow(self._display)
+		self._info = self._xss.XScreenSaverAllocInfo()
+
+	def getIdleTime(self):
+		self._xss.XScreenSaverQueryInfo(self._display, self._root, self._info)
+		return self._info.contents.idle / 1000
+
+	def waitForInput(self, timeout):
+		lastIdle = self.getIdleTime()
+		deadline = None if timeout is None else self.now() + timeout
+
+		while True:
+			if deadline is None:
+				wait = self.INPUT_POLL
+			else:
+				wait = min(self.INPUT_POLL, deadline - self.now())
+				if wait <= 0:
+					return False
+			if self.sleep(wait):
+				return True
+			idle = self.getIdleTime()
+			if idle < lastIdle:
+				return True
+			lastIdle = idle
+
+
+class FakeIdleSource(IdleSource):
+	# Virtual clock with a scripted list of input event times. sleep() and waitForInput() advance the clock
+	# instead of blocking, so the scheduler can be driven through hours of idle time instantly. Inputs are
+	# looked up by bisection, so week-long recorded traces (see IdleMiner_Simulator.py) replay in linear time.
+
+	def __init__(self, inputs=(), start=0.0):
+		IdleSource.__init__(self)
+		self.clock = start
+		self.inputs = sorted(inputs)
+		self._lastInput = start
+		self._interrupted = False
+
+	def now(self):
+		return self.clock
+
+	def addInput(self, t=None):
+		# Schedules an input event at time t (default: now)
+		if t is None:
+			t = self.clock
+		bisect.insort(self.inputs, t)
+
+	def advance(self, seconds):
+		self.clock += seconds
+
+	def _nextInput(self):
+		i = bisect.bisect_right(self.inputs, self._lastInput)
+		return self.inputs[i] if i < len(self.inputs) else None
+
+	def getIdleTime(self):
+		i = bisect.bisect_right(self.inputs, self.clock)
+		if i and self.inputs[i - 1] > self._lastInput:
+			self._lastInput = self.inputs[i - 1]
+		return self.clock - self._lastInput
+
+	def sleep(self, timeout):
+		if self._interrupted:
+			self._interrupted = False
+			return True
+		if timeout is None:
+			raise RuntimeError("FakeIdleSource cannot sleep forever")
+		self._advance(timeout)
+		return False
+
+	def waitForInput(self, timeout):
+		if self._interrupted:
+			self._interrupted = False
+			return True
+		self.getIdleTime()
+		nextInput = self._nextInput()
+		if nextInput is not None and (timeout is None or nextInput <= self.clock + timeout):
+			self.clock = max(self.clock, nextInput)
+			return True
+		if timeout is None:
+			raise RuntimeError("FakeIdleSource has no more input events")
+		self._advance(timeout)
+		return False
+
+	def _advance(self, timeout):
+		# A timeout computed as a difference of clock times can be smaller than the clock's float resolution, which
+		# would leave the clock where it is and the scheduler waking forever just short of a threshold
+		self.clock = max(self.clock + timeout, math.nextafter(self.clock, math.inf))
+
+	def interrupt(self):
+		self._interrupted = True
+
+
+class HeadlessIdleSource(IdleSource):
+	# For machines without an interactive user: idle time counts up from creation and there is never input,
+	# so mining starts once the idle timer has passed and only stops on request.
+
+	def __init__(self):
+		IdleSource.__init__(self)
+		self._created = self.now()
+
+	def getIdleTime(self):
+		return self.now() - self._created
+
+
+def createIdleSource(headless=False):
+	# Returns the best available idle source for this platform. With headless=True, falls back to
+	# HeadlessIdleSource instead of raising OSError when there is no way to observe user input.
+	try:
+		if sys.platform == 'win32':
+			return Win32IdleSource()
+		if sys.platform.startswith('linux'):
+			try:
+				return LinuxIdleSource()
+			except OSError:
+				return X11IdleSource()
+		raise OSError("No idle source available for platform " + sys.platform)
+	except OSError as e:
+		if not headless:
+			raise
+		print("No user input source (" + str(e) + "), treating the machine as always idle.")
+		return HeadlessIdleSource()
+
+
+class IdleScheduler():
+	# Deadline-driven replacement for the polling loop.
+	#
+	# Each pass samples idle time once and asks the PolicyEngine (see IdleMiner_Policy.py) what to do and how long
+	# that answer holds. By default mining starts once idle time reaches idle_timer, and stops when idle time drops
+	# below idle_timer/2. While not mining, idle time can only reach the start threshold idle_timer - idle seconds
+	# from now (input only pushes that further away), so the scheduler sleeps exactly that long and re-samples.
+	# While mining, the stop threshold can only be crossed by new input, so the scheduler blocks until input
+	# arrives (or until a policy rule's answer may change, e.g. at the end of a mining window).
+	#
+	# wake() must be called after any external change (timer length, manual start/stop, timer toggle) so the
+	# scheduler re-evaluates immediately. onIdle/onActive may act asynchronously (e.g. by posting an event); if
+	# the mining state has not changed when they return, the scheduler waits for the wake() that follows.
+
+	def __init__(self, source, idle_timer, onIdle, onActive, isMining, isEnabled, policy_engine=None):
+		self.source = source
+		self.idle_timer = idle_timer
+		self.onIdle = onIdle  # Called when the policy decides to start
+		self.onActive = onActive  # Called when the policy decides to stop; self.decision says which rule
+		self.isMining = isMining
+		self.isEnabled = isEnabled  # Returns False while the timer is disabled or overridden
+		self.policy = policy_engine or policy.PolicyEngine(policy.IdleRule(idle_timer), clock=source.now)
+		self.policy.setIdleTimer(idle_timer)
+		self.decision = None  # Last policy decision
+		self.onDecision = None  # Called with each decision that differs from the previous one in action or rule
+		self.wakeups = 0
+		self.detection_lag = None  # Seconds between mining becoming due and onIdle being called
+		self._deadline = None  # When the current sleep was meant to end
+		self._stopped = False
+
+	def setIdleTimer(self, idle_timer):
+		self.idle_timer = idle_timer
+		self.policy.setIdleTimer(idle_timer)
+		self.wake()
+
+	def wake(self):
+		self.source.interrupt()
+
+	def stop(self):
+		self._stopped = True
+		self.wake()
+
+	def step(self):
+		# Samples idle time once, fires any due transition, and returns (timeout, waitForInput) for the next wait.
+		# A timeout of 0 means re-evaluate immediately; None means wait until woken.
+		if not self.isEnabled():
+			return (None, False)
+
+		idle = self.source.getIdleTime()
+		mining = self.isMining()
+		decision = self.policy.decide(idle, mining)
+		previous, self.decision = self.decision, decision
+		if self.onDecision and (previous is None or decision[:2] != previous[:2]):
+			self.onDecision(decision)
+
+		if decision.action == policy.START:
+			# How late the start is: past the planned wake-up, but never more than the time spent over the threshold
+			lag = idle - self.policy.idle.start
+			if self._deadline is not None:
+				lag = min(lag, self.source.now() - self._deadline)
+			self.detection_lag = max(0.0, lag)
+			self.onIdle()
+			return (0, False) if self.isMining() else (None, False)
+		if decision.action == policy.STOP:
+			self.onActive()
+			return (0, False) if not self.isMining() else (None, False)
+		return (decision.timeout, decision.forInput)
+
+	def run(self, until=None):
+		# Runs until stop() is called, or until the source clock reaches 'until' (used with FakeIdleSource)
+		while not self._stopped:
+			timeout, forInput = self.step()
+			if timeout == 0:
+				continue
+
+			if until is not None:
+				remaining = until - self.source.now()
+				if remaining <= 0:
+					break
+				timeout = remaining if timeout is None else min(timeout, remaining)
+
+			self.wakeups += 1
+			self._deadline = self.source.now() + timeout if timeout is not None else None
+			if forInput:
+				self.source.waitForInput(timeout)
+			else:
+				self.source.sleep(timeout)
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import socket
+import secrets
+import threading
+import socketserver
+
+# Single-instance guard.
+#
+# The first IdleMiner process takes an OS lock on a byte of IdleMiner.lock and writes its pid, the port of a
+# small loopback command listener and a random token into the file. The OS drops the lock when the process
+# exits, however it exits, so a lock file left behind by a crashed instance is simply reclaimed by the next one.
+#
+# A later launch fails to take the lock, reads the port and token, sends its command (start, stop, pause, status,
+# quit) as one JSON line and prints the running instance's one-line JSON reply, then exits - it never loads the
+# miners. The token keeps other local users' processes from driving the listener, as only the owner can read it.
+
+LOCK_OFFSET = 1 << 20  # Locked byte, past the instance info, so the info stays readable while locked
+CONNECT_RETRIES = 20  # The running instance may still be starting up and not listening yet
+CONNECT_RETRY_DELAY = 0.1
+TIMEOUT = 5
+
+if sys.platform == 'win32':
+	import msvcrt
+
+	def _lock(fd):
+		os.lseek(fd, LOCK_OFFSET, os.SEEK_SET)
+		msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)  # Raises OSError if held
+
+	def _unlock(fd):
+		os.lseek(fd, LOCK_OFFSET, os.SEEK_SET)
+		msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+	import fcntl
+
+	def _lock(fd):
+		fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, LOCK_OFFSET)
+
+	def _unlock(fd):
+		fcntl.lockf(fd, fcntl.LOCK_UN, 1, LOCK_OFFSET)
+
+
+class InstanceError(Exception):
+	pass
+
+
+class InstanceGuard():
+	def __init__(self, path):
+		self.path = path
+		self.token = secrets.token_hex(16)
+		self.server = None
+		self.reclaimed = None  # Info left by a crashed instance, if its lock was reclaimed
+		self._fd = None
+
+	def acquire(self):
+		# True if this is now the only instance. Never truncates the file unless the lock was taken.
+		fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			_lock(fd)
+		except OSError:
+			os.close(fd)
+			return False
+		self._fd = fd
+		previous = self._readInfo()
+		if previous and previous.get('pid') != os.getpid():
+			self.reclaimed = previous
+			print("Reclaimed lock left by a previous instance (pid " + str(previous.get('pid')) + ").")
+		self._writeInfo(None)
+		return True
+
+	def _readInfo(self):
+		# Reads through the locked descriptor: closing any other descriptor of the file would drop a POSIX lock
+		os.lseek(self._fd, 0, os.SEEK_SET)
+		try:
+			return json.loads(os.read(self._fd, 4096).split(b'\n')[0].decode('utf-8'))
+		except ValueError:
+			return None
+
+	def _writeInfo(self, port):
+		info = json.dumps({'pid': os.getpid(), 'port': port, 'token': self.token}).encode('utf-8')
+		os.lseek(self._fd, 0, os.SEEK_SET)
+		os.ftruncate(self._fd, 0)
+		os.write(self._fd, info + b'\n')
+
+	def serve(self, handle):
+		# Starts the command listener. handle(command, params) returns a JSON-serialisable reply and runs on the
+		# listener thread; raising ValueError replies with an error.
+		guard = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			timeout = TIMEOUT
+
+			def handle(self):
+				try:
+					request = json.loads(self.rfile.readline().decode('utf-8'))
+					if request.get('token') != guard.token:
+						reply = {'error': 'bad token'}
+					else:
+						reply = handle(request.get('command'), request.get('params') or {})
+				except ValueError as e:
+					reply = {'error': str(e)}
+				self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+		self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, name='InstanceListener', daemon=True).start()
+		self._writeInfo(self.server.server_address[1])
+		return self
+
+	def release(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+		if self._fd is not None:
+			os.ftruncate(self._fd, 0)
+			_unlock(self._fd)
+			os.close(self._fd)
+			self._fd = None
+
+
+def readInfo(path):
+	# {'pid', 'port', 'token'} written by the instance holding the lock, or None
+	try:
+		with open(path, 'r') as f:
+			return json.loads(f.readline())
+	except (OSError, ValueError):
+		return None
+
+
+def forward(path, command, params=None):
+	# Sends a command to the running instance and returns its reply. Raises InstanceError if it cannot be reached.
+	for attempt in range(CONNECT_RETRIES):
+		info = readInfo(path)
+		if info and info.get('port'):
+			try:
+				with socket.create_connection(('127.0.0.1', info['port']), TIMEOUT) as conn:
+					request = {'token': info['token'], 'command': command, 'params': params or {}}
+					conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+					reply = conn.makefile('rb').readline()
+				return json.loads(reply.decode('utf-8'))
+			except (OSError, ValueError):
+				pass
+		time.sleep(CONNECT_RETRY_DELAY)
+	raise InstanceError("IdleMiner is already running but not answering (pid " + str((info or {}).get('pid')) + ").")
@@ -0,0 +1,136 @@
+import threading
+
+# Tray menu model.
+#
+# The tray menu is a tree of MenuNodes. Every node gets an ID when it is added and keeps it until it is removed,
+# and the tree keeps an id -> node index, so a WM_COMMAND from the native menu is resolved with one dict lookup
+# and callers can hold on to nodes and update them in place (text, icon, check state, children). Any change marks
+# the tree dirty; SysTrayIcon only rebuilds the native menu when it is shown while dirty. Setters that do not
+# change anything leave the tree clean, so refreshing a readout with the same value is free.
+#
+# A node with children is a submenu; a node without children is an item that runs its action when clicked.
+# Actions are called as action(sysTrayIcon, id). The legacy (text, icon, action) tuple format, where 'action'
+# may be a tuple of sub-options, can be converted with fromOptions().
+
+FIRST_ID = 1024
+MAX_ID = 0xFFFF  # Menu command IDs arrive in the low word of WM_COMMAND's wparam
+
+
+class MenuNode():
+	def __init__(self, id, text, icon=None, action=None, checked=False, data=None):
+		self.id = id
+		self.text = text
+		self.icon = icon  # Path of an icon file, or None
+		self.action = action
+		self.checked = checked
+		self.data = data  # Caller's payload, e.g. the value a menu choice stands for
+		self.parent = None
+		self.children = []
+
+	def isSubmenu(self):
+		return len(self.children) > 0
+
+	def __repr__(self):
+		return 'MenuNode(' + str(self.id) + ', ' + repr(self.text) + ')'
+
+
+class MenuTree():
+	def __init__(self, first_id=FIRST_ID, check_icon=None):
+		self.first_id = first_id
+		self.check_icon = check_icon  # Icon drawn for checked items; None uses the native check mark
+		self.root = MenuNode(None, '')
+		self.index = {}  # id -> node
+		self.dirty = True
+		self.rebuilds = 0  # Times the native menu was regenerated (see clean())
+		self.lock = threading.RLock()  # Held while the tree is changed or read as a whole
+		self._next_id = first_id
+		self._free_ids = []
+
+	def _allocateId(self):
+		if self._free_ids:
+			return self._free_ids.pop()
+		if self._next_id > MAX_ID:
+			raise OverflowError('Out of menu IDs')
+		self._next_id += 1
+		return self._next_id - 1
+
+	def add(self, parent, text, icon=None, action=None, checked=False, data=None):
+		# Appends a node under 'parent' (None for the top level) and returns it
+		with self.lock:
+			parent = parent or self.root
+			node = MenuNode(self._allocateId(), text, icon, action, checked, data)
+			node.parent = parent
+			parent.children.append(node)
+			self.index[node.id] = node
+			self.dirty = True
+			return node
+
+	def remove(self, node):
+		with self.lock:
+			for child in list(node.children):
+				self.remove(child)
+			node.parent.children.remove(node)
+			node.parent = None
+			del self.index[node.id]
+			self._free_ids.append(node.id)
+			self.dirty = True
+
+	def get(self, id):
+		# Node for a menu command ID, or None
+		return self.index.get(id)
+
+	def _set(self, node, attr, value):
+		with self.lock:
+			if getattr(node, attr) != value:
+				setattr(node, attr, value)
+				self.dirty = True
+
+	def setText(self, node, text):
+		self._set(node, 'text', text)
+
+	def setIcon(self, node, icon):
+		self._set(node, 'icon', icon)
+
+	def setChecked(self, node, checked):
+		self._set(node, 'checked', checked)
+
+	def setAction(self, node, action):
+		self._set(node, 'action', action)
+
+	def setChildren(self, node, items):
+		# Makes node's children match 'items', a list of (text, icon, action) tuples. Existing children are
+		# updated in place (keeping their IDs); extra ones are added or removed at the end.
+		with self.lock:
+			for child, (text, icon, action) in zip(list(node.children), items):
+				self.setText(child, text)
+				self.setIcon(child, icon)
+				self.setAction(child, action)
+			for text, icon, action in items[len(node.children):]:
+				self.add(node, text, icon, action)
+			for child in node.children[len(items):]:
+				self.remove(child)
+
+	def clean(self):
+		# Called by the consumer after regenerating its native menu
+		self.dirty = False
+		self.rebuilds += 1
+
+	def iconPaths(self, node=None):
+		# All icon paths used in the tree
+		node = node or self.root
+		paths = [node.icon] if node.icon else []
+		if self.check_icon and node.checked:
+			paths.append(self.check_icon)
+		for child in node.children:
+			paths.extend(self.iconPaths(child))
+		return paths
+
+	def fromOptions(self, menu_options, parent=None):
+		# Adds nodes from the legacy nested (text, icon, action) tuple format
+		for option_text, option_icon, option_action in menu_options:
+			if callable(option_action) or isinstance(option_action, str):
+				self.add(parent, option_text, option_icon, option_action)
+			else:
+				submenu = self.add(parent, option_text, option_icon)
+				self.fromOptions(option_action, submenu)
+		return self
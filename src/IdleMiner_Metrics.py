@@ -0,0 +1,62 @@
+import bisect
+import threading
+
+# Metrics.
+#
+# Small, dependency-free counters and histograms. Histograms use fixed upper bounds and cumulative bucket
+# counts like Prometheus, so they can be rendered in the Prometheus text format as they are.
+
+# Default buckets for latencies in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram():
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = tuple(sorted(buckets))
+		self.counts = [0] * (len(self.buckets) + 1)  # Last entry counts observations above every bound (+Inf)
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+		self._lock = threading.Lock()
+
+	def observe(self, value):
+		with self._lock:
+			self.counts[bisect.bisect_left(self.buckets, value)] += 1
+			self.count += 1
+			self.sum += value
+			self.max = max(self.max, value)
+
+	def cumulative(self):
+		# List of (upper bound, observations <= bound), ending with (inf, count)
+		with self._lock:
+			result = []
+			total = 0
+			for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+				total += n
+				result.append((bound, total))
+			return result
+
+	def quantile(self, q):
+		# Upper bound of the bucket containing the q-th quantile (e.g. q=0.95), or None when empty
+		if self.count == 0:
+			return None
+		rank = q * self.count
+		for bound, total in self.cumulative():
+			if total >= rank:
+				return bound if bound != float('inf') else self.max
+		return self.max
+
+	def mean(self):
+		return self.sum / self.count if self.count else None
+
+	def render(self, name, labels=''):
+		# Prometheus text format lines for this histogram
+		lines = []
+		sep = ',' if labels else ''
+		for bound, total in self.cumulative():
+			le = '+Inf' if bound == float('inf') else repr(float(bound))
+			lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, le, total))
+		suffix = '{' + labels + '}' if labels else ''
+		lines.append('{}_sum{} {}'.format(name, suffix, self.sum))
+		lines.append('{}_count{} {}'.format(name, suffix, self.count))
+		return lines
@@ -0,0 +1,420 @@
+import sys
+import time
+import asyncio
+import threading
+import subprocess
+
+import IdleMiner_Output as output
+import IdleMiner_Process as proc
+import IdleMiner_Metrics as metrics
+
+# Miner orchestrator.
+#
+# Runs one ManagedMiner per profile on a private asyncio event loop in a background thread. Each ManagedMiner
+# owns its process, its output pipeline and its state; the orchestrator starts and stops them concurrently and
+# reports their combined hashrate. The public MinerOrchestrator methods are thread-safe and block until the
+# requested operation has completed on the loop.
+#
+# Miners can also be paused instead of stopped. A paused miner's process tree is frozen in place (SIGSTOP on
+# POSIX, NtSuspendProcess on Windows), so resuming it skips the warm-up (solver/DAG initialisation, kernel
+# setup, pool login) that a fresh start pays. A miner left paused longer than max_pause is stopped for real so
+# it does not hold GPU memory indefinitely.
+#
+# Stopping is bounded: the miner's process group is asked to exit, given stop_timeout seconds, then killed,
+# and finally every process left in its tree (including children orphaned by the miner's exit) is reaped.
+# The time from stop request until the whole tree is gone is recorded in the stop_latency histogram.
+#
+# With a CaptureManager (see IdleMiner_Capture.py), each miner's output is also written to its log file.
+
+# Miner states
+STOPPED = 'stopped'
+STARTING = 'starting'  # Process launched, no hashrate reading yet
+RUNNING = 'running'  # At least one hashrate reading received
+STOPPING = 'stopping'
+PAUSED = 'paused'
+EXITED = 'exited'  # Process exited without being asked to
+
+# Bytes to read from a miner's output pipe at a time
+READ_SIZE = 65536
+
+# Seconds to wait for a cross-thread operation to complete
+CALL_TIMEOUT = 60
+
+# Default seconds to wait for a graceful exit before killing the miner
+STOP_TIMEOUT = 5
+
+# Seconds to wait for killed processes to disappear, and how often to check
+REAP_TIMEOUT = 2
+REAP_POLL = 0.01
+
+
+class ManagedMiner():
+	def __init__(self, profile, onSample=None, stop_timeout=STOP_TIMEOUT, stop_latency=None, log=None):
+		self.profile = profile
+		self.log = log  # MinerLog capturing the output, or None
+		self.stop_timeout = stop_timeout
+		self.stop_latency = stop_latency if stop_latency is not None else metrics.Histogram()
+		self.last_stop_latency = None
+		self.state = STOPPED
+		self.process = None
+		self.returncode = None
+		self.started_at = None
+		self.paused_at = None
+		self.paused_by = None  # 'idle' (user returned), 'throttle' (system load too high) or 'thermal' (too hot)
+		self.options = None  # Miner options the current process was started with
+		self.server = None  # Pool endpoint to use, from the profile's list (set by the pool selector; None: the first)
+		self.endpoint = None  # Pool endpoint the current process was started with
+		self.warmup = None  # Seconds from launch to first hashrate reading, measured on the last fresh start
+		self.warmup_saved = 0  # Total warm-up seconds avoided by resuming instead of restarting
+		self.resumes = 0
+		self.starts = 0  # Fresh process launches
+		self._expiry = None  # Timer that stops the miner when a pause runs too long
+		self.onSample = onSample
+		self.output = output.OutputPipeline(output.PARSERS[profile.miner_type](), onSample=self._sample)
+		self._tasks = []
+
+	def _sample(self, sample):
+		if self.state == STARTING:
+			self.state = RUNNING
+			self.warmup = sample.time - self.started_at
+		if self.onSample:
+			self.onSample(self, sample)
+
+	def setProfile(self, profile):
+		# Only while stopped; the next start uses the new profile
+		if profile.miner_type != self.profile.miner_type:
+			self.output = output.OutputPipeline(output.PARSERS[profile.miner_type](), onSample=self._sample)
+		self.profile = profile
+
+	def isActive(self):
+		return self.state in (STARTING, RUNNING)
+
+	def hashrate(self):
+		return self.output.current() if self.isActive() else None
+
+	async def start(self, options=None):
+		if self.isActive():
+			return
+
+		kwargs = proc.startOptions()
+		if sys.platform == 'win32':
+			# Prepare options for window hiding. See: https://docs.python.org/3/library/subprocess.html#subprocess.STARTUPINFO
+			startupinfo = subprocess.STARTUPINFO()
+			startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+			kwargs['startupinfo'] = startupinfo
+
+		self.output.reset()
+		self.returncode = None
+		self.options = dict(self.profile.options if options is None else options)
+		self.endpoint = self.server if self.server in self.profile.servers else self.profile.server
+		command = self.profile.buildCommand(options, self.endpoint)
+		if self.log:
+			self.log.mark('starting: ' + subprocess.list2cmdline(command))
+		self.process = await asyncio.create_subprocess_exec(*command,
+															stdout=asyncio.subprocess.PIPE,
+															stderr=asyncio.subprocess.STDOUT,
+															**kwargs)
+		self.started_at = time.time()
+		self.state = STARTING
+		self.starts += 1
+		self._tasks = [asyncio.ensure_future(self._readOutput(self.process)),
+					   asyncio.ensure_future(self._waitExit(self.process))]
+
+	async def _readOutput(self, process):
+		# Drains the miner's output so its pipe never fills up. It is read in chunks rather than lines, as some
+		# miners redraw their status line with '\r' and never end it with '\n'.
+		splitter = output.LineSplitter()
+		while True:
+			data = await process.stdout.read(READ_SIZE)
+			lines = splitter.feed(data) if data else splitter.flush()
+			for line in lines:
+				if self.log:
+					self.log.write(line)
+				self.output.feed(line)
+			if not data:
+				break
+
+	async def _waitExit(self, process):
+		returncode = await process.wait()
+		if self.log:
+			self.log.mark('exited with code ' + str(returncode))
+		if process is not self.process:
+			# An earlier process of this miner that has since been replaced
+			return
+		self.returncode = returncode
+		if self.state != STOPPING:
+			self.state = EXITED
+			print("Miner '" + self.profile.name + "' exited with code " + str(self.returncode))
+
+	def pause(self, max_pause=None, reason='idle'):
+		# Freezes the miner's process tree. It is stopped for real once max_pause seconds have passed.
+		if self.state == PAUSED:
+			# Already paused (e.g. by the throttle); the user leaving takes precedence
+			self.paused_by = reason
+			if max_pause is not None and self._expiry is None:
+				self._expiry = asyncio.get_event_loop().call_later(max_pause, self._expirePause)
+			return
+		if not self.isActive() or self.process.returncode is not None:
+			return
+		proc.suspendTree(self.process.pid)
+		self.state = PAUSED
+		self.paused_at = time.time()
+		self.paused_by = reason
+		if max_pause is not None:
+			self._expiry = asyncio.get_event_loop().call_later(max_pause, self._expirePause)
+
+	def _expirePause(self):
+		if self.state == PAUSED:
+			print("Miner '" + self.profile.name + "' paused too long, stopping.")
+			asyncio.ensure_future(self.stop())
+
+	def resume(self):
+		if self.state != PAUSED:
+			return
+		self._cancelExpiry()
+		proc.resumeTree(self.process.pid)
+		self.paused_at = None
+		self.paused_by = None
+		self.resumes += 1
+		if self.warmup is not None:
+			self.warmup_saved += self.warmup
+		self.state = RUNNING if len(self.output.samples) else STARTING
+
+	def _cancelExpiry(self):
+		if self._expiry:
+			self._expiry.cancel()
+			self._expiry = None
+
+	async def stop(self):
+		# Graceful signal, bounded wait, kill, then reap the whole tree. Returns the stop latency in seconds.
+		self._cancelExpiry()
+		process = self.process
+		if process is None:
+			self.state = STOPPED
+			return None
+
+		requested = time.monotonic()
+		tree = proc.processTree(process.pid) if process.returncode is None else []
+
+		if self.state == PAUSED:
+			# A stopped process only acts on SIGTERM once it is continued
+			proc.resumeTree(process.pid)
+		self.state = STOPPING
+
+		if process.returncode is None:
+			proc.signalGraceful(process)
+			try:
+				await asyncio.wait_for(asyncio.shield(process.wait()), self.stop_timeout)
+			except asyncio.TimeoutError:
+				print("Miner '" + self.profile.name + "' did not exit within " + str(self.stop_timeout) + "s, killing.")
+				try:
+					process.kill()
+				except ProcessLookupError:
+					pass
+
+		await self._reap(process.pid, tree)
+		try:
+			await asyncio.wait_for(asyncio.gather(*self._tasks, return_exceptions=True), REAP_TIMEOUT)
+		except asyncio.TimeoutError:
+			pass
+
+		latency = time.monotonic() - requested
+		self.last_stop_latency = latency
+		self.stop_latency.observe(latency)
+		self.state = STOPPED
+		return latency
+
+	async def _reap(self, group, tree):
+		# Kills whatever is left of the process tree and waits, bounded, until it is gone
+		deadline = time.monotonic() + REAP_TIMEOUT
+		while True:
+			alive = [pid for pid in set(tree + proc.groupMembers(group)) if proc.isAlive(pid)]
+			if not alive:
+				return
+			if time.monotonic() > deadline:
+				print("Miner '" + self.profile.name + "': processes still alive after kill: " + str(alive))
+				return
+			proc.killPids(alive, group)
+			await asyncio.sleep(REAP_POLL)
+
+
+class MinerOrchestrator():
+	def __init__(self, profiles, onSample=None, stop_timeout=STOP_TIMEOUT, capture=None):
+		# Shared across miners: seconds from stop request until a miner's whole process tree is gone
+		self.stop_latency = metrics.Histogram()
+		self.onSample = onSample
+		self.stop_timeout = stop_timeout
+		self.capture = capture  # CaptureManager for the miners' output, or None
+		self.miners = [self._newMiner(profile) for profile in profiles]
+		# Options applied on top of every profile's own options when a miner starts (set by the throttle)
+		self.option_overrides = {}
+		# Profile name -> {option: highest value} capped on top of the above (set by the thermal governor)
+		self.option_limits = {}
+		# Names of the profiles startAll/resumeAll run (all by default; narrowed by profit switching)
+		self.selected = set(m.profile.name for m in self.miners)
+		if sys.platform == 'win32':
+			# Subprocesses need the proactor loop on Windows
+			self.loop = asyncio.ProactorEventLoop()
+		else:
+			self.loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target=self._runLoop, name='MinerOrchestrator', daemon=True)
+		self._thread.start()
+
+	def _newMiner(self, profile):
+		log = self.capture.open(profile.name) if self.capture else None
+		return ManagedMiner(profile, self.onSample, self.stop_timeout, self.stop_latency, log)
+
+	def _runLoop(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_forever()
+
+	def call(self, coro):
+		# Runs a coroutine on the orchestrator loop from any thread and returns its result
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result(CALL_TIMEOUT)
+
+	def getMiner(self, name):
+		for m in self.miners:
+			if m.profile.name == name:
+				return m
+		raise KeyError(name)
+
+	def optionsFor(self, miner):
+		options = dict(miner.profile.options)
+		options.update(self.option_overrides)
+		for key, limit in self.option_limits.get(miner.profile.name, {}).items():
+			value = options.get(key)
+			if not isinstance(value, (int, float)) or value > limit:
+				options[key] = limit
+		return options
+
+	async def _startAll(self, miners):
+		results = await asyncio.gather(*[m.start(self.optionsFor(m)) for m in miners], return_exceptions=True)
+		for m, result in zip(miners, results):
+			if isinstance(result, Exception):
+				m.state = EXITED
+				print("Miner '" + m.profile.name + "' failed to start: " + str(result))
+
+	async def _stopAll(self, miners):
+		await asyncio.gather(*[m.stop() for m in miners], return_exceptions=True)
+
+	async def _pauseAll(self, miners, max_pause):
+		for m in miners:
+			m.pause(max_pause)
+
+	async def _resumeAll(self, miners):
+		# Resumes paused miners and starts any that are not running (never started, expired or exited)
+		stopped = []
+		for m in miners:
+			if m.state == PAUSED:
+				m.resume()
+			elif not m.isActive():
+				stopped.append(m)
+		if stopped:
+			await self._stopAll(stopped)
+			await self._startAll(stopped)
+
+	def selectedMiners(self):
+		return [m for m in self.miners if m.profile.name in self.selected]
+
+	async def replaceProfile(self, old, new, mining):
+		# Coroutine: replaces profile 'old' with 'new' in the selection, restarting if currently mining
+		self.selected.discard(old)
+		self.selected.add(new)
+		if old is not None and old != new:
+			await self._stopAll([self.getMiner(old)])
+		if mining:
+			await self._startAll([self.getMiner(new)])
+
+	async def _updateProfiles(self, profiles, mining):
+		# Adds, removes and replaces miners to match 'profiles'. A miner whose profile changed is stopped and, if
+		# it was running, restarted with the new profile; a paused one starts fresh on the next resume.
+		current = dict((m.profile.name, m) for m in self.miners)
+		names = set(p.name for p in profiles)
+		stopping = [m for m in self.miners if m.profile.name not in names]
+		starting = []
+		miners = []
+		for profile in profiles:
+			m = current.get(profile.name)
+			if m is None:
+				m = self._newMiner(profile)
+				self.selected.add(profile.name)
+				if mining:
+					starting.append(m)
+			elif m.profile != profile:
+				if m.isActive() or m.state == PAUSED:
+					stopping.append(m)
+					if m.isActive():
+						starting.append(m)
+			miners.append(m)
+
+		await self._stopAll(stopping)
+		for profile in profiles:
+			m = current.get(profile.name)
+			if m is not None and m.profile != profile:
+				m.setProfile(profile)
+		self.miners = miners
+		self.selected &= names
+		await self._startAll([m for m in starting if m.profile.name in self.selected])
+
+	def updateProfiles(self, profiles, mining):
+		# Applies a changed set of profiles (e.g. after a config reload)
+		self.call(self._updateProfiles(profiles, mining))
+
+	def setStopTimeout(self, stop_timeout):
+		self.stop_timeout = stop_timeout
+		for m in self.miners:
+			m.stop_timeout = stop_timeout
+
+	def startAll(self):
+		self.call(self._startAll(self.selectedMiners()))
+
+	def pauseAll(self, max_pause=None):
+		self.call(self._pauseAll(self.miners, max_pause))
+
+	def resumeAll(self):
+		self.call(self._resumeAll(self.selectedMiners()))
+
+	def warmupSaved(self):
+		# Total seconds of miner warm-up avoided by resuming paused miners
+		return sum(m.warmup_saved for m in self.miners)
+
+	def stopAll(self):
+		self.call(self._stopAll(self.miners))
+
+	def start(self, name):
+		self.call(self._startAll([self.getMiner(name)]))
+
+	def stop(self, name):
+		self.call(self._stopAll([self.getMiner(name)]))
+
+	def isMining(self):
+		return any(m.isActive() for m in self.miners)
+
+	def hashrate(self):
+		# Combined current hashrate, as a dict of unit -> total (miners may report different units)
+		totals = {}
+		for m in self.miners:
+			rate = m.hashrate()
+			if rate is not None:
+				unit = m.output.parser.UNIT
+				totals[unit] = totals.get(unit, 0) + rate
+		return totals
+
+	def averageHashrate(self, seconds):
+		totals = {}
+		for m in self.miners:
+			if not m.isActive():
+				continue
+			rate = m.output.average(seconds)
+			if rate is not None:
+				unit = m.output.parser.UNIT
+				totals[unit] = totals.get(unit, 0) + rate
+		return totals
+
+	def status(self):
+		# List of (name, state, current hashrate, unit) per miner
+		return [(m.profile.name, m.state, m.hashrate(), m.output.parser.UNIT) for m in self.miners]
+
+	def shutdown(self):
+		self.stopAll()
+		self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,244 @@
+import re
+import time
+import threading
+import collections
+
+# Miner output pipeline.
+#
+# The miner's stdout/stderr is read in chunks on the orchestrator's asyncio loop (ManagedMiner._readOutput in
+# IdleMiner_Orchestrator.py) so the child never blocks on a full pipe, and a LineSplitter cuts them into lines at
+# '\n' or '\r' (some miners only ever redraw their status line in place). Each line is handed to a per-miner
+# parser, and parsed hashrate readings are stored as Samples in a fixed-size RingBuffer (locked, as the tray
+# reads them from another thread). Lines are discarded once parsed, so memory use is bounded no matter how long
+# the miner runs.
+
+# One hashrate reading. 'gpus' maps GPU index to that GPU's hashrate.
+Sample = collections.namedtuple('Sample', ['time', 'hashrate', 'accepted', 'rejected', 'gpus'])
+
+# Strips ANSI colour codes (EWBF colours its console output)
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+# Longest line kept from the pipe. The overlong part of a longer line is discarded.
+MAX_LINE = 4096
+
+# Line breaks in miner output
+LINE_BREAK = re.compile(rb'[\r\n]')
+
+
+class RingBuffer():
+	# Fixed-size buffer that overwrites its oldest entry when full
+
+	def __init__(self, size):
+		self.size = size
+		self._items = [None] * size
+		self._next = 0
+		self._count = 0
+		self._lock = threading.Lock()
+
+	def append(self, item):
+		with self._lock:
+			self._items[self._next] = item
+			self._next = (self._next + 1) % self.size
+			self._count = min(self._count + 1, self.size)
+
+	def __len__(self):
+		return self._count
+
+	def latest(self):
+		with self._lock:
+			if self._count == 0:
+				return None
+			return self._items[(self._next - 1) % self.size]
+
+	def items(self):
+		# Returns the stored items, oldest first
+		with self._lock:
+			start = (self._next - self._count) % self.size
+			return [self._items[(start + i) % self.size] for i in range(self._count)]
+
+	def clear(self):
+		with self._lock:
+			self._items = [None] * self.size
+			self._next = 0
+			self._count = 0
+
+
+class LineSplitter():
+	# Cuts raw pipe output into lines at '\n' or '\r'. The unterminated tail is kept for the next chunk, up to
+	# 'limit' bytes; a longer line is cut at 'limit' and the rest of it dropped.
+
+	def __init__(self, limit=MAX_LINE):
+		self.limit = limit
+		self._tail = b''
+		self._overflow = False  # Dropping the rest of an overlong line
+
+	def feed(self, data):
+		# Returns the complete, non-empty lines (bytes, without line breaks)
+		pieces = LINE_BREAK.split(self._tail + data)
+		self._tail = pieces.pop()
+		lines = []
+		for piece in pieces:
+			if self._overflow:
+				self._overflow = False
+				continue
+			if piece:
+				lines.append(piece)
+		if len(self._tail) > self.limit:
+			if not self._overflow:
+				lines.append(self._tail[:self.limit])
+			self._overflow = True
+			self._tail = b''
+		return lines
+
+	def flush(self):
+		# Returns the unterminated tail as a final line (at end of output), if any
+		tail = b'' if self._overflow else self._tail
+		self._tail = b''
+		self._overflow = False
+		return [tail] if tail else []
+
+
+class MinerParser():
+	# Base class for miner output parsers.
+	# parseLine() receives one line (without ANSI codes) and updates the parser's running state. It returns True
+	# when the line completes a hashrate reading, after which sample() returns the current state.
+	UNIT = 'H/s'
+
+	def __init__(self):
+		self.hashrate = None
+		self.accepted = 0
+		self.rejected = 0
+		self.gpus = {}
+
+	def parseLine(self, line):
+		raise NotImplementedError
+
+	def sample(self, t):
+		return Sample(t, self.hashrate, self.accepted, self.rejected, dict(self.gpus))
+
+
+class EWBFParser(MinerParser):
+	# Parser for the EWBF Zcash miner. Relevant output lines look like:
+	#	GPU0: 298 Sol/s GPU1: 305 Sol/s
+	#	Total speed: 603 Sol/s
+	#	INFO 22:36:22: GPU0 Accepted share 140ms [A:12, R:0]
+	UNIT = 'Sol/s'
+
+	GPU_SPEED = re.compile(r'GPU(\d+):\s*([\d.]+)\s*Sol/s')
+	TOTAL_SPEED = re.compile(r'Total speed:\s*([\d.]+)\s*Sol/s')
+	SHARES = re.compile(r'\[A:(\d+),\s*R:(\d+)\]')
+
+	def parseLine(self, line):
+		m = self.TOTAL_SPEED.search(line)
+		if m:
+			self.hashrate = float(m.group(1))
+			return True
+
+		m = self.SHARES.search(line)
+		if m:
+			self.accepted = int(m.group(1))
+			self.rejected = int(m.group(2))
+			return False
+
+		speeds = self.GPU_SPEED.findall(line)
+		if speeds:
+			self.gpus = {int(gpu): float(rate) for gpu, rate in speeds}
+		return False
+
+
+class GenericParser(MinerParser):
+	# Fallback parser for miners that print a total hashrate such as "Speed: 24.5 MH/s".
+	# Every line containing a rate completes a reading; rates are normalised to H/s.
+	# Share counts are only read from the usual counter forms, "[A:12, R:1]" and "accepted (12/1)", so numbers
+	# such as a share's latency ("accepted 140ms") are not mistaken for them.
+	RATE = re.compile(r'([\d.]+)\s*([kMGT]?)(H|Sol|Sols)/s', re.IGNORECASE)
+	SCALE = {'': 1, 'k': 1e3, 'm': 1e6, 'g': 1e9, 't': 1e12}
+	COUNTS = re.compile(r'\bA:\s*(\d+)[,\s]+R:\s*(\d+)')
+	ACCEPTED_REJECTED = re.compile(r'accepted\s*\(\s*(\d+)\s*/\s*(\d+)\s*\)', re.IGNORECASE)
+
+	def parseLine(self, line):
+		m = self.COUNTS.search(line) or self.ACCEPTED_REJECTED.search(line)
+		if m:
+			self.accepted = int(m.group(1))
+			self.rejected = int(m.group(2))
+
+		m = self.RATE.search(line)
+		if m:
+			self.hashrate = float(m.group(1)) * self.SCALE[m.group(2).lower()]
+			return True
+		return False
+
+
+# Parsers by miner type, as named in the config file
+PARSERS = {'ewbf': EWBFParser,
+		   'generic': GenericParser}
+
+
+class OutputPipeline():
+	# Feeds miner output lines through a parser into a ring buffer of samples.
+	# onSample, if given, is called with each new Sample (from the reader thread).
+
+	def __init__(self, parser, size=600, onSample=None):
+		self.parser = parser
+		self.samples = RingBuffer(size)
+		self.onSample = onSample
+		self.lines = 0
+
+	def feedLine(self, line):
+		self.lines += 1
+		line = ANSI_ESCAPE.sub('', line)
+		if self.parser.parseLine(line):
+			sample = self.parser.sample(time.time())
+			self.samples.append(sample)
+			if self.onSample:
+				self.onSample(sample)
+
+	def feed(self, data):
+		# Accepts raw bytes from the pipe. Carriage returns are treated as line breaks because some miners
+		# redraw their status line in place.
+		text = data.decode('utf-8', 'replace')
+		for line in text.replace('\r', '\n').split('\n'):
+			if line.strip():
+				self.feedLine(line)
+
+	def current(self):
+		# Latest hashrate, or None before the first reading
+		sample = self.samples.latest()
+		return sample.hashrate if sample else None
+
+	def average(self, seconds=None, now=None):
+		# Mean hashrate over the last 'seconds' seconds (all stored samples if None)
+		if now is None:
+			now = time.time()
+		rates = [s.hashrate for s in self.samples.items()
+				 if s.hashrate is not None and (seconds is None or now - s.time <= seconds)]
+		if not rates:
+			return None
+		return sum(rates) / len(rates)
+
+	def reset(self):
+		self.samples.clear()
+		self.lines = 0
+
+
+def formatHashrate(value, unit):
+	if value is None:
+		return '- ' + unit
+	if unit == 'H/s':
+		# Scale plain hash rates to a readable prefix
+		for prefix in ('T', 'G', 'M', 'k'):
+			scale = GenericParser.SCALE[prefix.lower()]
+			if value >= scale:
+				value = value / scale
+				unit = prefix + unit
+				break
+	if value >= 100:
+		return '{:.0f} {}'.format(value, unit)
+	return '{:.1f} {}'.format(value, unit)
+
+
+def formatTotals(totals):
+	# Formats a dict of unit -> hashrate, e.g. "603 Sol/s + 24.5 MH/s"
+	if not totals:
+		return '-'
+	return ' + '.join(formatHashrate(value, unit) for unit, value in sorted(totals.items()))
@@ -0,0 +1,559 @@
+import os
+import sys
+import glob
+import time
+import datetime
+import collections
+
+# Start/stop policy.
+#
+# The idle scheduler asks a PolicyEngine once per pass whether to start mining, stop it, or leave things as they
+# are, and for how long that answer holds. The engine combines:
+#
+#	IdleRule		When the user counts as away or back. Starts at IDLE_TIMER seconds idle and stops when idle time
+#					drops below stop_below x IDLE_TIMER (hysteresis band). With 'confirm', input must still be
+#					going on 'confirm' seconds after it began, so a brief mouse nudge does not stop the miners.
+#	other rules		Each may forbid mining (allows), hold off an idle stop (holds), and say when its answer could
+#					change (expires), so the scheduler can keep sleeping until then instead of polling. A rule may
+#					also overrule the idle rule's start decision (overrides), e.g. to start before IDLE_TIMER.
+#
+# A rule that forbids mining blocks a start, and stops mining that is already running ('policy_stop'), even
+# during the minimum run time. Manual mining from the tray is not subject to the policy. Every Decision names
+# the rule behind it and why, e.g. ('stop', 'window', 'outside mining hours').
+#
+# Rules are configured as a list under POLICY in the config file, e.g.
+#
+#	POLICY:
+#	- {rule: idle, stop_below: 0.5, confirm: 10}
+#	- {rule: min_run, seconds: 600}
+#	- {rule: cooldown, seconds: 120}
+#	- {rule: window, windows: [{start: '22:00', end: '07:00'}, {days: [sat, sun], start: '00:00', end: '24:00'}]}
+#	- {rule: tariff, max_price: 0.15, default_price: 0.30, periods: [{start: '23:00', end: '06:00', price: 0.12}]}
+#	- {rule: power, require_ac: true, min_battery: 80}
+#	- {rule: budget, hours: 6}
+#	- {rule: predict, warmup: 120, early_after: 60, long: 1800, confidence: 0.8}
+#
+# Times are local 'HH:MM'; a window ending at or before its start runs past midnight. 'days' (mon..sun, default
+# every day) is the day a window starts on.
+
+START = 'start'
+STOP = 'stop'
+STAY = 'stay'
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+DAY = 24*60*60
+
+# 'timeout' is how long the decision holds (None: until woken); 'forInput' means the scheduler should wake on
+# user input before then
+Decision = collections.namedtuple('Decision', ['action', 'rule', 'reason', 'timeout', 'forInput'])
+
+# What rules see: wall-clock 'now', seconds idle, whether mining, seconds since mining started (None if not
+# mining), seconds since it last stopped (None if mining or never), and seconds mined today (local time)
+PolicyContext = collections.namedtuple('PolicyContext', ['now', 'idle', 'mining', 'mining_for', 'stopped_for',
+														 'mined_today'])
+
+
+def _minutes(value):
+	# 'HH:MM' -> minutes after midnight. YAML 1.1 reads unquoted 22:00 as the base-60 number 1320, which is
+	# already in minutes.
+	if isinstance(value, int) and not isinstance(value, bool):
+		minutes = value
+	else:
+		hours, _, mins = str(value).partition(':')
+		minutes = int(hours) * 60 + int(mins or 0)
+	if not 0 <= minutes <= 24*60:
+		raise ValueError('time out of range: ' + str(value))
+	return minutes
+
+
+def _days(value):
+	if value is None:
+		return set(range(7))
+	days = set()
+	for day in value:
+		if str(day).lower()[:3] not in DAYS:
+			raise ValueError('unknown day: ' + str(day))
+		days.add(DAYS.index(str(day).lower()[:3]))
+	return days
+
+
+def _midnight(now):
+	# Local midnight starting the day 'now' falls in
+	t = time.localtime(now)
+	return time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1))
+
+
+class Period():
+	# A daily (or weekly, with 'days') time span, with an optional value such as a tariff price
+	def __init__(self, start, end, days=None, value=None):
+		self.start = _minutes(start)
+		self.end = _minutes(end)
+		self.days = _days(days)
+		self.value = value
+
+	def occurrences(self, now):
+		# (start, end) epoch times of the occurrences from yesterday until a week from now
+		result = []
+		today = datetime.date.fromtimestamp(now)
+		for offset in range(-1, 8):
+			day = today + datetime.timedelta(days=offset)
+			if day.weekday() not in self.days:
+				continue
+			midnight = time.mktime(day.timetuple())
+			end = self.end if self.end > self.start else self.end + 24*60
+			result.append((midnight + self.start*60, midnight + end*60))
+		return result
+
+
+class Rule():
+	# Base class. Each method returns None when the rule has nothing to say.
+	name = 'rule'
+
+	def allows(self, ctx):
+		# (reason, seconds until it may allow mining) if mining is not allowed now
+		return None
+
+	def holds(self, ctx):
+		# (reason, seconds) to keep mining although the user is back
+		return None
+
+	def expires(self, ctx):
+		# Seconds until allows() could start refusing, while mining
+		return None
+
+	def overrides(self, ctx, decision):
+		# A Decision to use instead of the idle rule's start 'decision' (START or STAY), while not mining
+		return None
+
+	def observe(self, ctx):
+		# Called with the context of every pass, before any decision
+		pass
+
+
+class IdleRule(Rule):
+	name = 'idle'
+
+	def __init__(self, start=300, stop_below=0.5, confirm=0):
+		if not 0 < stop_below <= 1:
+			raise ValueError('stop_below must be between 0 and 1')
+		self.start = start
+		self.stop_below = stop_below
+		self.confirm = confirm
+		self.active_since = None  # Clock time of the input being confirmed
+		self.dismissed = float('-inf')  # Clock time of the last input found to be only a nudge
+		self.started_after = float('-inf')  # Clock time of the last input before the policy started mining
+
+	def stopAt(self):
+		return self.start * self.stop_below
+
+	def startDecision(self, ctx):
+		self.active_since = None
+		if ctx.idle >= self.start:
+			return Decision(START, self.name, 'idle for ' + str(int(ctx.idle)) + ' s', 0, False)
+		return Decision(STAY, self.name, 'idle ' + str(int(ctx.idle)) + '/' + str(self.start) + ' s',
+						self.start - ctx.idle, False)
+
+	def stopDecision(self, ctx, clock):
+		last_input = clock - ctx.idle
+		# Input from before the start does not count, for starts before IDLE_TIMER (see PredictRule)
+		ignored = max(self.dismissed, self.started_after)
+		if self.active_since is None and (ctx.idle >= self.stopAt() or last_input <= ignored + 0.1):
+			return Decision(STAY, self.name, 'user away', None, True)
+		if self.confirm <= 0:
+			return Decision(STOP, self.name, 'user back', 0, False)
+		if self.active_since is None:
+			# First input: look again once the confirmation time has passed
+			self.active_since = last_input
+		if clock - self.active_since < self.confirm:
+			return Decision(STAY, self.name, 'confirming user activity',
+							self.confirm - (clock - self.active_since), False)
+		self.active_since = None
+		if ctx.idle < self.confirm / 2:
+			return Decision(STOP, self.name, 'user back', 0, False)
+		# Only a nudge: keep mining and ignore that input from now on
+		self.dismissed = last_input
+		return Decision(STAY, self.name, 'user away', None, True)
+
+
+class MinRunRule(Rule):
+	name = 'min_run'
+
+	def __init__(self, seconds):
+		self.seconds = seconds
+
+	def holds(self, ctx):
+		if ctx.mining_for is not None and ctx.mining_for < self.seconds:
+			return ('minimum run time', self.seconds - ctx.mining_for)
+		return None
+
+
+class CooldownRule(Rule):
+	name = 'cooldown'
+
+	def __init__(self, seconds):
+		self.seconds = seconds
+
+	def allows(self, ctx):
+		if ctx.stopped_for is not None and ctx.stopped_for < self.seconds:
+			return ('cooling down after stop', self.seconds - ctx.stopped_for)
+		return None
+
+
+class WindowRule(Rule):
+	# Mining only inside the given time windows
+	name = 'window'
+
+	def __init__(self, windows):
+		self.periods = [Period(w['start'], w['end'], w.get('days')) for w in windows]
+		if not self.periods:
+			raise ValueError('no windows given')
+
+	def _current(self, now):
+		# (end of the current window or None, start of the next one)
+		end = None
+		next_start = now + 7*DAY
+		for period in self.periods:
+			for start, stop in period.occurrences(now):
+				if start <= now < stop:
+					end = max(end or stop, stop)
+				elif start > now:
+					next_start = min(next_start, start)
+		return end, next_start
+
+	def allows(self, ctx):
+		end, next_start = self._current(ctx.now)
+		if end is None:
+			return ('outside mining hours until ' + time.strftime('%a %H:%M', time.localtime(next_start)),
+					next_start - ctx.now)
+		return None
+
+	def expires(self, ctx):
+		end, next_start = self._current(ctx.now)
+		return end - ctx.now if end is not None else None
+
+
+class TariffRule(Rule):
+	# Mining only while the electricity price is at most max_price. Periods not covered cost default_price.
+	name = 'tariff'
+
+	def __init__(self, max_price, periods, default_price=None):
+		self.max_price = max_price
+		self.default_price = default_price
+		self.periods = [Period(p['start'], p['end'], p.get('days'), p['price']) for p in periods]
+
+	def price(self, now):
+		# (current price, seconds until the price may change)
+		price = self.default_price
+		change = 7*DAY
+		for period in self.periods:
+			for start, stop in period.occurrences(now):
+				if start <= now < stop:
+					price = period.value
+					change = min(change, stop - now)
+				elif start > now:
+					change = min(change, start - now)
+		return price, change
+
+	def allows(self, ctx):
+		price, change = self.price(ctx.now)
+		if price is not None and price > self.max_price:
+			return ('price ' + str(price) + ' above ' + str(self.max_price), change)
+		return None
+
+	def expires(self, ctx):
+		return self.price(ctx.now)[1]
+
+
+class BudgetRule(Rule):
+	# At most 'hours' of mining per day
+	name = 'budget'
+
+	def __init__(self, hours):
+		self.seconds = hours * 60*60
+
+	def allows(self, ctx):
+		if ctx.mined_today >= self.seconds:
+			return ('daily budget used', _midnight(ctx.now) + DAY - ctx.now)
+		return None
+
+	def expires(self, ctx):
+		return self.seconds - ctx.mined_today
+
+
+class PowerSource():
+	# Base class for power state backends
+	def status(self):
+		# (on AC power: True/False/None if unknown or no battery, battery percent or None)
+		return (None, None)
+
+
+class Win32PowerSource(PowerSource):
+	def __init__(self):
+		import ctypes
+		from ctypes import wintypes
+
+		class SYSTEM_POWER_STATUS(ctypes.Structure):
+			_fields_ = [('ACLineStatus', wintypes.BYTE), ('BatteryFlag', wintypes.BYTE),
+						('BatteryLifePercent', wintypes.BYTE), ('SystemStatusFlag', wintypes.BYTE),
+						('BatteryLifeTime', wintypes.DWORD), ('BatteryFullLifeTime', wintypes.DWORD)]
+
+		self._status = SYSTEM_POWER_STATUS()
+		self._get = ctypes.windll.kernel32.GetSystemPowerStatus
+		self._ref = ctypes.byref(self._status)
+
+	def status(self):
+		if not self._get(self._ref) or self._status.BatteryFlag & 128:  # 128: no system battery
+			return (None, None)
+		on_ac = {0: False, 1: True}.get(self._status.ACLineStatus & 0xFF)
+		percent = self._status.BatteryLifePercent & 0xFF
+		return (on_ac, percent if percent <= 100 else None)
+
+
+class SysfsPowerSource(PowerSource):
+	def __init__(self, sys_root='/sys'):
+		self.root = os.path.join(sys_root, 'class/power_supply')
+
+	def _read(self, path):
+		try:
+			with open(path) as f:
+				return f.read().strip()
+		except OSError:
+			return None
+
+	def status(self):
+		on_ac = None
+		percent = None
+		for supply in glob.glob(os.path.join(self.root, '*')):
+			kind = self._read(os.path.join(supply, 'type'))
+			if kind == 'Mains':
+				on_ac = (on_ac or False) or self._read(os.path.join(supply, 'online')) == '1'
+			elif kind == 'Battery':
+				capacity = self._read(os.path.join(supply, 'capacity'))
+				percent = int(capacity) if capacity and capacity.isdigit() else percent
+		return (on_ac if percent is not None else None, percent)
+
+
+class FakePowerSource(PowerSource):
+	def __init__(self, on_ac=None, percent=None):
+		self.set(on_ac, percent)
+
+	def set(self, on_ac=None, percent=None):
+		self.on_ac = on_ac
+		self.percent = percent
+
+	def status(self):
+		return (self.on_ac, self.percent)
+
+
+def createPowerSource():
+	if sys.platform == 'win32':
+		return Win32PowerSource()
+	return SysfsPowerSource()
+
+
+class PowerRule(Rule):
+	# No mining on battery (require_ac), or only while the battery is above min_battery percent
+	name = 'power'
+
+	def __init__(self, require_ac=True, min_battery=None, poll=60, source=None):
+		self.require_ac = require_ac
+		self.min_battery = min_battery
+		self.poll = poll  # Power state changes are not signalled; look again this often
+		self.source = source or createPowerSource()
+
+	def allows(self, ctx):
+		on_ac, percent = self.source.status()
+		if on_ac is False and self.require_ac:
+			return ('on battery', self.poll)
+		if on_ac is False and self.min_battery is not None and percent is not None and percent < self.min_battery:
+			return ('battery at ' + str(percent) + '%', self.poll)
+		return None
+
+	def expires(self, ctx):
+		return self.poll
+
+
+class PredictRule(Rule):
+	# Uses an IdleModel of the user's idle spells (see IdleMiner_Predict.py) to start before IDLE_TIMER when the
+	# idle window will very likely be long, and to not start when it will likely be too short to be worth the
+	# miners' warm-up. It changes only start decisions, never stops, and says nothing until the model has seen
+	# enough spells like the current one, so a new model behaves like the plain idle timer.
+	#
+	#	warmup			Seconds a fresh miner start takes before it hashes
+	#	early_after		Idle seconds before an early start is considered
+	#	long			Start early once the window will last 'long' more seconds with probability 'confidence'
+	#	recheck			Seconds between looking again while waiting, as the odds change with the idle time
+	#
+	# A start at IDLE_TIMER is skipped while the expected hashing time (remaining idle time less the warm-up)
+	# is shorter than the warm-up itself. The rule keeps looking, so a spell that goes on longer than expected
+	# still starts the miners.
+	name = 'predict'
+
+	def __init__(self, warmup=120, early_after=60, long=30*60, confidence=0.8, recheck=60, min_samples=5,
+				 slot=30*60, half_life_days=28, path=None):
+		import IdleMiner_Predict as predict
+		if not 0 < confidence <= 1:
+			raise ValueError('confidence must be between 0 and 1')
+		if early_after < predict.MIN_SPELL:
+			raise ValueError('early_after must be at least ' + str(predict.MIN_SPELL) + ' seconds')
+		self.warmup = warmup
+		self.early_after = early_after
+		self.long = long
+		self.confidence = confidence
+		self.recheck = recheck
+		self.model = predict.IdleModel(slot, half_life_days * 24*60*60, min_samples, path)
+		self.tracker = predict.SpellTracker(self.model)
+
+	def observe(self, ctx):
+		self.tracker.observe(ctx.now, ctx.idle, ctx.mining)
+
+	def overrides(self, ctx, decision):
+		if decision.action == START:
+			estimate = self.model.estimate(ctx.now - ctx.idle, ctx.idle, ctx.now)
+			if estimate is None:
+				return None
+			if estimate.beyond(self.warmup) >= self.warmup:
+				return None
+			return Decision(STAY, self.name, 'short idle window expected (' + str(int(estimate.expected)) + ' s)',
+							self.recheck, False)
+		# Too few spells that long seen yet means too few longer ones, so there is nothing to wait for
+		estimate = self.model.estimate(ctx.now - ctx.idle, max(ctx.idle, self.early_after), ctx.now)
+		if estimate is None:
+			return None
+		if ctx.idle < self.early_after:
+			return decision._replace(timeout=min(decision.timeout, self.early_after - ctx.idle))
+		if estimate.survival(self.long) >= self.confidence:
+			return Decision(START, self.name, 'long idle window expected (' + str(int(estimate.expected)) + ' s)',
+							0, False)
+		return decision._replace(timeout=min(decision.timeout, self.recheck))
+
+
+# Rule name -> function(options) building it
+RULES = {
+	'min_run': lambda o: MinRunRule(o['seconds']),
+	'cooldown': lambda o: CooldownRule(o['seconds']),
+	'window': lambda o: WindowRule(o['windows']),
+	'tariff': lambda o: TariffRule(o['max_price'], o.get('periods') or [], o.get('default_price')),
+	'power': lambda o: PowerRule(o.get('require_ac', True), o.get('min_battery'), o.get('poll', 60)),
+	'budget': lambda o: BudgetRule(o['hours']),
+}
+
+MODEL_FILE = 'IdleMiner_IdleModel.json'
+
+
+def loadRules(policy_config, idle_timer, directory=None):
+	# Builds (idle rule, other rules) from the POLICY config list. Raises ValueError, KeyError or TypeError.
+	# The predict rule's model is kept in 'directory', or only in memory without one.
+	idle = IdleRule(idle_timer)
+	rules = []
+	for options in policy_config or []:
+		name = options.get('rule')
+		if name == 'idle':
+			idle = IdleRule(idle_timer, options.get('stop_below', 0.5), options.get('confirm', 0))
+		elif name == 'predict':
+			rules.append(PredictRule(options.get('warmup', 120), options.get('early_after', 60),
+									 options.get('long', 30*60), options.get('confidence', 0.8),
+									 options.get('recheck', 60), options.get('min_samples', 5),
+									 options.get('slot', 30*60), options.get('half_life_days', 28),
+									 os.path.join(directory, options.get('model', MODEL_FILE)) if directory else None))
+		elif name in RULES:
+			rules.append(RULES[name](options))
+		else:
+			raise ValueError('unknown rule: ' + str(name))
+	return idle, rules
+
+
+class PolicyEngine():
+	def __init__(self, idle=None, rules=(), clock=time.monotonic, wallclock=time.time):
+		self.idle = idle or IdleRule()
+		self.rules = list(rules)
+		self.clock = clock
+		self.wallclock = wallclock
+		self.decisions = 0
+		self.mining_since = None  # Clock time mining started
+		self.stopped_at = None  # Clock time mining last stopped
+		self.mined_day = None  # Local midnight of the day mined_seconds counts
+		self.mined_seconds = 0.0
+
+	def setRules(self, idle, rules):
+		# Keeps the mining history, so a config reload does not reset cooldowns or the daily budget
+		idle.started_after = self.idle.started_after
+		self.idle = idle
+		self.rules = list(rules)
+
+	def setIdleTimer(self, idle_timer):
+		self.idle.start = idle_timer
+
+	def started(self):
+		# Called whenever mining starts, whether from the policy or not
+		if self.mining_since is None:
+			self.mining_since = self.clock()
+
+	def stopped(self):
+		if self.mining_since is not None:
+			self._addMined(self.clock() - self.mining_since)
+			self.mining_since = None
+			self.stopped_at = self.clock()
+
+	def _addMined(self, seconds):
+		now = self.wallclock()
+		midnight = _midnight(now)
+		if self.mined_day != midnight:
+			# New day: only the part of the session after midnight counts
+			self.mined_day = midnight
+			self.mined_seconds = 0.0
+			seconds = min(seconds, now - midnight)
+		self.mined_seconds += seconds
+
+	def minedToday(self, now):
+		mined = self.mined_seconds if self.mined_day == _midnight(now) else 0.0
+		if self.mining_since is not None:
+			mined += min(self.clock() - self.mining_since, now - _midnight(now))
+		return mined
+
+	def context(self, idle, mining):
+		now = self.wallclock()
+		clock = self.clock()
+		mining_for = clock - self.mining_since if mining and self.mining_since is not None else (0.0 if mining else None)
+		stopped_for = clock - self.stopped_at if not mining and self.stopped_at is not None else None
+		return PolicyContext(now, idle, mining, mining_for, stopped_for, self.minedToday(now))
+
+	def decide(self, idle, mining):
+		# One pass over the rules
+		self.decisions += 1
+		ctx = self.context(idle, mining)
+		for rule in self.rules:
+			rule.observe(ctx)
+		if not mining:
+			for rule in self.rules:
+				refusal = rule.allows(ctx)
+				if refusal:
+					return Decision(STAY, rule.name, refusal[0], max(0.0, refusal[1]), False)
+			decision = self.idle.startDecision(ctx)
+			for rule in self.rules:
+				decision = rule.overrides(ctx, decision) or decision
+			if decision.action == START:
+				self.idle.started_after = self.clock() - idle
+			return decision
+
+		timeout = None
+		for rule in self.rules:
+			refusal = rule.allows(ctx)
+			if refusal:
+				return Decision(STOP, rule.name, refusal[0], 0, False)
+			expires = rule.expires(ctx)
+			if expires is not None:
+				timeout = expires if timeout is None else min(timeout, expires)
+
+		decision = self.idle.stopDecision(ctx, self.clock())
+		if decision.action == STOP:
+			for rule in self.rules:
+				hold = rule.holds(ctx)
+				if hold:
+					timeout = hold[1] if timeout is None else min(timeout, hold[1])
+					return Decision(STAY, rule.name, hold[0], max(0.0, timeout), False)
+		if decision.action == STAY and timeout is not None:
+			# Also wake when another rule's answer may change
+			decision = decision._replace(timeout=max(0.0, timeout if decision.timeout is None
+															else min(timeout, decision.timeout)))
+		return decision
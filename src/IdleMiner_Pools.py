@@ -0,0 +1,295 @@
+import json
+import time
+import asyncio
+import argparse
+import threading
+import collections
+import socketserver
+
+# Pool endpoint failover.
+#
+# POOL_SERVER (or a profile's 'server') may be a list of endpoints for the same pool, e.g. its regional
+# servers. While mining, a PoolSelector probes every endpoint of the running profiles with a timed TCP connect
+# and stratum handshake (mining.subscribe), caches the results for 'probe_interval' seconds, and points each
+# miner at the fastest endpoint that answers:
+#
+#	- A miner is moved off its endpoint at once when the endpoint stops answering, or when the miner's rejected
+#	  (mostly stale) shares exceed 'stale_ratio' of its shares in 'stale_window' seconds; that endpoint is then
+#	  avoided for 'penalty' seconds.
+#	- It is moved to a faster endpoint only if that is at least 'margin' faster and 'min_gain' seconds quicker,
+#	  and not within 'dwell' seconds of its last move, since every move restarts the miner (a warm-up).
+#
+# Endpoints are passed to the miner as written ({server} in the profile's args). For probing, a port in the
+# endpoint ('host:port', 'stratum+tcp://host:port') is used, else the profile's 'port' option, else 3333.
+#
+# FakeStratumServer is a local stratum endpoint with configurable latency and downtime, for tests:
+#
+#	python IdleMiner_Pools.py serve --port 3333 --delay 0.05
+#	python IdleMiner_Pools.py probe 127.0.0.1:3333 eu.pool.example:3333
+
+DEFAULT_PORT = 3333
+
+SUBSCRIBE = json.dumps({'id': 1, 'method': 'mining.subscribe', 'params': ['IdleMiner']}).encode('utf-8') + b'\n'
+
+# 'latency' is seconds from connecting until the handshake reply (or the connect alone without handshake)
+ProbeResult = collections.namedtuple('ProbeResult', ['endpoint', 'ok', 'latency', 'error', 'time'])
+
+
+def parseEndpoint(server, default_port=DEFAULT_PORT):
+	# 'stratum+tcp://host:port', 'host:port' or 'host' -> (host, port)
+	address = str(server).split('://', 1)[-1].split('/', 1)[0]
+	host, sep, port = address.rpartition(':')
+	if sep and port.isdigit() and host:
+		return host.strip('[]'), int(port)
+	return address, int(default_port)
+
+
+async def probe(host, port, timeout=5, handshake=True):
+	# Returns (latency, None), or (None, error message) if the endpoint did not connect or answer in time
+	started = time.perf_counter()
+	writer = None
+	try:
+		reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+		if handshake:
+			writer.write(SUBSCRIBE)
+			await writer.drain()
+			remaining = timeout - (time.perf_counter() - started)
+			line = await asyncio.wait_for(reader.readline(), max(0.001, remaining))
+			if not line:
+				return None, 'connection closed'
+			reply = json.loads(line.decode('utf-8'))
+			if not isinstance(reply, dict) or reply.get('id') != 1:
+				return None, 'unexpected reply'
+			if reply.get('error'):
+				return None, 'error: ' + str(reply['error'])
+		return time.perf_counter() - started, None
+	except asyncio.TimeoutError:
+		return None, 'timeout'
+	except (OSError, ValueError) as e:
+		return None, str(e) or type(e).__name__
+	finally:
+		if writer is not None:
+			writer.close()
+
+
+class EndpointStats():
+	def __init__(self):
+		self.last = None  # Latest ProbeResult
+		self.latency = None  # Smoothed handshake latency of successful probes
+		self.probes = 0
+		self.failures = 0
+		self.penalty_until = 0  # Avoided until then (stale shares)
+
+
+class PoolSelector():
+	def __init__(self, orchestrator, interval=60, probe_interval=300, timeout=5, handshake=True, margin=0.3,
+				 min_gain=0.02, dwell=600, stale_ratio=0.1, stale_min=5, stale_window=600, penalty=1800,
+				 smoothing=0.5, clock=time.monotonic):
+		self.orchestrator = orchestrator
+		self.interval = interval  # Seconds between checks while mining
+		self.probe_interval = probe_interval
+		self.timeout = timeout
+		self.handshake = handshake
+		self.margin = margin
+		self.min_gain = min_gain
+		self.dwell = dwell
+		self.stale_ratio = stale_ratio
+		self.stale_min = stale_min
+		self.stale_window = stale_window
+		self.penalty = penalty
+		self.smoothing = smoothing
+		self.clock = clock
+		self.stats = {}  # (host, port) -> EndpointStats
+		self.moved_at = {}  # Profile name -> time of its last move
+		self.switches = 0
+		self.probed_at = None
+		self._future = None
+
+	def addressOf(self, m, server):
+		return parseEndpoint(server, m.profile.options.get('port', DEFAULT_PORT))
+
+	def miners(self):
+		# Selected miners with more than one endpoint to choose from
+		return [m for m in self.orchestrator.miners
+				if m.profile.name in self.orchestrator.selected and len(m.profile.servers) > 1]
+
+	async def probeAll(self):
+		addresses = sorted(set(self.addressOf(m, s) for m in self.miners() for s in m.profile.servers))
+		results = await asyncio.gather(*[probe(host, port, self.timeout, self.handshake) for host, port in addresses])
+		now = self.clock()
+		for address, (latency, error) in zip(addresses, results):
+			stats = self.stats.setdefault(address, EndpointStats())
+			stats.last = ProbeResult(address, error is None, latency, error, now)
+			stats.probes += 1
+			if error is None:
+				stats.failures = 0
+				stats.latency = latency if stats.latency is None else \
+					self.smoothing * latency + (1 - self.smoothing) * stats.latency
+			else:
+				stats.failures += 1
+		self.probed_at = now
+
+	def usable(self, address, now):
+		stats = self.stats.get(address)
+		return stats is not None and stats.failures == 0 and stats.latency is not None and now >= stats.penalty_until
+
+	def staleShares(self, m):
+		# (rejected, total) shares of the running miner over the last stale_window seconds (samples carry time.time())
+		now = time.time()
+		samples = [s for s in m.output.samples.items() if now - s.time <= self.stale_window]
+		if len(samples) < 2:
+			return 0, 0
+		rejected = samples[-1].rejected - samples[0].rejected
+		accepted = samples[-1].accepted - samples[0].accepted
+		return rejected, accepted + rejected
+
+	def choose(self, m, now):
+		# Returns the endpoint the miner should use, and why if it differs from the current one
+		current = m.server if m.server in m.profile.servers else m.profile.server
+		address = self.addressOf(m, current)
+		reason = None
+		if m.isActive() and m.endpoint == current:
+			rejected, total = self.staleShares(m)
+			if rejected >= self.stale_min and rejected > self.stale_ratio * total:
+				self.stats.setdefault(address, EndpointStats()).penalty_until = now + self.penalty
+				reason = str(rejected) + ' of ' + str(total) + ' shares rejected'
+
+		candidates = [(self.stats[self.addressOf(m, s)].latency, s) for s in m.profile.servers
+					  if self.usable(self.addressOf(m, s), now)]
+		if not candidates:
+			return current, None  # Nothing answers; stay put rather than hop between dead endpoints
+		latency, best = min(candidates, key=lambda c: c[0])
+		if best == current:
+			return current, None
+		if not self.usable(address, now):
+			stats = self.stats.get(address)
+			return best, reason or (stats.last.error if stats and stats.last and stats.last.error else 'unavailable')
+		current_latency = self.stats[address].latency
+		if now - self.moved_at.get(m.profile.name, -self.dwell) < self.dwell:
+			return current, None
+		if latency < current_latency * (1 - self.margin) and current_latency - latency >= self.min_gain:
+			return best, str(round(current_latency * 1000)) + ' ms -> ' + str(round(latency * 1000)) + ' ms'
+		return current, None
+
+	async def check(self, mining):
+		# Probes when the cached results are too old, then moves miners to their best endpoints
+		now = self.clock()
+		if self.probed_at is None or now - self.probed_at >= self.probe_interval:
+			await self.probeAll()
+			now = self.clock()
+		for m in self.miners():
+			server, reason = self.choose(m, now)
+			current = m.server if m.server in m.profile.servers else m.profile.server
+			if server == current:
+				continue
+			print("Pool: '" + m.profile.name + "' " + current + " -> " + server + " (" + reason + ")")
+			m.server = server
+			self.moved_at[m.profile.name] = now
+			self.switches += 1
+			if mining and m.isActive():
+				await m.stop()
+				await m.start(self.orchestrator.optionsFor(m))
+
+	def checkNow(self, mining=False):
+		# Thread-safe, blocking evaluation (used before mining starts)
+		return self.orchestrator.call(self.check(mining))
+
+	def status(self):
+		# 'host:port' -> {'ok', 'latency' (s), 'error', 'avoided'}
+		now = self.clock()
+		result = {}
+		for (host, port), stats in sorted(self.stats.items()):
+			result[host + ':' + str(port)] = {'ok': stats.last.ok if stats.last else None, 'latency': stats.latency,
+											  'error': stats.last.error if stats.last else None,
+											  'avoided': now < stats.penalty_until}
+		return result
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			try:
+				await self.check(True)
+			except Exception as e:
+				print("Pool: " + repr(e))
+
+	def start(self):
+		if self._future is None:
+			self._future = asyncio.run_coroutine_threadsafe(self.run(), self.orchestrator.loop)
+
+	def stop(self):
+		if self._future is not None:
+			self._future.cancel()
+			self._future = None
+
+
+class FakeStratumServer():
+	# Minimal stratum endpoint on localhost. Answers subscribe/authorize/submit after 'delay' seconds; while
+	# 'down' is set, it drops connections without answering. 'reject' is the fraction of submits rejected (as stale).
+	def __init__(self, port=0, host='127.0.0.1', delay=0.0, reject=0.0):
+		self.delay = delay
+		self.reject = reject
+		self.down = False
+		self.connections = 0
+		self.submits = 0
+		server = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				server.connections += 1
+				for line in self.rfile:
+					if server.down:
+						return
+					try:
+						request = json.loads(line.decode('utf-8'))
+					except ValueError:
+						return
+					result = True
+					if request.get('method') == 'mining.subscribe':
+						result = [None, '00000000']
+					elif request.get('method') == 'mining.submit':
+						server.submits += 1
+						result = not (server.reject and server.submits % max(1, round(1 / server.reject)) == 0)
+					time.sleep(server.delay)
+					reply = {'id': request.get('id'), 'result': result, 'error': None if result else [23, 'Stale', None]}
+					self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+		self.tcp = socketserver.ThreadingTCPServer((host, port), Handler)
+		self.tcp.daemon_threads = True
+		self.address = self.tcp.server_address
+		self.endpoint = self.address[0] + ':' + str(self.address[1])
+		self._thread = threading.Thread(target=self.tcp.serve_forever, name='FakeStratum', daemon=True)
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.tcp.shutdown()
+		self.tcp.server_close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Probe stratum endpoints, or serve a fake one for testing.')
+	commands = parser.add_subparsers(dest='command', required=True)
+	serve = commands.add_parser('serve', help='Run a fake stratum endpoint')
+	serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+	serve.add_argument('--delay', type=float, default=0.0, help='Seconds before each reply')
+	serve.add_argument('--reject', type=float, default=0.0, help='Fraction of submitted shares to reject')
+	check = commands.add_parser('probe', help='Time a stratum handshake with each endpoint')
+	check.add_argument('endpoints', nargs='+')
+	check.add_argument('--timeout', type=float, default=5)
+	args = parser.parse_args()
+
+	if args.command == 'serve':
+		fake = FakeStratumServer(args.port, delay=args.delay, reject=args.reject).start()
+		print('Fake stratum endpoint at ' + fake.endpoint + ', Ctrl+C to stop.')
+		try:
+			while True:
+				time.sleep(1)
+		except KeyboardInterrupt:
+			fake.stop()
+	else:
+		for endpoint in args.endpoints:
+			host, port = parseEndpoint(endpoint)
+			latency, error = asyncio.run(probe(host, port, args.timeout))
+			print(endpoint + ': ' + (str(round(latency * 1000, 1)) + ' ms' if error is None else error))
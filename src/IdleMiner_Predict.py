@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import bisect
+import collections
+
+# Idle window prediction.
+#
+# The idle timer only knows how long the user has been away, not how long they will stay away. An IdleModel
+# learns that from the user's own history: every spell of idleness (from one input to the next) of at least a
+# minute is added to a histogram of spell lengths, kept per weekday and time of day (the 'slot' the spell
+# started in, 30 minutes by default), plus one for all spells. Old spells fade out with a half-life of
+# 'half_life' seconds, so the model follows a changing routine.
+#
+# estimate(start, idle) answers for a spell that started at wall-clock time 'start' and has lasted 'idle'
+# seconds so far: given that it has lasted this long, how much longer will it last? It uses the most specific
+# histogram with at least 'min_samples' spells longer than 'idle': that weekday's slot, then the same slot on
+# the same kind of day (Monday to Friday, or the weekend), then all spells. Within a histogram bin, spell
+# lengths are taken to be spread evenly.
+#
+# The model is small (a few hundred histograms of len(EDGES) - 1 counts) and is saved as JSON after each spell.
+# The PredictRule in IdleMiner_Policy.py uses it to start early and to skip short idle windows.
+
+# Histogram bin edges in seconds. Longer spells count as EDGES[-1].
+EDGES = (0, 60, 120, 180, 300, 450, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400, 21600, 28800,
+		 43200, 86400)
+WEEKDAYS = (0, 1, 2, 3, 4)
+WEEKEND = (5, 6)
+MIN_SPELL = EDGES[1]  # Shorter spells are not recorded
+VERSION = 1
+
+# 'samples': weight of the spells longer than the idle time so far, 'level': histogram used ('day', 'slot' or
+# 'all'), 'expected': mean remaining seconds, 'survival': function(seconds) -> probability of lasting at least
+# that many seconds more, 'beyond': function(seconds) -> mean seconds the spell lasts past that many more
+Estimate = collections.namedtuple('Estimate', ['samples', 'level', 'expected', 'survival', 'beyond'])
+
+
+def _above(counts, x):
+	# Weight of the spells longer than x
+	total = 0.0
+	for i, count in enumerate(counts):
+		lo, hi = EDGES[i], EDGES[i + 1]
+		if x <= lo:
+			total += count
+		elif x < hi:
+			total += count * (hi - x) / (hi - lo)
+	return total
+
+
+def _integral(counts, x):
+	# Integral of _above() from x to EDGES[-1]: spell-seconds beyond x
+	total = 0.0
+	beyond = 0.0  # Weight of the spells longer than the current bin
+	for i in range(len(counts) - 1, -1, -1):
+		lo, hi = EDGES[i], EDGES[i + 1]
+		if hi > x:
+			start = max(lo, x)
+			# _above() falls linearly across the bin, from (beyond + the part of the bin above start) to beyond
+			total += (hi - start) * (beyond + counts[i] * (hi - start) / (hi - lo) / 2)
+		beyond += counts[i]
+	return total
+
+
+class IdleModel():
+	def __init__(self, slot=30*60, half_life=28*24*60*60, min_samples=5, path=None):
+		self.slot = slot
+		self.half_life = half_life
+		self.min_samples = min_samples
+		self.path = path  # JSON file the model is loaded from and saved to; None keeps it in memory
+		self.buckets = {}  # 'day-slot' or 'all' -> [time of last update, counts per bin]
+		self.spells = 0
+		if path:
+			self.load()
+
+	def key(self, start):
+		t = time.localtime(start)
+		return str(t.tm_wday) + '-' + str((t.tm_hour*3600 + t.tm_min*60 + t.tm_sec) // self.slot)
+
+	def _decayed(self, bucket, now):
+		factor = 0.5 ** (max(0.0, now - bucket[0]) / self.half_life)
+		return [count * factor for count in bucket[1]]
+
+	def record(self, start, length):
+		# Adds an idle spell that started at wall-clock time 'start' and lasted 'length' seconds
+		if length < MIN_SPELL:
+			return
+		index = min(bisect.bisect_right(EDGES, length), len(EDGES) - 1) - 1
+		for key in (self.key(start), 'all'):
+			bucket = self.buckets.get(key)
+			counts = self._decayed(bucket, start) if bucket else [0.0] * (len(EDGES) - 1)
+			counts[index] += 1
+			self.buckets[key] = [max(start, bucket[0]) if bucket else start, counts]
+		self.spells += 1
+		if self.path:
+			self.save()
+
+	def histograms(self, start, now):
+		# (level, counts) from the most to the least specific
+		key = self.key(start)
+		weekday, _, slot = key.partition('-')
+		day = self.buckets.get(key)
+		same_slot = [0.0] * (len(EDGES) - 1)
+		for day_key in (str(d) + '-' + slot for d in (WEEKEND if int(weekday) in WEEKEND else WEEKDAYS)):
+			if day_key in self.buckets:
+				same_slot = [a + b for a, b in zip(same_slot, self._decayed(self.buckets[day_key], now))]
+		everything = self.buckets.get('all')
+		return [('day', self._decayed(day, now) if day else None), ('slot', same_slot),
+				('all', self._decayed(everything, now) if everything else None)]
+
+	def estimate(self, start, idle, now=None):
+		# Estimate for a spell that started at 'start' and has lasted 'idle' seconds, or None if too few spells
+		# that long have been seen yet
+		now = start + idle if now is None else now
+		idle = min(idle, EDGES[-1] - 1)
+		for level, counts in self.histograms(start, now):
+			if not counts:
+				continue
+			samples = _above(counts, idle)
+			if samples >= self.min_samples:
+				return Estimate(samples, level, _integral(counts, idle) / samples,
+								lambda seconds, c=counts, n=samples: _above(c, idle + seconds) / n,
+								lambda seconds, c=counts, n=samples: _integral(c, idle + seconds) / n)
+		return None
+
+	def load(self):
+		try:
+			with open(self.path) as f:
+				data = json.load(f)
+		except FileNotFoundError:
+			return
+		except (OSError, ValueError) as e:
+			print("Idle model " + self.path + " could not be read, starting a new one: " + repr(e))
+			return
+		if data.get('version') != VERSION or data.get('slot') != self.slot or data.get('edges') != list(EDGES):
+			print("Idle model " + self.path + " has different settings, starting a new one.")
+			return
+		self.buckets = data.get('buckets') or {}
+		self.spells = data.get('spells', 0)
+
+	def save(self):
+		# Writes to a temporary file first, so the model is never left half-written
+		data = {'version': VERSION, 'slot': self.slot, 'edges': list(EDGES), 'spells': self.spells,
+				'buckets': {key: [round(updated, 1), [round(c, 4) for c in counts]]
+							for key, (updated, counts) in self.buckets.items()}}
+		try:
+			with open(self.path + '.tmp', 'w') as f:
+				json.dump(data, f, separators=(',', ':'))
+			os.replace(self.path + '.tmp', self.path)
+		except OSError as e:
+			print("Idle model could not be saved: " + repr(e))
+
+
+class SpellTracker():
+	# Finds the idle spells in the (wall-clock time, idle seconds, mining) samples the policy engine sees and
+	# records them in a model. The scheduler samples rarely, so a spell that ends while not mining is recorded
+	# as the longest idle time seen during it, which may be a little short. While mining, the scheduler wakes
+	# on the first input, so the spell's end is known.
+
+	def __init__(self, model):
+		self.model = model
+		self.start = None  # Wall-clock time of the input that began the current spell
+		self.longest = 0.0
+		self.mining = False  # Whether the previous sample was taken while mining
+
+	def observe(self, now, idle, mining):
+		last_input = now - idle
+		if self.start is None:
+			self.start = last_input
+		elif last_input > self.start + 1:
+			self.model.record(self.start, last_input - self.start if self.mining and mining else self.longest)
+			self.start = last_input
+			self.longest = 0.0
+		self.longest = max(self.longest, idle)
+		self.mining = mining
@@ -0,0 +1,302 @@
+import os
+import sys
+import signal
+import subprocess
+
+# Process tree helpers.
+#
+# Miners often launch helper processes (one per GPU, watchdogs, etc.), so suspending, resuming or killing just
+# the top-level process is not enough. These functions act on a process and all of its descendants.
+# Linux reads /proc, other POSIX systems fall back to 'ps', and Windows uses the Toolhelp snapshot API and
+# NtSuspendProcess/NtResumeProcess through ctypes.
+
+
+def _parentMapProc():
+	parents = {}
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			with open('/proc/' + entry + '/stat', 'rb') as f:
+				stat = f.read()
+		except OSError:
+			continue
+		# The command name is in parentheses and may contain spaces, so split after the last ')'
+		fields = stat[stat.rfind(b')') + 2:].split()
+		parents[int(entry)] = int(fields[1])
+	return parents
+
+
+def _parentMapPs():
+	parents = {}
+	out = subprocess.check_output(['ps', '-A', '-o', 'pid=,ppid='])
+	for line in out.splitlines():
+		pid, ppid = line.split()
+		parents[int(pid)] = int(ppid)
+	return parents
+
+
+def _parentMapWin32():
+	import ctypes
+	from ctypes import wintypes
+
+	class PROCESSENTRY32(ctypes.Structure):
+		_fields_ = [('dwSize', wintypes.DWORD),
+					('cntUsage', wintypes.DWORD),
+					('th32ProcessID', wintypes.DWORD),
+					('th32DefaultHeapID', ctypes.c_void_p),
+					('th32ModuleID', wintypes.DWORD),
+					('cntThreads', wintypes.DWORD),
+					('th32ParentProcessID', wintypes.DWORD),
+					('pcPriClassBase', ctypes.c_long),
+					('dwFlags', wintypes.DWORD),
+					('szExeFile', ctypes.c_char * 260)]
+
+	TH32CS_SNAPPROCESS = 0x2
+	kernel32 = ctypes.windll.kernel32
+	kernel32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+	snapshot = kernel32.CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+	parents = {}
+	try:
+		entry = PROCESSENTRY32()
+		entry.dwSize = ctypes.sizeof(PROCESSENTRY32)
+		ok = kernel32.Process32First(snapshot, ctypes.byref(entry))
+		while ok:
+			parents[entry.th32ProcessID] = entry.th32ParentProcessID
+			ok = kernel32.Process32Next(snapshot, ctypes.byref(entry))
+	finally:
+		kernel32.CloseHandle(snapshot)
+	return parents
+
+
+def parentMap():
+	# Returns a dict of pid -> parent pid for every process on the system
+	if sys.platform == 'win32':
+		return _parentMapWin32()
+	if os.path.isdir('/proc/self'):
+		return _parentMapProc()
+	return _parentMapPs()
+
+
+def descendants(pid):
+	# Returns the pids of all descendants of pid, parents before children
+	children = {}
+	for child, parent in parentMap().items():
+		if child != parent:
+			children.setdefault(parent, []).append(child)
+
+	result = []
+	queue = [pid]
+	while queue:
+		for child in children.get(queue.pop(0), []):
+			if child not in result:
+				result.append(child)
+				queue.append(child)
+	return result
+
+
+def processTree(pid):
+	# pid followed by its descendants
+	return [pid] + descendants(pid)
+
+
+def isAlive(pid):
+	if sys.platform == 'win32':
+		import ctypes
+		PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+		STILL_ACTIVE = 259
+		kernel32 = ctypes.windll.kernel32
+		handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+		if not handle:
+			return False
+		try:
+			code = ctypes.c_ulong()
+			kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+			return code.value == STILL_ACTIVE
+		finally:
+			kernel32.CloseHandle(handle)
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	# Zombies still answer kill(0); treat them as gone since they hold no resources
+	try:
+		with open('/proc/' + str(pid) + '/stat', 'rb') as f:
+			stat = f.read()
+		return stat[stat.rfind(b')') + 2:].split()[0] != b'Z'
+	except OSError:
+		return True
+
+
+def _win32SuspendResume(pids, function):
+	import ctypes
+	PROCESS_SUSPEND_RESUME = 0x0800
+	kernel32 = ctypes.windll.kernel32
+	ntdll = ctypes.windll.ntdll
+	for pid in pids:
+		handle = kernel32.OpenProcess(PROCESS_SUSPEND_RESUME, False, pid)
+		if not handle:
+			continue
+		try:
+			getattr(ntdll, function)(handle)
+		finally:
+			kernel32.CloseHandle(handle)
+
+
+def _signalAll(pids, sig):
+	for pid in pids:
+		try:
+			os.kill(pid, sig)
+		except (ProcessLookupError, PermissionError):
+			pass
+
+
+def suspendTree(pid):
+	# Freezes pid and all of its descendants. The parent is stopped first so it cannot spawn new children
+	# while the tree is being walked. Returns the list of suspended pids.
+	if sys.platform == 'win32':
+		_win32SuspendResume([pid], 'NtSuspendProcess')
+		pids = descendants(pid)
+		_win32SuspendResume(pids, 'NtSuspendProcess')
+	else:
+		_signalAll([pid], signal.SIGSTOP)
+		pids = descendants(pid)
+		_signalAll(pids, signal.SIGSTOP)
+	return [pid] + pids
+
+
+def resumeTree(pid):
+	# Resumes pid and its descendants, children first so the parent never sees them stopped
+	pids = processTree(pid)[::-1]
+	if sys.platform == 'win32':
+		_win32SuspendResume(pids, 'NtResumeProcess')
+	else:
+		_signalAll(pids, signal.SIGCONT)
+	return pids
+
+
+def startOptions():
+	# subprocess keyword arguments that put the miner in its own process group, so the whole group can be
+	# signalled at once and children orphaned by the miner's exit can still be found on POSIX
+	if sys.platform == 'win32':
+		return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+	return {'start_new_session': True}
+
+
+def signalGraceful(process):
+	# Asks a miner started with startOptions() to shut down. Console miners handle Ctrl+Break on Windows.
+	try:
+		if sys.platform == 'win32':
+			process.send_signal(signal.CTRL_BREAK_EVENT)
+		else:
+			os.killpg(process.pid, signal.SIGTERM)
+	except (ProcessLookupError, PermissionError, OSError):
+		pass
+
+
+def killPids(pids, group=None):
+	# Force-kills the given pids, and on POSIX the whole process group 'group'
+	if sys.platform == 'win32':
+		import ctypes
+		PROCESS_TERMINATE = 0x0001
+		kernel32 = ctypes.windll.kernel32
+		for pid in pids:
+			handle = kernel32.OpenProcess(PROCESS_TERMINATE, False, pid)
+			if handle:
+				kernel32.TerminateProcess(handle, 1)
+				kernel32.CloseHandle(handle)
+		return
+
+	if group is not None:
+		try:
+			os.killpg(group, signal.SIGKILL)
+		except (ProcessLookupError, PermissionError):
+			pass
+	_signalAll(pids, signal.SIGKILL)
+
+
+def groupMembers(group):
+	# Pids still in POSIX process group 'group' (empty on Windows)
+	if sys.platform == 'win32' or not os.path.isdir('/proc/self'):
+		return []
+	members = []
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			with open('/proc/' + entry + '/stat', 'rb') as f:
+				stat = f.read()
+		except OSError:
+			continue
+		fields = stat[stat.rfind(b')') + 2:].split()
+		if int(fields[2]) == group and fields[0] != b'Z':
+			members.append(int(entry))
+	return members
+
+
+# Priority names used in the config file, as (POSIX nice value, Windows priority class)
+PRIORITIES = {'normal': (0, 0x00000020),
+			  'below_normal': (10, 0x00004000),
+			  'idle': (19, 0x00000040)}
+
+
+def setPriority(pids, priority):
+	# Sets the scheduling priority of each pid to one of PRIORITIES. Returns the pids whose priority could not be
+	# set: an unprivileged POSIX process may lower a nice value, but not raise it back.
+	nice, priority_class = PRIORITIES[priority]
+	denied = []
+	for pid in pids:
+		try:
+			if sys.platform == 'win32':
+				import ctypes
+				PROCESS_SET_INFORMATION = 0x0200
+				kernel32 = ctypes.windll.kernel32
+				handle = kernel32.OpenProcess(PROCESS_SET_INFORMATION, False, pid)
+				if handle:
+					if not kernel32.SetPriorityClass(handle, priority_class):
+						denied.append(pid)
+					kernel32.CloseHandle(handle)
+			else:
+				os.setpriority(os.PRIO_PROCESS, pid, nice)
+		except PermissionError:
+			denied.append(pid)
+		except OSError:
+			pass  # Already gone
+	return denied
+
+
+def setAffinity(pids, cpus):
+	# Restricts each pid to the given set of CPU indices (None = all CPUs)
+	if cpus is None:
+		cpus = range(os.cpu_count())
+	for pid in pids:
+		try:
+			if sys.platform == 'win32':
+				import ctypes
+				PROCESS_SET_INFORMATION = 0x0200
+				kernel32 = ctypes.windll.kernel32
+				handle = kernel32.OpenProcess(PROCESS_SET_INFORMATION, False, pid)
+				if handle:
+					kernel32.SetProcessAffinityMask(handle, ctypes.c_size_t(sum(1 << c for c in cpus)))
+					kernel32.CloseHandle(handle)
+			elif hasattr(os, 'sched_setaffinity'):
+				os.sched_setaffinity(pid, set(cpus))
+		except (ProcessLookupError, PermissionError, OSError):
+			pass
+
+
+def cpuTimes(pids):
+	# Total user+system CPU seconds used by the given pids (Linux only; 0 elsewhere)
+	total = 0
+	ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+	for pid in pids:
+		try:
+			with open('/proc/' + str(pid) + '/stat', 'rb') as f:
+				stat = f.read()
+		except OSError:
+			continue
+		fields = stat[stat.rfind(b')') + 2:].split()
+		total += (int(fields[11]) + int(fields[12])) / ticks
+	return total
@@ -0,0 +1,113 @@
+import shlex
+
+# Miner profiles.
+#
+# A profile describes one miner process: the binary to run, an argument template, the devices it drives and
+# any extra --key value options. Profiles are read from the MINER_PROFILES section of the config file, e.g.
+#
+#	MINER_PROFILES:
+#	  nvidia:
+#	    binary: C:/miners/ewbf/miner.exe
+#	    type: ewbf
+#	    args: [--server, '{server}', --user, '{user}', --cuda_devices, '{devices}']
+#	    devices: [0, 1]
+#	    options: {intensity: 64, port: 6666}
+#	  amd:
+#	    binary: C:/miners/claymore/ZecMiner64.exe
+#	    type: generic
+#	    args: [-zpool, '{server}', -zwal, '{user}', -di, '{devices}']
+#	    devices: [2]
+#	    device_separator: ''
+#	    algorithm: equihash
+#
+# Placeholders in 'args' are filled from the profile ('server' and 'user' default to POOL_SERVER and
+# USER_ADDRESS). 'server' may be a list of endpoints of the same pool; the first is used unless the pool
+# selector (see IdleMiner_Pools.py) picks another. Without a MINER_PROFILES section, a single 'default' profile is built from the legacy
+# MINER_PATH/POOL_SERVER/USER_ADDRESS/EXTRA_OPTIONS keys.
+#
+# 'algorithm' and 'group' are used by profit switching: profiles in the same group (by default, those driving
+# the same devices) are alternatives, and only one of them runs at a time.
+
+DEFAULT_ARGS = ['--server', '{server}', '--user', '{user}']
+
+
+class MinerProfile():
+	def __init__(self, name, binary, args=None, devices=None, options=None, miner_type='ewbf',
+				 server=None, user=None, device_separator=' ', algorithm=None, group=None):
+		self.name = name
+		self.binary = binary
+		self.args = list(args if args is not None else DEFAULT_ARGS)
+		self.devices = list(devices or [])
+		self.options = dict(options or {})
+		self.miner_type = miner_type
+		self.servers = [str(s) for s in (server if isinstance(server, (list, tuple)) else [server] if server else [])]
+		self.server = self.servers[0] if self.servers else None
+		self.user = user
+		self.device_separator = device_separator
+		self.algorithm = algorithm
+		self.group = group if group is not None else ','.join(str(d) for d in self.devices) or 'all'
+
+	def templateValues(self):
+		return {'name': self.name,
+				'server': self.server or '',
+				'user': self.user or '',
+				'devices': self.device_separator.join(str(d) for d in self.devices)}
+
+	def buildCommand(self, options=None, server=None):
+		# Returns the full command line as a list. 'options' overrides the profile's own extra options, 'server'
+		# the endpoint.
+		values = self.templateValues()
+		if server:
+			values['server'] = server
+		cmd = [self.binary]
+		for arg in self.args:
+			if arg == '{devices}' and self.device_separator == ' ':
+				# Space-separated device lists are passed as separate arguments
+				cmd.extend(str(d) for d in self.devices)
+				continue
+			arg = arg.format(**values)
+			if arg:
+				cmd.append(arg)
+
+		for opt, value in (self.options if options is None else options).items():
+			cmd.append('--' + opt)
+			cmd.append(str(value))
+		return cmd
+
+	def __eq__(self, other):
+		return isinstance(other, MinerProfile) and vars(self) == vars(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return 'MinerProfile(' + self.name + ': ' + ' '.join(shlex.quote(a) for a in self.buildCommand()) + ')'
+
+
+def loadProfiles(config):
+	# Builds the list of MinerProfiles from a parsed config dict
+	server = config.get('POOL_SERVER')
+	user = config.get('USER_ADDRESS')
+
+	if not config.get('MINER_PROFILES'):
+		return [MinerProfile('default', config['MINER_PATH'],
+							 options=config.get('EXTRA_OPTIONS'),
+							 miner_type=config.get('MINER_TYPE', 'ewbf'),
+							 server=server, user=user,
+							 algorithm=config.get('ALGORITHM', 'equihash'))]
+
+	profiles = []
+	for name, p in config['MINER_PROFILES'].items():
+		if not p.get('enabled', True):
+			continue
+		profiles.append(MinerProfile(name, p['binary'],
+									 args=p.get('args'),
+									 devices=p.get('devices'),
+									 options=p.get('options'),
+									 miner_type=p.get('type', 'ewbf'),
+									 server=p.get('server', server),
+									 user=p.get('user', user),
+									 device_separator=str(p.get('device_separator', ' ')),
+									 algorithm=p.get('algorithm'),
+									 group=p.get('group')))
+	return profiles
@@ -0,0 +1,243 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+import urllib.request
+import http.server
+
+import yaml
+
+# Profitability-aware profile switching.
+#
+# Profiles in the same group (see IdleMiner_Profiles.py) are alternative ways to use the same devices. The
+# ProfitSwitcher scores each one as benchmarked hashrate x revenue rate for its algorithm, and keeps the best
+# profile of each group running. Rates come from a pluggable RateSource: a local YAML/JSON file, or any
+# HTTP endpoint returning the same JSON (RateServer below is a local stand-in). Rates are cached for a TTL.
+#
+# A rate table maps algorithm name to revenue per day per unit of hashrate (per Sol/s, H/s, ... as reported
+# by that profile's miner), e.g.
+#
+#	equihash: 0.00000251
+#	ethash: 0.0000000000012
+#
+# Switching costs a restart, so the switcher only moves to a better profile when
+#	- its score beats the current one by more than 'margin' (hysteresis, avoids flapping), and
+#	- the extra revenue until the next evaluation exceeds the revenue lost while the new miner warms up.
+
+
+class RateSource():
+	# Base class for rate backends
+	def fetch(self):
+		# Returns a dict of algorithm -> revenue per day per unit hashrate
+		raise NotImplementedError
+
+
+class FileRateSource(RateSource):
+	def __init__(self, path):
+		self.path = path
+
+	def fetch(self):
+		with open(self.path, 'r') as f:
+			return {str(k): float(v) for k, v in yaml.safe_load(f).items()}
+
+
+class HttpRateSource(RateSource):
+	def __init__(self, url, timeout=5):
+		self.url = url
+		self.timeout = timeout
+
+	def fetch(self):
+		with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+			return {str(k): float(v) for k, v in json.loads(response.read().decode('utf-8')).items()}
+
+
+class CachedRateSource(RateSource):
+	# Caches another source's rates for 'ttl' seconds. If a refresh fails, the stale rates are kept.
+	def __init__(self, source, ttl=300, clock=time.monotonic):
+		self.source = source
+		self.ttl = ttl
+		self.clock = clock
+		self.rates = None
+		self.fetched_at = None
+		self.fetches = 0
+		self.errors = 0
+
+	def fetch(self):
+		now = self.clock()
+		if self.rates is not None and now - self.fetched_at < self.ttl:
+			return self.rates
+		try:
+			self.rates = self.source.fetch()
+			self.fetches += 1
+		except (OSError, ValueError, TypeError, AttributeError, yaml.YAMLError) as e:
+			self.errors += 1
+			print("Rate source error: " + str(e))
+			if self.rates is None:
+				return {}
+		self.fetched_at = now
+		return self.rates
+
+
+def createRateSource(location, ttl=300):
+	# 'location' is a file path or an http(s) URL
+	if location.startswith('http://') or location.startswith('https://'):
+		source = HttpRateSource(location)
+	else:
+		source = FileRateSource(location)
+	return CachedRateSource(source, ttl)
+
+
+def benchmarkedHashrates(config):
+	# Profile name -> hashrate, from BENCHMARK_RESULTS (written by --benchmark) or a profile's own 'hashrate'
+	hashrates = {}
+	for name, result in (config.get('BENCHMARK_RESULTS') or {}).items():
+		hashrates[name] = result['hashrate']
+	for name, p in (config.get('MINER_PROFILES') or {}).items():
+		if 'hashrate' in p:
+			hashrates[name] = p['hashrate']
+	return hashrates
+
+
+class ProfitSwitcher():
+	def __init__(self, orchestrator, rate_source, hashrates, margin=0.05, interval=600, default_warmup=60):
+		self.orchestrator = orchestrator
+		self.rate_source = rate_source
+		self.hashrates = hashrates
+		self.margin = margin
+		self.interval = interval  # Seconds between evaluations while mining
+		self.default_warmup = default_warmup  # Restart cost assumed before a miner's warm-up has been measured
+		self.switches = 0
+		self._future = None
+
+		# Keep one already selected profile per group (the switcher may be rebuilt on a config reload),
+		# otherwise start with the first profile of each group
+		selected = {}
+		for m in orchestrator.miners:
+			if m.profile.name in orchestrator.selected:
+				selected.setdefault(m.profile.group, m.profile.name)
+		for m in orchestrator.miners:
+			selected.setdefault(m.profile.group, m.profile.name)
+		orchestrator.selected = set(selected.values())
+
+	def groups(self):
+		groups = {}
+		for m in self.orchestrator.miners:
+			groups.setdefault(m.profile.group, []).append(m)
+		return groups
+
+	def score(self, miner, rates):
+		# Expected revenue per day, or None when the profile cannot be scored
+		hashrate = self.hashrates.get(miner.profile.name)
+		rate = rates.get(miner.profile.algorithm)
+		if hashrate is None or not isinstance(rate, (int, float)) or isinstance(rate, bool):
+			return None
+		return hashrate * rate
+
+	def restartCost(self, miner):
+		# Seconds of lost mining when switching to this miner
+		return miner.warmup if miner.warmup is not None else self.default_warmup
+
+	def shouldSwitch(self, current_score, best_score, warmup):
+		if current_score is None:
+			return True
+		if best_score <= current_score * (1 + self.margin):
+			return False
+		# Extra revenue over the next interval must pay for the revenue lost during warm-up
+		return (best_score - current_score) * self.interval > best_score * warmup
+
+	def evaluate(self):
+		# Returns a list of (group, old profile name, new profile name) switches worth making now
+		rates = self.rate_source.fetch()
+		switches = []
+		for group, miners in sorted(self.groups().items()):
+			current = next((m for m in miners if m.profile.name in self.orchestrator.selected), None)
+			scored = [(self.score(m, rates), m) for m in miners]
+			scored = [(s, m) for s, m in scored if s is not None]
+			if not scored:
+				continue
+			best_score, best = max(scored, key=lambda sm: sm[0])
+			if current is best:
+				continue
+			current_score = self.score(current, rates) if current is not None else None
+			if self.shouldSwitch(current_score, best_score, self.restartCost(best)):
+				switches.append((group, current.profile.name if current else None, best.profile.name))
+		return switches
+
+	async def check(self, mining):
+		# Evaluates on the orchestrator loop (the rate fetch runs in a worker thread) and applies switches
+		loop = asyncio.get_event_loop()
+		switches = await loop.run_in_executor(None, self.evaluate)
+		for group, old, new in switches:
+			print("Profit switch (" + group + "): " + str(old) + " -> " + new)
+			self.switches += 1
+			await self.orchestrator.replaceProfile(old, new, mining)
+		return switches
+
+	def checkNow(self, mining=False):
+		# Thread-safe, blocking evaluation (used before mining starts)
+		return self.orchestrator.call(self.check(mining))
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			try:
+				await self.check(True)
+			except Exception as e:
+				print("Profit switch: " + repr(e))
+
+	def start(self):
+		if self._future is None:
+			self._future = asyncio.run_coroutine_threadsafe(self.run(), self.orchestrator.loop)
+
+	def stop(self):
+		if self._future is not None:
+			self._future.cancel()
+			self._future = None
+
+
+class RateServer():
+	# Local HTTP stand-in for a rates API. Serves the current 'rates' dict as JSON on any GET path.
+	def __init__(self, rates, port=0, host='127.0.0.1'):
+		self.rates = dict(rates)
+		server = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = json.dumps(server.rates).encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.httpd = http.server.HTTPServer((host, port), Handler)
+		self.url = 'http://' + host + ':' + str(self.httpd.server_address[1]) + '/rates'
+		self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve a rate table file over HTTP as a local rates API.')
+	parser.add_argument('rates', help='YAML/JSON file of algorithm -> revenue per day per unit hashrate')
+	parser.add_argument('--port', type=int, default=8765)
+	args = parser.parse_args()
+
+	rate_server = RateServer(FileRateSource(args.rates).fetch(), args.port).start()
+	print('Serving ' + args.rates + ' at ' + rate_server.url)
+	try:
+		rate_server._thread.join()
+	except KeyboardInterrupt:
+		rate_server.stop()
+		sys.exit(0)
@@ -0,0 +1,379 @@
+import os
+import sys
+import gzip
+import json
+import time
+import bisect
+import socket
+import argparse
+import collections
+import multiprocessing
+
+import yaml
+
+import IdleMiner_Idle as idle
+import IdleMiner_Policy as policy
+
+# Idle policy simulator.
+#
+# Changes to the start/stop logic are hard to judge by living with them, so this records real idle-time traces
+# and replays them against the policy engine and idle scheduler on a virtual clock:
+#
+#	python IdleMiner_Simulator.py record monday.trace			Records user input times until Ctrl+C
+#	python IdleMiner_Simulator.py replay monday.trace			Replays a trace against the config file's policy
+#	python IdleMiner_Simulator.py bench --policies p.yaml traces/*.trace
+#																Every policy against every trace, in parallel
+#
+# A trace holds only the times of user input, at 0.1 s resolution, delta-encoded as varints and gzipped: a
+# working day of continuous mouse use takes a few kilobytes. Replays use the recorded wall-clock times, so
+# window, tariff and budget rules see the hours the trace was actually recorded at. Traces carry no battery
+# state; power rules assume the machine is on AC power.
+#
+# The miners are replaced by a SimulatedMiner with a warm-up (no hashes until it has passed), a steady hashrate
+# and a stop time. Each replay reports:
+#
+#	mined_hours			Time the miners were running (including warm-up)
+#	useful				Share of mined_hours past the warm-up
+#	hashes				Hashes after warm-up (hashrate x seconds, in the unit of --hashrate)
+#	starts, resumes		Fresh miner launches (each costs a warm-up), and paused miners resumed in suspend mode
+#	latency				Start of the user's spell of input until the miners had stopped, for stops caused by the
+#						user coming back (mean, 95th percentile and max): how long the user shared the machine
+#						with a running miner. Inputs less than BURST_GAP seconds apart are one spell.
+#
+# Policies to compare are named in a YAML file, each with any of idle_timer, policy (a POLICY rule list, see
+# IdleMiner_Policy.py), suspend and max_pause; missing keys come from the config file:
+#
+#	current: {}
+#	patient: {idle_timer: 600}
+#	confirm: {policy: [{rule: idle, stop_below: 0.5, confirm: 10}, {rule: min_run, seconds: 600}]}
+#	suspend: {suspend: true, max_pause: 1800}
+#	predict: {policy: [{rule: predict, warmup: 30}]}
+#
+# The predict rule's idle model starts empty on every replay and learns from the trace as it goes, so it needs
+# traces of a few weeks (its 'warmup' should match --warmup).
+
+MAGIC = b'IdleMinerTrace 1\n'
+RESOLUTION = 0.1  # Seconds per trace time unit
+SAVE_INTERVAL = 5*60  # Seconds between saves while recording
+BURST_GAP = 30  # Seconds between inputs that still count as one spell of use
+
+# A recorded trace: wall-clock start, length in seconds, input times in seconds from the start, and the host
+Trace = collections.namedtuple('Trace', ['start', 'duration', 'inputs', 'machine'])
+
+SimResult = collections.namedtuple('SimResult', ['trace', 'policy', 'hours', 'mined_hours', 'productive_hours',
+												 'hashes', 'starts', 'resumes', 'latencies', 'wakeups'])
+
+
+def _varints(values):
+	out = bytearray()
+	for value in values:
+		while value >= 0x80:
+			out.append((value & 0x7F) | 0x80)
+			value >>= 7
+		out.append(value)
+	return bytes(out)
+
+
+def _unvarints(data):
+	values = []
+	value = shift = 0
+	for byte in data:
+		value |= (byte & 0x7F) << shift
+		if byte & 0x80:
+			shift += 7
+		else:
+			values.append(value)
+			value = shift = 0
+	return values
+
+
+def saveTrace(path, trace):
+	# Writes to a temporary file first, so a trace being recorded is never left half-written
+	header = {'start': trace.start, 'duration': trace.duration, 'machine': trace.machine, 'resolution': RESOLUTION,
+			  'inputs': len(trace.inputs)}
+	deltas = []
+	last = 0
+	for t in trace.inputs:
+		tick = max(last, int(round(t / RESOLUTION)))
+		deltas.append(tick - last)
+		last = tick
+	with gzip.open(path + '.tmp', 'wb') as f:
+		f.write(MAGIC + json.dumps(header).encode('utf-8') + b'\n' + _varints(deltas))
+	os.replace(path + '.tmp', path)
+
+
+def loadTrace(path):
+	with gzip.open(path, 'rb') as f:
+		data = f.read()
+	if not data.startswith(MAGIC):
+		raise ValueError(path + ' is not an IdleMiner trace')
+	header, _, body = data[len(MAGIC):].partition(b'\n')
+	header = json.loads(header.decode('utf-8'))
+	inputs = []
+	tick = 0
+	for delta in _unvarints(body):
+		tick += delta
+		inputs.append(tick * header['resolution'])
+	return Trace(header['start'], header['duration'], inputs, header.get('machine'))
+
+
+class TraceRecorder():
+	# Samples an IdleSource every 'interval' seconds and keeps the time of each new input. Continuous input is
+	# recorded as one event per interval, which is all the scheduler can tell apart anyway.
+
+	def __init__(self, source, interval=1.0, wallclock=time.time):
+		self.source = source
+		self.interval = interval
+		self.start = wallclock()
+		self.origin = source.now()
+		self.inputs = []
+		self.last_input = None
+
+	def sample(self):
+		now = self.source.now() - self.origin
+		last_input = now - self.source.getIdleTime()
+		if last_input >= 0 and (self.last_input is None or last_input - self.last_input >= RESOLUTION):
+			self.inputs.append(round(last_input, 1))
+			self.last_input = last_input
+		return now
+
+	def trace(self):
+		return Trace(self.start, self.source.now() - self.origin, list(self.inputs), socket.gethostname())
+
+	def run(self, path, duration=None, save_interval=SAVE_INTERVAL):
+		saved = 0
+		try:
+			while True:
+				now = self.sample()
+				if duration is not None and now >= duration:
+					break
+				if now - saved >= save_interval:
+					saveTrace(path, self.trace())
+					saved = now
+				self.source.sleep(self.interval)
+		except KeyboardInterrupt:
+			pass
+		saveTrace(path, self.trace())
+		return self.trace()
+
+
+class SimulatedMiner():
+	# Stands in for the orchestrator on the virtual clock. In suspend mode a stop is a pause, and starting
+	# again within max_pause seconds resumes without a warm-up.
+
+	def __init__(self, clock, warmup=30, hashrate=1.0, stop_time=1.0, pause_time=0.05):
+		self.clock = clock
+		self.warmup = warmup
+		self.hashrate = hashrate
+		self.stop_time = stop_time  # Seconds from stop request until the miner has exited
+		self.pause_time = pause_time
+		self.mining = False
+		self.started_at = None
+		self.productive_from = None  # When the warm-up of the current run ends
+		self.paused_at = None
+		self.starts = 0
+		self.resumes = 0
+		self.mined = 0.0
+		self.productive = 0.0
+
+	def start(self, resume_within=None):
+		now = self.clock()
+		if self.paused_at is not None and resume_within is not None and now - self.paused_at <= resume_within:
+			self.resumes += 1
+			self.productive_from = now
+		else:
+			self.starts += 1
+			self.productive_from = now + self.warmup
+		self.mining = True
+		self.started_at = now
+		self.paused_at = None
+
+	def stop(self, pause=False):
+		# Returns the seconds until the miner is no longer using the machine
+		now = self.clock()
+		self.mined += now - self.started_at
+		self.productive += max(0.0, now - max(self.started_at, self.productive_from))
+		self.mining = False
+		self.paused_at = now if pause else None
+		return self.pause_time if pause else self.stop_time
+
+	def hashes(self):
+		return self.productive * self.hashrate
+
+
+def loadPolicies(path, config):
+	# Named policy specs from a YAML file (see above), or just the config file's own policy
+	base = {'idle_timer': config.get('IDLE_TIMER', 300), 'policy': config.get('POLICY') or [],
+			'suspend': config.get('SUSPEND_MODE', False), 'max_pause': config.get('SUSPEND_MAX_PAUSE', 30*60)}
+	if path is None:
+		return {'config': base}
+	with open(path) as f:
+		specs = yaml.safe_load(f) or {}
+	policies = {}
+	for name, spec in specs.items():
+		policies[str(name)] = dict(base, **(spec or {}))
+		policy.loadRules(policies[str(name)]['policy'], policies[str(name)]['idle_timer'])  # Fail early if invalid
+	return policies
+
+
+def simulate(trace, spec, warmup=30, hashrate=1.0, stop_time=1.0, name=None, trace_name=None):
+	# Replays a trace against one policy spec and returns a SimResult
+	source = idle.FakeIdleSource(trace.inputs)
+	idle_rule, rules = policy.loadRules(spec['policy'], spec['idle_timer'])
+	for rule in rules:
+		if isinstance(rule, policy.PowerRule):
+			rule.source = policy.FakePowerSource(True, 100)
+	engine = policy.PolicyEngine(idle_rule, rules, clock=source.now, wallclock=lambda: trace.start + source.now())
+	miner = SimulatedMiner(source.now, warmup, hashrate, stop_time)
+	latencies = []
+	scheduler = None
+
+	def onIdle():
+		miner.start(spec['max_pause'] if spec['suspend'] else None)
+		engine.started()
+
+	def onActive():
+		stopping = miner.stop(pause=spec['suspend'])
+		engine.stopped()
+		if scheduler.decision.rule == policy.IdleRule.name:
+			# The user has been sharing the machine since the start of their current spell of input
+			i = bisect.bisect_right(trace.inputs, source.now()) - 1
+			inputs = trace.inputs
+			while i > 0 and inputs[i - 1] > miner.started_at and inputs[i] - inputs[i - 1] <= BURST_GAP:
+				i -= 1
+			first = inputs[i] if i >= 0 and inputs[i] > miner.started_at else source.now()
+			latencies.append(source.now() - first + stopping)
+
+	scheduler = idle.IdleScheduler(source, spec['idle_timer'], onIdle, onActive, lambda: miner.mining,
+								   lambda: True, policy_engine=engine)
+	scheduler.run(until=trace.duration)
+	if miner.mining:
+		miner.stop()
+		engine.stopped()
+	return SimResult(trace_name, name, trace.duration / 3600, miner.mined / 3600, miner.productive / 3600,
+					 miner.hashes(), miner.starts, miner.resumes, latencies, scheduler.wakeups)
+
+
+def percentile(values, fraction):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarise(results):
+	# Adds up results per policy: {policy: dict of totals}, in the order the policies were first seen
+	totals = collections.OrderedDict()
+	for r in results:
+		t = totals.setdefault(r.policy, {'traces': 0, 'hours': 0.0, 'mined_hours': 0.0, 'productive_hours': 0.0,
+										 'hashes': 0.0, 'starts': 0, 'resumes': 0, 'wakeups': 0, 'latencies': []})
+		t['traces'] += 1
+		for key in ('hours', 'mined_hours', 'productive_hours', 'hashes', 'starts', 'resumes', 'wakeups'):
+			t[key] += getattr(r, key)
+		t['latencies'] += r.latencies
+	for t in totals.values():
+		latencies = t.pop('latencies')
+		t['stops'] = len(latencies)
+		t['useful'] = t['productive_hours'] / t['mined_hours'] if t['mined_hours'] else None
+		t['latency_mean'] = sum(latencies) / len(latencies) if latencies else None
+		t['latency_p95'] = percentile(latencies, 0.95)
+		t['latency_max'] = max(latencies) if latencies else None
+	return totals
+
+
+def formatTable(totals):
+	def seconds(value):
+		return '-' if value is None else str(round(value, 1)) + 's'
+
+	lines = ['policy              mined h  useful    hashes        starts  resumes  stops  latency mean/p95/max']
+	for name, t in totals.items():
+		useful = '-' if t['useful'] is None else str(int(round(t['useful'] * 100))) + '%'
+		lines.append(name[:18].ljust(20) + str(round(t['mined_hours'], 1)).rjust(7) + '  ' + useful.rjust(6) + '  ' +
+					 ('%.4g' % t['hashes']).rjust(10) + '  ' + str(t['starts']).rjust(8) + '  ' +
+					 str(t['resumes']).rjust(7) + '  ' + str(t['stops']).rjust(5) + '  ' +
+					 seconds(t['latency_mean']) + ' / ' + seconds(t['latency_p95']) + ' / ' + seconds(t['latency_max']))
+	return '\n'.join(lines)
+
+
+_traces = {}  # Per worker process: path -> Trace, so each trace is decoded once per worker
+
+
+def _runTask(task):
+	path, name, spec, miner_options = task
+	if path not in _traces:
+		_traces[path] = loadTrace(path)
+	return simulate(_traces[path], spec, name=name, trace_name=os.path.basename(path), **miner_options)
+
+
+def bench(paths, policies, miner_options, jobs=None):
+	# Runs every policy against every trace on a pool of worker processes; returns the SimResults
+	tasks = [(path, name, spec, miner_options) for path in paths for name, spec in policies.items()]
+	if jobs == 1 or len(tasks) == 1:
+		return [_runTask(task) for task in tasks]
+	with multiprocessing.Pool(jobs) as pool:
+		# Tasks are grouped by trace, so with chunking each worker decodes few traces
+		return pool.map(_runTask, tasks, chunksize=max(1, len(tasks) // (4 * (jobs or os.cpu_count() or 1))))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Records idle traces and replays them against start/stop policies.')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	record = commands.add_parser('record', help='Record user input times until Ctrl+C')
+	record.add_argument('trace')
+	record.add_argument('--interval', type=float, default=1.0, help='Seconds between idle time samples')
+	record.add_argument('--duration', type=float, default=None, help='Stop after this many seconds')
+
+	for name, text in (('replay', 'Replay traces against the config file policy (or --policies), one by one'),
+					   ('bench', 'Run every policy against every trace in parallel worker processes')):
+		command = commands.add_parser(name, help=text)
+		command.add_argument('traces', nargs='+')
+		command.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+															  'IdleMiner_Config.yaml'))
+		command.add_argument('--policies', default=None, help='YAML file of named policies to compare')
+		command.add_argument('--warmup', type=float, default=30, help='Simulated miner warm-up in seconds')
+		command.add_argument('--hashrate', type=float, default=1.0, help='Simulated miner hashrate after warm-up')
+		command.add_argument('--stop-time', type=float, default=1.0, help='Seconds the simulated miner takes to stop')
+		command.add_argument('--json', default=None, help='Also write the totals to this JSON file')
+		if name == 'bench':
+			command.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes (default: all CPUs)')
+	args = parser.parse_args(argv)
+
+	if args.command == 'record':
+		try:
+			source = idle.createIdleSource()
+		except OSError as e:
+			print("Cannot record user input: " + str(e))
+			sys.exit(1)
+		print('Recording user input to ' + args.trace + ', Ctrl+C to stop.')
+		trace = TraceRecorder(source, args.interval).run(args.trace, args.duration)
+		print('Recorded ' + str(len(trace.inputs)) + ' inputs over ' + str(round(trace.duration / 3600, 2)) + ' h.')
+		return
+
+	with open(args.config) as f:
+		config = yaml.safe_load(f) or {}
+	policies = loadPolicies(args.policies, config)
+	miner_options = {'warmup': args.warmup, 'hashrate': args.hashrate, 'stop_time': args.stop_time}
+	started = time.perf_counter()
+	if args.command == 'replay':
+		results = []
+		for path in args.traces:
+			trace = loadTrace(path)
+			for name, spec in policies.items():
+				result = simulate(trace, spec, name=name, trace_name=os.path.basename(path), **miner_options)
+				print(result.trace + ' / ' + name + ': mined ' + str(round(result.mined_hours, 2)) + ' of ' +
+					  str(round(result.hours, 2)) + ' h, ' + str(result.starts) + ' starts, ' +
+					  str(result.resumes) + ' resumes, ' + str(len(result.latencies)) + ' user stops')
+				results.append(result)
+	else:
+		results = bench(args.traces, policies, miner_options, args.jobs)
+	totals = summarise(results)
+	print(formatTable(totals))
+	print(str(len(results)) + ' replays in ' + str(round(time.perf_counter() - started, 2)) + ' s')
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(totals, f, indent=1)
+
+
+if __name__ == '__main__':
+	main()
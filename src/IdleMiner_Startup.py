@@ -0,0 +1,99 @@
+import sys
+import time
+import builtins
+import threading
+
+# Startup profiling.
+#
+# IdleMiner.bat runs from the Startup folder, where it competes with every other login task, so startup cost
+# is tracked as numbers. With --profile-startup, IdleMiner.py marks the end of each startup phase and prints,
+# once the idle scheduler is running, each phase's wall time and the modules imported during it:
+#
+#	phase          ms  imports  import ms
+#	imports      41.2       96       38.9
+#	config        3.1        0        0.0
+#	...
+#	slowest imports (cumulative ms, self ms): asyncio 22.4 5.1, ...
+#
+# Import times are measured by wrapping __import__ on the main thread, so they include everything a module
+# imports in turn ('cumulative') as well as its own code alone ('self'), like python -X importtime. Modules
+# already imported cost nothing and are not counted. Time spent before this module is imported (interpreter
+# startup, site packages) is not included.
+
+FLAG = '--profile-startup'
+
+
+class ImportTimer():
+	def __init__(self):
+		self.times = {}  # Module name -> (cumulative, self) seconds
+		self._original = None
+		self._thread = threading.get_ident()
+		self._stack = []  # Seconds spent in nested imports, per import in progress
+
+	def install(self):
+		self._original = builtins.__import__
+		builtins.__import__ = self._import
+
+	def uninstall(self):
+		if self._original is not None:
+			builtins.__import__ = self._original
+			self._original = None
+
+	def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+		if level or name in sys.modules or threading.get_ident() != self._thread:
+			return self._original(name, globals, locals, fromlist, level)
+		started = time.perf_counter()
+		self._stack.append(0.0)
+		try:
+			return self._original(name, globals, locals, fromlist, level)
+		finally:
+			elapsed = time.perf_counter() - started
+			nested = self._stack.pop()
+			if self._stack:
+				self._stack[-1] += elapsed
+			self.times[name] = (elapsed, elapsed - nested)
+
+
+class StartupProfiler():
+	# mark(name) ends phase 'name', which ran since the previous mark. Without 'enabled' it does nothing.
+
+	def __init__(self, enabled=False):
+		self.enabled = enabled
+		self.phases = []  # (name, seconds, modules imported, import seconds)
+		self.imports = ImportTimer() if enabled else None
+		self._last = time.perf_counter()
+		self._started = self._last
+		self._seen = set(sys.modules)
+		if self.imports:
+			self.imports.install()
+
+	def mark(self, name):
+		if not self.enabled:
+			return
+		now = time.perf_counter()
+		loaded = set(sys.modules) - self._seen
+		self._seen.update(loaded)
+		# Self times add up to the phase's import time without counting nested imports twice
+		timed = [self.imports.times[m] for m in loaded if m in self.imports.times]
+		self.phases.append((name, now - self._last, len(loaded), sum(own for _, own in timed)))
+		self._last = now
+
+	def total(self):
+		return self._last - self._started
+
+	def report(self, top=10):
+		# Stops timing imports and returns the report as text
+		if not self.enabled:
+			return ''
+		self.imports.uninstall()
+		lines = ['Startup profile:', '  {:<14}{:>9}{:>9}{:>11}'.format('phase', 'ms', 'imports', 'import ms')]
+		for name, seconds, count, import_seconds in self.phases:
+			lines.append('  {:<14}{:>9.1f}{:>9}{:>11.1f}'.format(name, seconds*1000, count, import_seconds*1000))
+		lines.append('  {:<14}{:>9.1f}{:>9}{:>11.1f}'.format('total', self.total()*1000,
+															 sum(p[2] for p in self.phases),
+															 sum(p[3] for p in self.phases)*1000))
+		slowest = sorted(self.imports.times.items(), key=lambda item: -item[1][0])[:top]
+		lines.append('  slowest imports (cumulative ms, self ms): ' +
+					 ', '.join(name + ' ' + str(round(cumulative*1000, 1)) + ' ' + str(round(own*1000, 1))
+							   for name, (cumulative, own) in slowest))
+		return '\n'.join(lines)
@@ -0,0 +1,367 @@
+import os
+import sys
+import glob
+import time
+import shutil
+import asyncio
+import subprocess
+import collections
+
+import IdleMiner_Orchestrator as orch
+
+# Thermal and power governor.
+#
+# While mining, a ThermalGovernor reads temperature and power sensors from a SensorSource every few seconds and
+# steps each miner's intensity down before its devices reach the configured ceiling, instead of letting the GPU
+# (or CPU) throttle itself. For each miner, the sensors that count are those of its profile's devices (gpu0,
+# gpu1, ...), or all GPUs when the profile names none, or the CPU when there are no GPU sensors.
+#
+#	reading >= limit - margin	step down one level (restarting the miner with the lower intensity), at most
+#								once per 'dwell' seconds so the reading can respond; pause at the lowest level
+#	reading >= limit			step down and pause the miner until it has cooled down
+#	reading < limit - 2*margin	for 'settle' seconds: resume, then step back up one level per 'settle' seconds
+#
+# The same applies to a miner's power draw with power_limit (watts). Levels are upper limits on one miner
+# option ('intensity' by default), set through the orchestrator's option_limits, so they combine with the
+# throttle's and the profile's own options by taking the lowest value.
+#
+# The governor also keeps hashes per watt for every profile and option value it has run at, so the most
+# efficient operating point can be read from efficiency() (also in the control API status and metrics).
+#
+# Backends:
+#	HwmonSensorSource		Linux hwmon/sysfs: amdgpu temperature and power, CPU package temperature, RAPL power
+#	NvidiaSmiSensorSource	nvidia-smi (Linux and Windows), when installed
+#	FakeSensorSource		Scripted readings, for tests
+
+# Temperatures in degrees C and power in watts, by sensor name ('gpu0', 'cpu', ...)
+SensorReading = collections.namedtuple('SensorReading', ['temps', 'power'])
+
+DEFAULT_STEPS = (56, 48, 40, 32)
+
+# Pause reason of miners paused by the governor
+THERMAL = 'thermal'
+
+
+class SensorSource():
+	# Base class for sensor backends
+	def read(self):
+		raise NotImplementedError
+
+
+class HwmonSensorSource(SensorSource):
+	CPU_DRIVERS = ('coretemp', 'k10temp', 'zenpower', 'cpu_thermal')
+
+	def __init__(self, sys_root='/sys', clock=time.monotonic):
+		self.sys_root = sys_root
+		self.clock = clock
+		self._rapl = None  # (time, energy in uJ) of the last RAPL reading
+
+	def _read(self, path):
+		try:
+			with open(path) as f:
+				return int(f.read().strip())
+		except (OSError, ValueError):
+			return None
+
+	def _gpuIndex(self, hwmon):
+		cards = glob.glob(os.path.join(hwmon, 'device', 'drm', 'card[0-9]*'))
+		return int(os.path.basename(cards[0])[4:]) if cards else None
+
+	def read(self):
+		temps = {}
+		power = {}
+		for hwmon in glob.glob(os.path.join(self.sys_root, 'class/hwmon/hwmon*')):
+			try:
+				with open(os.path.join(hwmon, 'name')) as f:
+					driver = f.read().strip()
+			except OSError:
+				continue
+			readings = [self._read(p) for p in glob.glob(os.path.join(hwmon, 'temp*_input'))]
+			readings = [r / 1000.0 for r in readings if r is not None]
+			if driver in ('amdgpu', 'nouveau', 'radeon'):
+				index = self._gpuIndex(hwmon)
+				if index is None:
+					continue
+				name = 'gpu' + str(index)
+				if readings:
+					temps[name] = max(readings)
+				watts = self._read(os.path.join(hwmon, 'power1_average'))
+				if watts is None:
+					watts = self._read(os.path.join(hwmon, 'power1_input'))
+				if watts is not None:
+					power[name] = watts / 1e6
+			elif driver in self.CPU_DRIVERS and readings:
+				temps['cpu'] = max(readings + [temps.get('cpu', 0)])
+
+		# CPU package power from the RAPL energy counter
+		energy = self._read(os.path.join(self.sys_root, 'class/powercap/intel-rapl:0/energy_uj'))
+		if energy is not None:
+			now = self.clock()
+			if self._rapl is not None and energy >= self._rapl[1] and now > self._rapl[0]:
+				power['cpu'] = (energy - self._rapl[1]) / 1e6 / (now - self._rapl[0])
+			self._rapl = (now, energy)
+		return SensorReading(temps, power)
+
+
+class NvidiaSmiSensorSource(SensorSource):
+	WINDOWS_PATH = r'C:\Program Files\NVIDIA Corporation\NVSMI\nvidia-smi.exe'
+
+	def __init__(self, path):
+		self.path = path
+
+	@classmethod
+	def find(cls):
+		path = shutil.which('nvidia-smi')
+		if path is None and sys.platform == 'win32' and os.path.exists(cls.WINDOWS_PATH):
+			path = cls.WINDOWS_PATH
+		return cls(path) if path else None
+
+	def read(self):
+		kwargs = {}
+		if sys.platform == 'win32':
+			kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW
+		try:
+			out = subprocess.run([self.path, '--query-gpu=index,temperature.gpu,power.draw',
+								  '--format=csv,noheader,nounits'],
+								 capture_output=True, text=True, timeout=10, **kwargs).stdout
+		except (OSError, subprocess.SubprocessError):
+			return SensorReading({}, {})
+		temps = {}
+		power = {}
+		for line in out.splitlines():
+			fields = [f.strip() for f in line.split(',')]
+			if len(fields) != 3 or not fields[0].isdigit():
+				continue
+			name = 'gpu' + fields[0]
+			for values, text in ((temps, fields[1]), (power, fields[2])):
+				try:
+					values[name] = float(text)
+				except ValueError:
+					pass  # '[N/A]' on cards without the sensor
+		return SensorReading(temps, power)
+
+
+class CombinedSensorSource(SensorSource):
+	# Merges several backends; later ones win for the same sensor
+	def __init__(self, sources):
+		self.sources = sources
+
+	def read(self):
+		temps = {}
+		power = {}
+		for source in self.sources:
+			reading = source.read()
+			temps.update(reading.temps)
+			power.update(reading.power)
+		return SensorReading(temps, power)
+
+
+class FakeSensorSource(SensorSource):
+	def __init__(self, temps=None, power=None):
+		self.set(temps, power)
+
+	def set(self, temps=None, power=None):
+		self.temps = dict(temps or {})
+		self.power = dict(power or {})
+
+	def read(self):
+		return SensorReading(dict(self.temps), dict(self.power))
+
+
+def createSensorSource():
+	sources = []
+	if sys.platform.startswith('linux'):
+		sources.append(HwmonSensorSource())
+	nvidia = NvidiaSmiSensorSource.find()
+	if nvidia:
+		sources.append(nvidia)
+	return CombinedSensorSource(sources)
+
+
+class ThermalGovernor():
+	def __init__(self, orchestrator, source, limit=80, margin=5, power_limit=None, power_margin=None,
+				 option='intensity', steps=DEFAULT_STEPS, interval=10, dwell=30, settle=120, clock=time.monotonic):
+		self.orchestrator = orchestrator
+		self.source = source
+		self.limit = limit
+		self.margin = margin
+		self.power_limit = power_limit
+		self.power_margin = power_margin if power_margin is not None else (power_limit or 0) * 0.05
+		self.option = option
+		self.steps = list(steps)
+		self.interval = interval
+		self.dwell = dwell
+		self.settle = settle
+		self.clock = clock
+		self.level = {}  # Profile name -> 0 (no limit) .. len(steps) (lowest intensity)
+		self.changed_at = {}  # Profile name -> time of its last step down
+		self.cool_since = {}  # Profile name -> time its readings dropped below the cool band
+		self.last_reading = None
+		self.last_tick = None
+		self.efficiency_data = {}  # (profile name, option value) -> [hash x seconds, watt x seconds, seconds]
+		self._future = None
+
+	def sensorsFor(self, miner, reading):
+		# Names of the sensors that count for a miner
+		gpus = sorted(name for name in set(reading.temps) | set(reading.power) if name.startswith('gpu'))
+		if miner.profile.devices:
+			wanted = ['gpu' + str(d) for d in miner.profile.devices]
+			return [name for name in wanted if name in gpus]
+		return gpus or ['cpu']
+
+	def band(self, miner, reading):
+		# How close the miner's devices are to the ceilings: 'hot' (at a limit), 'warm' (within the margin),
+		# 'ok', or 'cool' (more than twice the margin below)
+		sensors = self.sensorsFor(miner, reading)
+		temps = [reading.temps[s] for s in sensors if s in reading.temps]
+		watts = [reading.power[s] for s in sensors if s in reading.power]
+		bands = []
+		if temps and self.limit is not None:
+			bands.append(self._band(max(temps), self.limit, self.margin))
+		if watts and self.power_limit is not None:
+			bands.append(self._band(sum(watts), self.power_limit, self.power_margin))
+		for band in ('hot', 'warm', 'ok'):
+			if band in bands:
+				return band
+		return 'cool'
+
+	def _band(self, value, limit, margin):
+		if value >= limit:
+			return 'hot'
+		if value >= limit - margin:
+			return 'warm'
+		if value >= limit - 2 * margin:
+			return 'ok'
+		return 'cool'
+
+	def isPaused(self, miner):
+		return miner.state == orch.PAUSED and miner.paused_by == THERMAL
+
+	def decide(self, miner, band, now):
+		# Returns the miner's new level and whether it should be paused
+		name = miner.profile.name
+		level = self.level.get(name, 0)
+		paused = self.isPaused(miner)
+		lowest = len(self.steps)
+		if band != 'cool':
+			self.cool_since.pop(name, None)
+		if band == 'hot':
+			self.changed_at[name] = now
+			return min(level + 1, lowest), True
+		if band == 'warm':
+			if level == lowest:
+				return level, True
+			if now - self.changed_at.get(name, now - self.dwell) >= self.dwell:
+				self.changed_at[name] = now
+				return level + 1, paused
+			return level, paused
+		if band == 'ok' or (level == 0 and not paused):
+			return level, paused
+		# Cool: after 'settle' seconds resume, then raise the intensity one level per 'settle' seconds
+		since = self.cool_since.setdefault(name, now)
+		if now - since < self.settle:
+			return level, paused
+		self.cool_since[name] = now
+		if paused:
+			return level, False
+		return level - 1, False
+
+	def limitFor(self, level):
+		return self.steps[level - 1] if level > 0 else None
+
+	async def tick(self):
+		now = self.clock()
+		reading = await asyncio.get_event_loop().run_in_executor(None, self.source.read)
+		self.last_reading = reading
+		self._track(reading, now)
+
+		for m in self.orchestrator.miners:
+			# Miners paused or stopped by the state machine or the throttle are left alone
+			if not (m.isActive() or self.isPaused(m)):
+				continue
+			name = m.profile.name
+			level, pause = self.decide(m, self.band(m, reading), now)
+			if level != self.level.get(name, 0):
+				self.level[name] = level
+				limit = self.limitFor(level)
+				self.orchestrator.option_limits[name] = {self.option: limit} if limit is not None else {}
+				print("Thermal: '" + name + "' " + self.option + " limit " + str(limit) +
+					  " (" + self.describe(m, reading) + ")")
+			if pause and not self.isPaused(m):
+				print("Thermal: pausing '" + name + "' (" + self.describe(m, reading) + ")")
+				m.pause(reason=THERMAL)
+			elif self.isPaused(m) and not pause:
+				print("Thermal: resuming '" + name + "' (" + self.describe(m, reading) + ")")
+				m.resume()
+
+			# A new limit needs a restart; unlike the throttle's, it is applied at once
+			wanted = self.orchestrator.optionsFor(m).get(self.option)
+			if m.isActive() and (m.options or {}).get(self.option) != wanted:
+				await m.stop()
+				await m.start(self.orchestrator.optionsFor(m))
+
+	def describe(self, miner, reading):
+		sensors = self.sensorsFor(miner, reading)
+		parts = [s + ' ' + str(round(reading.temps[s])) + 'C' for s in sensors if s in reading.temps]
+		parts += [s + ' ' + str(round(reading.power[s])) + 'W' for s in sensors if s in reading.power]
+		return ', '.join(parts) or 'no sensors'
+
+	def _track(self, reading, now):
+		# Adds the time since the last tick to each running miner's hashes and energy at its current option value
+		elapsed = now - self.last_tick if self.last_tick is not None else 0
+		self.last_tick = now
+		if elapsed <= 0 or elapsed > 3 * self.interval:
+			return
+		for m in self.orchestrator.miners:
+			if m.state != orch.RUNNING:
+				continue
+			rate = m.hashrate()
+			watts = [reading.power[s] for s in self.sensorsFor(m, reading) if s in reading.power]
+			if rate is None or not watts:
+				continue
+			key = (m.profile.name, (m.options or {}).get(self.option))
+			data = self.efficiency_data.setdefault(key, [0.0, 0.0, 0.0])
+			data[0] += rate * elapsed
+			data[1] += sum(watts) * elapsed
+			data[2] += elapsed
+
+	def efficiency(self):
+		# One dict per profile and option value it ran at (average hashrate and watts, hashes per watt-second),
+		# most efficient first within each profile
+		result = []
+		for (name, value), (hashes, energy, seconds) in self.efficiency_data.items():
+			if energy <= 0:
+				continue
+			result.append({'profile': name, 'option': self.option, 'value': value, 'hashrate': hashes / seconds,
+						   'watts': energy / seconds, 'per_watt': hashes / energy, 'seconds': seconds})
+		result.sort(key=lambda e: (e['profile'], -e['per_watt']))
+		return result
+
+	def best(self):
+		# Profile name -> option value with the most hashes per watt so far
+		best = {}
+		for e in self.efficiency():
+			best.setdefault(e['profile'], e['value'])
+		return best
+
+	async def run(self):
+		while True:
+			try:
+				await self.tick()
+			except Exception as e:
+				print("Thermal: " + repr(e))
+			await asyncio.sleep(self.interval)
+
+	def start(self):
+		# Starts monitoring on the orchestrator loop (called when mining starts). Levels carry over from the last
+		# session, so a machine that ran hot does not start at full intensity again.
+		if self._future is None:
+			self.last_tick = None
+			self.cool_since = {}
+			self._future = asyncio.run_coroutine_threadsafe(self.run(), self.orchestrator.loop)
+
+	def stop(self):
+		# Stops monitoring (called when mining stops); miners it paused are stopped by the state machine
+		if self._future is not None:
+			self._future.cancel()
+			self._future = None
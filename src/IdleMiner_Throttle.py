@@ -0,0 +1,315 @@
+import os
+import sys
+import glob
+import time
+import asyncio
+import collections
+
+import IdleMiner_Process as proc
+import IdleMiner_Orchestrator as orch
+
+# Adaptive intensity throttling.
+#
+# While mining, a ThrottleController samples system load from a LoadSource every few seconds and moves the
+# miners between configured throttle levels, from 'full' down to the lightest level, instead of treating the
+# machine as either idle or busy. Light background work (video playback, a build left running) then shares the
+# machine with a throttled miner rather than stopping it.
+#
+# Each level sets the miners' OS priority and CPU affinity, which are applied to the running process tree in
+# place, and optional miner options (e.g. intensity), which need a restart and are only applied once the
+# level has been stable for restart_dwell seconds. Above the lightest level's load limit, miners are paused.
+#
+# Load is measured excluding the miners' own CPU time, so a miner cannot throttle itself.
+
+# Fractions of capacity in use by everything except the miners (None when unknown)
+LoadSample = collections.namedtuple('LoadSample', ['cpu', 'gpu', 'memory'])
+
+# A throttle level applies while the non-miner load is below 'below'.
+# 'cpus' is the fraction of CPUs the miners may use (None = all), 'options' overrides miner options.
+ThrottleLevel = collections.namedtuple('ThrottleLevel', ['name', 'below', 'priority', 'cpus', 'options'])
+
+DEFAULT_LEVELS = [ThrottleLevel('full', 0.15, 'normal', None, {}),
+				  ThrottleLevel('shared', 0.5, 'below_normal', 0.5, {}),
+				  ThrottleLevel('light', 0.85, 'idle', 0.25, {})]
+
+
+class LoadSource():
+	# Base class for load backends
+	def sample(self, exclude_pids=()):
+		# Returns a LoadSample. exclude_pids are the miners' processes, whose CPU use is not counted.
+		raise NotImplementedError
+
+
+class LinuxLoadSource(LoadSource):
+	# CPU from /proc/stat minus the miners' share from /proc/<pid>/stat, memory from /proc/meminfo, and GPU from
+	# the amdgpu 'gpu_busy_percent' sysfs files. GPU busy time cannot be attributed to processes, so it is only
+	# reported while no miner is running.
+
+	def __init__(self, proc_root='/proc', sys_root='/sys'):
+		self.proc_root = proc_root
+		self.gpu_paths = glob.glob(os.path.join(sys_root, 'class/drm/card*/device/gpu_busy_percent'))
+		self.ticks = os.sysconf('SC_CLK_TCK')
+		self._last = None
+
+	def _cpuTotals(self):
+		with open(os.path.join(self.proc_root, 'stat')) as f:
+			fields = [int(x) for x in f.readline().split()[1:9]]
+		total = sum(fields)
+		idle = fields[3] + fields[4]  # idle + iowait
+		return total / self.ticks, (total - idle) / self.ticks
+
+	def _memory(self):
+		info = {}
+		with open(os.path.join(self.proc_root, 'meminfo')) as f:
+			for line in f:
+				key, value = line.split(':', 1)
+				info[key] = int(value.split()[0])
+		return 1 - info['MemAvailable'] / info['MemTotal']
+
+	def _gpu(self):
+		busy = []
+		for path in self.gpu_paths:
+			try:
+				with open(path) as f:
+					busy.append(int(f.read()) / 100)
+			except (OSError, ValueError):
+				pass
+		return max(busy) if busy else None
+
+	def sample(self, exclude_pids=()):
+		total, busy = self._cpuTotals()
+		miner = proc.cpuTimes(exclude_pids)
+		cpu = None
+		if self._last is not None:
+			d_total = total - self._last[0]
+			if d_total > 0:
+				cpu = min(1.0, max(0.0, ((busy - self._last[1]) - (miner - self._last[2])) / d_total))
+		self._last = (total, busy, miner)
+		return LoadSample(cpu, None if exclude_pids else self._gpu(), self._memory())
+
+
+class Win32LoadSource(LoadSource):
+	# CPU from GetSystemTimes minus the miners' GetProcessTimes, memory from GlobalMemoryStatusEx.
+
+	def __init__(self):
+		import ctypes
+		from ctypes import wintypes
+
+		class MEMORYSTATUSEX(ctypes.Structure):
+			_fields_ = [('dwLength', wintypes.DWORD),
+						('dwMemoryLoad', wintypes.DWORD),
+						('ullTotalPhys', ctypes.c_ulonglong),
+						('ullAvailPhys', ctypes.c_ulonglong),
+						('ullTotalPageFile', ctypes.c_ulonglong),
+						('ullAvailPageFile', ctypes.c_ulonglong),
+						('ullTotalVirtual', ctypes.c_ulonglong),
+						('ullAvailVirtual', ctypes.c_ulonglong),
+						('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+		self._ctypes = ctypes
+		self._MEMORYSTATUSEX = MEMORYSTATUSEX
+		self._kernel32 = ctypes.windll.kernel32
+		self._last = None
+
+	def _filetime(self, ft):
+		return (ft.dwHighDateTime << 32 | ft.dwLowDateTime) / 1e7
+
+	def _processTimes(self, pids):
+		ctypes = self._ctypes
+		from ctypes import wintypes
+		PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+		total = 0
+		for pid in pids:
+			handle = self._kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+			if not handle:
+				continue
+			times = [wintypes.FILETIME() for _ in range(4)]
+			if self._kernel32.GetProcessTimes(handle, *[ctypes.byref(t) for t in times]):
+				total += self._filetime(times[2]) + self._filetime(times[3])
+			self._kernel32.CloseHandle(handle)
+		return total
+
+	def sample(self, exclude_pids=()):
+		ctypes = self._ctypes
+		from ctypes import wintypes
+		idle, kernel, user = wintypes.FILETIME(), wintypes.FILETIME(), wintypes.FILETIME()
+		self._kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user))
+		# Kernel time includes idle time. Both system and process times are CPU-seconds summed over all CPUs.
+		total = self._filetime(kernel) + self._filetime(user)
+		busy = total - self._filetime(idle)
+		miner = self._processTimes(exclude_pids)
+
+		cpu = None
+		if self._last is not None:
+			d_total = total - self._last[0]
+			if d_total > 0:
+				cpu = min(1.0, max(0.0, ((busy - self._last[1]) - (miner - self._last[2])) / d_total))
+		self._last = (total, busy, miner)
+
+		status = self._MEMORYSTATUSEX()
+		status.dwLength = ctypes.sizeof(status)
+		self._kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+		return LoadSample(cpu, None, status.dwMemoryLoad / 100)
+
+
+class FakeLoadSource(LoadSource):
+	# Returns whatever load is set on it, for tests and simulation
+	def __init__(self, cpu=0.0, gpu=None, memory=0.0):
+		self.load = LoadSample(cpu, gpu, memory)
+
+	def set(self, cpu=0.0, gpu=None, memory=0.0):
+		self.load = LoadSample(cpu, gpu, memory)
+
+	def sample(self, exclude_pids=()):
+		return self.load
+
+
+def createLoadSource():
+	if sys.platform == 'win32':
+		return Win32LoadSource()
+	return LinuxLoadSource()
+
+
+def loadLevels(levels_config):
+	# Builds ThrottleLevels from the 'levels' list of the THROTTLE config section
+	levels = []
+	for level in levels_config:
+		levels.append(ThrottleLevel(level['name'], level['below'], level.get('priority', 'normal'),
+									level.get('cpus'), dict(level.get('options') or {})))
+	return levels
+
+
+class ThrottleController():
+	# levels are ordered from full to lightest. Moving to a lighter level happens immediately; moving back
+	# to a heavier one waits until load has stayed low enough for 'settle' seconds.
+
+	def __init__(self, orchestrator, source, levels=DEFAULT_LEVELS, interval=5, settle=30, restart_dwell=120,
+				 memory_limit=0.9, clock=time.monotonic):
+		self.orchestrator = orchestrator
+		self.source = source
+		self.levels = levels
+		self.interval = interval
+		self.settle = settle
+		self.restart_dwell = restart_dwell
+		self.memory_limit = memory_limit
+		self.clock = clock
+		self.level = 0  # Index into levels, or len(levels) when paused
+		self.level_since = clock()
+		self._lower_since = None
+		self._future = None
+		self.last_sample = None
+		self.priority_denied = set()  # Miner pids whose priority could not be set even after a restart
+
+	def levelName(self):
+		return self.levels[self.level].name if self.level < len(self.levels) else 'paused'
+
+	def chooseLevel(self, load):
+		# Index of the heaviest level whose limit is above the load (len(levels) = pause)
+		for idx, level in enumerate(self.levels):
+			if load < level.below:
+				return idx
+		return len(self.levels)
+
+	def decide(self, sample, now):
+		# Returns the level index to use given a LoadSample, applying the settle time when going heavier
+		load = max(x for x in (sample.cpu, sample.gpu, 0) if x is not None)
+		target = self.chooseLevel(load)
+		if sample.memory is not None and sample.memory >= self.memory_limit:
+			target = max(target, len(self.levels) - 1)
+
+		if target >= self.level:
+			self._lower_since = None
+			return target
+
+		if self._lower_since is None:
+			self._lower_since = now
+		if now - self._lower_since >= self.settle:
+			self._lower_since = None
+			return target
+		return self.level
+
+	def _minerPids(self):
+		pids = []
+		for m in self.orchestrator.miners:
+			if m.process is not None and m.process.returncode is None:
+				pids.extend(proc.processTree(m.process.pid))
+		return pids
+
+	async def tick(self):
+		now = self.clock()
+		pids = self._minerPids()
+		self.last_sample = self.source.sample(pids)
+		if self.last_sample.cpu is None:
+			# First sample only primes the CPU counters
+			return
+
+		target = self.decide(self.last_sample, now)
+		if target != self.level:
+			print("Throttle: " + self.levelName() + " -> " +
+				  (self.levels[target].name if target < len(self.levels) else 'paused'))
+			self.level = target
+			self.level_since = now
+		await self.apply(now)
+
+	async def apply(self, now):
+		miners = self.orchestrator.miners
+		if self.level == len(self.levels):
+			for m in miners:
+				if m.isActive():
+					m.pause(reason='throttle')
+			return
+
+		level = self.levels[self.level]
+		self.orchestrator.option_overrides = level.options
+		cpus = None
+		if level.cpus is not None:
+			count = max(1, int(os.cpu_count() * level.cpus))
+			cpus = range(os.cpu_count() - count, os.cpu_count())  # Leave the first cores to the user
+
+		for m in miners:
+			if m.state == orch.PAUSED and m.paused_by == 'throttle':
+				m.resume()
+			if not m.isActive():
+				continue
+			pids = proc.processTree(m.process.pid)
+			if proc.setPriority(pids, level.priority) and m.process.pid not in self.priority_denied:
+				# A process cannot always be raised back from a lower priority; a new one starts at ours
+				print("Throttle: cannot raise '" + m.profile.name + "' back to " + level.priority +
+					  " priority, restarting it")
+				await m.stop()
+				await m.start(self.orchestrator.optionsFor(m))
+				pids = proc.processTree(m.process.pid)
+				if proc.setPriority(pids, level.priority):
+					print("Throttle: cannot set '" + m.profile.name + "' to " + level.priority + " priority")
+					self.priority_denied.add(m.process.pid)
+			proc.setAffinity(pids, cpus)
+
+			# Option changes need a restart, which costs a warm-up, so wait until the level is stable
+			wanted = self.orchestrator.optionsFor(m)
+			if wanted != m.options and now - self.level_since >= self.restart_dwell:
+				print("Throttle: restarting '" + m.profile.name + "' with options " + str(wanted))
+				await m.stop()
+				await m.start(wanted)
+
+	async def run(self):
+		while True:
+			try:
+				await self.tick()
+			except Exception as e:
+				print("Throttle: " + repr(e))
+			await asyncio.sleep(self.interval)
+
+	def start(self):
+		# Starts sampling on the orchestrator loop (called when mining starts)
+		if self._future is None:
+			self.level = 0
+			self.level_since = self.clock()
+			self._lower_since = None
+			self.orchestrator.option_overrides = self.levels[0].options
+			self._future = asyncio.run_coroutine_threadsafe(self.run(), self.orchestrator.loop)
+
+	def stop(self):
+		# Stops sampling (called when mining stops) so the controller does not wake while idle
+		if self._future is not None:
+			self._future.cancel()
+			self._future = None
@@ -10,11 +10,11 @@
 
 import os
 import sys
-import win32api
 import win32con
 import win32gui_struct
-import win32ui
 import time
+import IdleMiner_Icons as icons
+import IdleMiner_Menu as traymenu
 
 try:
 	import winxpgui as win32gui
@@ -43,13 +43,10 @@ class SysTrayIcon(object):
 		self.on_quit = on_quit
 		self.extra_icon_paths = extra_icon_paths
 		
-		menu_options = menu_options + (('Quit', None, self.QUIT),)
-		self._next_action_id = self.FIRST_ID
-		self.menu_actions_by_id = set()
-		self.menu_options = self._add_ids_to_menu_options(list(menu_options))
-		self.menu_actions_by_id = dict(self.menu_actions_by_id)
-		del self._next_action_id
-		
+		# The menu is a MenuTree (see IdleMiner_Menu.py) that callers may keep updating in place,
+		# or a tuple of (text, icon, action) options as in the self test below
+		self.hmenu = None
+		self.set_menu(menu_options)
 		
 		self.default_menu_index = (default_menu_index or 0)
 		self.window_class_name = window_class_name or "SysTrayIconPy"
@@ -61,7 +58,8 @@ class SysTrayIcon(object):
 					   win32con.WM_DESTROY: self.destroy,
 					   win32con.WM_COMMAND: self.command,
 					   win32con.WM_USER+self.OFFSET : self.notify,
-					   win32con.WM_USER+self.OFFSET+1 : self.change_icon,}
+					   win32con.WM_USER+self.OFFSET+1 : self.change_icon,
+					   win32con.WM_SYSCOLORCHANGE: self.sys_color_change,}
 		# Register the Window class.
 		window_class = win32gui.WNDCLASS()
 		hinst = window_class.hInstance = win32gui.GetModuleHandle(None)
@@ -85,6 +83,11 @@ class SysTrayIcon(object):
 										  hinst,
 										  None)
 		win32gui.UpdateWindow(self.hwnd)
+		
+		# Icons and menu bitmaps are loaded once and kept until the window is destroyed
+		self.icons = icons.IconCache(icons.Win32IconBackend(self.hwnd))
+		self.icons.preload([self.icon] + list(self.extra_icon_paths or []), self.menu.iconPaths())
+		
 		self.notify_id = None
 		self.refresh_icon()
 		
@@ -94,50 +97,25 @@ class SysTrayIcon(object):
 		# Runs the main loop that waits for messages in this thread
 		win32gui.PumpMessages()
 		
-	def _add_ids_to_menu_options(self, menu_options):
-		result = []
-		for menu_option in menu_options:
-			option_text, option_icon, option_action = menu_option
-			if callable(option_action) or option_action in self.SPECIAL_ACTIONS: # This will be called if a function is given
-				self.menu_actions_by_id.add((self._next_action_id, option_action))
-				result.append(menu_option + (self._next_action_id,))
-			elif non_string_iterable(option_action): # This will be called when function is replaced by submenu
-				result.append((option_text,
-							   option_icon,
-							   self._add_ids_to_menu_options(option_action), # recursion
-							   self._next_action_id))
-			else:
-				print ('Unknown item', option_text, option_icon, option_action)
-			self._next_action_id += 1
-		return result
-	
+	def set_menu(self, menu_options):
+		if isinstance(menu_options, traymenu.MenuTree):
+			self.menu = menu_options
+		else:
+			self.menu = traymenu.MenuTree(self.FIRST_ID).fromOptions(menu_options)
+		if not any(node.action == self.QUIT for node in self.menu.root.children):
+			self.menu.add(None, 'Quit', action=self.QUIT)
 	
-	def find_menu_option(self, menu_options, id):
-		# A function to recursively parse through all submenus in menu_options looking for a matching 'id'
-		for menu_option in menu_options:
-			_, _, option_action, option_id = menu_option
-			if callable(option_action) or option_action in self.SPECIAL_ACTIONS: # This will be called if a function is given
-				if option_id == id:
-					return menu_option[0]
-			elif non_string_iterable(option_action): # This will be called when function is replaced by submenu
-				return self.find_menu_option(option_action, id) # Search the "action" which is a list of submenu options
-		print("find_menu_option: ID not found.")
-		
+	def find_menu_option(self, id):
+		# Text of the menu option with the given 'id', or None
+		node = self.menu.get(id)
+		if node is None:
+			print("find_menu_option: ID not found.")
+			return None
+		return node.text
 		
 	def refresh_icon(self):
-		# Try and find a custom icon
-		hinst = win32gui.GetModuleHandle(None)
-		if os.path.isfile(self.icon):
-			icon_flags = win32con.LR_LOADFROMFILE | win32con.LR_DEFAULTSIZE
-			hicon = win32gui.LoadImage(hinst,
-									   self.icon,
-									   win32con.IMAGE_ICON,
-									   0,
-									   0,
-									   icon_flags)
-		else:
-			print ("Can't find icon file - using default.")
-			hicon = win32gui.LoadIcon(0, win32con.IDI_APPLICATION)
+		# Cached; falls back to the default application icon if the file is missing
+		hicon = self.icons.trayIcon(self.icon)
 
 		if self.notify_id: message = win32gui.NIM_MODIFY  # NIM_MODIFY sends a message to modify an icon in the taskbar.
 		else: message = win32gui.NIM_ADD  # NIM_ADD sends a message to add an icon in the taskbar.
@@ -153,6 +131,14 @@ class SysTrayIcon(object):
 						  self.hover_text)
 		win32gui.Shell_NotifyIcon(message, self.notify_id)  # Registers the message 'win32con.WM_USER+self.OFFSET' to trigger the 'notify' function on mouse-event
 	
+	def set_hover_text(self, hover_text):
+		# Updates only the tooltip of the existing tray icon (no icon reload). Tooltips are limited to 128 characters.
+		self.hover_text = hover_text[:127]
+		if not self.notify_id:
+			return
+		self.notify_id = self.notify_id[:2] + (win32gui.NIF_TIP,) + self.notify_id[3:5] + (self.hover_text,)
+		win32gui.Shell_NotifyIcon(win32gui.NIM_MODIFY, self.notify_id)
+
 	def restart(self, hwnd, msg, wparam, lparam):
 		self.refresh_icon()
 	
@@ -163,10 +149,19 @@ class SysTrayIcon(object):
 		except IndexError:
 			print("change_icon: Icon paths missing.")
 	
+	def sys_color_change(self, hwnd, msg, wparam, lparam):
+		# Menu bitmaps are drawn on the menu background colour; redraw them with the new one when next shown
+		self.icons.releaseBitmaps()
+		self.menu.dirty = True
+	
 	def destroy(self, hwnd, msg, wparam, lparam):
 		if self.on_quit: self.on_quit(self)
 		nid = (self.hwnd, 0)
 		win32gui.Shell_NotifyIcon(win32gui.NIM_DELETE, nid)
+		if self.hmenu is not None:
+			win32gui.DestroyMenu(self.hmenu)
+			self.hmenu = None
+		self.icons.release()
 		win32gui.PostQuitMessage(0) # Terminate the app.
 
 	def notify(self, hwnd, msg, wparam, lparam):
@@ -177,7 +172,7 @@ class SysTrayIcon(object):
 				pass
 			else:
 				# If default_menu_index >= 0, that menu item will be activated on double left-click
-				self.execute_menu_option(self.default_menu_index + self.FIRST_ID)
+				self.execute_menu_option(self.menu.root.children[self.default_menu_index].id)
 		elif lparam==win32con.WM_RBUTTONUP:  # Right-click handler
 			self.show_menu()
 		elif lparam==win32con.WM_LBUTTONUP:  # Left-click handler
@@ -186,14 +181,20 @@ class SysTrayIcon(object):
 		return True
 		
 	def show_menu(self):
-		menu = win32gui.CreatePopupMenu()
-		self.create_menu(menu, self.menu_options)
+		# The native menu is kept between clicks and only regenerated when the menu tree has changed
+		with self.menu.lock:
+			if self.menu.dirty or self.hmenu is None:
+				if self.hmenu is not None:
+					win32gui.DestroyMenu(self.hmenu)  # Also destroys submenus; the cached bitmaps are not affected
+				self.hmenu = win32gui.CreatePopupMenu()
+				self.create_menu(self.hmenu, self.menu.root.children)
+				self.menu.clean()
 		#win32gui.SetMenuDefaultItem(menu, 1000, 0)
 		
 		pos = win32gui.GetCursorPos()
 		# See http://msdn.microsoft.com/library/default.asp?url=/library/en-us/winui/menus_0hdi.asp
 		win32gui.SetForegroundWindow(self.hwnd)
-		win32gui.TrackPopupMenu(menu,
+		win32gui.TrackPopupMenu(self.hmenu,
 								win32con.TPM_LEFTALIGN,
 								pos[0],
 								pos[1],
@@ -202,91 +203,44 @@ class SysTrayIcon(object):
 								None)
 		win32gui.PostMessage(self.hwnd, win32con.WM_NULL, 0, 0)
 	
-	def create_menu(self, menu, menu_options):
-		for option_text, option_icon, option_action, option_id in menu_options[::-1]:
+	def create_menu(self, menu, nodes):
+		for node in nodes[::-1]:
+			option_icon = node.icon
+			if node.checked and self.menu.check_icon:
+				option_icon = self.menu.check_icon
 			if option_icon:
-				option_icon = self.prep_menu_icon(option_icon)
+				option_icon = self.icons.menuBitmap(option_icon)
+			state = win32con.MFS_CHECKED if node.checked and not self.menu.check_icon else None
 			
-			if option_id in self.menu_actions_by_id:                
-				item, extras = win32gui_struct.PackMENUITEMINFO(text=option_text,
+			if not node.isSubmenu():
+				item, extras = win32gui_struct.PackMENUITEMINFO(text=node.text,
 																hbmpItem=option_icon,
-																wID=option_id)
+																fState=state,
+																wID=node.id)
 				win32gui.InsertMenuItem(menu, 0, 1, item)
 			else:
 				submenu = win32gui.CreatePopupMenu()
-				self.create_menu(submenu, option_action)
-				item, extras = win32gui_struct.PackMENUITEMINFO(text=option_text,
+				self.create_menu(submenu, node.children)
+				item, extras = win32gui_struct.PackMENUITEMINFO(text=node.text,
 																hbmpItem=option_icon,
+																fState=state,
 																hSubMenu=submenu)
 				win32gui.InsertMenuItem(menu, 0, 1, item)
 
 				
 	def update_menu_options(self, menu_options):
-		# Refreshes menu options to update any changes in icons, text, or handler functions
-		self.menu_options = menu_options + (('Quit', None, self.QUIT),)
-		self._next_action_id = self.FIRST_ID
-		self.menu_actions_by_id = set()
-		self.menu_options = self._add_ids_to_menu_options(list(self.menu_options))
-		self.menu_actions_by_id = dict(self.menu_actions_by_id)
-		del self._next_action_id
+		# Replaces the whole menu. Callers holding a MenuTree can update its nodes in place instead.
+		self.set_menu(menu_options)
 		
-	def prep_menu_icon(self, icon):
-		# Version of prep_menu_icon using win32ui package
-		# Source: https://stackoverflow.com/questions/45716730/add-image-in-window-tray-menu/45890829
-		
-		# First load the icon.
-		ico_x = win32api.GetSystemMetrics(win32con.SM_CXSMICON)
-		ico_y = win32api.GetSystemMetrics(win32con.SM_CYSMICON)
-		hicon = win32gui.LoadImage(0, icon, win32con.IMAGE_ICON, ico_x, ico_y, win32con.LR_LOADFROMFILE)
-
-		hwndDC = win32gui.GetWindowDC(self.hwnd)
-		dc = win32ui.CreateDCFromHandle(hwndDC)
-		memDC = dc.CreateCompatibleDC()
-		iconBitmap = win32ui.CreateBitmap()
-		iconBitmap.CreateCompatibleBitmap(dc, ico_x, ico_y)
-		oldBmp = memDC.SelectObject(iconBitmap)
-		brush = win32gui.GetSysColorBrush(win32con.COLOR_MENU)
-
-		win32gui.FillRect(memDC.GetSafeHdc(), (0, 0, ico_x, ico_y), brush)
-		win32gui.DrawIconEx(memDC.GetSafeHdc(), 0, 0, hicon, ico_x, ico_y, 0, 0, win32con.DI_NORMAL)
-
-		memDC.SelectObject(oldBmp)
-		memDC.DeleteDC()
-		win32gui.ReleaseDC(self.hwnd, hwndDC)
-
-		return iconBitmap.GetHandle()
-	
-	def prep_menu_icon_OriginalVersion(self, icon):
-		# Original version of prep_menu_icon function. Deprecated.
-		
-		# First load the icon.
-		ico_x = win32api.GetSystemMetrics(win32con.SM_CXSMICON)
-		ico_y = win32api.GetSystemMetrics(win32con.SM_CYSMICON)
-		hicon = win32gui.LoadImage(0, icon, win32con.IMAGE_ICON, ico_x, ico_y, win32con.LR_LOADFROMFILE)
-
-		hdcBitmap = win32gui.CreateCompatibleDC(0)
-		hdcScreen = win32gui.GetDC(0)
-		hbm = win32gui.CreateCompatibleBitmap(hdcScreen, ico_x, ico_y)
-		hbmOld = win32gui.SelectObject(hdcBitmap, hbm)
-		# Fill the background.
-		brush = win32gui.GetSysColorBrush(win32con.COLOR_MENU)
-		win32gui.FillRect(hdcBitmap, (0, 0, 16, 16), brush)
-		# unclear if brush needs to be feed.  Best clue I can find is:
-		# "GetSysColorBrush returns a cached brush instead of allocating a new
-		# one." - implies no DeleteObject
-		# draw the icon
-		win32gui.DrawIconEx(hdcBitmap, 0, 0, hicon, ico_x, ico_y, 0, 0, win32con.DI_NORMAL)
-		win32gui.SelectObject(hdcBitmap, hbmOld)
-		win32gui.DeleteDC(hdcBitmap)
-		
-		return hbm
-
 	def command(self, hwnd, msg, wparam, lparam):
 		id = win32gui.LOWORD(wparam)
 		self.execute_menu_option(id)
 		
 	def execute_menu_option(self, id):
-		menu_action = self.menu_actions_by_id[id]
+		node = self.menu.get(id)
+		if node is None or node.isSubmenu():
+			return
+		menu_action = node.action
 		
 		if menu_action == self.QUIT:
 			win32gui.DestroyWindow(self.hwnd)  # hwnd = Window Handle (window id?)
@@ -0,0 +1,153 @@
+import json
+import types
+import urllib.error
+import urllib.request
+
+import IdleMiner_Api as api
+import IdleMiner_Events as events
+import IdleMiner_Metrics as metrics
+
+
+class Clock():
+	def __init__(self):
+		self.t = 1000.0
+
+	def __call__(self):
+		return self.t
+
+
+def request(url, path, body=None, method='POST'):
+	data = json.dumps(body).encode('utf-8') if body is not None else None
+	req = urllib.request.Request(url + path, data=data, method=method)
+	try:
+		with urllib.request.urlopen(req, timeout=5) as response:
+			return response.status, response.read().decode('utf-8')
+	except urllib.error.HTTPError as e:
+		return e.code, e.read().decode('utf-8')
+
+
+def server(bus, **kwargs):
+	snapshot = api.StatusSnapshot()
+	commands = api.eventCommands(bus, lambda: ['cpu', 'gpu'])
+	return api.ControlServer(snapshot, commands, lambda: 'idleminer_up 1\n', port=0, **kwargs).start(), snapshot
+
+
+def test_commands_queue_their_events_on_the_bus():
+	bus = events.EventBus(Clock())
+	calls = []
+	machine = events.MinerStateMachine(bus, lambda resume: calls.append(('start', resume)),
+									   lambda pause: calls.append(('stop', pause)))
+	control, snapshot = server(bus)
+	try:
+		snapshot.update({'state': machine.state})
+		assert request(control.url, '/status', method='GET') == (200, '{"state": "idle"}')
+
+		assert request(control.url, '/start') == (202, '{"queued": "manual_start"}')
+		bus.runPending()
+		assert machine.state == events.MANUAL and calls == [('start', False)]
+
+		assert request(control.url, '/pause') == (202, '{"queued": "pause"}')
+		bus.runPending()
+		assert machine.state == events.PAUSED and machine.held and calls[-1] == ('stop', True)
+
+		assert request(control.url, '/start') == (202, '{"queued": "manual_start"}')
+		bus.runPending()
+		assert machine.state == events.MANUAL and calls[-1] == ('start', True)
+
+		assert request(control.url, '/stop') == (202, '{"queued": "manual_stop"}')
+		bus.runPending()
+		assert machine.state == events.IDLE and calls[-1] == ('stop', False)
+	finally:
+		control.stop()
+
+
+def test_timer_and_profile_take_query_or_json_parameters():
+	bus = events.EventBus(Clock())
+	seen = []
+	bus.subscribe([events.SET_TIMER, events.TIMER_ON, events.TIMER_OFF, events.SWITCH_PROFILE],
+				  lambda event: seen.append((event.kind, event.data)))
+	control, snapshot = server(bus)
+	try:
+		assert request(control.url, '/timer?seconds=600&enabled=0') == (202, '{"queued": ["set_timer", "timer_off"]}')
+		assert request(control.url, '/timer', {'enabled': 'yes'}) == (202, '{"queued": ["timer_on"]}')
+		assert request(control.url, '/profile?name=gpu') == (202, '{"queued": "switch_profile"}')
+		bus.runPending()
+		assert seen == [(events.SET_TIMER, 600), (events.TIMER_OFF, None), (events.TIMER_ON, None),
+						(events.SWITCH_PROFILE, 'gpu')]
+
+		# Bad parameters answer 400 and queue nothing
+		for path, body in (('/timer?seconds=2', None), ('/timer', None), ('/timer', {'seconds': 'soon'}),
+						   ('/profile?name=asic', None)):
+			code, text = request(control.url, path, body)
+			assert code == 400 and 'error' in json.loads(text)
+		bus.runPending()
+		assert len(seen) == 4
+	finally:
+		control.stop()
+
+
+def disabled(params):
+	raise ValueError("mining history is disabled")
+
+
+def test_unknown_paths_and_queries():
+	bus = events.EventBus(Clock())
+	queries = {'history/hashes': lambda params: [{'days': int(params['days'])}], 'history/sessions': disabled}
+	control, snapshot = server(bus, queries=queries)
+	try:
+		assert request(control.url, '/launch')[0] == 404
+		assert request(control.url, '/history/nothing', method='GET')[0] == 404
+		assert request(control.url, '/history/hashes?days=7', method='GET') == (200, '[{"days": 7}]')
+		assert request(control.url, '/history/sessions', method='GET')[0] == 400
+		assert request(control.url, '/metrics', method='GET') == (200, 'idleminer_up 1\n')
+	finally:
+		control.stop()
+
+
+def miner(name, unit, rate, starts, resumes):
+	output = types.SimpleNamespace(parser=types.SimpleNamespace(UNIT=unit))
+	return types.SimpleNamespace(profile=types.SimpleNamespace(name=name), output=output, hashrate=lambda: rate,
+								 starts=starts, resumes=resumes)
+
+
+def test_metrics_text():
+	clock = Clock()
+	bus = events.EventBus(clock)
+	machine = events.MinerStateMachine(bus, lambda resume: None, lambda pause: None)
+	bus.post(events.MANUAL_START)
+	clock.t += 0.2
+	bus.runPending()
+	clock.t += 60
+	orchestrator = types.SimpleNamespace(miners=[miner('gpu', 'Sol/s', 603, 2, 1), miner('cpu "x"', 'H/s', None, 1, 0)],
+										 stop_latency=metrics.Histogram())
+	orchestrator.stop_latency.observe(3.0)
+	watchdog = types.SimpleNamespace(status=lambda: {'gpu': {'health': 'healthy', 'restarts': 0},
+													 'cpu "x"': {'health': 'stalled', 'restarts': 3}})
+	pools = types.SimpleNamespace(status=lambda: {'pool:3333': {'ok': True, 'latency': 0.25},
+												  'backup:3333': {'ok': False, 'latency': None}})
+	lines = api.renderMetrics(machine, orchestrator, watchdog=watchdog, pools=pools).splitlines()
+
+	assert 'idleminer_mining_seconds_total 60.0' in lines
+	assert 'idleminer_state{state="manual"} 1' in lines
+	assert 'idleminer_state{state="idle"} 0' in lines
+	assert 'idleminer_hashrate{miner="gpu",unit="Sol/s"} 603.0' in lines
+	assert 'idleminer_hashrate{miner="cpu \\"x\\"",unit="H/s"} 0.0' in lines
+	assert 'idleminer_miner_starts_total{miner="gpu"} 2' in lines
+	assert 'idleminer_miner_resumes_total{miner="gpu"} 1' in lines
+	assert 'idleminer_miner_healthy{miner="gpu",state="healthy"} 1' in lines
+	assert 'idleminer_miner_healthy{miner="cpu \\"x\\"",state="stalled"} 0' in lines
+	assert 'idleminer_watchdog_restarts_total{miner="cpu \\"x\\""} 3' in lines
+	assert 'idleminer_pool_up{endpoint="pool:3333"} 1' in lines
+	assert 'idleminer_pool_up{endpoint="backup:3333"} 0' in lines
+	assert 'idleminer_pool_latency_seconds{endpoint="pool:3333"} 0.25' in lines
+	assert not any(line.startswith('idleminer_pool_latency_seconds{endpoint="backup') for line in lines)
+	assert 'idleminer_stop_latency_seconds_count 1' in lines
+	assert 'idleminer_stop_latency_seconds_bucket{le="+Inf"} 1' in lines
+	assert 'idleminer_decision_latency_seconds_count 1' in lines
+	assert not any(line.startswith('idleminer_temperature_celsius') for line in lines)
+	# Every sample belongs to a declared metric family
+	families = {line.split()[2] for line in lines if line.startswith('# TYPE')}
+	for line in lines:
+		if not line.startswith('#'):
+			name = line.split('{')[0].split()[0]
+			assert name in families or name.rsplit('_', 1)[0] in families
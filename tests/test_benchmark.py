@@ -0,0 +1,47 @@
+import os
+import sys
+import collections
+
+import IdleMiner_Profiles as profiles
+import IdleMiner_Benchmark as benchmark
+import IdleMiner_FakeMiner as fakeminer
+
+FAKE_MINER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'IdleMiner_FakeMiner.py')
+
+Sample = collections.namedtuple('Sample', ['time', 'hashrate'])
+
+
+def test_candidates_cover_every_combination_in_order():
+	space = {'intensity': [32, 64], 'cuda': [0, 1]}
+	assert benchmark.candidates(space) == [{'cuda': 0, 'intensity': 32}, {'cuda': 0, 'intensity': 64},
+										   {'cuda': 1, 'intensity': 32}, {'cuda': 1, 'intensity': 64}]
+	assert benchmark.candidates({}) == [{}]
+
+
+def test_steady_state_drops_warmup_and_missing_readings():
+	samples = [Sample(100, 10.0), Sample(104, 20.0), Sample(105, None), Sample(106, 30.0), Sample(110, 40.0)]
+	steady, discarded = benchmark.steadyState(samples, 100, 5)
+	assert steady == [30.0, 40.0]
+	assert discarded == 3
+
+
+def test_fake_miner_peaks_at_best_intensity():
+	assert fakeminer.hashrateAt(300, 48, 48) == 300
+	assert fakeminer.hashrateAt(300, 32, 48) < 300
+	assert fakeminer.hashrateAt(300, 32, 48) == fakeminer.hashrateAt(300, 64, 48)
+	assert fakeminer.hashrateAt(300, 1000, 48) == 0.0
+
+
+def test_benchmark_picks_the_best_intensity_of_the_fake_miner():
+	profile = profiles.MinerProfile('fake', sys.executable, args=[FAKE_MINER],
+									options={'rate': 300, 'warmup': 0, 'interval': 0.2, 'noise': 0, 'seed': 1})
+	bench = benchmark.Benchmark(profile, {'intensity': [16, 48]}, window=2, warmup=0.5)
+	seen = []
+	best = bench.run(onResult=seen.append)
+
+	assert len(seen) == 2
+	assert all(r.samples > 0 for r in seen)
+	assert best.options['intensity'] == 48
+	assert abs(best.hashrate - 300) < 5
+	assert seen[0].hashrate < best.hashrate
+	assert best.options['rate'] == 300  # The profile's own options are kept
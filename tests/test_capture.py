@@ -0,0 +1,75 @@
+import os
+import gzip
+
+import IdleMiner_Capture as capture
+
+
+def lines(path):
+	# Captured lines without their timestamps
+	opener = gzip.open if path.endswith('.gz') else open
+	with opener(path, 'rb') as f:
+		return [line.rstrip(b'\n')[20:] for line in f]
+
+
+def test_lines_are_stamped_and_kept_in_the_tail(tmp_path):
+	manager = capture.CaptureManager(str(tmp_path), tail=3, flush_interval=0.05).start()
+	log = manager.open('gpu 0')
+	log.mark('started')
+	for i in range(4):
+		log.write(b'\x1b[32mline ' + str(i).encode('ascii') + b'\x1b[0m\r\n')
+	manager.close()
+
+	assert log.path == os.path.join(str(tmp_path), 'miner-gpu_0.log')
+	assert lines(log.path)[0] == b'-- started --'
+	assert len(lines(log.path)) == 5
+	assert [line[9:] for line in log.lastLines()] == ['line 1', 'line 2', 'line 3']
+	assert [line[9:] for line in log.lastLines(1)] == ['line 3']
+	assert log.lastLines(0) == []
+	assert manager.status()['gpu 0'] == {'lines': 5, 'dropped': 0, 'file': log.path, 'segments': 0}
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path):
+	manager = capture.CaptureManager(str(tmp_path), queue_size=10)  # Writer not started
+	log = manager.open('gpu')
+	for i in range(15):
+		log.write(b'line')
+	assert len(manager.pending) == 10
+	assert log.dropped == 5
+	assert log.lines == 15
+	assert len(log.tail) == 15
+
+
+def test_rotates_at_max_file_and_compresses_segments(tmp_path):
+	manager = capture.CaptureManager(str(tmp_path), max_file=1000, max_total=10**6, flush_interval=0.05).start()
+	log = manager.open('gpu')
+	written = [('line %03d ' % i).encode('ascii') + b'x' * 40 for i in range(100)]
+	for line in written:
+		log.write(line)
+	manager.close()
+
+	segments = log.segments()
+	assert manager.rotations == len(segments) >= 6
+	assert all(s.endswith('.log.gz') for s in segments)
+	assert len(set(segments)) == len(segments)  # Rotations within one second get a suffix
+	assert os.path.getsize(log.path) <= 1000
+	captured = [line for s in segments for line in lines(s)] + lines(log.path)
+	assert sorted(captured) == written
+	assert manager.deleted == 0
+
+
+def test_prunes_oldest_segments_to_max_total(tmp_path):
+	other = tmp_path / 'notes.log'
+	other.write_bytes(b'x' * 5000)  # Not a capture file, never counted or deleted
+	manager = capture.CaptureManager(str(tmp_path), max_file=1000, max_total=4000, flush_interval=0.05).start()
+	log = manager.open('gpu')
+	for i in range(300):
+		log.write(os.urandom(20).hex().encode('ascii'))
+	manager.close()
+
+	assert manager.deleted > 0
+	assert os.path.exists(log.path)
+	assert other.exists()
+	total = sum(os.path.getsize(os.path.join(str(tmp_path), n)) for n in os.listdir(str(tmp_path))
+				if n.startswith(capture.PREFIX))
+	assert total <= 4000
+	assert manager.rotations == manager.deleted + len(log.segments())
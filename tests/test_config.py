@@ -0,0 +1,173 @@
+import os
+import time
+import threading
+
+import yaml
+import pytest
+
+import IdleMiner_Config as cfg
+
+
+def wait(condition, timeout=5):
+	deadline = time.monotonic() + timeout
+	while not condition():
+		if time.monotonic() > deadline:
+			return False
+		time.sleep(0.01)
+	return True
+
+
+def write(path, data):
+	with open(path, 'w') as f:
+		yaml.dump(data, f)
+
+
+def test_schema_rejects_bad_values():
+	assert cfg.validate({'IDLE_TIMER': 600, 'SUSPEND_MODE': True}) == []
+	assert cfg.validate(['IDLE_TIMER']) == ['top level must be a mapping']
+	assert cfg.validate({'IDLE_TIMER': '600'}) == ['IDLE_TIMER: wrong type str']
+	assert cfg.validate({'IDLE_TIMER': True}) == ['IDLE_TIMER: wrong type bool']
+	assert cfg.validate({'IDLE_TIMER': 2}) == ['IDLE_TIMER: must be between 5 and 3600 seconds']
+	assert cfg.validate({'STOP_TIMEOUT': 0}) == ['STOP_TIMEOUT: must be positive']
+	assert cfg.validate({'POLICY': [{'rule': 'no_such_rule'}]})[0].startswith('POLICY: ')
+	assert cfg.validate({'THROTTLE': {'levels': [{'name': 'full'}]}}) == \
+		['THROTTLE.levels: each level needs a name and a below limit']
+	assert cfg.validate({'THERMAL': {'steps': []}}) == ['THERMAL.steps: must be a list of numbers']
+	with pytest.raises(cfg.ConfigError):
+		cfg.parse('IDLE_TIMER: 1\n')
+
+
+def test_config_is_immutable_with_defaults():
+	config = cfg.parse('IDLE_TIMER: 600\nSUSPEND_MODE:\nEXTRA_OPTIONS: {intensity: 64}\n')
+	assert config.IDLE_TIMER == 600 and config['IDLE_TIMER'] == 600
+	assert config.SUSPEND_MODE is False  # Left empty: default
+	assert config.STOP_TIMEOUT == 5
+	with pytest.raises(AttributeError):
+		config.IDLE_TIMER = 60
+	with pytest.raises(TypeError):
+		config.EXTRA_OPTIONS['intensity'] = 32
+	data = config.toDict()
+	data['EXTRA_OPTIONS']['intensity'] = 32
+	assert config.EXTRA_OPTIONS['intensity'] == 64
+
+
+def test_write_atomic_keeps_mode_and_never_shows_a_partial_file(tmp_path):
+	path = str(tmp_path / 'config.yaml')
+	versions = [{'IDLE_TIMER': 300 + i, 'EXTRA_OPTIONS': {'opt' + str(k): 'x' * 50 for k in range(200)}}
+				for i in range(30)]
+	cfg.writeAtomic(path, versions[0])
+	os.chmod(path, 0o600)
+
+	seen = []
+	stop = threading.Event()
+
+	def read():
+		while not stop.is_set():
+			with open(path) as f:
+				seen.append(yaml.safe_load(f))
+
+	reader = threading.Thread(target=read)
+	reader.start()
+	try:
+		for data in versions[1:]:
+			cfg.writeAtomic(path, data)
+	finally:
+		stop.set()
+		reader.join()
+	assert seen and all(data in versions for data in seen)
+	assert os.stat(path).st_mode & 0o777 == 0o600
+	assert os.listdir(str(tmp_path)) == ['config.yaml']
+
+
+def test_failed_write_leaves_the_old_file(tmp_path):
+	path = str(tmp_path / 'config.yaml')
+	cfg.writeAtomic(path, {'IDLE_TIMER': 300})
+	with pytest.raises(yaml.YAMLError):
+		cfg.writeAtomic(path, {'IDLE_TIMER': object()})
+	assert cfg.load(path).IDLE_TIMER == 300
+	assert os.listdir(str(tmp_path)) == ['config.yaml']
+
+
+def test_writer_coalesces_updates_and_keeps_hand_edits(tmp_path):
+	path = str(tmp_path / 'config.yaml')
+	write(path, {'IDLE_TIMER': 300})
+	writer = cfg.ConfigWriter(path, debounce=0.2)
+	writer.update({'IDLE_TIMER': 600})
+	writer.update({'SUSPEND_MODE': True})
+	write(path, {'IDLE_TIMER': 300, 'STOP_TIMEOUT': 10})  # Edited by hand meanwhile
+	writer.update({'IDLE_TIMER': 900})
+	time.sleep(0.1)
+	assert writer.writes == 0
+	assert wait(lambda: writer.writes == 1)
+	time.sleep(0.3)
+	assert writer.writes == 1
+	assert cfg.load(path).toDict()['IDLE_TIMER'] == 900
+	with open(path) as f:
+		assert yaml.safe_load(f) == {'IDLE_TIMER': 900, 'SUSPEND_MODE': True, 'STOP_TIMEOUT': 10}
+
+
+def test_writer_does_not_save_invalid_changes(tmp_path, capsys):
+	path = str(tmp_path / 'config.yaml')
+	write(path, {'IDLE_TIMER': 300})
+	writer = cfg.ConfigWriter(path)
+	writer.update({'IDLE_TIMER': 1})
+	writer.flush()
+	assert writer.writes == 0
+	assert cfg.load(path).IDLE_TIMER == 300
+	assert 'Not saving config' in capsys.readouterr().out
+
+
+class PollingWatcher(cfg.ConfigWatcher):
+	# The fallback used where no change notification API is available
+	POLL_INTERVAL = 0.05
+
+	def run(self):
+		self._runPolling()
+
+
+def test_polling_waits_for_a_rewrite_to_finish(tmp_path):
+	path = str(tmp_path / 'config.yaml')
+	write(path, {'IDLE_TIMER': 600})
+	changes = []
+	watcher = PollingWatcher(path, cfg.load(path), lambda new, old: changes.append((old.IDLE_TIMER, new.IDLE_TIMER)))
+	watcher.SETTLE = 0.3
+	watcher.start()
+	try:
+		time.sleep(0.2)
+		with open(path, 'w') as f:
+			f.flush()  # Empty for a few polls, which would load as the defaults
+			time.sleep(0.1)
+			f.write('IDLE_TIMER: 900\n')
+		assert wait(lambda: changes == [(600, 900)])
+		time.sleep(0.2)
+		assert changes == [(600, 900)]
+	finally:
+		watcher.stop()
+		watcher.join(5)
+
+
+@pytest.mark.parametrize('watcher_class', [cfg.ConfigWatcher, PollingWatcher])
+def test_watcher_applies_edits_and_ignores_invalid_ones(tmp_path, watcher_class):
+	path = str(tmp_path / 'config.yaml')
+	write(path, {'IDLE_TIMER': 300})
+	changes = []
+	watcher = watcher_class(path, cfg.load(path), lambda new, old: changes.append((old.IDLE_TIMER, new.IDLE_TIMER)))
+	watcher.start()
+	try:
+		time.sleep(0.2)
+		cfg.writeAtomic(path, {'IDLE_TIMER': 600})
+		assert wait(lambda: changes == [(300, 600)])
+
+		with open(path, 'w') as f:
+			f.write('IDLE_TIMER: 1\n')  # Invalid: the previous config stays
+		time.sleep(0.5)
+		assert watcher.config.IDLE_TIMER == 600
+
+		with open(path, 'w') as f:
+			f.write('IDLE_TIMER: 900\n')
+		assert wait(lambda: changes == [(300, 600), (600, 900)])
+		assert watcher.reloads == 2
+	finally:
+		watcher.stop()
+		watcher.join(5)
+	assert not watcher.is_alive()
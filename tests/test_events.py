@@ -0,0 +1,153 @@
+import IdleMiner_Events as events
+import IdleMiner_Idle as idle
+
+
+class Harness():
+	# A state machine on a bus dispatched by hand, with an idle scheduler on a fake clock
+	def __init__(self, idle_timer=60, inputs=(), hold_on_stop=False, suspend=False):
+		self.source = idle.FakeIdleSource(inputs)
+		self.bus = events.EventBus(clock=self.source.now)
+		self.calls = []
+		self.machine = events.MinerStateMachine(self.bus, lambda resume: self.calls.append(('start', resume)),
+												lambda pause: self.calls.append(('stop', pause)),
+												suspend=lambda: suspend, hold_on_stop=hold_on_stop)
+		self.scheduler = idle.IdleScheduler(self.source, idle_timer,
+											lambda: self.bus.post(events.IDLE_DETECTED),
+											lambda: self.bus.post(events.USER_ACTIVE),
+											self.machine.isMining, self.machine.timerEnabled)
+		# As in IdleMiner.py: re-evaluate whenever the mining state or the timer setting changes
+		self.bus.subscribe([events.STATE, events.TIMER_ON, events.TIMER_OFF], lambda event: self.scheduler.wake())
+
+	def post(self, kind, data=None):
+		self.bus.post(kind, data)
+		self.bus.runPending()
+
+	def run(self, seconds):
+		# Runs the scheduler for 'seconds' of fake time, dispatching events after each pass
+		until = self.source.now() + seconds
+		while self.source.now() < until:
+			timeout, forInput = self.scheduler.step()
+			self.bus.runPending()
+			if timeout == 0:
+				continue
+			remaining = until - self.source.now()
+			timeout = remaining if timeout is None else min(timeout, remaining)
+			if forInput:
+				self.source.waitForInput(timeout)
+			else:
+				self.source.sleep(timeout)
+
+	def states(self):
+		return [t.new for t in self.machine.transitions]
+
+
+def test_headless_stop_stays_stopped():
+	# Without input, idle time never resets: a stop request must not be undone by the idle timer
+	h = Harness(idle_timer=60, hold_on_stop=True)
+	h.run(61)
+	assert h.machine.state == events.MINING
+	h.post(events.MANUAL_STOP)
+	assert h.machine.state == events.IDLE
+	h.run(600)
+	assert h.machine.state == events.IDLE
+	assert h.machine.held
+	assert [c[0] for c in h.calls] == ['start', 'stop']
+	h.post(events.MANUAL_START)
+	assert h.machine.state == events.MANUAL and not h.machine.held
+
+
+def test_headless_stop_before_start_holds():
+	h = Harness(idle_timer=60, hold_on_stop=True)
+	h.post(events.MANUAL_STOP)
+	h.run(600)
+	assert h.machine.state == events.IDLE
+	assert h.calls == []
+
+
+def test_stop_without_hold_lets_idle_timer_restart():
+	h = Harness(idle_timer=60)
+	h.run(61)
+	h.post(events.MANUAL_STOP)
+	assert not h.machine.held
+	h.run(1)
+	assert h.machine.state == events.MINING
+
+
+def test_idle_start_and_user_stop():
+	h = Harness(idle_timer=60, inputs=[0, 100])
+	h.run(99)
+	assert h.machine.state == events.MINING
+	h.run(2)
+	assert h.machine.state == events.IDLE
+	assert h.states() == [events.STARTING, events.MINING, events.STOPPING, events.IDLE]
+	assert h.calls == [('start', False), ('stop', False)]
+	assert [t.event for t in h.machine.transitions][-1] == events.USER_ACTIVE
+
+
+def test_suspend_pauses_and_resumes():
+	h = Harness(idle_timer=60, inputs=[0, 100], suspend=True)
+	h.run(200)
+	assert h.calls == [('start', False), ('stop', True), ('start', True)]
+	assert h.machine.state == events.MINING
+
+
+def test_pause_holds_until_a_manual_start():
+	h = Harness(idle_timer=60)
+	h.run(61)
+	h.post(events.PAUSE)
+	assert h.machine.state == events.PAUSED and h.machine.held
+	assert not h.machine.timerEnabled()
+	h.run(600)
+	assert h.machine.state == events.PAUSED
+	h.post(events.MANUAL_START)
+	assert h.machine.state == events.MANUAL and not h.machine.held
+	assert h.calls[-1] == ('start', True)
+
+
+def test_manual_mode_overrides_the_timer():
+	h = Harness(idle_timer=60, inputs=[0, 30])
+	h.post(events.MANUAL_START)
+	assert h.machine.state == events.MANUAL
+	h.run(100)
+	assert h.machine.state == events.MANUAL  # User input does not stop manual mining
+	h.post(events.MANUAL_STOP)
+	assert h.machine.state == events.IDLE
+
+
+def test_quit_from_paused_stops_the_miners():
+	h = Harness(idle_timer=60)
+	h.run(61)
+	h.post(events.PAUSE)
+	h.post(events.QUIT)
+	assert h.machine.state == events.IDLE
+	assert h.calls[-1] == ('stop', False)
+
+
+def test_timer_off_blocks_idle_starts():
+	h = Harness(idle_timer=60)
+	h.post(events.TIMER_OFF)
+	h.run(600)
+	assert h.machine.state == events.IDLE and h.calls == []
+	h.post(events.TIMER_ON)
+	h.run(1)
+	assert h.machine.state == events.MINING
+
+
+def test_failed_start_returns_to_idle(capsys):
+	bus = events.EventBus()
+
+	def start(resume):
+		raise OSError('miner missing')
+
+	machine = events.MinerStateMachine(bus, start, lambda pause: None)
+	bus.post(events.MANUAL_START)
+	bus.runPending()
+	assert machine.state == events.IDLE
+	assert 'miner missing' in capsys.readouterr().out
+
+
+def test_mining_seconds_and_latency():
+	h = Harness(idle_timer=60, inputs=[0, 160])
+	h.run(200)
+	assert h.machine.miningSeconds() == 100
+	assert h.machine.latency.count == 2
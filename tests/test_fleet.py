@@ -0,0 +1,108 @@
+import IdleMiner_Fleet as fleet
+
+
+class Host():
+	# Status the agent reports; 'uptime' changes with every snapshot
+	def __init__(self):
+		self.status = {'state': 'mining', 'hashrate': {'Sol/s': 100.0}, 'uptime': 0}
+		self.config = {}
+
+	def getStatus(self):
+		self.status['uptime'] += 1
+		return dict(self.status)
+
+
+def agent(url, **kwargs):
+	host = Host()
+	return fleet.FleetAgent(url, host.getStatus, host.config.update, name='pc-1', **kwargs), host
+
+
+def test_reports_are_deltas_and_a_full_queue_merges_the_oldest():
+	a, host = agent('http://127.0.0.1:1', buffer=3)
+	a.snapshot(1000)
+	host.status['state'] = 'idle'
+	a.snapshot(1010)
+	assert a.queue[0]['full'] and a.queue[0]['changes']['hashrate'] == {'Sol/s': 100.0}
+	assert a.queue[1] == {'seq': 2, 'base': 1, 'time': 1010, 'full': False, 'changes': {'state': 'idle', 'uptime': 2}}
+	for t in (1020, 1030, 1040):
+		a.snapshot(t)
+	assert len(a.queue) == 3
+	assert a.merged == 2
+	assert a.queue[0]['full'] and a.queue[0]['seq'] == 3
+	assert [r['base'] for r in list(a.queue)[1:]] == [3, 4]
+
+
+def test_buffers_while_down_and_resyncs_after_a_coordinator_restart():
+	coordinator = fleet.FleetCoordinator(port=0).start()
+	port = coordinator.httpd.server_address[1]
+	try:
+		a, host = agent(coordinator.url, timeout=2)
+		a.snapshot(1000)
+		assert a.send()
+		assert a.connected and a.sent == 1 and not a.queue
+		assert coordinator.hosts['pc-1'].status['uptime'] == 1
+	finally:
+		coordinator.stop()
+
+	# Coordinator down: reports stay queued
+	for t in (1010, 1020, 1030):
+		a.snapshot(t)
+	assert not a.send()
+	assert a.connected is False
+	assert len(a.queue) == 3
+
+	# It comes back on the same port with no memory of the host
+	coordinator = fleet.FleetCoordinator(port=port).start()
+	try:
+		assert a.send()
+		assert a.queue[0]['full'] and a.queue[0]['seq'] == 2
+		assert a.queue[0]['changes']['state'] == 'mining'  # Carried over from the acknowledged status
+		assert coordinator.hosts['pc-1'].resyncs == 1 and coordinator.hosts['pc-1'].seq is None
+		assert a.send()
+		assert not a.queue
+		assert a.sent == 4
+
+		h = coordinator.summary()['hosts']['pc-1']
+		assert h['state'] == 'mining'
+		assert coordinator.hosts['pc-1'].status['uptime'] == 4
+		assert h['hashes'] == {'Sol/s': 2000.0}  # 1010 to 1030, reported after the outage
+		assert h['config_current']
+	finally:
+		coordinator.stop()
+
+
+def test_missed_report_asks_for_a_resync():
+	coordinator = fleet.FleetCoordinator(port=0).start()
+	try:
+		a, host = agent(coordinator.url, timeout=2)
+		a.snapshot(1000)
+		a.send()
+		a.snapshot(1010)
+		a.queue.popleft()  # Lost on the way
+		a.snapshot(1020)
+		assert a.send()
+		assert coordinator.hosts['pc-1'].resyncs == 1
+		assert a.queue[0]['full']
+		assert a.send()
+		assert coordinator.hosts['pc-1'].seq == 3
+		assert coordinator.hosts['pc-1'].status['uptime'] == 3
+	finally:
+		coordinator.stop()
+
+
+def test_pushes_config_once(tmp_path):
+	path = tmp_path / 'fleet.yaml'
+	path.write_text('all:\n  IDLE_TIMER: 600\nhosts:\n  pc-1:\n    IDLE_TIMER: 900\n')
+	coordinator = fleet.FleetCoordinator(port=0, config_path=str(path)).start()
+	try:
+		a, host = agent(coordinator.url, timeout=2)
+		a.snapshot(1000)
+		a.send()
+		assert host.config == {'IDLE_TIMER': 900}
+		host.config.clear()
+		a.snapshot(1010)
+		a.send()
+		assert host.config == {}
+		assert coordinator.summary()['hosts']['pc-1']['config_current']
+	finally:
+		coordinator.stop()
@@ -0,0 +1,232 @@
+import types
+import asyncio
+
+import IdleMiner_Health as health
+import IdleMiner_Output as output
+import IdleMiner_Profiles as profiles
+import IdleMiner_Orchestrator as orch
+
+
+class StubMiner():
+	def __init__(self, clock, name='gpu'):
+		self.clock = clock
+		self.profile = profiles.MinerProfile(name, 'miner')
+		self.output = types.SimpleNamespace(samples=output.RingBuffer(1000))
+		self.state = orch.STOPPED
+		self.paused_by = None
+		self.returncode = None
+		self.starts = 0
+		self.resumes = 0
+		self.stops = 0
+
+	def isActive(self):
+		return self.state in (orch.STARTING, orch.RUNNING)
+
+	def feed(self, rate, accepted=0, rejected=0):
+		self.output.samples.append(output.Sample(self.clock(), rate, accepted, rejected, {}))
+		self.state = orch.RUNNING
+
+	async def start(self, options=None):
+		self.output.samples.clear()
+		self.state = orch.STARTING
+		self.starts += 1
+
+	async def stop(self):
+		self.state = orch.STOPPED
+		self.stops += 1
+
+
+class Clock():
+	def __init__(self):
+		self.t = 0.0
+
+	def __call__(self):
+		return self.t
+
+
+def watchdog(**kwargs):
+	clock = Clock()
+	m = StubMiner(clock)
+	orchestrator = types.SimpleNamespace(miners=[m], selected=[m.profile.name], optionsFor=lambda m: {})
+	changes = []
+	w = health.MinerWatchdog(orchestrator, warmup=120, stall=60, zero=60, decay=0.5, decay_window=300,
+							 onChange=lambda name, h: changes.append(h.state), clock=clock, **kwargs)
+	asyncio.run(m.start())
+	asyncio.run(w.tick())
+	return w, m, clock, changes
+
+
+def run(w, m, clock, seconds, rate=100.0, step=5):
+	# Advances the clock, with a reading every 'step' seconds if 'rate' is not None, and checks on each one
+	end = clock.t + seconds
+	while clock.t < end:
+		clock.t += step
+		if rate is not None and m.isActive():
+			m.feed(rate)
+		asyncio.run(w.tick())
+
+
+def test_warm_up_then_healthy():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 115)
+	assert w.health['gpu'].state == health.STARTING
+	run(w, m, clock, 10)
+	assert w.health['gpu'].state == health.HEALTHY
+	assert w.status() == {'gpu': {'health': 'healthy', 'reason': '', 'restarts': 0}}
+
+
+def test_stalled_without_readings():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 120, rate=None)
+	assert changes[:2] == [health.STALLED, health.BACKOFF]
+	assert m.stops == 1
+
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 200)
+	run(w, m, clock, 55, rate=None)
+	assert w.health['gpu'].state == health.HEALTHY
+	run(w, m, clock, 5, rate=None)
+	assert changes[-2:] == [health.STALLED, health.BACKOFF]
+
+
+def test_zero_hashrate():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 175, rate=0.0)
+	assert w.health['gpu'].state == health.HEALTHY  # Zero for less than 'zero' seconds after the warm-up
+	run(w, m, clock, 5, rate=0.0)
+	assert changes[-2:] == [health.NO_HASHRATE, health.BACKOFF]
+
+
+def test_degraded_against_the_best_average_of_the_run():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 500)
+	assert w.health['gpu'].baseline == 100.0
+	run(w, m, clock, 25, rate=40.0)
+	assert w.health['gpu'].state == health.HEALTHY  # Recent average still above half
+	run(w, m, clock, 35, rate=40.0)
+	assert health.DEGRADED in changes
+	assert w.health['gpu'].state == health.BACKOFF
+
+
+def test_rejecting():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 120)
+	shares = 0
+	while w.health['gpu'].state == health.HEALTHY:
+		clock.t += 5
+		shares += 1
+		m.feed(100.0, accepted=shares, rejected=shares)
+		asyncio.run(w.tick())
+	assert changes[-2:] == [health.REJECTING, health.BACKOFF]
+	assert shares == 5  # reject_min rejected shares, half of all
+
+
+def test_backoff_doubles_up_to_the_maximum():
+	w, m, clock, changes = watchdog(backoff=10, backoff_max=600, max_restarts=100)
+	h = w.health.setdefault('gpu', health.MinerHealth(clock()))
+	delays = []
+	for _ in range(8):
+		m.state = orch.EXITED
+		asyncio.run(w.tick())
+		assert h.state == health.BACKOFF
+		delays.append(h.retry_at - clock.t)
+		clock.t = h.retry_at
+		asyncio.run(w.tick())
+		assert m.isActive() and h.state == health.STARTING
+	assert delays == [10, 20, 40, 80, 160, 320, 600, 600]
+	assert h.total_restarts == 8
+
+
+def test_backoff_starts_over_after_running_healthy():
+	w, m, clock, changes = watchdog(backoff=10, backoff_max=600, max_restarts=100)
+	h = w.health.setdefault('gpu', health.MinerHealth(clock()))
+	for _ in range(3):
+		m.state = orch.EXITED
+		asyncio.run(w.tick())
+		clock.t = h.retry_at
+		asyncio.run(w.tick())
+	assert h.failures == 3
+	run(w, m, clock, 120 + 595)
+	assert h.state == health.HEALTHY and h.failures == 3
+	run(w, m, clock, 10)
+	assert h.failures == 0
+	m.state = orch.EXITED
+	asyncio.run(w.tick())
+	assert h.retry_at - clock.t == 10
+
+
+def test_breaker_opens_after_max_restarts_in_the_window():
+	w, m, clock, changes = watchdog(backoff=10, max_restarts=3, restart_window=1800, breaker_cooldown=1800)
+	h = w.health.setdefault('gpu', health.MinerHealth(clock()))
+	for _ in range(3):
+		m.state = orch.EXITED
+		asyncio.run(w.tick())
+		clock.t = h.retry_at
+		asyncio.run(w.tick())
+	assert h.state == health.STARTING and len(h.restarts) == 3
+	m.state = orch.EXITED
+	asyncio.run(w.tick())
+	assert h.state == health.FAILED
+	assert h.retry_at == clock.t + 1800
+	assert 'crash loop: 3 restarts in 30 min' in h.reason
+
+	# Started again with the other miners while the breaker is open: stopped at once
+	asyncio.run(m.start())
+	clock.t += 60
+	asyncio.run(w.tick())
+	assert m.state == orch.STOPPED and h.state == health.FAILED
+
+	# Another chance after the cooldown
+	clock.t = h.retry_at
+	asyncio.run(w.tick())
+	assert m.isActive() and h.state == health.STARTING
+	assert h.total_restarts == 4
+
+
+def test_restarts_outside_the_window_do_not_open_the_breaker():
+	w, m, clock, changes = watchdog(backoff=10, max_restarts=3, restart_window=1800)
+	h = w.health.setdefault('gpu', health.MinerHealth(clock()))
+	for _ in range(6):
+		m.state = orch.EXITED
+		asyncio.run(w.tick())
+		clock.t = h.retry_at + 1000
+		asyncio.run(w.tick())
+	assert health.FAILED not in changes
+
+
+def test_other_components_pauses_and_stops_are_left_alone():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 200)
+	for reason in ('throttle', 'thermal', 'idle'):
+		m.state = orch.PAUSED
+		m.paused_by = reason
+		run(w, m, clock, 600, rate=None)
+		assert w.health['gpu'].state == health.PAUSED
+		assert w.health['gpu'].reason == 'paused by ' + reason
+	m.state = orch.STOPPED
+	run(w, m, clock, 600, rate=None)
+	assert m.stops == 0 and m.starts == 1
+	assert health.BACKOFF not in changes
+
+
+def test_resume_gets_a_stall_grace_and_keeps_the_baseline():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 500)
+	m.state = orch.PAUSED
+	m.paused_by = 'idle'
+	run(w, m, clock, 600, rate=None)
+	m.state = orch.RUNNING
+	m.resumes += 1
+	run(w, m, clock, 55, rate=None)  # 'stall' seconds from the first check after resuming
+	assert w.health['gpu'].state == health.STARTING
+	assert w.health['gpu'].baseline == 100.0
+	run(w, m, clock, 10)
+	assert w.health['gpu'].state == health.HEALTHY
+
+
+def test_unselected_miners_are_forgotten():
+	w, m, clock, changes = watchdog()
+	run(w, m, clock, 10)
+	w.orchestrator.selected = []
+	asyncio.run(w.tick())
+	assert w.health == {}
@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+import IdleMiner_History as history
+
+
+@pytest.fixture
+def berlin(monkeypatch):
+	# UTC+2 in summer, with clock changes
+	monkeypatch.setenv('TZ', 'Europe/Berlin')
+	time.tzset()
+	yield
+	monkeypatch.undo()
+	time.tzset()
+
+
+def local(*fields):
+	return time.mktime(fields + (0, 0, -1))
+
+
+def sample(t, hashes):
+	return {'session': 1, 'time': t, 'machine': 'm', 'profile': 'p', 'unit': 'Sol/s', 'hashrate': 1.0,
+			'hashes': hashes}
+
+
+def test_day_rollups_follow_local_midnight(berlin, tmp_path):
+	store = history.HistoryStore(os.path.join(str(tmp_path), 'history.db'), flush_interval=0.01).start()
+	store.recordSample(sample(local(2026, 6, 1, 0, 30, 0), 1.0))  # 22:30 UTC the day before
+	store.recordSample(sample(local(2026, 6, 1, 23, 30, 0), 2.0))
+	store.recordSample(sample(local(2026, 6, 2, 1, 30, 0), 4.0))
+	assert store.flush(5)
+	days = [(time.strftime('%Y-%m-%d %H:%M', time.localtime(day)), hashes)
+			for day, machine, profile, unit, hashes in store.hashesPerDay()]
+	assert days == [('2026-06-01 00:00', 3.0), ('2026-06-02 00:00', 4.0)]
+	store.close()
+
+
+def test_buckets_across_a_clock_change(berlin):
+	# 29 March 2026 has 23 hours in Berlin
+	day = history.bucketStart('day', 24*60*60, local(2026, 3, 29, 23, 0, 0))
+	assert day == local(2026, 3, 29, 0, 0, 0)
+	assert history.bucketStart('day', 24*60*60, local(2026, 3, 30, 0, 0, 0)) == day + 23*60*60
+	assert history.bucketStart('hour', 60*60, local(2026, 3, 29, 3, 59, 0)) == local(2026, 3, 29, 3, 0, 0)
+
+
+def test_days_before_counts_calendar_days(berlin):
+	t = local(2026, 3, 30, 0, 30, 0)
+	assert history.daysBefore(0, t) == history.bucketStart('day', 24*60*60, t)
+	# 24 hours back from 00:30 after the 23-hour day is 23:30 on the 28th; one calendar day back is the 29th
+	assert history.bucketStart('day', 24*60*60, t - 24*60*60) == local(2026, 3, 28, 0, 0, 0)
+	assert history.daysBefore(1, t) == local(2026, 3, 29, 0, 0, 0)
+	assert history.daysBefore(2, t) == local(2026, 3, 28, 0, 0, 0)
+	assert history.daysBefore(31, t) == local(2026, 2, 27, 0, 0, 0)
+
+
+def test_hashes_per_day_since_includes_the_oldest_day(berlin, tmp_path):
+	store = history.HistoryStore(os.path.join(str(tmp_path), 'history.db'), flush_interval=0.01).start()
+	for day in (29, 30, 31):
+		store.recordSample(sample(local(2026, 5, day, 8, 0, 0), float(day)))
+	assert store.flush(5)
+	now = local(2026, 5, 31, 12, 0, 0)
+	assert [hashes for day, machine, profile, unit, hashes in store.hashesPerDay(now - 2*24*60*60)] == [30.0, 31.0]
+	rows = store.hashesPerDay(history.daysBefore(2, now))
+	assert [hashes for day, machine, profile, unit, hashes in rows] == [29.0, 30.0, 31.0]
+	store.close()
+
+
+def test_hour_buckets_with_a_half_hour_offset(monkeypatch):
+	monkeypatch.setenv('TZ', 'Asia/Kolkata')
+	time.tzset()
+	try:
+		t = local(2026, 6, 1, 10, 45, 0)
+		assert history.bucketStart('hour', 60*60, t) == local(2026, 6, 1, 10, 0, 0)
+	finally:
+		monkeypatch.undo()
+		time.tzset()
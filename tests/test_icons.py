@@ -0,0 +1,50 @@
+import IdleMiner_Icons as icons
+
+
+def test_each_icon_is_loaded_once():
+	backend = icons.FakeIconBackend()
+	cache = icons.IconCache(backend)
+	first = cache.trayIcon('mining.ico')
+	for _ in range(10):
+		assert cache.trayIcon('mining.ico') == first
+	assert cache.misses == 1
+	assert cache.hits == 10
+	assert backend.loads == 1
+
+
+def test_tray_icon_and_menu_bitmap_are_cached_separately():
+	backend = icons.FakeIconBackend()
+	cache = icons.IconCache(backend)
+	cache.preload(tray_paths=['idle.ico', 'mining.ico'], menu_paths=['idle.ico'])
+	assert cache.misses == 3 and cache.hits == 0
+	assert cache.menuBitmap('idle.ico') != cache.trayIcon('idle.ico')
+	assert cache.hits == 2
+	assert cache.live() == 3
+	assert sorted(backend.live.values()) == [('menu', 'idle.ico'), ('tray', 'idle.ico'), ('tray', 'mining.ico')]
+
+
+def test_missing_files_fall_back_and_are_not_freed():
+	backend = icons.FakeIconBackend(files={'mining.ico'})
+	cache = icons.IconCache(backend)
+	assert cache.trayIcon('gone.ico') == 0
+	assert cache.menuBitmap('gone.ico') is None
+	assert cache.trayIcon('gone.ico') == 0
+	assert cache.misses == 2 and cache.hits == 1
+	assert cache.live() == 0
+	cache.release()  # Would raise if the default icon were destroyed
+	assert backend.loads == 0
+
+
+def test_release_bitmaps_keeps_tray_icons_and_reloads_on_demand():
+	backend = icons.FakeIconBackend()
+	cache = icons.IconCache(backend)
+	cache.preload(tray_paths=['idle.ico'], menu_paths=['idle.ico', 'quit.ico'])
+	cache.releaseBitmaps()
+	assert list(backend.live.values()) == [('tray', 'idle.ico')]
+	cache.trayIcon('idle.ico')
+	assert cache.hits == 1
+	cache.menuBitmap('quit.ico')
+	assert cache.misses == 4
+	cache.release()
+	assert backend.live == {}
+	assert cache.live() == 0
@@ -0,0 +1,80 @@
+import IdleMiner_Idle as idle
+
+
+class Miner():
+	# Starts and stops at once when the scheduler says so, and remembers when
+	def __init__(self, source):
+		self.source = source
+		self.mining = False
+		self.starts = []
+		self.stops = []
+
+	def onIdle(self):
+		self.mining = True
+		self.starts.append(self.source.now())
+
+	def onActive(self):
+		self.mining = False
+		self.stops.append(self.source.now())
+
+
+def schedule(inputs, idle_timer=300, enabled=lambda: True):
+	source = idle.FakeIdleSource(inputs)
+	miner = Miner(source)
+	scheduler = idle.IdleScheduler(source, idle_timer, miner.onIdle, miner.onActive, lambda: miner.mining, enabled)
+	return source, miner, scheduler
+
+
+def test_fake_source_idle_time_and_input_wait():
+	source = idle.FakeIdleSource([10, 20])
+	assert source.getIdleTime() == 0
+	source.advance(15)
+	assert source.getIdleTime() == 5
+	assert source.waitForInput(100) is True
+	assert source.now() == 20 and source.getIdleTime() == 0
+	assert source.waitForInput(30) is False
+	assert source.now() == 50
+
+
+def test_starts_at_the_idle_timer_without_polling():
+	source, miner, scheduler = schedule([0, 100], idle_timer=300)
+	scheduler.run(until=2000)
+	assert miner.starts == [400]
+	assert scheduler.detection_lag == 0
+	# Slept until the threshold could be reached instead of waking every second
+	assert scheduler.wakeups <= 5
+
+
+def test_stops_on_the_first_input_while_mining():
+	source, miner, scheduler = schedule([0, 1000.5, 1001], idle_timer=300)
+	scheduler.run(until=1100)
+	assert miner.starts == [300]
+	assert miner.stops == [1000.5]
+	assert not miner.mining
+
+
+def test_restarts_after_the_user_leaves_again():
+	source, miner, scheduler = schedule([0, 500, 510], idle_timer=300)
+	scheduler.run(until=2000)
+	assert miner.starts == [300, 810]
+	assert miner.stops == [500]
+
+
+def test_disabled_timer_never_starts():
+	enabled = [False]
+	source, miner, scheduler = schedule([0], enabled=lambda: enabled[0])
+	assert scheduler.step() == (None, False)
+	enabled[0] = True
+	source.advance(300)
+	scheduler.step()
+	assert miner.starts == [300]
+
+
+def test_set_idle_timer_reevaluates():
+	source, miner, scheduler = schedule([0], idle_timer=600)
+	timeout, forInput = scheduler.step()
+	assert timeout == 600 and not forInput
+	source.advance(200)
+	scheduler.setIdleTimer(100)
+	scheduler.step()
+	assert miner.starts == [200]
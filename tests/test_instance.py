@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import socket
+import subprocess
+
+import pytest
+
+import IdleMiner_Instance as instance
+
+# A separate process holds the lock: POSIX record locks never conflict within one process
+CHILD = '''
+import sys
+import IdleMiner_Instance as instance
+
+def handle(command, params):
+	if command == 'status':
+		return {'state': 'mining', 'params': params}
+	raise ValueError("unknown command: " + str(command))
+
+guard = instance.InstanceGuard(sys.argv[1])
+print(guard.acquire(), flush=True)
+guard.serve(handle)
+print('serving', flush=True)
+sys.stdin.read()
+'''
+
+
+@pytest.fixture
+def child(tmp_path):
+	path = str(tmp_path / 'IdleMiner.lock')
+	env = dict(os.environ, PYTHONPATH=os.path.dirname(instance.__file__))
+	process = subprocess.Popen([sys.executable, '-c', CHILD, path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+							   env=env, universal_newlines=True)
+	assert process.stdout.readline() == 'True\n'
+	assert process.stdout.readline() == 'serving\n'
+	yield path, process
+	process.kill()
+	process.wait()
+
+
+def test_second_guard_forwards_to_the_running_instance(child):
+	path, process = child
+	guard = instance.InstanceGuard(path)
+	assert not guard.acquire()
+	info = instance.readInfo(path)
+	assert info['pid'] == process.pid and info['port']
+
+	assert instance.forward(path, 'status', {'verbose': 1}) == {'state': 'mining', 'params': {'verbose': 1}}
+	assert instance.forward(path, 'launch') == {'error': 'unknown command: launch'}
+
+	# Without the token the listener refuses the command
+	with socket.create_connection(('127.0.0.1', info['port']), instance.TIMEOUT) as conn:
+		conn.sendall(json.dumps({'token': 'guess', 'command': 'status'}).encode('utf-8') + b'\n')
+		assert json.loads(conn.makefile('rb').readline().decode('utf-8')) == {'error': 'bad token'}
+
+
+def test_lock_of_a_killed_instance_is_reclaimed(child):
+	path, process = child
+	assert not instance.InstanceGuard(path).acquire()
+	process.kill()
+	process.wait()
+
+	guard = instance.InstanceGuard(path)
+	try:
+		assert guard.acquire()
+		assert guard.reclaimed['pid'] == process.pid
+		assert instance.readInfo(path) == {'pid': os.getpid(), 'port': None, 'token': guard.token}
+	finally:
+		guard.release()
+	assert instance.readInfo(path) is None
+	assert os.path.exists(path)  # The file is kept, only emptied
+
+
+def test_forward_gives_up_when_nothing_answers(tmp_path, monkeypatch):
+	monkeypatch.setattr(instance, 'CONNECT_RETRIES', 3)
+	monkeypatch.setattr(instance, 'CONNECT_RETRY_DELAY', 0)
+	listener = socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	port = listener.getsockname()[1]
+	listener.close()
+	path = tmp_path / 'IdleMiner.lock'
+	path.write_text(json.dumps({'pid': 4321, 'port': port, 'token': 'x'}) + '\n')
+	with pytest.raises(instance.InstanceError, match='pid 4321'):
+		instance.forward(str(path), 'status')
@@ -0,0 +1,89 @@
+import IdleMiner_Menu as menu
+
+
+def noop(sysTrayIcon, id):
+	pass
+
+
+# Legacy nested (text, icon, action) tuples with two submenus, as the tray used to build them
+OPTIONS = (('Start Mining', 'on.ico', noop),
+		   ('Idle Timer', None, (('5 min', None, noop), ('10 min', None, noop))),
+		   ('Profiles', None, (('gpu', None, noop), ('cpu', None, noop))),
+		   ('Quit', None, 'QUIT'))
+
+
+def test_ids_resolve_in_every_submenu():
+	tree = menu.MenuTree().fromOptions(OPTIONS)
+	texts = {}
+
+	def walk(node):
+		for child in node.children:
+			texts[child.id] = child.text
+			walk(child)
+
+	walk(tree.root)
+	assert len(texts) == 8
+	for id, text in texts.items():
+		assert tree.get(id).text == text
+	# The old lookup stopped in the first submenu; options of the second one must be found too
+	profiles = tree.root.children[2]
+	assert profiles.isSubmenu()
+	assert tree.get(profiles.children[1].id).text == 'cpu'
+	assert tree.get(profiles.children[1].id).parent is profiles
+	assert tree.get(menu.MAX_ID) is None
+
+
+def test_ids_are_stable_and_reused_after_removal():
+	tree = menu.MenuTree()
+	first = tree.add(None, 'a')
+	second = tree.add(None, 'b')
+	assert (first.id, second.id) == (menu.FIRST_ID, menu.FIRST_ID + 1)
+	tree.remove(first)
+	assert tree.get(menu.FIRST_ID) is None
+	assert tree.get(second.id) is second
+	assert tree.add(None, 'c').id == menu.FIRST_ID
+
+
+def test_setters_mark_dirty_only_on_change():
+	tree = menu.MenuTree().fromOptions(OPTIONS)
+	assert tree.dirty
+	tree.clean()
+	node = tree.root.children[0]
+	tree.setText(node, 'Start Mining')
+	tree.setChecked(node, False)
+	tree.setIcon(node, 'on.ico')
+	assert not tree.dirty
+	tree.setText(node, 'Stop Mining')
+	assert tree.dirty and node.text == 'Stop Mining'
+	tree.clean()
+	tree.setChecked(node, True)
+	assert tree.dirty
+	assert tree.rebuilds == 2
+
+
+def test_set_children_updates_in_place():
+	tree = menu.MenuTree().fromOptions(OPTIONS)
+	profiles = tree.root.children[2]
+	ids = [child.id for child in profiles.children]
+	tree.clean()
+
+	tree.setChildren(profiles, [('gpu', None, noop), ('cpu', None, noop)])
+	assert not tree.dirty
+
+	tree.setChildren(profiles, [('gpu', None, noop), ('cpu (paused)', None, noop), ('fake', None, noop)])
+	assert tree.dirty
+	assert [child.id for child in profiles.children][:2] == ids
+	assert [child.text for child in profiles.children] == ['gpu', 'cpu (paused)', 'fake']
+	tree.clean()
+
+	tree.setChildren(profiles, [('gpu', None, noop)])
+	assert tree.dirty
+	assert [child.text for child in profiles.children] == ['gpu']
+	assert tree.get(ids[1]) is None
+
+
+def test_icon_paths():
+	tree = menu.MenuTree(check_icon='check.ico').fromOptions(OPTIONS)
+	assert tree.iconPaths() == ['on.ico']
+	tree.setChecked(tree.root.children[1].children[0], True)
+	assert tree.iconPaths() == ['on.ico', 'check.ico']
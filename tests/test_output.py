@@ -0,0 +1,86 @@
+import sys
+import asyncio
+
+import IdleMiner_Output as output
+import IdleMiner_Profiles as profiles
+import IdleMiner_Orchestrator as orch
+
+
+def test_ring_buffer_keeps_the_newest():
+	ring = output.RingBuffer(3)
+	assert ring.latest() is None and ring.items() == []
+	for i in range(5):
+		ring.append(i)
+	assert len(ring) == 3
+	assert ring.items() == [2, 3, 4]
+	assert ring.latest() == 4
+	ring.clear()
+	assert len(ring) == 0 and ring.items() == []
+
+
+def test_ewbf_parser():
+	pipeline = output.OutputPipeline(output.EWBFParser())
+	pipeline.feed(b'\x1b[32mGPU0: 298 Sol/s GPU1: 305 Sol/s\x1b[0m\n')
+	pipeline.feed(b'INFO 22:36:22: GPU0 Accepted share 140ms [A:12, R:1]\n')
+	assert pipeline.current() is None
+	pipeline.feed(b'Total speed: 603 Sol/s\n')
+	sample = pipeline.samples.latest()
+	assert sample.hashrate == 603
+	assert sample.gpus == {0: 298, 1: 305}
+	assert (sample.accepted, sample.rejected) == (12, 1)
+
+
+def test_generic_parser_scales_rates():
+	parser = output.GenericParser()
+	assert parser.parseLine('Speed: 24.5 MH/s')
+	assert parser.hashrate == 24.5e6
+	assert parser.parseLine('total 1.2 kh/s')
+	assert parser.hashrate == 1200
+	assert not parser.parseLine('Connecting to pool')
+
+
+def test_generic_parser_reads_only_share_counters():
+	parser = output.GenericParser()
+	parser.parseLine('GPU0 accepted 140ms')
+	parser.parseLine('share rejected 25ms, stale')
+	assert (parser.accepted, parser.rejected) == (0, 0)
+	parser.parseLine('[2026-01-01 12:00:00] cpu accepted (12/1) diff 100001 (45 ms)')
+	assert (parser.accepted, parser.rejected) == (12, 1)
+	parser.parseLine('GPU0 share found, 140ms [A:15, R:2]')
+	assert (parser.accepted, parser.rejected) == (15, 2)
+
+
+def test_average_over_a_window():
+	pipeline = output.OutputPipeline(output.GenericParser())
+	for t, rate in ((100, 10.0), (150, 20.0), (160, None), (170, 30.0)):
+		pipeline.samples.append(output.Sample(t, rate, 0, 0, {}))
+	assert pipeline.average(now=170) == 20.0
+	assert pipeline.average(30, now=170) == 25.0
+	assert pipeline.average(5, now=200) is None
+
+
+def test_line_splitter_handles_redraws_and_partial_lines():
+	splitter = output.LineSplitter(limit=16)
+	assert splitter.feed(b'Speed: 1 H/s\rSpe') == [b'Speed: 1 H/s']
+	assert splitter.feed(b'ed: 2 H/s\r\nok\n\n') == [b'Speed: 2 H/s', b'ok']
+	# An overlong line is cut at the limit and the rest of it dropped
+	assert splitter.feed(b'x' * 20) == [b'x' * 16]
+	assert splitter.feed(b'yyyy\rnext') == []
+	assert splitter.flush() == [b'next']
+	assert splitter.flush() == []
+
+
+def test_miner_redrawing_with_carriage_returns_only():
+	# 400 in-place redraws, never a '\n'
+	script = 'import sys\nfor i in range(400):\n\tsys.stdout.write("Speed: %d H/s\\r" % (i + 1))\nsys.stdout.flush()\n'
+	profile = profiles.MinerProfile('redraw', sys.executable, args=['-c', script], miner_type='generic')
+	miner = orch.ManagedMiner(profile)
+
+	async def run():
+		await miner.start()
+		await asyncio.wait_for(asyncio.gather(*miner._tasks), 30)
+
+	asyncio.run(run())
+	assert len(miner.output.samples) == 400
+	assert miner.output.current() == 400
+	assert miner.returncode == 0
@@ -0,0 +1,115 @@
+import time
+
+import IdleMiner_Idle as idle
+import IdleMiner_Policy as policy
+
+
+class Clock():
+	def __init__(self, t=0.0):
+		self.t = t
+
+	def __call__(self):
+		return self.t
+
+
+def engine(rules=(), idle_rule=None, now=None):
+	clock = Clock()
+	wallclock = Clock(now if now is not None else time.mktime((2026, 6, 1, 12, 0, 0, 0, 0, -1)))
+	return policy.PolicyEngine(idle_rule or policy.IdleRule(300), rules, clock=clock, wallclock=wallclock), clock
+
+
+def test_hysteresis_band():
+	e, clock = engine(idle_rule=policy.IdleRule(300, stop_below=0.5))
+	d = e.decide(200, False)
+	assert (d.action, d.timeout) == (policy.STAY, 100)
+	assert e.decide(300, False).action == policy.START
+	e.started()
+	# Above stop_below x IDLE_TIMER the user still counts as away
+	d = e.decide(200, True)
+	assert d.action == policy.STAY and d.forInput
+	assert e.decide(149, True).action == policy.STOP
+
+
+def test_confirm_ignores_a_nudge_but_stops_for_real_use():
+	def run(inputs):
+		source = idle.FakeIdleSource(inputs)
+		state = {'mining': False, 'stops': []}
+
+		def onIdle():
+			state['mining'] = True
+			scheduler.policy.started()
+
+		def onActive():
+			state['mining'] = False
+			state['stops'].append(source.now())
+			scheduler.policy.stopped()
+
+		rule = policy.IdleRule(300, stop_below=0.5, confirm=10)
+		scheduler = idle.IdleScheduler(source, 300, onIdle, onActive, lambda: state['mining'], lambda: True,
+									   policy_engine=policy.PolicyEngine(rule, clock=source.now))
+		scheduler.run(until=2000)
+		return state
+
+	nudge = run([0, 1000])
+	assert nudge['mining'] and nudge['stops'] == []
+	use = run([0] + [1000 + i for i in range(30)])
+	assert use['stops'] == [1010]
+
+
+def test_min_run_holds_a_stop():
+	e, clock = engine([policy.MinRunRule(600)])
+	e.started()
+	clock.t = 100
+	d = e.decide(0, True)
+	assert (d.action, d.rule, d.timeout) == (policy.STAY, 'min_run', 500)
+	clock.t = 600
+	assert e.decide(0, True).action == policy.STOP
+
+
+def test_cooldown_blocks_a_start():
+	e, clock = engine([policy.CooldownRule(120)])
+	e.started()
+	clock.t = 10
+	e.stopped()
+	clock.t = 40
+	d = e.decide(400, False)
+	assert (d.action, d.rule, d.timeout) == (policy.STAY, 'cooldown', 90)
+	clock.t = 130
+	assert e.decide(400, False).action == policy.START
+
+
+def test_window_forbids_and_stops_outside_hours():
+	rule = policy.WindowRule([{'start': '22:00', 'end': '07:00'}])
+	noon = time.mktime((2026, 6, 1, 12, 0, 0, 0, 0, -1))
+	e, clock = engine([rule], now=noon)
+	d = e.decide(400, False)
+	assert (d.action, d.rule) == (policy.STAY, 'window')
+	assert d.timeout == 10*60*60
+	assert e.decide(400, True).action == policy.STOP
+	e.wallclock.t = noon + 11*60*60
+	assert e.decide(400, False).action == policy.START
+	# While mining, wake when the window closes
+	d = e.decide(400, True)
+	assert d.action == policy.STAY and d.timeout == 8*60*60
+
+
+def test_budget_counts_mining_time():
+	e, clock = engine([policy.BudgetRule(1)])
+	e.started()
+	clock.t = 3600
+	assert e.decide(400, True).action == policy.STOP
+	e.stopped()
+	assert e.decide(400, False).rule == 'budget'
+
+
+def test_load_rules():
+	idle_rule, rules = policy.loadRules([{'rule': 'idle', 'stop_below': 0.25, 'confirm': 5},
+										 {'rule': 'min_run', 'seconds': 60}], 120)
+	assert (idle_rule.start, idle_rule.stopAt(), idle_rule.confirm) == (120, 30, 5)
+	assert [r.name for r in rules] == ['min_run']
+	for bad in ([{'rule': 'nope'}], [{'rule': 'idle', 'stop_below': 2}], [{'rule': 'min_run'}]):
+		try:
+			policy.loadRules(bad, 120)
+		except (KeyError, ValueError):
+			continue
+		raise AssertionError('accepted ' + repr(bad))
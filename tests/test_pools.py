@@ -0,0 +1,138 @@
+import time
+import types
+import asyncio
+import collections
+
+import IdleMiner_Pools as pools
+import IdleMiner_Profiles as profiles
+
+Sample = collections.namedtuple('Sample', ['time', 'accepted', 'rejected'])
+
+
+class StubMiner():
+	def __init__(self, servers):
+		self.profile = profiles.MinerProfile('pool', 'miner', server=servers)
+		self.server = None
+		self.endpoint = None
+		self.state = 'running'
+		self.samples = []
+		self.output = types.SimpleNamespace(samples=types.SimpleNamespace(items=lambda: list(self.samples)))
+		self.restarts = 0
+
+	def isActive(self):
+		return self.state == 'running'
+
+	async def stop(self):
+		self.state = 'stopped'
+
+	async def start(self, options):
+		self.endpoint = self.server or self.profile.server
+		self.state = 'running'
+		self.restarts += 1
+
+
+class Clock():
+	def __init__(self):
+		self.t = 1000.0
+
+	def __call__(self):
+		return self.t
+
+
+def selector(m, **kwargs):
+	orchestrator = types.SimpleNamespace(miners=[m], selected=[m.profile.name], optionsFor=lambda m: {})
+	clock = Clock()
+	return pools.PoolSelector(orchestrator, timeout=1, clock=clock, **kwargs), clock
+
+
+def test_parse_endpoint():
+	assert pools.parseEndpoint('stratum+tcp://eu.pool.example:4444') == ('eu.pool.example', 4444)
+	assert pools.parseEndpoint('eu.pool.example') == ('eu.pool.example', 3333)
+	assert pools.parseEndpoint('eu.pool.example', 5555) == ('eu.pool.example', 5555)
+	assert pools.parseEndpoint('[::1]:3334') == ('::1', 3334)
+
+
+def test_probe_handshake_and_failures():
+	fake = pools.FakeStratumServer().start()
+	try:
+		host, port = fake.address
+		latency, error = asyncio.run(pools.probe(host, port))
+		assert error is None and latency >= 0
+		fake.down = True
+		latency, error = asyncio.run(pools.probe(host, port))
+		assert latency is None and error == 'connection closed'
+	finally:
+		fake.stop()
+	latency, error = asyncio.run(pools.probe(host, port, timeout=1))
+	assert latency is None and error
+
+
+def test_fails_over_and_back():
+	slow = pools.FakeStratumServer(delay=0.2).start()
+	fast = pools.FakeStratumServer().start()
+	try:
+		m = StubMiner([slow.endpoint, fast.endpoint])
+		m.endpoint = slow.endpoint
+		sel, clock = selector(m, probe_interval=300, dwell=600, min_gain=0.05)
+
+		# The fastest endpoint that answers is chosen before mining starts
+		asyncio.run(sel.check(False))
+		assert m.server == fast.endpoint
+		assert m.restarts == 0
+		asyncio.run(m.start({}))
+		assert m.endpoint == fast.endpoint
+
+		# Cached results are reused until probe_interval has passed
+		fast.down = True
+		clock.t += 60
+		asyncio.run(sel.check(True))
+		assert m.server == fast.endpoint
+
+		# A dead endpoint is left at once, dwell or not
+		clock.t += 300
+		asyncio.run(sel.check(True))
+		assert m.server == slow.endpoint
+		assert m.endpoint == slow.endpoint
+		assert m.restarts == 2
+		assert sel.switches == 2
+		status = sel.status()
+		assert status[fast.endpoint]['ok'] is False
+		assert status[slow.endpoint]['ok'] is True
+
+		# Back on the faster endpoint only after the dwell
+		fast.down = False
+		clock.t += 300
+		asyncio.run(sel.check(True))
+		assert m.server == slow.endpoint
+		clock.t += 300
+		asyncio.run(sel.check(True))
+		assert m.server == fast.endpoint
+	finally:
+		slow.stop()
+		fast.stop()
+
+
+def test_stale_shares_move_the_miner_and_penalise_the_endpoint():
+	a = pools.FakeStratumServer().start()
+	b = pools.FakeStratumServer(delay=0.1).start()
+	try:
+		m = StubMiner([a.endpoint, b.endpoint])
+		sel, clock = selector(m, stale_ratio=0.1, stale_min=5, penalty=1800)
+		asyncio.run(m.start({}))
+		asyncio.run(sel.check(True))
+		assert m.server is None or m.server == a.endpoint
+
+		now = time.time()
+		m.samples = [Sample(now - 300, 10, 0), Sample(now, 30, 8)]
+		asyncio.run(sel.check(True))
+		assert m.server == b.endpoint
+		assert sel.status()[a.endpoint]['avoided']
+
+		# Shares are fine on the new endpoint; the old one stays avoided for the penalty
+		m.samples = []
+		clock.t += 1200
+		asyncio.run(sel.check(True))
+		assert m.server == b.endpoint
+	finally:
+		a.stop()
+		b.stop()
@@ -0,0 +1,57 @@
+import time
+
+import IdleMiner_Predict as predict
+
+# A Monday 12:00 local time, and one week
+MONDAY = time.mktime((2026, 1, 5, 12, 0, 0, 0, 0, -1))
+WEEK = 7*24*60*60
+
+
+def test_short_spells_are_not_recorded():
+	model = predict.IdleModel()
+	model.record(MONDAY, 30)
+	assert model.spells == 0 and model.buckets == {}
+
+
+def test_estimate_needs_min_samples_and_prefers_the_same_slot():
+	model = predict.IdleModel(min_samples=2, half_life=10**9)  # Practically no fading
+	for week in range(3):
+		model.record(MONDAY + week * WEEK, 3600)  # Long lunch breaks on Mondays
+		model.record(MONDAY + week * WEEK + 3*60*60, 120)  # Short breaks in the afternoon
+	start = MONDAY + 3 * WEEK
+	assert model.estimate(start, 10*60).level == 'day'
+	assert 3500 < model.estimate(start, 10*60).expected < 4500
+	assert model.estimate(start, 10*60).survival(30*60) > 0.5
+	# Tuesday at noon falls back to Monday's slot (both weekdays), Saturday to all spells
+	assert model.estimate(start + 24*60*60, 10*60).level == 'slot'
+	assert model.estimate(start + 5*24*60*60, 10*60).level == 'all'
+	# No spell has lasted two hours
+	assert model.estimate(start, 2*60*60) is None
+
+
+def test_saves_and_loads(tmp_path):
+	path = str(tmp_path / 'model.json')
+	model = predict.IdleModel(path=path)
+	model.record(MONDAY, 600)
+	loaded = predict.IdleModel(path=path)
+	assert loaded.spells == 1
+	assert loaded.buckets.keys() == model.buckets.keys()
+	assert predict.IdleModel(slot=15*60, path=path).spells == 0  # Different settings start afresh
+
+
+def test_tracker_records_spells_between_inputs():
+	model = predict.IdleModel()
+	tracker = predict.SpellTracker(model)
+	tracker.observe(MONDAY + 100, 100, False)
+	tracker.observe(MONDAY + 400, 400, True)
+	tracker.observe(MONDAY + 900, 0, True)  # Input while mining: the spell lasted 900 s
+	assert model.spells == 1
+	assert model.buckets['all'][1][predict.EDGES.index(900)] == 1
+
+
+def test_old_spells_fade():
+	model = predict.IdleModel(min_samples=1, half_life=WEEK)
+	for _ in range(4):
+		model.record(MONDAY, 3600)
+	assert abs(model.estimate(MONDAY + 2 * WEEK - 600, 600).samples - 1.0) < 1e-9
+	assert model.estimate(MONDAY + 3 * WEEK - 600, 600) is None
@@ -0,0 +1,128 @@
+import types
+import asyncio
+
+import IdleMiner_Profit as profit
+
+
+def stubOrchestrator(*profiles):
+	# Just what the switcher reads: miners with profiles, and the selected profile names
+	miners = [types.SimpleNamespace(profile=types.SimpleNamespace(name=name, group=group, algorithm=algorithm),
+									warmup=None) for name, group, algorithm in profiles]
+	return types.SimpleNamespace(miners=miners, selected=set(), loop=None)
+
+
+class FailingRateSource(profit.RateSource):
+	def __init__(self):
+		self.fetches = 0
+
+	def fetch(self):
+		self.fetches += 1
+		raise RuntimeError('rate source down')
+
+
+def test_score_ignores_rates_that_are_not_numbers():
+	orchestrator = stubOrchestrator(('a', 'gpu', 'equihash'), ('b', 'gpu', 'ethash'))
+	switcher = profit.ProfitSwitcher(orchestrator, None, {'a': 10.0, 'b': 20.0})
+	a, b = orchestrator.miners
+	assert switcher.score(a, {'equihash': 2}) == 20.0
+	assert switcher.score(a, {'equihash': 'lots'}) is None
+	assert switcher.score(a, {'equihash': None}) is None
+	assert switcher.score(b, {'ethash': True}) is None
+
+
+def test_run_survives_a_failing_check(capsys):
+	source = FailingRateSource()
+	switcher = profit.ProfitSwitcher(stubOrchestrator(('a', 'gpu', 'equihash')), source, {}, interval=0.01)
+
+	async def runBriefly():
+		task = asyncio.ensure_future(switcher.run())
+		await asyncio.sleep(0.2)
+		assert not task.done()
+		task.cancel()
+
+	asyncio.run(runBriefly())
+	assert source.fetches >= 2
+	assert 'rate source down' in capsys.readouterr().out
+
+
+class Clock():
+	def __init__(self):
+		self.t = 0.0
+
+	def __call__(self):
+		return self.t
+
+
+class TableRateSource(profit.RateSource):
+	# Returns the current 'rates'; raises when they are None
+	def __init__(self, rates):
+		self.rates = rates
+		self.fetches = 0
+
+	def fetch(self):
+		self.fetches += 1
+		if self.rates is None:
+			raise OSError('rate source down')
+		return dict(self.rates)
+
+
+def test_switches_only_past_the_hysteresis_margin():
+	switcher = profit.ProfitSwitcher(stubOrchestrator(), None, {}, margin=0.05, interval=600)
+	assert switcher.shouldSwitch(None, 1.0, 60)
+	assert not switcher.shouldSwitch(100.0, 104.0, 0)
+	assert not switcher.shouldSwitch(100.0, 105.0, 0)
+	assert switcher.shouldSwitch(100.0, 106.0, 0)
+
+
+def test_gain_must_pay_for_the_warmup():
+	switcher = profit.ProfitSwitcher(stubOrchestrator(), None, {}, margin=0.05, interval=600)
+	# (200 - 100) * 600 s of extra revenue against 200 * warm-up seconds lost
+	assert switcher.shouldSwitch(100.0, 200.0, 299)
+	assert not switcher.shouldSwitch(100.0, 200.0, 300)
+	# A small gain past the margin is only worth a quick restart: 6 * 600 > 106 * 33, but not > 106 * 34
+	assert switcher.shouldSwitch(100.0, 106.0, 33)
+	assert not switcher.shouldSwitch(100.0, 106.0, 34)
+
+
+def test_evaluate_uses_the_measured_warmup_over_the_default():
+	orchestrator = stubOrchestrator(('a', 'gpu', 'equihash'), ('b', 'gpu', 'ethash'))
+	source = TableRateSource({'equihash': 1.0, 'ethash': 1.0})
+	switcher = profit.ProfitSwitcher(orchestrator, source, {'a': 100.0, 'b': 200.0}, interval=600, default_warmup=400)
+	assert orchestrator.selected == {'a'}
+	assert switcher.evaluate() == []  # 400 s default warm-up costs more than the gain
+	orchestrator.miners[1].warmup = 30
+	assert switcher.evaluate() == [('gpu', 'a', 'b')]
+	source.rates['ethash'] = 0.52  # 104 against 100: within the margin
+	assert switcher.evaluate() == []
+
+
+def test_cached_rates_are_refetched_after_the_ttl():
+	clock = Clock()
+	source = TableRateSource({'equihash': 1.0})
+	cached = profit.CachedRateSource(source, ttl=300, clock=clock)
+	assert cached.fetch() == {'equihash': 1.0}
+	source.rates = {'equihash': 2.0}
+	clock.t = 299
+	assert cached.fetch() == {'equihash': 1.0}
+	assert source.fetches == 1
+	clock.t = 300
+	assert cached.fetch() == {'equihash': 2.0}
+	assert source.fetches == 2 and cached.fetches == 2
+
+
+def test_failed_refresh_keeps_the_stale_rates_for_another_ttl(capsys):
+	clock = Clock()
+	source = TableRateSource(None)
+	cached = profit.CachedRateSource(source, ttl=300, clock=clock)
+	assert cached.fetch() == {}
+	assert cached.errors == 1 and cached.rates is None
+	source.rates = {'equihash': 1.0}
+	assert cached.fetch() == {'equihash': 1.0}  # Nothing cached yet, so it retries at once
+	source.rates = None
+	clock.t = 300
+	assert cached.fetch() == {'equihash': 1.0}
+	assert cached.errors == 2 and source.fetches == 3
+	clock.t = 599
+	assert cached.fetch() == {'equihash': 1.0}
+	assert source.fetches == 3
+	assert 'rate source down' in capsys.readouterr().out
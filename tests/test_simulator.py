@@ -0,0 +1,96 @@
+import gzip
+
+import pytest
+
+import IdleMiner_Idle as idle
+import IdleMiner_Simulator as simulator
+
+# Input at 0 and 10 s, then a burst at 500-510 s. With a 100 s idle timer, mining runs from 110 s until the
+# burst and again from 100 s after it until the end of the trace.
+TRACE = simulator.Trace(1767268800, 1000, [0, 10, 500, 505, 510], 'test')
+SPEC = {'idle_timer': 100, 'policy': [], 'suspend': False, 'max_pause': 1800}
+
+
+def test_varints_round_trip():
+	values = [0, 1, 127, 128, 300, 2**35]
+	assert simulator._varints([300]) == b'\xac\x02'
+	assert simulator._unvarints(simulator._varints(values)) == values
+
+
+def test_record_save_and_load(tmp_path):
+	source = idle.FakeIdleSource([5, 5.05, 12.3])
+	recorder = simulator.TraceRecorder(source, interval=1.0, wallclock=lambda: 1767268800)
+	path = str(tmp_path / 'day.trace')
+	trace = recorder.run(path, duration=20)
+	# 5.05 s is within RESOLUTION of the previous input
+	assert trace.inputs == [0.0, 5.0, 12.3]
+	assert trace.duration == 20
+	loaded = simulator.loadTrace(path)
+	assert loaded.start == 1767268800 and loaded.duration == 20
+	assert loaded.inputs == pytest.approx([0.0, 5.0, 12.3])
+	assert loaded.machine == trace.machine
+
+
+def test_load_rejects_other_files(tmp_path):
+	path = str(tmp_path / 'other.gz')
+	with gzip.open(path, 'wb') as f:
+		f.write(b'hello\n')
+	with pytest.raises(ValueError):
+		simulator.loadTrace(path)
+
+
+def test_simulated_miner_warm_up_accounting():
+	clock = idle.FakeIdleSource()
+	miner = simulator.SimulatedMiner(clock.now, warmup=30, hashrate=2.0, stop_time=1.0)
+	miner.start()
+	clock.advance(20)
+	assert miner.stop(pause=True) == 0.05
+	assert (miner.mined, miner.productive) == (20, 0)  # Stopped during the warm-up
+	clock.advance(100)
+	miner.start(resume_within=1800)
+	clock.advance(50)
+	assert miner.stop() == 1.0
+	assert (miner.starts, miner.resumes) == (1, 1)
+	assert (miner.mined, miner.productive) == (70, 50)  # A resume has no warm-up
+	assert miner.hashes() == 100
+
+
+def test_replay_metrics():
+	result = simulator.simulate(TRACE, SPEC, warmup=30, hashrate=2.0, stop_time=1.0)
+	# 110-500 s and 610-1000 s, each with a 30 s warm-up
+	assert result.mined_hours * 3600 == pytest.approx(780)
+	assert result.productive_hours * 3600 == pytest.approx(720)
+	assert result.hashes == pytest.approx(1440)
+	assert (result.starts, result.resumes) == (2, 0)
+	# Stopped on the first input of the burst, plus the stop time
+	assert result.latencies == pytest.approx([1.0])
+
+
+def test_replay_with_confirmation_counts_the_whole_spell():
+	spec = dict(SPEC, policy=[{'rule': 'idle', 'confirm': 10}])
+	result = simulator.simulate(TRACE, spec, warmup=30, hashrate=2.0, stop_time=1.0)
+	# Stopped at 510 s, once the input had lasted 10 s; the user shared the machine from 500 s
+	assert result.mined_hours * 3600 == pytest.approx(400 + 390)
+	assert result.latencies == pytest.approx([11.0])
+
+
+def test_replay_in_suspend_mode_resumes():
+	spec = dict(SPEC, suspend=True)
+	result = simulator.simulate(TRACE, spec, warmup=30, hashrate=2.0, stop_time=1.0)
+	assert (result.starts, result.resumes) == (1, 1)
+	assert result.productive_hours * 3600 == pytest.approx(360 + 390)
+	assert result.latencies == pytest.approx([0.05])
+
+
+def test_summarise():
+	results = [simulator.simulate(TRACE, SPEC, name='plain', trace_name='a'),
+			   simulator.simulate(TRACE, dict(SPEC, suspend=True), name='suspend', trace_name='a'),
+			   simulator.simulate(TRACE, SPEC, name='plain', trace_name='b')]
+	totals = simulator.summarise(results)
+	assert list(totals) == ['plain', 'suspend']
+	assert totals['plain']['traces'] == 2
+	assert totals['plain']['starts'] == 4
+	assert totals['plain']['stops'] == 2
+	assert totals['plain']['useful'] == pytest.approx(720 / 780)
+	assert totals['plain']['latency_max'] == pytest.approx(1.0)
+	assert 'plain' in simulator.formatTable(totals)
@@ -0,0 +1,161 @@
+import types
+import asyncio
+
+import IdleMiner_Profiles as profiles
+import IdleMiner_Thermal as thermal
+
+
+class StubMiner():
+	def __init__(self, name, devices=None, intensity=64, rate=100.0):
+		self.profile = profiles.MinerProfile(name, 'miner', devices=devices, options={'intensity': intensity})
+		self.state = 'running'
+		self.paused_by = None
+		self.options = dict(self.profile.options)
+		self.rate = rate
+		self.restarts = 0
+
+	def isActive(self):
+		return self.state == 'running'
+
+	def pause(self, reason='idle'):
+		self.state = 'paused'
+		self.paused_by = reason
+
+	def resume(self):
+		self.state = 'running'
+		self.paused_by = None
+
+	def hashrate(self):
+		return self.rate
+
+	async def stop(self):
+		self.state = 'stopped'
+
+	async def start(self, options):
+		self.options = dict(options)
+		self.state = 'running'
+		self.restarts += 1
+
+
+class StubOrchestrator():
+	# Limits combine with the profile's options by taking the lowest value
+	def __init__(self, miners):
+		self.miners = miners
+		self.option_limits = {}
+		self.loop = None
+
+	def optionsFor(self, m):
+		options = dict(m.profile.options)
+		for opt, limit in self.option_limits.get(m.profile.name, {}).items():
+			if opt in options:
+				options[opt] = min(options[opt], limit)
+		return options
+
+
+class Clock():
+	def __init__(self):
+		self.t = 0.0
+
+	def __call__(self):
+		return self.t
+
+
+def governor(miners, **kwargs):
+	source = thermal.FakeSensorSource()
+	clock = Clock()
+	gov = thermal.ThermalGovernor(StubOrchestrator(miners), source, limit=80, margin=5, dwell=30, settle=120,
+								  interval=10, clock=clock, **kwargs)
+	return gov, source, clock
+
+
+def tick(gov, clock, seconds=10):
+	asyncio.run(gov.tick())
+	clock.t += seconds
+
+
+def test_bands():
+	gov, source, clock = governor([])
+	m = StubMiner('gpu', devices=[0])
+	for temp, band in ((80, 'hot'), (76, 'warm'), (71, 'ok'), (69, 'cool')):
+		assert gov.band(m, thermal.SensorReading({'gpu0': temp, 'gpu1': 95}, {})) == band
+
+
+def test_sensors_follow_profile_devices():
+	gov, source, clock = governor([])
+	reading = thermal.SensorReading({'gpu0': 50, 'gpu1': 60, 'cpu': 70}, {})
+	assert gov.sensorsFor(StubMiner('a', devices=[1]), reading) == ['gpu1']
+	assert gov.sensorsFor(StubMiner('b'), reading) == ['gpu0', 'gpu1']
+	assert gov.sensorsFor(StubMiner('c'), thermal.SensorReading({'cpu': 70}, {})) == ['cpu']
+
+
+def test_warm_steps_down_once_per_dwell():
+	m = StubMiner('gpu', devices=[0])
+	gov, source, clock = governor([m])
+	source.set({'gpu0': 77})
+	tick(gov, clock)
+	assert gov.level['gpu'] == 1
+	assert m.options['intensity'] == 56 and m.restarts == 1
+	tick(gov, clock)
+	tick(gov, clock)
+	assert gov.level['gpu'] == 1  # Still within the dwell
+	tick(gov, clock)
+	assert gov.level['gpu'] == 2
+	assert m.options['intensity'] == 48
+	assert m.isActive()
+
+
+def test_hot_pauses_then_cool_resumes_and_steps_back_up():
+	m = StubMiner('gpu', devices=[0])
+	gov, source, clock = governor([m])
+	source.set({'gpu0': 85})
+	tick(gov, clock)
+	assert gov.isPaused(m)
+	assert gov.level['gpu'] == 1
+
+	source.set({'gpu0': 60})
+	for _ in range(12):
+		tick(gov, clock)
+	assert gov.isPaused(m)  # Not yet settled
+	tick(gov, clock)
+	assert m.isActive()
+	assert m.options['intensity'] == 56
+	for _ in range(12):
+		tick(gov, clock)
+	assert gov.level['gpu'] == 0
+	assert m.options['intensity'] == 64
+
+
+def test_power_limit():
+	m = StubMiner('gpu', devices=[0])
+	gov, source, clock = governor([m], power_limit=200)
+	source.set({'gpu0': 50}, {'gpu0': 195})
+	tick(gov, clock)
+	assert gov.level['gpu'] == 1
+	assert not gov.isPaused(m)
+
+
+def test_other_pauses_are_left_alone():
+	m = StubMiner('gpu', devices=[0])
+	m.pause(reason='throttle')
+	gov, source, clock = governor([m])
+	source.set({'gpu0': 90})
+	tick(gov, clock)
+	assert m.paused_by == 'throttle'
+	assert gov.level == {}
+
+
+def test_efficiency_per_option_value():
+	m = StubMiner('gpu', devices=[0], rate=300.0)
+	gov, source, clock = governor([m])
+	source.set({'gpu0': 60}, {'gpu0': 150})
+	for _ in range(4):
+		tick(gov, clock)
+	m.options['intensity'] = 48
+	m.rate = 270.0
+	source.set({'gpu0': 60}, {'gpu0': 100})
+	for _ in range(4):
+		tick(gov, clock)
+	assert gov.best() == {'gpu': 48}
+	first = gov.efficiency()[0]
+	assert first['value'] == 48
+	assert abs(first['per_watt'] - 2.7) < 1e-9
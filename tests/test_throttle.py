@@ -0,0 +1,202 @@
+import os
+import sys
+import types
+import asyncio
+import subprocess
+
+import pytest
+
+import IdleMiner_Throttle as throttle
+
+
+class StubMiner():
+	# Its process is a real child, as priority and affinity are set on it
+	def __init__(self):
+		self.state = 'running'
+		self.paused_by = None
+		self.options = {}
+		self.profile = types.SimpleNamespace(name='cpu')
+		self.starts = 0
+		self.process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+
+	def close(self):
+		self.process.kill()
+		self.process.wait()
+
+	async def stop(self):
+		self.close()
+		self.state = 'stopped'
+
+	async def start(self, options):
+		self.options = dict(options)
+		self.process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+		self.state = 'running'
+		self.starts += 1
+
+	def isActive(self):
+		return self.state == 'running'
+
+	def pause(self, reason='idle'):
+		self.state = 'paused'
+		self.paused_by = reason
+
+	def resume(self):
+		self.state = 'running'
+		self.paused_by = None
+
+
+class Clock():
+	def __init__(self):
+		self.t = 0.0
+
+	def __call__(self):
+		return self.t
+
+
+def controller(miners=()):
+	orchestrator = types.SimpleNamespace(miners=list(miners), option_overrides={}, loop=None,
+										 optionsFor=lambda m: m.options)
+	source = throttle.FakeLoadSource()
+	clock = Clock()
+	return throttle.ThrottleController(orchestrator, source, settle=30, clock=clock), source, clock
+
+
+def test_lighter_at_once_heavier_after_settling():
+	c, source, clock = controller()
+	assert c.decide(throttle.LoadSample(0.1, None, 0.0), clock()) == 0
+	c.level = c.decide(throttle.LoadSample(0.3, None, 0.0), clock())
+	assert c.levelName() == 'shared'
+	clock.t = 10
+	assert c.decide(throttle.LoadSample(0.05, None, 0.0), clock.t) == 1
+	clock.t = 39
+	assert c.decide(throttle.LoadSample(0.05, None, 0.0), clock.t) == 1
+	clock.t = 40
+	assert c.decide(throttle.LoadSample(0.05, None, 0.0), clock.t) == 0
+
+
+def test_gpu_and_memory_load():
+	c, source, clock = controller()
+	assert c.decide(throttle.LoadSample(0.0, 0.6, 0.0), 0) == 2
+	assert c.decide(throttle.LoadSample(0.0, 0.9, 0.0), 0) == 3  # Paused
+	c.level = 0
+	assert c.decide(throttle.LoadSample(0.0, None, 0.95), 0) == 2  # Memory pressure: lightest level
+
+
+def test_tick_pauses_and_resumes_miners():
+	miner = StubMiner()
+	c, source, clock = controller([miner])
+	source.set(cpu=None)
+	asyncio.run(c.tick())
+	assert c.levelName() == 'full'  # The first sample only primes the counters
+
+	source.set(cpu=0.95)
+	asyncio.run(c.tick())
+	assert c.levelName() == 'paused'
+	assert miner.state == 'paused' and miner.paused_by == 'throttle'
+
+	source.set(cpu=0.0)
+	clock.t = 100
+	asyncio.run(c.tick())
+	clock.t = 130
+	asyncio.run(c.tick())
+	assert c.levelName() == 'full'
+	assert miner.state == 'running'
+	miner.close()
+
+
+def test_pause_by_the_user_is_not_undone():
+	miner = StubMiner()
+	miner.pause('idle')
+	c, source, clock = controller([miner])
+	source.set(cpu=0.0)
+	asyncio.run(c.tick())
+	assert miner.state == 'paused'
+	miner.close()
+
+
+def test_run_survives_a_failing_sample(capsys):
+	class Broken(throttle.LoadSource):
+		def __init__(self):
+			self.samples = 0
+
+		def sample(self, exclude_pids=()):
+			self.samples += 1
+			raise OSError('no /proc')
+
+	c, source, clock = controller()
+	c.source = Broken()
+	c.interval = 0.01
+
+	async def runBriefly():
+		task = asyncio.ensure_future(c.run())
+		await asyncio.sleep(0.1)
+		assert not task.done()
+		task.cancel()
+
+	asyncio.run(runBriefly())
+	assert c.source.samples >= 2
+	assert 'no /proc' in capsys.readouterr().out
+
+
+def test_load_levels():
+	levels = throttle.loadLevels([{'name': 'full', 'below': 0.2}, {'name': 'low', 'below': 0.7, 'cpus': 0.5,
+																	'options': {'intensity': 10}}])
+	assert levels[0] == throttle.ThrottleLevel('full', 0.2, 'normal', None, {})
+	assert levels[1].options == {'intensity': 10}
+
+
+class Unprivileged():
+	# setPriority() of a user who may lower a process's priority but not raise it; 'floor' is the nice value
+	# new processes start at
+	def __init__(self, floor=0):
+		self.floor = floor
+		self.nice = {}
+
+	def __call__(self, pids, priority):
+		nice = throttle.proc.PRIORITIES[priority][0]
+		denied = [pid for pid in pids if nice < self.nice.setdefault(pid, self.floor)]
+		for pid in pids:
+			if pid not in denied:
+				self.nice[pid] = nice
+		return denied
+
+
+def test_miner_that_cannot_be_raised_back_is_restarted(monkeypatch):
+	setPriority = Unprivileged()
+	monkeypatch.setattr(throttle.proc, 'setPriority', setPriority)
+	miner = StubMiner()
+	c, source, clock = controller([miner])
+	c.level = 2
+	asyncio.run(c.apply(clock()))
+	assert setPriority.nice[miner.process.pid] == 19
+	c.level = 0
+	asyncio.run(c.apply(clock()))
+	assert miner.starts == 1
+	assert setPriority.nice[miner.process.pid] == 0
+	asyncio.run(c.apply(clock()))
+	assert miner.starts == 1
+	miner.close()
+
+
+def test_priority_failure_is_reported_once(monkeypatch, capsys):
+	# IdleMiner itself runs niced, so a restarted miner cannot reach normal priority either
+	monkeypatch.setattr(throttle.proc, 'setPriority', Unprivileged(floor=10))
+	miner = StubMiner()
+	c, source, clock = controller([miner])
+	for _ in range(3):
+		asyncio.run(c.apply(clock()))
+	assert miner.starts == 1
+	assert c.priority_denied == {miner.process.pid}
+	assert capsys.readouterr().out.count("cannot set 'cpu' to normal priority") == 1
+	miner.close()
+
+
+@pytest.mark.skipif(sys.platform == 'win32' or os.geteuid() == 0, reason='needs an unprivileged POSIX user')
+def test_set_priority_reports_denied_pids():
+	child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+	try:
+		assert throttle.proc.setPriority([child.pid], 'idle') == []
+		assert throttle.proc.setPriority([child.pid], 'normal') == [child.pid]
+	finally:
+		child.kill()
+		child.wait()